@@ -0,0 +1,275 @@
+import io
+import os
+import logging
+import argparse
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, List, Dict, Tuple
+
+import pandas as pd
+from dotenv import load_dotenv
+
+import artifacts
+from analyzer import CRITERIA
+from call_store import CALL_STORE_DIR, STAGE_ANALYSES, StageStore
+from log_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Кэш дневных агрегатов: по нему пересчитываются только новые и изменившиеся дни.
+# Агрегаты дней, удаленных из хранилища по сроку хранения, в кэше остаются — статистика не теряется.
+ANALYTICS_CACHE_DIR = Path(os.getenv("ANALYTICS_CACHE_DIR", "cache/analytics"))
+
+AGGREGATES_FILE = "daily_aggregates.csv.gz"
+MANIFEST_FILE = "manifest.json"
+
+# Столбцы дневного агрегата: сколько раз критерий получил каждую оценку у менеджера за день
+AGGREGATE_COLUMNS = ["date", "manager_name", "call_category", "criterion", "score", "count"]
+# Псевдокритерий со счетчиком звонков: по нему считается число звонков менеджера независимо от критериев
+CALLS_CRITERION = "_calls"
+
+DATE_FORMAT = "%d.%m.%Y"
+
+
+def _folder_date(folder: Path) -> Optional[datetime]:
+    try:
+        return datetime.strptime(folder.name.split("_", 1)[1], DATE_FORMAT)
+    except (IndexError, ValueError):
+        return None
+
+
+def _signature(path: Path) -> List[int]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return [0, 0]
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def aggregate_day(analyses_path: Path, date: datetime) -> pd.DataFrame:
+    """
+    Дневной агрегат по журналу анализов одной даты: число оценок 1/0/-1 по менеджеру, категории звонка
+    и критерию, плюс строки CALLS_CRITERION с числом звонков. Анализы с ошибкой не учитываются,
+    поврежденные записи журнала пропускаются: одна испорченная строка не должна ломать статистику за всю историю.
+    """
+    records = [record["analysis"] for record in StageStore(analyses_path).read(skip_corrupted=True)]
+    if not records:
+        return pd.DataFrame(columns=AGGREGATE_COLUMNS)
+
+    frame = pd.DataFrame.from_records(records).reindex(columns=["manager_name", "call_category", "summary"] + CRITERIA)
+    frame = frame[~frame["summary"].fillna("").astype(str).str.startswith("Ошибка анализа")]
+    frame["manager_name"] = frame["manager_name"].fillna("Неизвестно")
+    frame["call_category"] = frame["call_category"].fillna("Неизвестно")
+    frame[CALLS_CRITERION] = 1
+
+    # Критерий, которого нет в старом анализе (добавлен позже), в агрегат не попадает
+    long = frame.melt(id_vars=["manager_name", "call_category"], value_vars=CRITERIA + [CALLS_CRITERION],
+                      var_name="criterion", value_name="score").dropna(subset=["score"])
+    long["score"] = long["score"].astype(int)
+    aggregate = long.groupby(["manager_name", "call_category", "criterion", "score"]).size().rename("count").reset_index()
+    aggregate.insert(0, "date", date.strftime("%Y-%m-%d"))
+    return aggregate[AGGREGATE_COLUMNS]
+
+
+def _rates(counts: pd.DataFrame, by: List[str]) -> pd.DataFrame:
+    """
+    Сводит счетчики оценок в доли: rate — доля выполненных (1) среди применимых (1 и -1).
+    """
+    table = counts.pivot_table(index=by, columns="score", values="count", aggfunc="sum", fill_value=0)
+    table = table.reindex(columns=[1, 0, -1], fill_value=0)
+    table.columns = ["выполнено", "не_применимо", "не_выполнено"]
+    applicable = table["выполнено"] + table["не_выполнено"]
+    table["rate"] = (table["выполнено"] / applicable.where(applicable > 0)).round(3)
+    return table
+
+
+class ManagerAnalytics:
+    """
+    Статистика менеджеров по сохраненным анализам: доли выполнения по менеджерам, критериям и дням и их динамика.
+
+    Анализы каждой даты сворачиваются в небольшой дневной агрегат (счетчики оценок), агрегаты всех дней
+    хранятся одной таблицей в ANALYTICS_CACHE_DIR. refresh() пересчитывает только даты, журнал анализов
+    которых изменился с прошлого раза, поэтому обновление не зависит от глубины истории.
+    """
+
+    def __init__(self, store_dir: Path = CALL_STORE_DIR, cache_dir: Path = ANALYTICS_CACHE_DIR):
+        self.store_dir = store_dir
+        self.cache_dir = cache_dir
+        self.aggregates = pd.DataFrame(columns=AGGREGATE_COLUMNS)
+        self.manifest: Dict[str, List[int]] = {}
+
+    def _load_cache(self):
+        aggregates_path = self.cache_dir / AGGREGATES_FILE
+        manifest_path = self.cache_dir / MANIFEST_FILE
+        if not (aggregates_path.exists() and manifest_path.exists()):
+            return
+        try:
+            self.manifest = artifacts.read_json(manifest_path)
+            self.aggregates = pd.read_csv(io.BytesIO(artifacts.read_bytes(aggregates_path)), compression="gzip",
+                                          dtype={"date": str, "manager_name": str, "call_category": str,
+                                                 "criterion": str})
+        except (ValueError, OSError) as e:
+            logger.warning(f"⚠️ Кэш аналитики не прочитан ({e}), агрегаты будут посчитаны заново.")
+            self.aggregates, self.manifest = pd.DataFrame(columns=AGGREGATE_COLUMNS), {}
+
+    def _save_cache(self):
+        buffer = io.BytesIO()
+        self.aggregates.to_csv(buffer, index=False, compression={"method": "gzip", "mtime": 0})
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        artifacts.write_bytes(self.cache_dir / AGGREGATES_FILE, buffer.getvalue())
+        artifacts.write_json(self.cache_dir / MANIFEST_FILE, self.manifest, checksum=False)
+
+    def refresh(self) -> int:
+        """
+        Пересчитывает агрегаты новых и изменившихся дат. Возвращает число пересчитанных дат.
+        """
+        self._load_cache()
+        changed: Dict[str, pd.DataFrame] = {}
+        if self.store_dir.exists():
+            for folder in sorted(self.store_dir.iterdir()):
+                date = _folder_date(folder)
+                if not folder.is_dir() or date is None:
+                    continue
+                analyses_path = folder / f"{STAGE_ANALYSES}.jsonl"
+                signature = _signature(analyses_path)
+                if self.manifest.get(folder.name) == signature:
+                    continue
+                changed[date.strftime("%Y-%m-%d")] = aggregate_day(analyses_path, date)
+                self.manifest[folder.name] = signature
+
+        if changed:
+            kept = self.aggregates[~self.aggregates["date"].isin(list(changed))]
+            self.aggregates = pd.concat([kept] + [frame for frame in changed.values() if not frame.empty],
+                                        ignore_index=True).sort_values(["date", "manager_name"], ignore_index=True)
+            self._save_cache()
+            logger.info(f"📊 Агрегаты аналитики пересчитаны за {len(changed)} дат "
+                        f"(всего дат в статистике: {self.aggregates['date'].nunique()}).")
+        self.aggregates["count"] = self.aggregates["count"].astype(int)
+        self.aggregates["score"] = self.aggregates["score"].astype(int)
+        return len(changed)
+
+    def _select(self, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                orders_only: bool = True) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Счетчики критериев (только звонки-заказы, если orders_only) и счетчики звонков за период.
+        """
+        frame = self.aggregates
+        if date_from:
+            frame = frame[frame["date"] >= date_from.strftime("%Y-%m-%d")]
+        if date_to:
+            frame = frame[frame["date"] <= date_to.strftime("%Y-%m-%d")]
+        is_calls = frame["criterion"] == CALLS_CRITERION
+        criteria = frame[~is_calls]
+        if orders_only:
+            # У звонков других категорий критерии продаж не оцениваются (равны 0)
+            criteria = criteria[criteria["call_category"] == "Заказ"]
+        return criteria, frame[is_calls]
+
+    def manager_summary(self, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> pd.DataFrame:
+        """
+        По менеджеру: число звонков по категориям и общая доля выполнения критериев в заказах.
+        """
+        criteria, calls = self._select(date_from, date_to)
+        summary = calls.pivot_table(index="manager_name", columns="call_category", values="count", aggfunc="sum",
+                                    fill_value=0)
+        summary.columns = [f"звонков: {category}" for category in summary.columns]
+        summary.insert(0, "звонков", summary.sum(axis=1))
+        if not criteria.empty:
+            summary = summary.join(_rates(criteria, ["manager_name"])["rate"], how="left")
+        return summary.sort_values("звонков", ascending=False)
+
+    def criterion_rates(self, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> pd.DataFrame:
+        """
+        Доля выполнения каждого критерия по менеджерам (строки — менеджеры, столбцы — критерии в порядке CRITERIA)
+        и по всем менеджерам вместе (строка "Все").
+        """
+        criteria, _ = self._select(date_from, date_to)
+        if criteria.empty:
+            return pd.DataFrame(columns=CRITERIA)
+        by_manager = _rates(criteria, ["manager_name", "criterion"])["rate"].unstack("criterion")
+        overall = _rates(criteria, ["criterion"])["rate"].rename("Все")
+        table = pd.concat([by_manager, overall.to_frame().T])
+        return table.reindex(columns=[key for key in CRITERIA if key in table.columns])
+
+    def daily_rates(self, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                    manager_name: Optional[str] = None) -> pd.DataFrame:
+        """
+        Доля выполнения критериев по дням (строки — даты, столбцы — критерии), по всем менеджерам или одному.
+        """
+        criteria, _ = self._select(date_from, date_to)
+        if manager_name:
+            criteria = criteria[criteria["manager_name"] == manager_name]
+        if criteria.empty:
+            return pd.DataFrame(columns=CRITERIA)
+        table = _rates(criteria, ["date", "criterion"])["rate"].unstack("criterion")
+        return table.reindex(columns=[key for key in CRITERIA if key in table.columns])
+
+    def trends(self, freq: str = "W", date_from: Optional[datetime] = None,
+               date_to: Optional[datetime] = None) -> pd.DataFrame:
+        """
+        Динамика общей доли выполнения по менеджерам: строки — менеджеры, столбцы — периоды freq
+        (W — недели, M — месяцы), последний столбец — изменение последнего периода к предыдущему.
+        """
+        criteria, _ = self._select(date_from, date_to)
+        if criteria.empty:
+            return pd.DataFrame()
+        criteria = criteria.assign(period=pd.to_datetime(criteria["date"]).dt.to_period(freq).astype(str))
+        table = _rates(criteria, ["manager_name", "period"])["rate"].unstack("period")
+        if table.shape[1] >= 2:
+            table["изменение"] = (table.iloc[:, -1] - table.iloc[:, -2]).round(3)
+        return table
+
+    def report(self, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> Dict[str, pd.DataFrame]:
+        return {
+            "менеджеры": self.manager_summary(date_from, date_to),
+            "критерии": self.criterion_rates(date_from, date_to),
+            "по_дням": self.daily_rates(date_from, date_to),
+            "динамика": self.trends(date_from=date_from, date_to=date_to),
+        }
+
+    def export(self, path: Path, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> List[Path]:
+        """
+        Выгружает отчет: в .xlsx — по листу на таблицу, иначе — по CSV на таблицу (<имя>_<таблица>.csv).
+        """
+        tables = self.report(date_from, date_to)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix == ".xlsx":
+            buffer = io.BytesIO()
+            with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+                for name, table in tables.items():
+                    table.to_excel(writer, sheet_name=name)
+            artifacts.write_bytes(path, buffer.getvalue(), checksum=False)
+            return [path]
+
+        paths = []
+        for name, table in tables.items():
+            table_path = path.with_name(f"{path.stem}_{name}.csv")
+            # utf-8-sig: кириллица корректно открывается в Excel
+            artifacts.write_bytes(table_path, table.to_csv().encode("utf-8-sig"), checksum=False)
+            paths.append(table_path)
+        return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Статистика менеджеров по сохраненным анализам звонков.")
+    parser.add_argument("--from", dest="date_from", help="Первая дата периода, ДД.ММ.ГГГГ.")
+    parser.add_argument("--to", dest="date_to", help="Последняя дата периода, ДД.ММ.ГГГГ.")
+    parser.add_argument("--export", help="Выгрузить отчет в файл .xlsx или .csv.")
+    args = parser.parse_args()
+
+    setup_logging()
+    period_from = datetime.strptime(args.date_from, DATE_FORMAT) if args.date_from else None
+    period_to = datetime.strptime(args.date_to, DATE_FORMAT) if args.date_to else None
+
+    analytics = ManagerAnalytics()
+    analytics.refresh()
+    if args.export:
+        for exported in analytics.export(Path(args.export), period_from, period_to):
+            logger.info(f"💾 Отчет сохранен: {exported}")
+    else:
+        summary = analytics.manager_summary(period_from, period_to)
+        rates = analytics.criterion_rates(period_from, period_to).T
+        logger.info(f"📊 Статистика менеджеров:\n{summary.to_string()}")
+        logger.info(f"📊 Доля выполнения критериев:\n{rates.to_string()}")
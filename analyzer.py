@@ -1,36 +1,46 @@
 import os
+import logging
 import json
 import re
+import hashlib
 import time
 from openai import OpenAI
 from dotenv import load_dotenv
 from datetime import datetime
-from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Set, Callable, Tuple, List
+from metrics import record_retry
+from circuit_breaker import guarded_request, defer_if_unavailable
+from cost_accounting import record_usage, track_call
+from model_router import get_router
+from log_config import setup_logging, log_context
+import artifacts
+from call_store import CallStore
+
+logger = logging.getLogger(__name__)
 
 # Попытка импорта всех необходимых функций из retailcrm_integration
 try:
     from retailcrm_integration import get_manager_name_from_crm, get_order_link_by_phone, \
         get_order_items_status
 except ImportError:
-    print(
+    logger.info(
         "ВНИМАНИЕ: Модуль retailcrm_integration не найден или функции не определены. Убедитесь, что он существует и доступен.")
 
 
     # Заглушки, чтобы код продолжал работать без ошибок
     def get_manager_name_from_crm(phone_number: str) -> str:
-        print("  ⚠️ Заглушка: get_manager_name_from_crm не реализована. Возвращаем 'Неизвестно'.")
+        logger.warning("  ⚠️ Заглушка: get_manager_name_from_crm не реализована. Возвращаем 'Неизвестно'.")
         return "Неизвестно"
 
 
     def get_order_link_by_phone(phone_number: str) -> str:
-        print("  ⚠️ Заглушка: get_order_link_by_phone не реализована. Возвращаем ''.")
+        logger.warning("  ⚠️ Заглушка: get_order_link_by_phone не реализована. Возвращаем ''.")
         return ""
 
 
     # ЗАГЛУШКА ДЛЯ НОВОЙ ФУНКЦИИ
     def get_order_items_status(phone_number: str) -> Dict[str, bool]:
-        print("  ⚠️ Заглушка: get_order_items_status не реализована. Возвращаем 'False, False'.")
+        logger.warning("  ⚠️ Заглушка: get_order_items_status не реализована. Возвращаем 'False, False'.")
         return {'has_plant': False, 'has_cachepot': False}
 
 load_dotenv()
@@ -244,6 +254,85 @@ PROMPT_TEMPLATE = '''Ты эксперт по продажам, анализир
 """
 '''
 
+# Модель анализа без маршрутизации: переоценка истории и дооценка отдельных критериев.
+# Новые звонки анализируются моделью, выбранной model_router.py
+ANALYSIS_MODEL = "gpt-5-mini"
+
+# Резюме анализа, который не удалось получить: такой анализ сохраняется, но при следующем запуске выполняется заново
+ANALYSIS_ERROR_PREFIX = "Ошибка анализа"
+ANALYSIS_ERROR_SUMMARY = f"{ANALYSIS_ERROR_PREFIX}: не удалось сгенерировать корректные данные."
+
+# Версия промпта и набора критериев сохраняется с каждым анализом: по ней rescore.py отличает оценки разных версий.
+# По умолчанию — хэш PROMPT_TEMPLATE и CRITERIA, меняется автоматически при любой их правке.
+PROMPT_VERSION = os.getenv("PROMPT_VERSION") or hashlib.sha256(
+    (PROMPT_TEMPLATE + "\n".join(CRITERIA)).encode("utf-8")).hexdigest()[:12]
+
+# Группы связанных критериев: при частичном анализе (появился новый критерий или изменилось описание старого)
+# в LLM отправляются только группы с такими критериями, а не весь чек-лист
+CRITERION_GROUPS = {
+    "контакт": ["улыбка_в_голосе", "установление_контакта"],
+    "потребности": ["квалификация", "выявление_потребности", "goal_clarified", "последующий_уточняющий"],
+    "презентация": ["пересогласование", "особенности_позиций"],
+    "возражения": ["возражение", "отработка_возражения"],
+    "допродажи": ["докомплект", "допродажа"],
+    "закрытие": ["состав_и_сумма", "согласование_деталей", "предоплата"],
+}
+
+GROUP_PROMPT_TEMPLATE = '''Ты эксперт по продажам, анализирующий телефонные звонки. Звонок уже определен как заказ. Выставь ТОЧНУЮ оценку только по критериям ниже.
+
+**Интерпретация оценок (СТРОГО используй только эти значения):**
+* **1 (выполнено):** Критерий выполнен полностью, эффективно и согласно всем требованиям.
+* **0 (не применимо):** Критерий не применим к данному конкретному диалогу.
+* **-1 (не выполнено):** Критерий был необходим, но менеджер его не выполнил, выполнил плохо, проигнорировал или допустил ошибку.
+
+**Критерии для анализа:**
+
+{sections}
+
+**Формат ответа:**
+Строго JSON ровно с полями {keys} (поле каждого критерия указано после его названия) и значениями 1, 0 или -1, без резюме и комментариев.
+
+Текст звонка для анализа:
+"""
+{transcript}
+"""
+'''
+
+
+def _split_criteria_sections(template: str) -> Dict[str, str]:
+    """
+    Описания критериев из PROMPT_TEMPLATE (нумерованные пункты раздела «Критерии для анализа») в порядке CRITERIA.
+    Пустой словарь, если разобрать шаблон не удалось: тогда частичный анализ не используется.
+    """
+    start = template.find("**Критерии для анализа")
+    end = template.find("Также, если Менеджер представился")
+    if start == -1 or end == -1:
+        return {}
+    body = template[template.index("\n", start):end]
+    sections = [section.strip() for section in re.split(r"\n(?=\s*\d+\.\s+\*\*)", body) if section.strip()]
+    if len(sections) != len(CRITERIA):
+        logger.warning(f"⚠️ В PROMPT_TEMPLATE найдено {len(sections)} описаний критериев вместо {len(CRITERIA)}: "
+                       f"частичный анализ отключен.")
+        return {}
+    return dict(zip(CRITERIA, sections))
+
+
+CRITERIA_SECTIONS = _split_criteria_sections(PROMPT_TEMPLATE)
+
+
+def _keyed_section(key: str) -> str:
+    """
+    Описание критерия для GROUP_PROMPT_TEMPLATE с JSON-ключом в заголовке: модель сопоставляет оценку
+    с критерием по ключу, а не по порядку описаний.
+    """
+    heading, _, rest = CRITERIA_SECTIONS[key].partition("\n")
+    return f'{heading} → ключ "{key}"' + (f"\n{rest}" if rest else "")
+
+# Версия каждого критерия — хэш его описания. Сохраняется с анализом: критерий, которого нет в анализе
+# или описание которого с тех пор изменилось, считается устаревшим и переоценивается отдельно
+CRITERIA_VERSIONS = {key: hashlib.sha256(section.encode("utf-8")).hexdigest()[:8]
+                     for key, section in CRITERIA_SECTIONS.items()}
+
 
 def clean_json_string(raw_content):
     """
@@ -283,18 +372,38 @@ def categorize_call_by_metadata(raw_call_data: dict) -> str:
     return "Заказ"
 
 
-def analyze_single_transcript(transcript_path: Path, target_folder_date_str: str, initial_category: str,
-                              phone_number: str | None = None):
+def _validate_analysis(parsed: Tuple[str, Dict[str, Any]]) -> List[str]:
     """
-    Проводит анализ одного транскрипта и сохраняет результат в виде JSON-файла.
+    Проблемы ответа LLM, при которых запрос повторяется на более сильной модели (model_router.py):
+    неизвестная категория, некорректный балл, имя менеджера не из ALLOWED_MANAGERS.
     """
-    output_folder = Path("analyses") / f"транскрибация_{target_folder_date_str}"
-    os.makedirs(output_folder, exist_ok=True)
-
-    filename = transcript_path.name
-    with open(transcript_path, "r", encoding="utf-8") as f:
-        transcript = f.read()
+    _, result_dict = parsed
+    problems = []
+    call_category = result_dict.get("call_category")
+    if call_category not in CALL_CATEGORIES:
+        problems.append(f"категория {call_category!r}")
+    if call_category == "Заказ":
+        invalid = [key for key in CRITERIA
+                   if result_dict.get(key) not in [1, 0, -1] and not (key == "goal_clarified" and key not in result_dict)]
+        if invalid:
+            problems.append(f"баллы {', '.join(invalid)}")
+    manager_name = result_dict.get("manager_name")
+    if manager_name not in (None, "", "Неизвестно") and manager_name not in ALLOWED_MANAGERS:
+        problems.append(f"менеджер {manager_name!r}")
+    return problems
+
+
+def score_transcript(transcript: str, initial_category: str, items_status: Dict[str, bool], filename: str,
+                     model: Optional[str] = None) -> Tuple[Dict[str, Any], bool, Dict[str, int]]:
+    """
+    Оценивает транскрипт по CRITERIA, без обращений в CRM и без сохранения.
+    Модель выбирается по длине транскрипта и повышается, если ответ не прошел проверку (model_router.py);
+    с model — только эта модель (переоценка истории в rescore.py, где оценки сравниваются между собой).
 
+    Returns:
+        (оценки с manager_name, summary и call_category; удалось ли получить корректный ответ;
+        токены всех попыток: prompt_tokens, completion_tokens и cached_tokens)
+    """
     # Форматируем PROMPT_TEMPLATE
     prompt = PROMPT_TEMPLATE.format(
         ", ".join(CALL_CATEGORIES),
@@ -302,183 +411,356 @@ def analyze_single_transcript(transcript_path: Path, target_folder_date_str: str
         transcript=transcript
     )
 
-    success = False
     # Инициализация словаря с новым критерием
     filtered_result = {key: 0 for key in CRITERIA}
     filtered_result["manager_name"] = "Неизвестно"
     filtered_result["summary"] = ""
     filtered_result["call_category"] = initial_category
 
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+
+    def request(current_model: str) -> Tuple[str, Dict[str, Any]]:
+        with guarded_request("openai", "analysis"):
+            response = client.chat.completions.create(
+                model=current_model,
+                messages=[{"role": "user", "content": prompt}],
+            )
+        entry = record_usage("analysis", current_model, getattr(response, "usage", None))
+        for key in usage:
+            usage[key] += entry[key]
+        raw_content = response.choices[0].message.content
+        try:
+            return raw_content, json.loads(clean_json_string(raw_content))
+        except json.JSONDecodeError:
+            logger.info(f"Сырой контент (начало): {raw_content[:500]}...")
+            raise
+
+    parsed, used_model = get_router("analysis").run(len(transcript), request, _validate_analysis,
+                                                    label=filename, model=model)
+    if parsed is None:
+        return filtered_result, False, usage
+
+    raw_content, result_dict = parsed
+    logger.info(f"🤖 Анализ {filename} выполнен моделью {used_model}")
+
+    call_category_from_llm = result_dict.get("call_category")
+    if call_category_from_llm in CALL_CATEGORIES:
+        filtered_result["call_category"] = call_category_from_llm
+    else:
+        logger.warning(
+            f"⚠️ Неизвестная категория звонка от LLM: {call_category_from_llm}. Используется начальная категория: {initial_category}.")
+        filtered_result["call_category"] = initial_category
+
+    analysis_summary = extract_summary(raw_content)
+    if not analysis_summary:
+        logger.warning(f"⚠️ Резюме для {filename} пустое.")
+        analysis_summary = "Резюме не сгенерировано."
+
+    if filtered_result["call_category"] != "Заказ":
+        for key in CRITERIA:
+            filtered_result[key] = 0
+        logger.info(
+            f"ℹ️ Звонок {filename} определен как '{filtered_result['call_category']}'. Критерии анализа продаж установлены в 0.")
+    else:
+        for key in CRITERIA:
+            score = result_dict.get(key)
+            # Проверка на наличие поля goal_clarified в result_dict
+            if key == "goal_clarified" and score is None:
+                # Если LLM не вернул новое поле, устанавливаем 0
+                score = 0
+
+            if score in [1, 0, -1]:
+                filtered_result[key] = score
+            else:
+                logger.warning(f"⚠️ Некорректный балл {score} для критерия '{key}' в файле {filename}. Устанавливаем 0.")
+                filtered_result[key] = 0
+
+        # --- ЛОГИКА ПРИНУДИТЕЛЬНОГО УСТАНОВЛЕНИЯ "ДОКОМПЛЕКТ" В 0 ---
+        if items_status['has_plant'] and items_status['has_cachepot']:
+            # Если в заказе уже есть и растение, и кашпо, то докомплект не применим
+            filtered_result["докомплект"] = 0
+            logger.info(f"✅ Принудительное присвоение 'докомплект'=0 для {filename}: Растение и Кашпо уже в заказе.")
+        # --- КОНЕЦ ЛОГИКИ ПРИНУДИТЕЛЬНОГО УСТАНОВЛЕНИЯ "ДОКОМПЛЕКТ" В 0 ---
+
+    manager_name_from_llm = result_dict.get("manager_name")
+    if manager_name_from_llm in ALLOWED_MANAGERS:
+        filtered_result["manager_name"] = manager_name_from_llm
+    else:
+        filtered_result["manager_name"] = "Неизвестно"
+
+    filtered_result["summary"] = analysis_summary
+    return filtered_result, True, usage
+
+
+def is_analysis_error(analysis_record: Optional[Dict[str, Any]]) -> bool:
+    return bool(analysis_record) and \
+        analysis_record["analysis"].get("summary", "").startswith(ANALYSIS_ERROR_PREFIX)
+
+
+def stale_criteria(analysis_record: Dict[str, Any]) -> List[str]:
+    """
+    Критерии, которые в сохраненном анализе отсутствуют или оценены по прежнему описанию.
+    У анализов, сохраненных до появления версий критериев, актуальными считаются все имеющиеся критерии.
+    """
+    analysis = analysis_record["analysis"]
+    if not CRITERIA_VERSIONS:
+        return list(CRITERIA)
+    versions = analysis_record.get("criteria_versions")
+    return [key for key in CRITERIA
+            if key not in analysis or (versions is not None and versions.get(key) != CRITERIA_VERSIONS[key])]
+
+
+def criteria_groups(criteria: List[str]) -> List[Tuple[str, List[str]]]:
+    """
+    Группы CRITERION_GROUPS, затронутые criteria, с критериями из criteria: по запросу на группу.
+    """
+    wanted = set(criteria)
+    # Критерий, не включенный ни в одну группу, оценивается отдельным запросом
+    grouped = {key for group_criteria in CRITERION_GROUPS.values() for key in group_criteria}
+    groups = list(CRITERION_GROUPS.items()) + [(key, [key]) for key in CRITERIA if key not in grouped]
+    return [(group, [key for key in group_criteria if key in wanted]) for group, group_criteria in groups
+            if any(key in wanted for key in group_criteria)]
+
+
+def score_criteria(transcript: str, criteria: List[str], items_status: Dict[str, bool], filename: str,
+                   model: str = ANALYSIS_MODEL) -> Tuple[Dict[str, int], bool, Dict[str, int]]:
+    """
+    Оценивает звонок-заказ только по criteria: по одному короткому запросу на каждую затронутую группу
+    CRITERION_GROUPS (до трех попыток на группу). Резюме, категория и имя менеджера не запрашиваются.
+
+    Returns:
+        (оценки запрошенных критериев; все ли группы оценены успешно; токены всех запросов)
+    """
+    scores = {}
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+    success = True
+    for group, keys in criteria_groups(criteria):
+        prompt = GROUP_PROMPT_TEMPLATE.format(
+            sections="\n\n".join(_keyed_section(key) for key in keys),
+            keys=", ".join(f'"{key}"' for key in keys),
+            transcript=transcript
+        )
+        group_scored = False
+        for attempt in range(3):
+            try:
+                if attempt > 0:
+                    record_retry("openai", "analysis_group")
+                with guarded_request("openai", "analysis_group"):
+                    response = client.chat.completions.create(
+                        model=model,
+                        messages=[{"role": "user", "content": prompt}],
+                    )
+                entry = record_usage("analysis_group", model, getattr(response, "usage", None))
+                for key in usage:
+                    usage[key] += entry[key]
+                result_dict = json.loads(clean_json_string(response.choices[0].message.content))
+                # Лишний или недостающий ключ означает, что модель спутала критерии: оценки группы не принимаются
+                if not isinstance(result_dict, dict) or set(result_dict) != set(keys):
+                    raise ValueError(f"ключи ответа {sorted(result_dict) if isinstance(result_dict, dict) else result_dict} "
+                                     f"не совпадают с запрошенными {keys}")
+                for key in keys:
+                    score = result_dict.get(key)
+                    if score not in [1, 0, -1]:
+                        logger.warning(f"⚠️ Некорректный балл {score} для критерия '{key}' в файле {filename}. Устанавливаем 0.")
+                        score = 0
+                    scores[key] = score
+                group_scored = True
+                break
+            except Exception as e:
+                defer_if_unavailable("openai", e)
+                logger.warning(f"⚠️ Ошибка оценки группы '{group}' для {filename} (попытка {attempt + 1}): {e}")
+                time.sleep(2)
+        success = success and group_scored
+
+    if "докомплект" in scores and items_status['has_plant'] and items_status['has_cachepot']:
+        # Если в заказе уже есть и растение, и кашпо, то докомплект не применим
+        scores["докомплект"] = 0
+    return scores, success, usage
+
+
+def merge_criteria_scores(analysis_record: Dict[str, Any], scores: Dict[str, int]) -> Dict[str, Any]:
+    """
+    Новая запись анализа: сохраненный анализ с замененными оценками scores и их версиями.
+    Резюме, категория и остальные оценки остаются прежними.
+    """
+    versions = analysis_record.get("criteria_versions")
+    if versions is None:
+        # Имеющиеся оценки анализа, сохраненного до появления версий, считаются актуальными
+        versions = {key: CRITERIA_VERSIONS[key] for key in CRITERIA
+                    if key in analysis_record["analysis"] and key in CRITERIA_VERSIONS}
+    return {
+        **analysis_record,
+        "criteria_versions": {**versions, **{key: CRITERIA_VERSIONS[key] for key in scores}},
+        "analysis": {**analysis_record["analysis"], **scores},
+    }
+
+
+def analyze_single_transcript(store: CallStore, communication_id: str, initial_category: str,
+                              phone_number: str | None = None):
+    """
+    Проводит анализ одного транскрипта из хранилища и сохраняет результат в хранилище (этап analyses).
+    Если звонок уже проанализирован по тому же транскрипту, дооцениваются только устаревшие критерии.
+    Возвращает False, если транскрипта нет или он поврежден и анализ не выполнялся.
+    """
+    try:
+        transcript_record = store.transcripts.get(communication_id)
+    except artifacts.ArtifactCorruptedError as e:
+        logger.warning(f"⚠️ {e}. Анализ пропущен.")
+        return False
+    if not transcript_record:
+        logger.warning(f"⚠️ Транскрипт звонка {communication_id} не найден. Анализ пропущен.")
+        return False
+
+    stem = transcript_record["stem"]
+    filename = f"{stem}.txt"
+    transcript = transcript_record["text"]
+    transcript_hash = hashlib.sha256(transcript.encode("utf-8")).hexdigest()[:16]
+
+    # Звонок уже проанализирован по этому же транскрипту: дооцениваются только устаревшие критерии
+    try:
+        existing_record = store.analyses.get(communication_id)
+    except artifacts.ArtifactCorruptedError:
+        existing_record = None
+    if existing_record and existing_record.get("transcript_hash", transcript_hash) == transcript_hash and \
+            not is_analysis_error(existing_record):
+        return update_stale_criteria(store, communication_id, existing_record, transcript, filename)
+
     # --- НОВЫЙ БЛОК: Поиск ссылки на заказ и статуса позиций ---
     order_link = ""
     items_status = {'has_plant': False, 'has_cachepot': False}  # Инициализация
 
     if phone_number:
-        print(f"🔗 Поиск ссылки на заказ и статуса позиций для номера: {phone_number}...")
+        logger.info(f"🔗 Поиск ссылки на заказ и статуса позиций для номера: {phone_number}...")
         order_link = get_order_link_by_phone(phone_number)
         items_status = get_order_items_status(phone_number)  # ВЫЗОВ НОВОЙ ФУНКЦИИ
-        print(f"🔗 Результат: {order_link or 'Не найдена'}. Статус позиций: {items_status}")
+        logger.info(f"🔗 Результат: {order_link or 'Не найдена'}. Статус позиций: {items_status}")
     else:
-        print("🔗 Номер телефона не найден. Пропускаем поиск ссылки на заказ и статуса позиций.")
+        logger.info("🔗 Номер телефона не найден. Пропускаем поиск ссылки на заказ и статуса позиций.")
     # --- КОНЕЦ НОВОГО БЛОКА ---
 
-    for attempt in range(3):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-5-mini",
-                messages=[{"role": "user", "content": prompt}],
-            )
-            raw_content = response.choices[0].message.content
-            json_str = clean_json_string(raw_content)
-            result_dict = json.loads(json_str)
-
-            call_category_from_llm = result_dict.get("call_category")
-            if call_category_from_llm in CALL_CATEGORIES:
-                filtered_result["call_category"] = call_category_from_llm
-            else:
-                print(
-                    f"⚠️ Неизвестная категория звонка от LLM: {call_category_from_llm}. Используется начальная категория: {initial_category}.")
-                filtered_result["call_category"] = initial_category
-
-            analysis_summary = extract_summary(raw_content)
-            if not analysis_summary:
-                print(f"⚠️ Резюме для {filename} пустое.")
-                analysis_summary = "Резюме не сгенерировано."
-
-            if filtered_result["call_category"] != "Заказ":
-                for key in CRITERIA:
-                    filtered_result[key] = 0
-                print(
-                    f"ℹ️ Звонок {filename} определен как '{filtered_result['call_category']}'. Критерии анализа продаж установлены в 0.")
-            else:
-                for key in CRITERIA:
-                    score = result_dict.get(key)
-                    # Проверка на наличие поля goal_clarified в result_dict
-                    if key == "goal_clarified" and score is None:
-                        # Если LLM не вернул новое поле, устанавливаем 0
-                        score = 0
-
-                    if score in [1, 0, -1]:
-                        filtered_result[key] = score
-                    else:
-                        print(f"⚠️ Некорректный балл {score} для критерия '{key}' в файле {filename}. Устанавливаем 0.")
-                        filtered_result[key] = 0
-
-                # --- ЛОГИКА ПРИНУДИТЕЛЬНОГО УСТАНОВЛЕНИЯ "ДОКОМПЛЕКТ" В 0 ---
-                if items_status['has_plant'] and items_status['has_cachepot']:
-                    # Если в заказе уже есть и растение, и кашпо, то докомплект не применим
-                    filtered_result["докомплект"] = 0
-                    print(f"✅ Принудительное присвоение 'докомплект'=0 для {filename}: Растение и Кашпо уже в заказе.")
-                # --- КОНЕЦ ЛОГИКИ ПРИНУДИТЕЛЬНОГО УСТАНОВЛЕНИЯ "ДОКОМПЛЕКТ" В 0 ---
-
-            manager_name_from_llm = result_dict.get("manager_name")
-            if manager_name_from_llm in ALLOWED_MANAGERS:
-                filtered_result["manager_name"] = manager_name_from_llm
-            else:
-                filtered_result["manager_name"] = "Неизвестно"
-
-            filtered_result["summary"] = analysis_summary
-            success = True
-            break
-        except json.JSONDecodeError as e:
-            print(f"⚠️ Ошибка JSON декодирования для {filename} (попытка {attempt + 1}): {e}")
-            print(f"Сырой контент (начало): {raw_content[:500]}...")
-            time.sleep(2)
-        except Exception as e:
-            print(f"⚠️ Непредвиденная ошибка при генерации/парсинге для {filename} (попытка {attempt + 1}): {e}")
-            time.sleep(2)
+    filtered_result, success, _ = score_transcript(transcript, initial_category, items_status, filename)
 
     if filtered_result["manager_name"] == "Неизвестно" and phone_number:
-        print(f"ℹ️ Имя менеджера не определено LLM. Пытаемся получить из CRM для номера: {phone_number}")
+        logger.info(f"ℹ️ Имя менеджера не определено LLM. Пытаемся получить из CRM для номера: {phone_number}")
         crm_manager_name = get_manager_name_from_crm(phone_number)
         if crm_manager_name and crm_manager_name in ALLOWED_MANAGERS:
             filtered_result["manager_name"] = crm_manager_name
-            print(f"✅ Имя менеджера успешно получено из CRM: {crm_manager_name}")
+            logger.info(f"✅ Имя менеджера успешно получено из CRM: {crm_manager_name}")
         else:
-            print("ℹ️ Не удалось получить имя менеджера из CRM.")
+            logger.info("ℹ️ Не удалось получить имя менеджера из CRM.")
 
     if not success:
-        fail_path = output_folder / f"{filename.replace('.txt', '')}_raw.txt"
-        with open(fail_path, "w", encoding="utf-8") as f:
-            f.write(transcript)
-        print(f"❌ Не удалось проанализировать: {filename} — исходный транскрипт сохранён как {fail_path}")
+        logger.error(f"❌ Не удалось проанализировать: {filename} — исходный транскрипт остается в хранилище")
         if filtered_result["manager_name"] == "Неизвестно":
             filtered_result["manager_name"] = "Неизвестно"
-        filtered_result["summary"] = "Ошибка анализа: не удалось сгенерировать корректные данные."
+        filtered_result["summary"] = ANALYSIS_ERROR_SUMMARY
         filtered_result["call_category"] = "Неизвестно"
         for key in CRITERIA:
             filtered_result[key] = 0
 
     if filtered_result["call_category"] != "Курьер/Технический":
-        out_path = output_folder / f"{transcript_path.stem}_analysis.json"
-
-        # Добавляем order_link и items_status в данные, которые будут сохранены в JSON
+        # Добавляем order_link и items_status в данные, которые будут сохранены в хранилище
         final_analysis_data = filtered_result.copy()
         final_analysis_data["order_link"] = order_link
         final_analysis_data["order_items_status"] = items_status  # Добавление статуса позиций
 
-        with open(out_path, "w", encoding="utf-8") as f:
-            json.dump(final_analysis_data, f, ensure_ascii=False, indent=2)
-        print(f"✅ Анализ сохранён: {out_path}")
+        store.analyses.append(communication_id, {"stem": stem, "prompt_version": PROMPT_VERSION,
+                                                 "criteria_versions": CRITERIA_VERSIONS,
+                                                 "transcript_hash": transcript_hash,
+                                                 "analysis": final_analysis_data})
+        logger.info(f"✅ Анализ сохранён: {stem}")
+    else:
+        logger.info(f"⏩ Звонок {filename} определен как 'Курьер/Технический'. Анализ не сохранен.")
+    return True
+
+
+def update_stale_criteria(store: CallStore, communication_id: str, analysis_record: Dict[str, Any], transcript: str,
+                          filename: str) -> bool:
+    """
+    Дооценивает в сохраненном анализе только отсутствующие и устаревшие критерии (score_criteria)
+    и сохраняет объединенный результат. Резюме, категория и ссылка на заказ не меняются.
+    """
+    criteria = stale_criteria(analysis_record)
+    if not criteria:
+        logger.info(f"⏩ Анализ {filename} актуален. Пропускаем.")
+        return True
+
+    analysis = analysis_record["analysis"]
+    if analysis.get("call_category") != "Заказ":
+        # Критерии продаж у звонков, не являющихся заказом, не применимы
+        scores = {key: 0 for key in criteria}
     else:
-        print(f"⏩ Звонок {filename} определен как 'Курьер/Технический'. Анализ не сохранен.")
+        logger.info(f"🧩 Дооценка {filename} по критериям: {', '.join(criteria)}")
+        items_status = analysis.get("order_items_status") or {'has_plant': False, 'has_cachepot': False}
+        scores, success, _ = score_criteria(transcript, criteria, items_status, filename)
+        if not success:
+            logger.error(f"❌ Не удалось оценить все устаревшие критерии: {filename} — неоцененные останутся устаревшими")
+        if not scores:
+            return True
 
+    store.analyses.append(communication_id, merge_criteria_scores(analysis_record, scores))
+    logger.info(f"✅ Анализ обновлён: {analysis_record['stem']} (переоценено критериев: {len(scores)})")
+    return True
 
-def analyze_transcripts(target_date_str: str):
+
+def analyze_transcripts(target_date_str: str, only_stems: Optional[Set[str]] = None,
+                        on_analyzed: Optional[Callable[[str], None]] = None):
     """
-    Проводит анализ всех транскриптов в указанной папке
-    и сохраняет результаты в виде JSON-файлов.
+    Проводит анализ всех транскриптов за дату из хранилища
+    и сохраняет результаты туда же.
 
     Args:
         target_date_str (str): Дата, за которую нужно анализировать транскрипты, в формате "ДД.ММ.ГГГГ".
+        only_stems: Если задано — анализировать только транскрипты с этими базовыми именами (звонки текущего
+            запуска), не трогая звонки прошлых запусков за тот же день.
+        on_analyzed: Вызывается с базовым именем после анализа каждого транскрипта (контрольные точки окна).
     """
-    transcripts_folder = Path("transcripts") / f"транскрибация_{target_date_str}"
-    audio_calls_folder = Path("audio") / f"звонки_{target_date_str}"  # Добавляем путь к папке с аудио-информацией
-
-    if not transcripts_folder.exists():
-        print(f"Папка с транскриптами не найдена: {transcripts_folder}. Пропускаем анализ.")
+    store = CallStore(target_date_str)
+    if not len(store.transcripts):
+        logger.info(f"Транскрипты за {target_date_str} не найдены. Пропускаем анализ.")
         return
 
-    print(f"Начинаем анализ транскриптов из папки: {transcripts_folder}")
-
-    for filename in os.listdir(transcripts_folder):
-        if filename.endswith(".txt") and not filename.endswith("_raw.txt"):
-            transcript_path = transcripts_folder / filename
-            base_name = filename.replace(".txt", "")
-
-            # Извлекаем номер телефона из имени файла транскрипции
-            # Пример имени файла: call123_79001234567.txt
-            phone_number_match = re.search(r'call\d+_(\d+)', base_name)
-            phone_number_from_filename = phone_number_match.group(1) if phone_number_match else None
-
-            # Попытка загрузить call_info.json для получения raw данных и начальной категории
-            initial_category = "Неизвестно"
-            info_path = audio_calls_folder / f"{base_name}_call_info.json"
-            if info_path.exists():
-                try:
-                    with open(info_path, "r", encoding="utf-8") as f:
-                        call_info = json.load(f)
-                        raw_call_data = call_info.get("raw", {})
-                        initial_category = categorize_call_by_metadata(raw_call_data)
-                except json.JSONDecodeError as e:
-                    print(f"Ошибка декодирования JSON для {info_path}: {e}")
-                except Exception as e:
-                    print(f"Ошибка при чтении или обработке {info_path}: {e}")
-            else:
-                print(
-                    f"Предупреждение: Файл информации о звонке не найден для {base_name}: {info_path}. Используем категорию по умолчанию.")
+    logger.info(f"Начинаем анализ транскриптов за {target_date_str} из хранилища {store.dir}")
+
+    communication_ids = store.ids_for_stems(only_stems) if only_stems is not None else None
+    for transcript_record in store.transcripts.read(communication_ids):
+        # merged — транскрипты повторных звонков, уже склеенные с основным звонком клиента
+        if transcript_record["merged"]:
+            continue
+        communication_id = transcript_record["communication_id"]
+        base_name = transcript_record["stem"]
+
+        # Извлекаем номер телефона из базового имени звонка
+        # Пример: call123_79001234567
+        phone_number_match = re.search(r'call\d+_(\d+)', base_name)
+        phone_number_from_filename = phone_number_match.group(1) if phone_number_match else None
+
+        # Информация о звонке нужна для raw данных и начальной категории
+        initial_category = "Неизвестно"
+        call_info = store.calls.get(communication_id)
+        if call_info:
+            initial_category = categorize_call_by_metadata(call_info.get("raw", {}))
+        else:
+            logger.warning(
+                f"Предупреждение: Информация о звонке не найдена для {base_name}. Используем категорию по умолчанию.")
 
-            print(f"  Анализируем: {filename} (Начальная категория: {initial_category})")
+        with log_context(communication_id=communication_id, phone=phone_number_from_filename), \
+                track_call(store, communication_id, base_name):
+            logger.info(f"  Анализируем: {base_name} (Начальная категория: {initial_category})")
             # Передаем извлеченный номер телефона в analyze_single_transcript
-            analyze_single_transcript(transcript_path, target_date_str, initial_category, phone_number_from_filename)
+            analyzed = analyze_single_transcript(store, communication_id, initial_category,
+                                                 phone_number_from_filename)
+        if analyzed and on_analyzed:
+            on_analyzed(base_name)
 
-    print(f"Анализ транскриптов для {target_date_str} завершен.")
+    logger.info(f"Анализ транскриптов для {target_date_str} завершен.")
 
 
 # УДАЛЕНИЕ: Функция test_openai_api удалена, так как она больше не нужна.
 
 # ТЕСТОВЫЙ БЛОК, ИМИТИРУЮЩИЙ РАБОТУ ОСНОВНОГО ПАЙПЛАЙНА
 if __name__ == "__main__":
+    setup_logging()
     TEST_TRANSCRIPT = """Менеджер: Добрый день. Это магазин «Тропик Хаус». Меня зовут Настасья. Я чем могу помочь?  
 Клиент: Здравствуйте, девушка. Я сегодня сейчас только что сделала заказ.  
 Менеджер: Угу.  
@@ -488,33 +770,26 @@ if __name__ == "__main__":
 Менеджер: Угу. Карина, очень приятно. Так, сейчас посмотрим ваш заказ. Секундочку.  
 Клиент: Угу.  """
 
-    TEST_FILENAME = "test_call_12345_79001112233.txt"
+    TEST_STEM = "test_call_12345_79001112233"
+    TEST_COMMUNICATION_ID = "test-12345"
     TEST_DATE_STR = datetime.today().strftime("%d.%m.%Y")
 
-    # 1. Создание тестовой папки и файла
-    temp_transcripts_folder = Path("transcripts") / f"транскрибация_{TEST_DATE_STR}"
-    os.makedirs(temp_transcripts_folder, exist_ok=True)
-    temp_transcript_path = temp_transcripts_folder / TEST_FILENAME
-
-    with open(temp_transcript_path, "w", encoding="utf-8") as f:
-        f.write(TEST_TRANSCRIPT)
+    # 1. Сохранение тестового транскрипта в хранилище
+    test_store = CallStore(TEST_DATE_STR)
+    test_store.transcripts.append(TEST_COMMUNICATION_ID, {"stem": TEST_STEM, "text": TEST_TRANSCRIPT, "merged": False})
 
     # 2. Имитация запуска анализа
-    print("--- ЗАПУСК ТЕСТОВОГО АНАЛИЗА ---")
+    logger.info("--- ЗАПУСК ТЕСТОВОГО АНАЛИЗА ---")
 
     # Извлекаем номер и начальную категорию для теста
     test_phone = "79001112233"
     test_initial_category = "Заказ"  # Устанавливаем вручную для имитации, что это не короткий звонок
 
     analyze_single_transcript(
-        transcript_path=temp_transcript_path,
-        target_folder_date_str=TEST_DATE_STR,
+        store=test_store,
+        communication_id=TEST_COMMUNICATION_ID,
         initial_category=test_initial_category,
         phone_number=test_phone
     )
 
-    # 3. Очистка тестовых файлов (по желанию, для чистоты)
-    # temp_transcript_path.unlink()
-    # temp_transcripts_folder.rmdir()
-
-    print("--- ТЕСТОВЫЙ АНАЛИЗ ЗАВЕРШЕН ---")
\ No newline at end of file
+    logger.info("--- ТЕСТОВЫЙ АНАЛИЗ ЗАВЕРШЕН ---")
\ No newline at end of file
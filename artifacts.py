@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import time
+import logging
+from pathlib import Path
+from typing import Any, Optional, Dict
+
+logger = logging.getLogger(__name__)
+
+# Рядом с каждым артефактом лежит <имя>.meta с размером и sha256 содержимого
+SIDECAR_SUFFIX = ".meta"
+
+
+class ArtifactCorruptedError(ValueError):
+    """
+    Артефакт не совпадает с записанными размером/контрольной суммой (например, обрезан при сбое).
+    """
+
+
+def sidecar_path(path: Path) -> Path:
+    return path.with_name(path.name + SIDECAR_SUFFIX)
+
+
+def _write_file(path: Path, data: bytes):
+    # Временный файл в той же папке: os.replace атомарен только в пределах одной файловой системы
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def _fsync_dir(directory: Path):
+    # Переименование попадает на диск только после fsync каталога
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_bytes(path: Path, data: bytes, checksum: bool = True):
+    """
+    Атомарно записывает артефакт: временный файл -> fsync -> os.replace.
+    Если checksum=True, сначала записывается .meta с размером и sha256: файл без совпадающей .meta
+    после сбоя считается неполным.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if checksum:
+        meta = {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+        _write_file(sidecar_path(path), json.dumps(meta).encode("utf-8"))
+    _write_file(path, data)
+    _fsync_dir(path.parent)
+
+
+def write_text(path: Path, text: str, checksum: bool = True):
+    write_bytes(path, text.encode("utf-8"), checksum)
+
+
+def write_json(path: Path, data: Any, checksum: bool = True, **dump_kwargs):
+    dump_kwargs.setdefault("ensure_ascii", False)
+    write_text(path, json.dumps(data, **dump_kwargs), checksum)
+
+
+def _read_meta(path: Path) -> Optional[Dict[str, Any]]:
+    try:
+        with open(sidecar_path(path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        return {}
+
+
+def _check(path: Path, data: bytes):
+    meta = _read_meta(path)
+    # Файлы без .meta записаны до появления контрольных сумм: считаем их целыми
+    if meta is None:
+        return
+    if meta.get("size") != len(data):
+        raise ArtifactCorruptedError(f"Артефакт {path} поврежден: размер {len(data)} байт, ожидалось {meta.get('size')}")
+    if meta.get("sha256") != hashlib.sha256(data).hexdigest():
+        raise ArtifactCorruptedError(f"Артефакт {path} поврежден: не совпадает контрольная сумма")
+
+
+def read_bytes(path: Path) -> bytes:
+    """
+    Читает артефакт и сверяет его с .meta. При несовпадении — ArtifactCorruptedError.
+    """
+    path = Path(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    _check(path, data)
+    touch(path)
+    return data
+
+
+def touch(path: Path):
+    """
+    Отмечает обращение к артефакту (atime): по нему retention.py вытесняет давно не используемые файлы.
+    Время изменения не трогается. atime выставляется явно, так как ФС часто смонтированы с relatime/noatime.
+    """
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        pass
+
+
+def read_text(path: Path) -> str:
+    return read_bytes(path).decode("utf-8")
+
+
+def read_json(path: Path) -> Any:
+    return json.loads(read_text(path))
+
+
+def is_valid(path: Path, verify_checksum: bool = False) -> bool:
+    """
+    Проверка "уже сделано" для этапов: артефакт есть и совпадает с .meta. По умолчанию сверяется
+    только размер (обрезанный файл), полная контрольная сумма — при чтении или verify_checksum=True.
+    Поврежденный артефакт удаляется (вместе с .meta), чтобы этап выполнился заново.
+    """
+    path = Path(path)
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        return False
+    try:
+        if verify_checksum:
+            read_bytes(path)
+        else:
+            meta = _read_meta(path)
+            if meta is not None and meta.get("size") != size:
+                raise ArtifactCorruptedError(
+                    f"Артефакт {path} поврежден: размер {size} байт, ожидалось {meta.get('size')}")
+        return True
+    except (ArtifactCorruptedError, OSError) as e:
+        logger.warning(f"⚠️ {e}. Файл будет получен заново.")
+        remove(path)
+        return False
+
+
+def remove(path: Path):
+    Path(path).unlink(missing_ok=True)
+    sidecar_path(Path(path)).unlink(missing_ok=True)
+
+
+def rename(src: Path, dst: Path):
+    """
+    Переименовывает артефакт вместе с его .meta.
+    """
+    src, dst = Path(src), Path(dst)
+    if sidecar_path(src).exists():
+        os.replace(sidecar_path(src), sidecar_path(dst))
+    os.replace(src, dst)
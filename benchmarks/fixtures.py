@@ -0,0 +1,119 @@
+import io
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Any, List
+
+import pandas as pd
+
+# Заголовок кадра MPEG-1 Layer III: 32 кбит/с, 44.1 кГц, моно. Длина кадра — 144 * 32000 / 44100 = 104 байта,
+# один кадр — 1152 сэмпла (~26 мс). Нули после заголовка декодируются как тишина.
+MP3_FRAME_HEADER = bytes([0xFF, 0xFB, 0x10, 0xC0])
+MP3_FRAME_SIZE = 104
+MP3_FRAMES_PER_SECOND = 44100 / 1152
+
+# Доли звонков в синтетическом отчете
+SHORT_CALL_SHARE = 0.2  # короче MIN_CALL_DURATION_SECONDS, отсеиваются до CRM
+REPEAT_CALLER_SHARE = 0.1  # повторные звонки того же клиента в окне
+NO_RECORD_SHARE = 0.05  # без записи разговора
+NOT_ANALYZABLE_ORDER_SHARE = 0.15  # последний заказ в статусе, не разрешенном к анализу
+NO_CUSTOMER_SHARE = 0.1  # клиента нет в CRM
+ALREADY_ANALYZED_SHARE = 0.05  # ссылка на последний заказ уже есть в таблице анализов
+
+MANAGERS = [{"id": 1, "firstName": "Анастасия"}, {"id": 2, "firstName": "Вера"}, {"id": 3, "firstName": "Антон"}]
+ANALYZABLE_STATUS = "new"
+NOT_ANALYZABLE_STATUS = "assembling"
+
+TRANSCRIPT_TEXT = (
+    "Менеджер: Добрый день, магазин «Тропик Хаус», меня зовут Анастасия. Чем могу помочь?\n"
+    "Клиент: Здравствуйте, хочу заказать монстеру с кашпо.\n"
+    "Менеджер: Отлично, подскажите, это для себя или в подарок?\n"
+    "Клиент: В подарок, нужна доставка завтра.\n"
+)
+
+
+def make_mp3(seconds: float) -> bytes:
+    """
+    Синтетическая MP3-запись тишины заданной длительности.
+    """
+    frame = MP3_FRAME_HEADER + bytes(MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+    return frame * max(1, int(seconds * MP3_FRAMES_PER_SECOND))
+
+
+class Scenario:
+    """
+    Синтетические данные одного прогона: отчет о звонках UIS, клиенты и заказы RetailCRM
+    и уже проанализированные заказы из таблицы. Генерация детерминирована (seed).
+    """
+
+    def __init__(self, calls_count: int, window_start: datetime, window_end: datetime, seed: int = 42):
+        self.calls_count = calls_count
+        rng = random.Random(seed)
+        window_seconds = int((window_end - window_start).total_seconds())
+
+        self.calls: List[Dict[str, Any]] = []
+        self.customers_by_phone: Dict[str, Dict[str, Any]] = {}
+        self.orders_by_customer: Dict[int, List[Dict[str, Any]]] = {}
+        self.orders_by_id: Dict[int, Dict[str, Any]] = {}
+        self.analyzed_order_ids: List[int] = []
+
+        phones = []
+        for i in range(calls_count):
+            if phones and rng.random() < REPEAT_CALLER_SHARE:
+                phone = rng.choice(phones)
+            else:
+                phone = f"79{rng.randrange(10 ** 9):09d}"
+                phones.append(phone)
+                self._add_customer(phone, rng)
+
+            short = rng.random() < SHORT_CALL_SHARE
+            start_time = window_start + timedelta(seconds=rng.randrange(max(window_seconds, 1)))
+            communication_id = 100000 + i
+            self.calls.append({
+                "communication_id": communication_id,
+                "contact_phone_number": phone,
+                "direction": rng.choice(["in", "out"]),
+                "total_duration": rng.randint(10, 59) if short else rng.randint(61, 600),
+                "start_time": start_time.strftime("%Y-%m-%d %H:%M:%S"),
+                "call_records": [] if rng.random() < NO_RECORD_SHARE else [f"rec{communication_id:x}"],
+            })
+
+    def _add_customer(self, phone: str, rng: random.Random):
+        if rng.random() < NO_CUSTOMER_SHARE:
+            return
+        customer_id = len(self.customers_by_phone) + 1
+        self.customers_by_phone[phone] = {"id": customer_id, "phones": [{"number": phone}]}
+
+        orders = []
+        for n in range(rng.randint(1, 3)):
+            order_id = customer_id * 10 + n
+            status = NOT_ANALYZABLE_STATUS if n == 0 and rng.random() < NOT_ANALYZABLE_ORDER_SHARE \
+                else ANALYZABLE_STATUS
+            order = {
+                "id": order_id,
+                "number": f"{order_id}A",
+                "customer": {"id": customer_id},
+                "status": status,
+                "createdAt": f"2025-0{n + 1}-15 10:00:00",
+                "managerId": rng.choice(MANAGERS)["id"],
+                "items": [
+                    {"offer": {"name": "Монстера Делициоза"}, "quantity": 1},
+                    {"offer": {"name": "Кашпо Lechuza Classico"}, "quantity": 1},
+                ],
+            }
+            orders.append(order)
+            self.orders_by_id[order_id] = order
+        # Последний заказ — с наибольшей датой создания (так его выбирает retailcrm_integration)
+        orders.sort(key=lambda order: order["createdAt"], reverse=True)
+        self.orders_by_customer[customer_id] = orders
+        if rng.random() < ALREADY_ANALYZED_SHARE:
+            self.analyzed_order_ids.append(orders[0]["id"])
+
+    def analyzed_sheet_xlsx(self, retailcrm_url: str, order_link_column: str) -> bytes:
+        """
+        Выгрузка таблицы анализов в XLSX со ссылками на уже проанализированные заказы.
+        """
+        frame = pd.DataFrame({order_link_column: [f"{retailcrm_url}/orders/{order_id}/edit"
+                                                  for order_id in self.analyzed_order_ids]})
+        buffer = io.BytesIO()
+        frame.to_excel(buffer, index=False)
+        return buffer.getvalue()
@@ -0,0 +1,173 @@
+"""
+Офлайн-бенчмарк пайплайна: run_processing_pipeline целиком против локальных заглушек внешних сервисов.
+
+Пример:
+    python -m benchmarks.run_benchmarks --calls 10 100 1000 --latency-ms 50 --jitter-ms 20 --error-rate 0.01
+
+Каждый сценарий выполняется в отдельном процессе и во временной рабочей папке, чтобы кэши модулей,
+файлы прошлых прогонов и пиковая память не влияли на результат.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Any, List
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+MSK = timezone(timedelta(hours=3))
+DEFAULT_SCENARIOS = [10, 100, 1000]
+RESULTS_DIR = PROJECT_ROOT / "benchmarks" / "results"
+
+# Окно 15:00 МСК: звонки с 12:00 до 14:59:59 (см. main.run_processing_pipeline)
+RUN_HOUR_MSK = 15
+WINDOW_START_HOUR = 12
+
+
+def _window(day: datetime):
+    start = day.replace(hour=WINDOW_START_HOUR, minute=0, second=0, microsecond=0)
+    end = day.replace(hour=RUN_HOUR_MSK - 1, minute=59, second=59, microsecond=0)
+    return start, end
+
+
+def run_child(now: datetime, result_path: Path):
+    """
+    Выполняется в дочернем процессе: один прогон пайплайна в текущей рабочей папке.
+    """
+    from log_config import setup_logging
+    setup_logging(log_dir=Path("logs"))
+
+    import main
+    from metrics import REGISTRY
+
+    started = time.perf_counter()
+    main.run_processing_pipeline(now=now)
+    wall_time = time.perf_counter() - started
+
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+
+    stages = {item["labels"]["stage"]: item["sum"]
+              for item in REGISTRY.summary()["histograms"].get("pipeline_stage_duration_seconds", [])}
+    result_path.write_text(json.dumps({"wall_time_s": round(wall_time, 3), "peak_rss_mb": round(peak_rss_mb, 1),
+                                       "stages_s": stages}, ensure_ascii=False), encoding="utf-8")
+
+
+def run_scenario(stand_ins, calls_count: int, day: datetime, args) -> Dict[str, Any]:
+    from benchmarks.fixtures import Scenario
+
+    window_start, window_end = _window(day)
+    stand_ins.set_scenario(Scenario(calls_count, window_start, window_end, seed=args.seed))
+
+    with tempfile.TemporaryDirectory(prefix=f"bench_{calls_count}_") as workdir:
+        result_path = Path(workdir) / "result.json"
+        env = dict(os.environ)
+        env.update(stand_ins.env())
+        env.update({
+            "PYTHONPATH": str(PROJECT_ROOT),
+            "STATUS_CONFIG_PATH": str(PROJECT_ROOT / "status_config.yaml"),
+            "LOG_LEVEL": args.log_level,
+            "LOG_CONSOLE_FORMAT": "text",
+            "METRICS_SUMMARY_DIR": str(Path(workdir) / "metrics"),
+            "TELEGRAM_PRIVATE_CHAT_INTERVAL": str(args.telegram_interval),
+            "TELEGRAM_GROUP_CHAT_INTERVAL": str(args.telegram_interval),
+            "TELEGRAM_DIGEST_MODE": "1" if args.telegram_digest else "0",
+        })
+        now = day.replace(hour=RUN_HOUR_MSK, minute=0, second=0, microsecond=0)
+        command = [sys.executable, "-m", "benchmarks.run_benchmarks", "--child", "--now", now.isoformat(),
+                   "--result", str(result_path)]
+        completed = subprocess.run(command, cwd=workdir, env=env,
+                                   stdout=None if args.verbose else subprocess.DEVNULL)
+        if completed.returncode != 0 or not result_path.exists():
+            raise RuntimeError(f"Сценарий на {calls_count} звонков завершился с кодом {completed.returncode}")
+        result = json.loads(result_path.read_text(encoding="utf-8"))
+
+    result.update({
+        "calls": calls_count,
+        "requests": dict(stand_ins.counts),
+        "injected_errors": dict(stand_ins.errors),
+    })
+    return result
+
+
+def print_report(results: List[Dict[str, Any]]):
+    services = sorted({service for result in results for service in result["requests"]})
+    header = f"{'звонков':>8} {'время, с':>9} {'RSS, МБ':>8} " + " ".join(f"{service:>13}" for service in services)
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        counts = " ".join(f"{result['requests'].get(service, 0):>13}" for service in services)
+        print(f"{result['calls']:>8} {result['wall_time_s']:>9.2f} {result['peak_rss_mb']:>8.1f} {counts}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк пайплайна на локальных заглушках сервисов")
+    parser.add_argument("--calls", type=int, nargs="+", default=DEFAULT_SCENARIOS,
+                        help="Число звонков в отчете UIS для каждого сценария")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Задержка ответа заглушек, мс")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="Разброс задержки, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 503")
+    parser.add_argument("--openai-latency-ms", type=float, default=None,
+                        help="Отдельная задержка для OpenAI (по умолчанию как у остальных)")
+    parser.add_argument("--audio-seconds", type=float, default=10, help="Длительность синтетической MP3-записи")
+    parser.add_argument("--telegram-interval", type=float, default=0,
+                        help="Интервал между сообщениями в один чат Telegram, с (в проде 1–3 с)")
+    parser.add_argument("--telegram-digest", action="store_true", help="Режим дайджеста Telegram")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--verbose", action="store_true", help="Показывать вывод пайплайна")
+    parser.add_argument("--output", type=Path, default=None, help="Файл JSON-отчета")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--now", help=argparse.SUPPRESS)
+    parser.add_argument("--result", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(datetime.fromisoformat(args.now), args.result)
+        return
+
+    # Заглушка OpenAI импортирует analyzer (список критериев), которому нужен ключ при импорте
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    from benchmarks.stand_ins import StandInServer, ServiceProfile
+
+    profiles = {"default": ServiceProfile(args.latency_ms, args.jitter_ms, args.error_rate)}
+    if args.openai_latency_ms is not None:
+        profiles["openai"] = ServiceProfile(args.openai_latency_ms, args.jitter_ms, args.error_rate)
+
+    stand_ins = StandInServer(profiles, audio_seconds=args.audio_seconds, seed=args.seed).start()
+    day = datetime.now(MSK)
+    results = []
+    try:
+        for calls_count in args.calls:
+            print(f"▶️ Сценарий: {calls_count} звонков...", flush=True)
+            results.append(run_scenario(stand_ins, calls_count, day, args))
+    finally:
+        stand_ins.stop()
+
+    print_report(results)
+
+    report = {
+        "started_at": day.isoformat(),
+        "settings": {"latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "error_rate": args.error_rate,
+                     "openai_latency_ms": args.openai_latency_ms, "audio_seconds": args.audio_seconds,
+                     "telegram_interval": args.telegram_interval, "telegram_digest": args.telegram_digest,
+                     "seed": args.seed},
+        "results": results,
+    }
+    output = args.output or RESULTS_DIR / f"bench_{day.strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"📊 Отчет сохранен: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, Optional, List
+from urllib.parse import urlparse, parse_qs
+
+from benchmarks.fixtures import Scenario, MANAGERS, ANALYZABLE_STATUS, NOT_ANALYZABLE_STATUS, TRANSCRIPT_TEXT, make_mp3
+
+# Сервисы, которые изображает локальный сервер, и префиксы их путей
+SERVICES = {
+    "uis_api": "/uis/api",
+    "uis_media": "/uis/media",
+    "retailcrm": "/crm",
+    "openai": "/openai",
+    "google_forms": "/forms",
+    "google_sheets": "/sheets",
+    "telegram": "/telegram",
+}
+
+
+class ServiceProfile:
+    """
+    Поведение заглушки сервиса: задержка ответа (мс), разброс задержки (мс) и доля ответов 503.
+    """
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+    def delay(self, rng: random.Random) -> float:
+        return max(0.0, self.latency_ms + rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+
+class StandInServer:
+    """
+    Один локальный HTTP-сервер, который изображает UIS, RetailCRM, OpenAI, Google Forms/Sheets и Telegram
+    на разных префиксах пути. Данные берутся из текущего сценария (set_scenario), число запросов
+    считается по сервисам (counts, errors).
+    """
+
+    def __init__(self, profiles: Optional[Dict[str, ServiceProfile]] = None, audio_seconds: float = 10,
+                 seed: int = 42):
+        self.profiles = profiles or {}
+        self.mp3 = make_mp3(audio_seconds)
+        self.scenario: Optional[Scenario] = None
+        self.counts = Counter()
+        self.errors = Counter()
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._sheet_xlsx = b""
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self) -> Dict[str, str]:
+        """
+        Переменные окружения, направляющие пайплайн на заглушки.
+        """
+        base = self.base_url
+        return {
+            "UIS_API_URL": f"{base}/uis/api",
+            "UIS_MEDIA_URL": f"{base}/uis/media",
+            "UIS_API_TOKEN": "bench",
+            "RETAILCRM_URL": f"{base}/crm",
+            "RETAILCRM_API_KEY": "bench",
+            "OPENAI_BASE_URL": f"{base}/openai/v1",
+            "OPENAI_API_KEY": "bench",
+            "FORM_URL": f"{base}/forms/formResponse",
+            "GS_DOWNLOAD_BASE_URL": f"{base}/sheets/{{sheet_id}}/export?format=xlsx&gid={{gid}}",
+            "TELEGRAM_API_URL": f"{base}/telegram",
+            "TELEGRAM_BOT_TOKEN": "bench",
+            "TELEGRAM_CHAT_ID": "1001",
+            "ROP_CHAT_IDS": "",
+            "TELEGRAM_TOPIC_ID": "",
+        }
+
+    def set_scenario(self, scenario: Scenario, order_link_column: str = "Ссылка на заказ"):
+        self.scenario = scenario
+        self._sheet_xlsx = scenario.analyzed_sheet_xlsx(f"{self.base_url}/crm", order_link_column)
+        self.reset_counts()
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts.clear()
+            self.errors.clear()
+
+    def start(self) -> "StandInServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stand-ins", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def before_request(self, service: str) -> bool:
+        """
+        Учитывает запрос, выдерживает задержку профиля и решает, отвечать ли ошибкой.
+        """
+        profile = self.profiles.get(service) or self.profiles.get("default") or ServiceProfile()
+        with self._lock:
+            self.counts[service] += 1
+            delay = profile.delay(self._rng)
+            fail = self._rng.random() < profile.error_rate
+            if fail:
+                self.errors[service] += 1
+        if delay:
+            time.sleep(delay)
+        return not fail
+
+    # --- Ответы сервисов ---
+
+    def uis_api(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        if body.get("method") != "get.calls_report":
+            return {"jsonrpc": "2.0", "id": body.get("id"), "error": {"code": -32601, "message": "Method not found"}}
+        calls = self.scenario.calls
+        report_filter = body.get("params", {}).get("filter")
+        if report_filter and report_filter.get("operator") == "=":
+            calls = [call for call in calls
+                     if str(call.get(report_filter["field"])) == str(report_filter["value"])]
+        return {"jsonrpc": "2.0", "id": body.get("id"), "result": {"data": calls}}
+
+    def retailcrm(self, path: str, query: Dict[str, str]) -> Dict[str, Any]:
+        scenario = self.scenario
+        if path == "/api/v5/customers" and "filter[name]" in query:
+            customer = scenario.customers_by_phone.get(query["filter[name]"])
+            return {"success": True, "customers": [customer] if customer else []}
+        if path == "/api/v5/customers":
+            return self._retailcrm_list("customers", list(scenario.customers_by_phone.values()), query)
+        if path == "/api/v5/orders" and "filter[customerId]" in query:
+            customer_id = int(query.get("filter[customerId]", 0) or 0)
+            return {"success": True, "orders": scenario.orders_by_customer.get(customer_id, [])}
+        if path == "/api/v5/orders":
+            return self._retailcrm_list("orders", list(scenario.orders_by_id.values()), query)
+        if path in ("/api/v5/orders/history", "/api/v5/customers/history"):
+            # Сценарий не меняется во время прогона: история изменений пуста
+            return {"success": True, "history": [], "pagination": {"limit": 100, "totalCount": 0}}
+        match = re.fullmatch(r"/api/v5/orders/(\d+)", path)
+        if match:
+            order = scenario.orders_by_id.get(int(match.group(1)))
+            return {"success": bool(order), "order": order}
+        if path == "/api/v5/users":
+            return {"success": True, "users": MANAGERS}
+        if path == "/api/v5/reference/statuses":
+            return {"success": True, "statuses": {
+                ANALYZABLE_STATUS: {"code": ANALYZABLE_STATUS, "name": "Новый", "group": "new", "active": True},
+                NOT_ANALYZABLE_STATUS: {"code": NOT_ANALYZABLE_STATUS, "name": "Комплектация", "group": "assembling",
+                                        "active": True},
+            }}
+        if path == "/api/v5/reference/status-groups":
+            return {"success": True, "statusGroups": {
+                "new": {"code": "new", "name": "Новый", "statuses": [ANALYZABLE_STATUS]},
+                "assembling": {"code": "assembling", "name": "Комплектация", "statuses": [NOT_ANALYZABLE_STATUS]},
+            }}
+        return {"success": False, "errorMsg": "Not found"}
+
+    @staticmethod
+    def _retailcrm_list(key: str, items: List[Dict[str, Any]], query: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Постраничный список RetailCRM (limit, page) с фильтром filter[ids][].
+        """
+        if "filter[ids][]" in query:
+            ids = {int(item_id) for item_id in query["filter[ids][]"]}
+            items = [item for item in items if item["id"] in ids]
+        limit = int(query.get("limit", 20))
+        page = int(query.get("page", 1))
+        return {"success": True, key: items[(page - 1) * limit:page * limit],
+                "pagination": {"limit": limit, "currentPage": page, "totalCount": len(items),
+                               "totalPageCount": max(1, -(-len(items) // limit))}}
+
+    def openai_chat(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        prompt = body["messages"][-1]["content"]
+        group_keys = re.findall(r'→ ключ "([^"]+)"', prompt)
+        if "Текст звонка для разделения" in prompt:
+            content = TRANSCRIPT_TEXT
+        elif group_keys:
+            # Оценка группы критериев (частичный анализ): только запрошенные ключи
+            content = json.dumps({key: 1 for key in group_keys}, ensure_ascii=False)
+        else:
+            from analyzer import CRITERIA
+            analysis = {key: 1 for key in CRITERIA}
+            analysis.update({"manager_name": MANAGERS[0]["firstName"], "call_category": "Заказ"})
+            # Формат ответа из PROMPT_TEMPLATE: JSON, затем резюме после разделителя
+            content = json.dumps(analysis, ensure_ascii=False) + \
+                "\n---SUMMARY---\nКлиент заказал растение с кашпо и доставкой на завтра."
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(content) // 4
+        return {
+            "id": f"chatcmpl-bench-{self.counts['openai']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", ""),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+
+def _make_handler(stand_ins: StandInServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _service(self) -> Optional[str]:
+            path = urlparse(self.path).path
+            for service, prefix in SERVICES.items():
+                if path.startswith(prefix + "/") or path == prefix:
+                    return service
+            return None
+
+        def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, data: Any, status: int = 200):
+            self._send(status, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+        def _read_body(self) -> bytes:
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def _handle(self):
+            body = self._read_body()
+            service = self._service()
+            if service is None:
+                self._send(404, b"{}")
+                return
+            if not stand_ins.before_request(service):
+                self._send_json({"error": "stand-in injected failure"}, status=503)
+                return
+
+            parsed = urlparse(self.path)
+            path = parsed.path[len(SERVICES[service]):]
+            # Параметры-массивы (filter[ids][]) передаются списком
+            query = {key: values if key.endswith("[]") else values[0]
+                     for key, values in parse_qs(parsed.query).items()}
+
+            if service == "uis_api":
+                self._send_json(stand_ins.uis_api(json.loads(body or b"{}")))
+            elif service == "uis_media":
+                self._send(200, stand_ins.mp3, "audio/mpeg")
+            elif service == "retailcrm":
+                self._send_json(stand_ins.retailcrm(path, query))
+            elif service == "openai":
+                if path.endswith("/audio/transcriptions"):
+                    self._send(200, TRANSCRIPT_TEXT.encode("utf-8"), "text/plain; charset=utf-8")
+                elif path.endswith("/chat/completions"):
+                    self._send_json(stand_ins.openai_chat(json.loads(body)))
+                else:
+                    self._send_json({"error": {"message": "Unknown endpoint"}}, status=404)
+            elif service == "google_forms":
+                self._send(200, b"<html>ok</html>", "text/html")
+            elif service == "google_sheets":
+                self._send(200, stand_ins._sheet_xlsx,
+                           "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            elif service == "telegram":
+                self._send_json({"ok": True, "result": {"message_id": stand_ins.counts["telegram"]}})
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,287 @@
+import os
+import json
+import shutil
+import logging
+from pathlib import Path
+from typing import Optional, Dict, Any, Iterable, Iterator, Tuple, List
+
+from dotenv import load_dotenv
+
+import artifacts
+from locks import file_lock
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Хранилище результатов этапов: по папке на дату (store/звонки_ДД.ММ.ГГГГ), в ней по JSONL-файлу на этап.
+# Записи аудио остаются отдельными MP3 в audio/звонки_ДД.ММ.ГГГГ.
+CALL_STORE_DIR = Path(os.getenv("CALL_STORE_DIR", "store"))
+
+STAGE_CALLS = "calls"
+STAGE_TRANSCRIPTS = "transcripts"
+STAGE_ANALYSES = "analyses"
+STAGE_USAGE = "usage"
+
+# Из отчета UIS в хранилище сохраняются только поля, которые читают следующие этапы
+CALL_INFO_RAW_FIELDS = ["communication_id", "contact_phone_number", "direction", "duration", "total_duration",
+                        "start_time"]
+
+# Индекс журнала этапа сохраняется, когда непроиндексированный хвост журнала больше индекса
+# (примерно INDEX_ENTRY_BYTES на звонок), но не меньше INDEX_MIN_TAIL_BYTES
+INDEX_ENTRY_BYTES = 40
+INDEX_MIN_TAIL_BYTES = 64 * 1024
+
+
+class StageStore:
+    """
+    Журнал результатов одного этапа: append-only JSONL, одна строка — одна запись звонка,
+    и индекс communication_id -> (смещение, длина) последней записи звонка.
+
+    Запись дописывается под межпроцессной блокировкой с fsync, повторная запись звонка заменяет
+    предыдущую (в индексе остается последняя). Индекс хранит размер проиндексированной части журнала:
+    строки, дописанные после него (другим процессом или до сбоя), дочитываются при обращении.
+    Поэтому индекс сохраняется не при каждой записи, а когда непроиндексированный хвост журнала
+    перерастает сам индекс: перезапись индекса стоит не больше дописанных данных, а дочитывание
+    хвоста при открытии — не больше чтения индекса. Недописанная при сбое строка в конце журнала отбрасывается.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.index_path = path.with_name(path.stem + ".idx.json")
+        self.lock_path = path.with_name(f".{path.name}.lock")
+        self._offsets: Dict[str, Tuple[int, int]] = {}
+        self._indexed_size = 0
+        # Размер журнала в сохраненном на диске индексе
+        self._saved_size = 0
+        self._load_index()
+
+    def _load_index(self):
+        if not self.index_path.exists():
+            return
+        try:
+            index = artifacts.read_json(self.index_path)
+            self._offsets = {key: (offset, length) for key, (offset, length) in index["offsets"].items()}
+            self._indexed_size = self._saved_size = index["size"]
+        except (ValueError, KeyError, OSError) as e:
+            logger.warning(f"⚠️ Индекс {self.index_path} не прочитан ({e}), журнал будет проиндексирован заново.")
+            self._offsets, self._indexed_size = {}, 0
+
+    def _save_index(self):
+        artifacts.write_json(self.index_path, {"size": self._indexed_size, "offsets": self._offsets},
+                             checksum=False)
+        self._saved_size = self._indexed_size
+
+    def _save_index_if_due(self):
+        # Запись индекса — около INDEX_ENTRY_BYTES на звонок
+        if self._indexed_size - self._saved_size >= max(len(self._offsets) * INDEX_ENTRY_BYTES, INDEX_MIN_TAIL_BYTES):
+            self._save_index()
+
+    def _catch_up(self, repair: bool = False):
+        """
+        Индексирует строки, дописанные после последнего обращения. С repair=True (под блокировкой записи)
+        обрезает недописанную строку в конце журнала.
+        """
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            self._offsets, self._indexed_size = {}, 0
+            return
+        if size < self._indexed_size:
+            # Журнал пересоздан (например, удален очисткой): индексируем с начала
+            self._offsets, self._indexed_size = {}, 0
+        if size == self._indexed_size:
+            return
+
+        with open(self.path, "rb") as f:
+            f.seek(self._indexed_size)
+            offset = self._indexed_size
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    key = str(json.loads(line)["communication_id"])
+                except (ValueError, KeyError):
+                    logger.warning(f"⚠️ Поврежденная строка в {self.path} (смещение {offset}) пропущена.")
+                else:
+                    self._offsets[key] = (offset, len(line))
+                offset += len(line)
+        self._indexed_size = offset
+
+        if repair and offset < size:
+            logger.warning(f"⚠️ Недописанная запись в конце {self.path} ({size - offset} байт) отброшена.")
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+                os.fsync(f.fileno())
+
+    def append(self, communication_id: Any, record: Dict[str, Any]):
+        """
+        Дописывает запись звонка. Поле communication_id добавляется в запись автоматически.
+        """
+        key = str(communication_id)
+        line = (json.dumps({"communication_id": key, **record}, ensure_ascii=False) + "\n").encode("utf-8")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.lock_path):
+            self._catch_up(repair=True)
+            with open(self.path, "ab") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._offsets[key] = (self._indexed_size, len(line))
+            self._indexed_size += len(line)
+            self._save_index_if_due()
+
+    def get(self, communication_id: Any) -> Optional[Dict[str, Any]]:
+        self._catch_up()
+        location = self._offsets.get(str(communication_id))
+        if location is None:
+            return None
+        with open(self.path, "rb") as f:
+            return self._read_at(f, *location)
+
+    def _read_at(self, f, offset: int, length: int) -> Dict[str, Any]:
+        f.seek(offset)
+        line = f.read(length)
+        try:
+            return json.loads(line)
+        except ValueError as e:
+            raise artifacts.ArtifactCorruptedError(f"Запись в {self.path} (смещение {offset}) повреждена: {e}")
+
+    def __contains__(self, communication_id: Any) -> bool:
+        self._catch_up()
+        return str(communication_id) in self._offsets
+
+    def __len__(self) -> int:
+        self._catch_up()
+        return len(self._offsets)
+
+    def keys(self) -> List[str]:
+        self._catch_up()
+        return list(self._offsets)
+
+    def read(self, communication_ids: Optional[Iterable[Any]] = None,
+             skip_corrupted: bool = False) -> Iterator[Dict[str, Any]]:
+        """
+        Последние записи звонков (всех или только communication_ids) в порядке записи в журнал.
+        Читается только нужное: по индексу, одним проходом по файлу.
+        С skip_corrupted поврежденные записи пропускаются (с предупреждением в лог), а не прерывают чтение.
+        """
+        self._catch_up()
+        if communication_ids is None:
+            locations = list(self._offsets.values())
+        else:
+            locations = [self._offsets[key] for key in map(str, communication_ids) if key in self._offsets]
+        if not locations:
+            return
+        with open(self.path, "rb") as f:
+            for offset, length in sorted(locations):
+                try:
+                    record = self._read_at(f, offset, length)
+                except artifacts.ArtifactCorruptedError as e:
+                    if not skip_corrupted:
+                        raise
+                    logger.warning(f"⚠️ {e}. Запись пропущена.")
+                    continue
+                yield record
+
+
+class CallStore:
+    """
+    Результаты этапов за одну дату папок: информация о звонке (calls), транскрипты (transcripts)
+    и анализы (analyses). Записи связаны по communication_id и содержат базовое имя файла звонка (stem).
+    """
+
+    def __init__(self, target_folder_date_str: str, base_dir: Path = CALL_STORE_DIR):
+        self.folder_date = target_folder_date_str
+        self.dir = base_dir / f"звонки_{target_folder_date_str}"
+        if not self.dir.exists():
+            self._import_legacy_files()
+        # Обращение к дате учитывается при вытеснении по LRU (retention.py)
+        artifacts.touch(self.dir)
+        self.calls = StageStore(self.dir / f"{STAGE_CALLS}.jsonl")
+        self.transcripts = StageStore(self.dir / f"{STAGE_TRANSCRIPTS}.jsonl")
+        self.analyses = StageStore(self.dir / f"{STAGE_ANALYSES}.jsonl")
+        # Токены, секунды аудио и стоимость запросов к OpenAI по этапам (cost_accounting.py)
+        self.usage = StageStore(self.dir / f"{STAGE_USAGE}.jsonl")
+
+    def versioned_analyses(self, prompt_version: str) -> StageStore:
+        """
+        Анализы, пересчитанные под другую версию промпта (rescore.py). Лежат рядом с основными и их не заменяют.
+        """
+        return StageStore(self.dir / f"{STAGE_ANALYSES}.{prompt_version}.jsonl")
+
+    def stems(self) -> Dict[str, str]:
+        """
+        communication_id -> базовое имя файлов звонка.
+        """
+        return {record["communication_id"]: record["stem"] for record in self.calls.read()}
+
+    def ids_for_stems(self, stems: Iterable[str]) -> List[str]:
+        stems = set(stems)
+        return [communication_id for communication_id, stem in self.stems().items() if stem in stems]
+
+    def _import_legacy_files(self):
+        """
+        Переносит в хранилище результаты, сохраненные отдельными файлами (*_call_info.json, *.txt,
+        *_analysis.json) до появления хранилища, чтобы незавершенные окна не обрабатывались заново.
+        """
+        audio_dir = Path("audio") / f"звонки_{self.folder_date}"
+        if not audio_dir.exists():
+            return
+        self.dir.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.dir.parent / f".{self.dir.name}.lock"):
+            if self.dir.exists():
+                return
+            # Перенос идет во временную папку: прерванный перенос не оставит неполное хранилище
+            import_dir = self.dir.with_name(f".{self.dir.name}.import")
+            if import_dir.exists():
+                shutil.rmtree(import_dir)
+            import_dir.mkdir()
+            calls = StageStore(import_dir / f"{STAGE_CALLS}.jsonl")
+            transcripts = StageStore(import_dir / f"{STAGE_TRANSCRIPTS}.jsonl")
+            analyses = StageStore(import_dir / f"{STAGE_ANALYSES}.jsonl")
+            transcripts_dir = Path("transcripts") / f"транскрибация_{self.folder_date}"
+            analyses_dir = Path("analyses") / f"транскрибация_{self.folder_date}"
+            imported = 0
+            for info_path in sorted(audio_dir.glob("*_call_info.json")):
+                stem = info_path.name[:-len("_call_info.json")]
+                try:
+                    call_info = artifacts.read_json(info_path)
+                    communication_id = call_info.get("raw", {}).get("communication_id")
+                    if communication_id is None:
+                        continue
+                    record = call_info_record(stem, call_info.get("raw", {}), call_info.get("contact_phone_number", ""),
+                                              call_info.get("record_link", ""))
+                    record["start_time"] = call_info.get("start_time", "")
+                    calls.append(communication_id, record)
+                    for transcript_path, merged in ((transcripts_dir / f"{stem}.txt", False),
+                                                    (transcripts_dir / f"{stem}_merged.txt", True)):
+                        if artifacts.is_valid(transcript_path):
+                            transcripts.append(communication_id, {"stem": stem,
+                                                                  "text": artifacts.read_text(transcript_path),
+                                                                  "merged": merged})
+                    analysis_path = analyses_dir / f"{stem}_analysis.json"
+                    if artifacts.is_valid(analysis_path):
+                        analyses.append(communication_id, {"stem": stem,
+                                                           "analysis": artifacts.read_json(analysis_path)})
+                    imported += 1
+                except (ValueError, OSError) as e:
+                    logger.error(f"Ошибка при переносе {info_path} в хранилище: {e}")
+            os.replace(import_dir, self.dir)
+            if imported:
+                logger.info(f"📦 В хранилище {self.dir} перенесено звонков из отдельных файлов: {imported}")
+
+
+def call_info_record(stem: str, call: Dict[str, Any], contact_phone: str, record_url: str) -> Dict[str, Any]:
+    """
+    Запись этапа загрузки: имя файлов звонка, ссылка на запись и нужные поля отчета UIS.
+    """
+    raw = call.get("raw") or {}
+    return {
+        "stem": stem,
+        "start_time": call.get("start_time", ""),
+        "contact_phone_number": contact_phone,
+        "record_link": record_url,
+        "raw": {field: call[field] if call.get(field) is not None else raw.get(field)
+                for field in CALL_INFO_RAW_FIELDS if call.get(field) is not None or raw.get(field) is not None},
+    }
@@ -0,0 +1,135 @@
+import logging
+import pandas as pd
+from typing import List, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Звонки не длиннее этого порога (в секундах) не скачиваются и не анализируются
+MIN_CALL_DURATION_SECONDS = 60
+
+# Поля отчета UIS, которые нужны для фильтрации. В отчете они лежат либо на верхнем уровне звонка, либо в "raw".
+CALL_FIELDS = ["communication_id", "contact_phone_number", "direction", "total_duration", "start_time"]
+
+SUPPORTED_DIRECTIONS = ["in", "out"]
+
+# Как поступать с повторными звонками одного клиента (один номер или один заказ) в окне:
+# "longest" — анализировать только самый длинный звонок, "concat" — склеить транскрипты в один.
+DUPLICATE_STRATEGY_LONGEST = "longest"
+DUPLICATE_STRATEGY_CONCAT = "concat"
+
+
+def normalize_phone_series(phones: pd.Series) -> pd.Series:
+    """
+    Векторная версия retailcrm_integration.normalize_phone: приводит номера к виду '7XXXXXXXXXX'.
+    """
+    digits = phones.fillna("").astype(str).str.replace(r"\D", "", regex=True)
+    lengths = digits.str.len()
+    starts_with_8 = digits.str.startswith("8") & (lengths == 11)
+    starts_with_9 = digits.str.startswith("9") & (lengths == 10)
+    normalized = digits.copy()
+    normalized[starts_with_8] = "7" + digits[starts_with_8].str[1:]
+    normalized[starts_with_9] = "7" + digits[starts_with_9]
+    return normalized
+
+
+def calls_to_frame(calls: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Один раз нормализует отчет UIS в таблицу: по столбцу на поле из CALL_FIELDS
+    (значение верхнего уровня, а если его нет — из "raw"), плюс has_record и normalized_phone.
+    Индекс таблицы совпадает с позицией звонка в исходном списке.
+    communication_id, найденный только в "raw", записывается и в сам звонок: загрузка записи
+    (download_record) и следующие этапы читают его с верхнего уровня.
+    """
+    for call in calls:
+        if call.get("communication_id") in (None, "") and (call.get("raw") or {}).get("communication_id") is not None:
+            call["communication_id"] = call["raw"]["communication_id"]
+
+    # dtype=object: иначе столбец с пропусками станет float (ID 123 -> 123.0),
+    # а полностью пустой — float, к которому combine_first попытается привести строки
+    top_level = pd.DataFrame([{field: call.get(field) for field in CALL_FIELDS} for call in calls],
+                             columns=CALL_FIELDS, dtype=object)
+    raw = pd.DataFrame([{field: (call.get("raw") or {}).get(field) for field in CALL_FIELDS} for call in calls],
+                       columns=CALL_FIELDS, dtype=object)
+
+    # Пустые строки считаем отсутствующими значениями, как и `call.get(...) or call.get("raw", {}).get(...)`
+    top_level = top_level.replace("", pd.NA)
+    frame = top_level.combine_first(raw) if len(calls) else top_level
+    frame.index = range(len(calls))
+
+    frame["total_duration"] = pd.to_numeric(frame["total_duration"], errors="coerce")
+    frame["has_record"] = pd.Series([bool(call.get("call_records")) for call in calls], index=frame.index, dtype=bool)
+    frame["normalized_phone"] = normalize_phone_series(frame["contact_phone_number"])
+    return frame
+
+
+def prefilter_calls(frame: pd.DataFrame, min_duration: int = MIN_CALL_DURATION_SECONDS) -> pd.DataFrame:
+    """
+    Применяет дешевые проверки векторно, до любых запросов в CRM:
+    есть номер и направление, направление поддерживается, есть запись и ID, длительность больше порога.
+    Возвращает подмножество строк frame.
+    """
+    has_phone_and_direction = frame["contact_phone_number"].notna() & frame["direction"].notna()
+    known_direction = frame["direction"].isin(SUPPORTED_DIRECTIONS)
+    downloadable = frame["communication_id"].notna() & frame["has_record"]
+    long_enough = frame["total_duration"] > min_duration
+
+    masks = [
+        ("нет номера или направления", has_phone_and_direction),
+        ("неизвестное направление", known_direction),
+        ("нет записи разговора", downloadable),
+        (f"длительность ≤ {min_duration}с", long_enough),
+    ]
+
+    keep = pd.Series(True, index=frame.index)
+    for reason, mask in masks:
+        dropped = int((keep & ~mask).sum())
+        if dropped:
+            logger.info(f"⏩ Отсеяно звонков ({reason}): {dropped}")
+        keep &= mask
+
+    logger.info(f"➡️ После предварительной фильтрации: {int(keep.sum())} из {len(frame)} звонков, "
+          f"уникальных номеров: {frame.loc[keep, 'normalized_phone'].nunique()}.")
+    return frame[keep]
+
+
+def dedupe_calls(frame: pd.DataFrame, order_links: Optional[Dict[str, str]] = None,
+                 strategy: str = DUPLICATE_STRATEGY_LONGEST) -> Tuple[pd.DataFrame, Dict[Any, List[Any]]]:
+    """
+    Группирует повторные звонки одного клиента: по ссылке на заказ, если она известна, иначе по нормализованному номеру.
+    Основным звонком группы считается самый длинный.
+
+    Args:
+        frame: Таблица звонков (после prefilter_calls).
+        order_links: Нормализованный номер -> ссылка на последний заказ (если известна).
+        strategy: DUPLICATE_STRATEGY_LONGEST или DUPLICATE_STRATEGY_CONCAT.
+
+    Returns:
+        (таблица звонков к загрузке, {communication_id основного звонка: [communication_id остальных звонков группы]}).
+        Для "longest" в таблице остаются только основные звонки, для "concat" — все звонки групп.
+    """
+    if frame.empty:
+        return frame, {}
+
+    order_links = order_links or {}
+    links = frame["normalized_phone"].map(order_links).fillna("")
+    group_key = links.where(links != "", "phone:" + frame["normalized_phone"])
+
+    # Сортировка по длительности по убыванию: первая строка группы — основной звонок
+    ordered = frame.assign(_group=group_key).sort_values(["_group", "total_duration"], ascending=[True, False],
+                                                         kind="stable")
+    is_primary = ~ordered["_group"].duplicated()
+
+    merge_groups = {}
+    for _, group in ordered[ordered["_group"].duplicated(keep=False)].groupby("_group", sort=False):
+        # Остальные звонки группы — в хронологическом порядке
+        secondary = group.iloc[1:].sort_values("start_time", kind="stable")
+        merge_groups[group["communication_id"].iloc[0]] = secondary["communication_id"].tolist()
+
+    duplicates = int((~is_primary).sum())
+    if duplicates:
+        action = "будут склеены с основным звонком" if strategy == DUPLICATE_STRATEGY_CONCAT else "пропущены"
+        logger.info(f"🔁 Повторные звонки клиентов в окне: {duplicates} ({len(merge_groups)} клиентов), {action}.")
+
+    if strategy == DUPLICATE_STRATEGY_CONCAT:
+        return frame, merge_groups
+    return frame.loc[ordered.index[is_primary]].sort_index(), {}
@@ -0,0 +1,201 @@
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Set, Iterable
+
+from dotenv import load_dotenv
+
+import artifacts
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Контрольные точки окон обработки: отобранные звонки, пройденные этапы и отправленные ссылки
+CHECKPOINTS_DIR = Path(os.getenv("CHECKPOINTS_DIR", "cache/checkpoints"))
+# Завершенные контрольные точки хранятся столько дней, потом удаляются
+CHECKPOINT_RETENTION_DAYS = 7
+# Окно, которое не удалось довести до конца за столько попыток, больше не возобновляется
+CHECKPOINT_MAX_RESUMES = 3
+
+STATUS_IN_PROGRESS = "in_progress"
+STATUS_COMPLETE = "complete"
+STATUS_ABANDONED = "abandoned"
+
+# Этапы в порядке выполнения
+STAGE_SELECT = "select"
+STAGE_DOWNLOAD = "download"
+STAGE_TRANSCRIBE = "transcribe"
+STAGE_ANALYZE = "analyze"
+STAGE_DELIVER = "deliver"
+
+
+class WindowCheckpoint:
+    """
+    Контрольная точка одного окна обработки (cache/checkpoints/<начало>-<конец>.json).
+
+    После каждого этапа фиксируется, что он пройден, а на этапе анализа — каждый проанализированный звонок.
+    Повторный запуск того же окна (или --resume) продолжает с места остановки: отчет UIS и фильтрация
+    по CRM не повторяются, уже скачанные, транскрибированные и проанализированные звонки пропускаются.
+    """
+
+    def __init__(self, path: Path, data: Dict[str, Any]):
+        self.path = path
+        self.data = data
+
+    @staticmethod
+    def window_id(start_time_period: datetime, end_time_period: datetime) -> str:
+        return f"{start_time_period.strftime('%Y%m%d_%H%M%S')}-{end_time_period.strftime('%Y%m%d_%H%M%S')}"
+
+    @classmethod
+    def for_window(cls, start_time_period: datetime, end_time_period: datetime,
+                   target_folder_date_str: str) -> "WindowCheckpoint":
+        path = CHECKPOINTS_DIR / f"{cls.window_id(start_time_period, end_time_period)}.json"
+        checkpoint = cls.load(path)
+        if checkpoint:
+            return checkpoint
+        return cls(path, {
+            "start": start_time_period.isoformat(),
+            "end": end_time_period.isoformat(),
+            "folder_date": target_folder_date_str,
+            "status": STATUS_IN_PROGRESS,
+            "runs": 0,
+            "stages": [],
+            "calls": [],
+            "merge_groups": {},
+            "analyzed_stems": [],
+            "sent_order_links": [],
+        })
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["WindowCheckpoint"]:
+        if not path.exists():
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return cls(path, json.load(f))
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать контрольную точку {path}: {e}. Окно будет обработано заново.")
+            return None
+
+    @property
+    def start(self) -> datetime:
+        return datetime.fromisoformat(self.data["start"])
+
+    @property
+    def end(self) -> datetime:
+        return datetime.fromisoformat(self.data["end"])
+
+    @property
+    def folder_date(self) -> str:
+        return self.data["folder_date"]
+
+    @property
+    def status(self) -> str:
+        return self.data["status"]
+
+    @property
+    def calls(self) -> List[dict]:
+        return self.data["calls"]
+
+    @property
+    def merge_groups(self) -> Dict[str, List[str]]:
+        return self.data["merge_groups"]
+
+    @property
+    def analyzed_stems(self) -> Set[str]:
+        return set(self.data["analyzed_stems"])
+
+    @property
+    def sent_order_links(self) -> Set[str]:
+        return set(self.data["sent_order_links"])
+
+    def stage_done(self, stage: str) -> bool:
+        return stage in self.data["stages"]
+
+    def save(self):
+        self.data["updated_at"] = datetime.now().isoformat()
+        # Контрольная точка перезаписывается целиком и атомарно: после сбоя на диске либо старая, либо новая версия
+        artifacts.write_json(self.path, self.data, checksum=False)
+
+    def start_run(self) -> bool:
+        """
+        Отмечает очередную попытку обработки окна. Возвращает False, если окно уже завершено
+        или попытки исчерпаны.
+        """
+        if self.status != STATUS_IN_PROGRESS:
+            return False
+        if self.data["runs"] >= CHECKPOINT_MAX_RESUMES:
+            logger.error(f"❌ Окно {self.path.stem} не удалось завершить за {CHECKPOINT_MAX_RESUMES} попыток. "
+                         f"Оно больше не будет возобновляться.")
+            self.data["status"] = STATUS_ABANDONED
+            self.save()
+            return False
+        if self.data["runs"]:
+            logger.info(f"♻️ Возобновляем окно {self.path.stem} (пройдены этапы: {', '.join(self.data['stages']) or 'нет'}).")
+        self.data["runs"] += 1
+        self.save()
+        return True
+
+    def record_selection(self, calls: List[dict], merge_groups: Dict[Any, List[Any]]):
+        self.data["calls"] = calls
+        self.data["merge_groups"] = {str(primary_id): [str(secondary_id) for secondary_id in ids]
+                                     for primary_id, ids in merge_groups.items()}
+        self.mark_stage(STAGE_SELECT)
+
+    def mark_stage(self, stage: str):
+        if stage not in self.data["stages"]:
+            self.data["stages"].append(stage)
+        self.save()
+
+    def mark_analyzed(self, stem: str):
+        if stem not in self.data["analyzed_stems"]:
+            self.data["analyzed_stems"].append(stem)
+            self.save()
+
+    def record_sent(self, order_links: Iterable[str]):
+        self.data["sent_order_links"] = sorted(self.sent_order_links | set(order_links))
+        self.mark_stage(STAGE_DELIVER)
+
+    def defer(self):
+        """
+        Окно отложено из-за недоступности внешнего сервиса: попытка не засчитывается в CHECKPOINT_MAX_RESUMES,
+        окно возобновится при следующем запуске.
+        """
+        self.data["runs"] = max(self.data["runs"] - 1, 0)
+        self.save()
+
+    def discard(self):
+        self.path.unlink(missing_ok=True)
+
+    def complete(self):
+        self.data["status"] = STATUS_COMPLETE
+        self.save()
+
+
+def list_checkpoints(status: Optional[str] = None) -> List[WindowCheckpoint]:
+    if not CHECKPOINTS_DIR.exists():
+        return []
+    checkpoints = [checkpoint for checkpoint in map(WindowCheckpoint.load, sorted(CHECKPOINTS_DIR.glob("*.json")))
+                   if checkpoint]
+    return [checkpoint for checkpoint in checkpoints if status is None or checkpoint.status == status]
+
+
+def incomplete_checkpoints() -> List[WindowCheckpoint]:
+    return list_checkpoints(STATUS_IN_PROGRESS)
+
+
+def protected_folder_dates() -> Set[str]:
+    """
+    Даты папок незавершенных окон: очистка старых папок их не удаляет, чтобы окно можно было возобновить.
+    """
+    return {checkpoint.folder_date for checkpoint in incomplete_checkpoints()}
+
+
+def prune_checkpoints(days_to_keep: int = CHECKPOINT_RETENTION_DAYS):
+    cutoff = (datetime.now() - timedelta(days=days_to_keep)).isoformat()
+    for checkpoint in list_checkpoints():
+        if checkpoint.status != STATUS_IN_PROGRESS and checkpoint.data.get("updated_at", "") < cutoff:
+            checkpoint.path.unlink(missing_ok=True)
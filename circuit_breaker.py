@@ -0,0 +1,207 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any
+
+import requests
+import openai
+from dotenv import load_dotenv
+
+from metrics import track_request, inc
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Цепь размыкается после стольких сбоев подряд (таймауты, ошибки соединения, HTTP 5xx)
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+# Разомкнутая цепь сразу отклоняет запросы столько секунд, затем пропускает один пробный запрос
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+# Что делать со звонками, пока зависимость недоступна:
+# defer — отложить до следующего запуска (окно остается незавершенным, задача очереди возвращается без траты попытки),
+# degrade — обрабатывать дальше без нее (для RetailCRM — без фильтра по статусу заказа и без данных из CRM)
+FALLBACK_DEFER = "defer"
+FALLBACK_DEGRADE = "degrade"
+DEFAULT_FALLBACK_POLICIES = {
+    "retailcrm": FALLBACK_DEFER,
+    "uis": FALLBACK_DEFER,
+    "openai": FALLBACK_DEFER,
+    "google_forms": FALLBACK_DEFER,
+    "telegram": FALLBACK_DEGRADE,
+}
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class DependencyUnavailableError(Exception):
+    """
+    Внешний сервис недоступен, и по политике defer звонок откладывается до следующего запуска.
+    """
+
+    def __init__(self, service: str, message: str = ""):
+        super().__init__(message or f"{service} недоступен")
+        self.service = service
+
+
+class CircuitOpenError(DependencyUnavailableError):
+    """
+    Запрос отклонен без обращения к сервису: цепь разомкнута.
+    """
+
+
+def fallback_policy(service: str) -> str:
+    return os.getenv(f"CIRCUIT_FALLBACK_{service.upper()}", DEFAULT_FALLBACK_POLICIES.get(service, FALLBACK_DEFER))
+
+
+def is_outage_error(error: Exception) -> bool:
+    """
+    Признак недоступности сервиса, а не ошибки конкретного запроса: таймаут, ошибка соединения или HTTP 5xx.
+    """
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.exceptions.HTTPError) and response is not None and response.status_code >= 500
+
+
+class CircuitBreaker:
+    """
+    Предохранитель внешней зависимости.
+
+    closed — запросы идут как обычно; после CIRCUIT_FAILURE_THRESHOLD сбоев подряд цепь размыкается (open)
+    и следующие запросы сразу получают CircuitOpenError вместо ожидания таймаута. Через reset_seconds цепь
+    полуоткрыта (half_open): проходит один пробный запрос, его успех замыкает цепь, сбой снова размыкает.
+    """
+
+    def __init__(self, service: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds: float = CIRCUIT_RESET_SECONDS):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._state = STATE_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started_at = 0.0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        return self._state != STATE_CLOSED
+
+    def _set_state(self, state: str):
+        if state == self._state:
+            return
+        self._state = state
+        inc("circuit_state_changes_total", service=self.service, state=state)
+        if state == STATE_OPEN:
+            logger.error(f"🔌 {self.service} недоступен: цепь разомкнута, запросы отклоняются "
+                         f"{self.reset_seconds:.0f} сек.")
+        elif state == STATE_CLOSED:
+            logger.info(f"🔌 {self.service} снова доступен: цепь замкнута.")
+
+    def before_request(self):
+        """
+        Пропускает запрос или поднимает CircuitOpenError. В полуоткрытом состоянии проходит только пробный запрос.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == STATE_OPEN and now - self._opened_at >= self.reset_seconds:
+                self._set_state(STATE_HALF_OPEN)
+                self._probe_started_at = 0.0
+            # Пробный запрос, по которому так и не пришел результат, через reset_seconds заменяется новым
+            if self._state == STATE_HALF_OPEN and now - self._probe_started_at >= self.reset_seconds:
+                self._probe_started_at = now
+                logger.info(f"🔌 Пробный запрос к {self.service}.")
+                return
+            if self._state != STATE_CLOSED:
+                self.rejected += 1
+                inc("circuit_rejected_total", service=self.service)
+                raise CircuitOpenError(self.service, f"{self.service} недоступен (цепь разомкнута)")
+
+    def record(self, failed: bool):
+        """
+        Учитывает исход пропущенного запроса: failed — сервис недоступен (см. is_outage_error).
+        """
+        with self._lock:
+            if not failed:
+                self._failures = 0
+                self._set_state(STATE_CLOSED)
+                return
+            self._failures += 1
+            if self._state == STATE_HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(STATE_OPEN)
+
+    def summary(self) -> Dict[str, Any]:
+        return {"state": self._state, "consecutive_failures": self._failures, "rejected": self.rejected,
+                "fallback": fallback_policy(self.service)}
+
+
+BREAKERS = {service: CircuitBreaker(service) for service in DEFAULT_FALLBACK_POLICIES}
+
+
+def get_breaker(service: str) -> CircuitBreaker:
+    return BREAKERS[service]
+
+
+def circuit_states() -> Dict[str, Dict[str, Any]]:
+    return {service: breaker.summary() for service, breaker in BREAKERS.items()}
+
+
+@contextmanager
+def guarded_request(service: str, operation: str):
+    """
+    Запрос к внешнему сервису через его предохранитель: при разомкнутой цепи — CircuitOpenError без запроса,
+    иначе замер запроса (track_request) и учет его исхода. Сбоем считается только недоступность (is_outage_error);
+    прочие ошибки (HTTP 4xx, неверный ответ) означают, что сервис отвечает.
+    """
+    breaker = get_breaker(service)
+    breaker.before_request()
+    try:
+        with track_request(service, operation):
+            yield
+    except Exception as e:
+        breaker.record(failed=is_outage_error(e))
+        raise
+    breaker.record(failed=False)
+
+
+def is_unavailable(service: str, error: Exception) -> bool:
+    """
+    Ошибка означает недоступность сервиса: запрос отклонен предохранителем, недоступность уже установлена ниже
+    по стеку (DependencyUnavailableError) или именно этот сбой разомкнул цепь.
+    Единичный сбой при замкнутой цепи недоступностью не считается.
+    """
+    if isinstance(error, DependencyUnavailableError):
+        return error.service == service
+    return is_outage_error(error) and get_breaker(service).is_open
+
+
+def defer_if_unavailable(service: str, error: Exception):
+    """
+    При недоступности сервиса и политике defer поднимает DependencyUnavailableError: звонок откладывается
+    до следующего запуска. Иначе вызывающий код обрабатывает ошибку как раньше.
+    """
+    if fallback_policy(service) == FALLBACK_DEFER and is_unavailable(service, error):
+        if isinstance(error, DependencyUnavailableError):
+            raise error
+        raise DependencyUnavailableError(service) from error
+
+
+def ensure_available(service: str):
+    """
+    Поднимает DependencyUnavailableError, если цепь сервиса разомкнута и для него задана политика defer
+    (например, после этапа, ошибки которого не прерывают его, но требуют повторить этап позже).
+    """
+    if fallback_policy(service) == FALLBACK_DEFER and get_breaker(service).is_open:
+        raise DependencyUnavailableError(service)
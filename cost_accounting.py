@@ -0,0 +1,207 @@
+import os
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Iterable
+
+from dotenv import load_dotenv
+
+from metrics import inc, record_openai_usage
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Цены OpenAI, USD за 1 млн токенов: (входные, входные из кэша, выходные)
+MODEL_PRICES_USD = {
+    "gpt-5": (1.25, 0.125, 10.0),
+    "gpt-5-mini": (0.25, 0.025, 2.0),
+    "gpt-5-nano": (0.05, 0.005, 0.4),
+    "gpt-4o": (2.5, 1.25, 10.0),
+    "gpt-4o-mini": (0.15, 0.075, 0.6),
+}
+# Whisper тарифицируется по длительности записи, USD за минуту
+AUDIO_PRICES_USD_PER_MINUTE = {
+    "whisper-1": 0.006,
+}
+
+# Бюджет одного запуска (окна обработки), USD; 0 — без лимита.
+# После RUN_BUDGET_ECONOMY_SHARE бюджета разметка ролей пропускается и модели не повышаются,
+# после исчерпания бюджета анализ идет только самой дешевой моделью.
+RUN_BUDGET_USD = float(os.getenv("RUN_BUDGET_USD", "0"))
+RUN_BUDGET_ECONOMY_SHARE = float(os.getenv("RUN_BUDGET_ECONOMY_SHARE", "0.8"))
+
+BUDGET_MODE_NORMAL = "normal"
+BUDGET_MODE_ECONOMY = "economy"
+BUDGET_MODE_MINIMAL = "minimal"
+
+# Затраты текущего звонка (внутри track_call)
+_call_usage = contextvars.ContextVar("call_usage", default=None)
+
+
+def usage_cost_usd(model: str, usage: Dict[str, int]) -> float:
+    """
+    Стоимость токенов по MODEL_PRICES_USD (неизвестная модель считается бесплатной и попадает в лог).
+    """
+    if model not in MODEL_PRICES_USD:
+        logger.debug(f"Нет цены для модели {model}, затраты не учтены.")
+        return 0.0
+    input_price, cached_price, output_price = MODEL_PRICES_USD[model]
+    cached_tokens = usage.get("cached_tokens", 0)
+    return ((usage["prompt_tokens"] - cached_tokens) * input_price + cached_tokens * cached_price
+            + usage["completion_tokens"] * output_price) / 1_000_000
+
+
+def audio_cost_usd(model: str, audio_seconds: float) -> float:
+    return AUDIO_PRICES_USD_PER_MINUTE.get(model, 0.0) * audio_seconds / 60
+
+
+def _empty_totals() -> Dict[str, Any]:
+    return {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "audio_seconds": 0.0,
+            "cost_usd": 0.0}
+
+
+def _add(totals: Dict[str, Any], entry: Dict[str, Any]):
+    for key in _empty_totals():
+        totals[key] += entry.get(key, 1 if key == "requests" else 0)
+
+
+class RunLedger:
+    """
+    Затраты на OpenAI за запуск: итог, по этапам и по моделям, и режим работы по бюджету RUN_BUDGET_USD.
+    """
+
+    def __init__(self, budget_usd: float = RUN_BUDGET_USD, spent_usd: float = 0.0):
+        self.budget_usd = budget_usd
+        self._lock = threading.Lock()
+        self.total = _empty_totals()
+        # Затраты окна до перезапуска (по сохраненным затратам звонков) тоже расходуют его бюджет
+        self.total["cost_usd"] = spent_usd
+        self.by_stage: Dict[str, Dict[str, Any]] = {}
+        self.by_model: Dict[str, Dict[str, Any]] = {}
+        self._mode = self._compute_mode()
+
+    def add(self, stage: str, model: str, entry: Dict[str, Any]):
+        with self._lock:
+            _add(self.total, entry)
+            _add(self.by_stage.setdefault(stage, _empty_totals()), entry)
+            _add(self.by_model.setdefault(model, _empty_totals()), entry)
+            mode = self._compute_mode()
+            if mode != self._mode:
+                self._mode = mode
+                logger.warning(f"💸 Затраты запуска ${self.total['cost_usd']:.2f} из ${self.budget_usd:.2f}: "
+                               f"режим {mode}.")
+                inc("budget_mode_changes_total", mode=mode)
+
+    def _compute_mode(self) -> str:
+        if not self.budget_usd:
+            return BUDGET_MODE_NORMAL
+        spent = self.total["cost_usd"]
+        if spent >= self.budget_usd:
+            return BUDGET_MODE_MINIMAL
+        if spent >= self.budget_usd * RUN_BUDGET_ECONOMY_SHARE:
+            return BUDGET_MODE_ECONOMY
+        return BUDGET_MODE_NORMAL
+
+    @property
+    def mode(self) -> str:
+        return self._mode
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "budget_usd": self.budget_usd,
+                "mode": self._mode,
+                "total": {**self.total, "cost_usd": round(self.total["cost_usd"], 4)},
+                "by_stage": {stage: {**totals, "cost_usd": round(totals["cost_usd"], 4)}
+                             for stage, totals in self.by_stage.items()},
+                "by_model": {model: {**totals, "cost_usd": round(totals["cost_usd"], 4)}
+                             for model, totals in self.by_model.items()},
+            }
+
+
+RUN_LEDGER = RunLedger()
+
+
+def start_run(spent_usd: float = 0.0):
+    """
+    Начинает учет нового запуска: у каждого окна обработки свой бюджет, даже в долгоживущем процессе.
+    spent_usd — уже потраченное на окно (доработка окна после сбоя, задачи окна в режиме очереди).
+    """
+    global RUN_LEDGER
+    RUN_LEDGER = RunLedger(spent_usd=spent_usd)
+
+
+def stored_cost_usd(store, communication_ids: Iterable[Any]) -> float:
+    """
+    Сохраненные затраты звонков (этап usage хранилища).
+    """
+    try:
+        return sum(record.get("cost_usd", 0) for record in store.usage.read(communication_ids))
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось прочитать затраты звонков {store.dir}: {e}")
+        return 0.0
+
+
+def budget_mode() -> str:
+    return RUN_LEDGER.mode
+
+
+def run_summary() -> Dict[str, Any]:
+    return RUN_LEDGER.summary()
+
+
+def record_usage(stage: str, model: str, usage: Any = None, audio_seconds: float = 0.0) -> Dict[str, Any]:
+    """
+    Учитывает один запрос к OpenAI: токены из поля usage ответа (с кэшированными) или секунды аудио.
+    Затраты добавляются к итогам запуска и к затратам текущего звонка (track_call), если он задан.
+    """
+    record_openai_usage(stage, model, usage)
+    details = getattr(usage, "prompt_tokens_details", None)
+    entry = {
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "cached_tokens": (getattr(details, "cached_tokens", 0) or 0) if details else 0,
+        "audio_seconds": audio_seconds,
+    }
+    entry["cost_usd"] = usage_cost_usd(model, entry) + audio_cost_usd(model, audio_seconds)
+    if audio_seconds:
+        inc("openai_audio_seconds_total", audio_seconds, stage=stage, model=model)
+    inc("openai_cost_usd_total", entry["cost_usd"], stage=stage, model=model)
+
+    RUN_LEDGER.add(stage, model, entry)
+    call_usage = _call_usage.get()
+    if call_usage is not None:
+        _add(call_usage.setdefault(stage, {"model": model, **_empty_totals()}), entry)
+        call_usage[stage]["model"] = model
+    return entry
+
+
+@contextmanager
+def track_call(store, communication_id: str, stem: Optional[str] = None):
+    """
+    Собирает затраты запросов внутри блока и дописывает их к затратам звонка в хранилище (этап usage).
+    """
+    call_usage: Dict[str, Dict[str, Any]] = {}
+    token = _call_usage.set(call_usage)
+    try:
+        yield call_usage
+    finally:
+        _call_usage.reset(token)
+        if call_usage:
+            _save_call_usage(store, communication_id, stem, call_usage)
+
+
+def _save_call_usage(store, communication_id: str, stem: Optional[str], call_usage: Dict[str, Dict[str, Any]]):
+    try:
+        record = store.usage.get(communication_id) or {"stem": stem, "stages": {}}
+        for stage, entry in call_usage.items():
+            totals = record["stages"].setdefault(stage, {"model": entry["model"], **_empty_totals()})
+            _add(totals, entry)
+            totals["model"] = entry["model"]
+        record["cost_usd"] = round(sum(totals["cost_usd"] for totals in record["stages"].values()), 6)
+        store.usage.append(communication_id, record)
+    except Exception as e:
+        # Учет затрат не должен прерывать обработку звонка
+        logger.warning(f"⚠️ Не удалось сохранить затраты звонка {communication_id}: {e}")
@@ -0,0 +1,419 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Iterable, Set
+
+from dotenv import load_dotenv
+
+from retailcrm_integration import RETAILCRM_URL, RETAILCRM_API_KEY, normalize_phone, _session
+from circuit_breaker import guarded_request
+from metrics import inc
+from log_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Локальное зеркало RetailCRM (клиенты, заказы, пользователи) для поиска заказов по номеру без запросов к API.
+# 1 — включено; при выключенном или устаревшем зеркале поиск идет напрямую в RetailCRM, как раньше
+CRM_MIRROR = os.getenv("CRM_MIRROR", "0") == "1"
+CRM_MIRROR_PATH = Path(os.getenv("CRM_MIRROR_PATH", "cache/crm_mirror.sqlite3"))
+# Зеркало догоняет RetailCRM по истории изменений не чаще раза в столько минут (при обращении к нему)
+CRM_MIRROR_SYNC_MINUTES = float(os.getenv("CRM_MIRROR_SYNC_MINUTES", "5"))
+# Если синхронизация не удается дольше этого срока, зеркало не используется и поиск идет в RetailCRM
+CRM_MIRROR_MAX_STALENESS_MINUTES = float(os.getenv("CRM_MIRROR_MAX_STALENESS_MINUTES", "60"))
+# Максимальный размер страницы API RetailCRM (списки и история)
+PAGE_LIMIT = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS customers (
+    id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS customer_phones (
+    phone TEXT NOT NULL,
+    customer_id INTEGER NOT NULL,
+    PRIMARY KEY (phone, customer_id)
+);
+CREATE INDEX IF NOT EXISTS customer_phones_customer ON customer_phones (customer_id);
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    customer_id INTEGER,
+    status TEXT,
+    manager_id INTEGER,
+    created_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_last ON orders (customer_id, created_at);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    first_name TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Сущности, которые зеркало догоняет по истории: сущность -> (список, история, ключ ответа списка, ключ в истории)
+ENTITIES = {
+    "orders": ("/api/v5/orders", "/api/v5/orders/history", "orders", "order"),
+    "customers": ("/api/v5/customers", "/api/v5/customers/history", "customers", "customer"),
+}
+
+
+def _order_customer_id(order: Dict[str, Any]) -> Optional[int]:
+    # У заказа корпоративного клиента телефон — у контактного лица
+    return (order.get("contact") or order.get("customer") or {}).get("id")
+
+
+class CrmMirror:
+    """
+    Зеркало RetailCRM в SQLite: клиенты с индексом по нормализованному номеру, заказы (статус, менеджер,
+    дата создания и состав) и пользователи.
+
+    Первая синхронизация выгружает клиентов и заказы постранично целиком, следующие — только изменения
+    из /orders/history и /customers/history начиная с сохраненного курсора (sinceId). Измененные сущности
+    запрашиваются пачками по id и перезаписываются вместе с курсором в одной транзакции, поэтому прерванная
+    синхронизация просто повторяется с прежнего места.
+    """
+
+    def __init__(self, path: Path = CRM_MIRROR_PATH):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._sync_lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._sync_thread: Optional[threading.Thread] = None
+        self._retry_at = 0.0
+        self._synced_at = 0.0
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # Отдельное соединение на операцию: зеркало используют несколько потоков и процессов
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _reader(self):
+        # Поиск идет на каждый звонок: соединение для чтения держится открытым в каждом потоке
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return conn
+
+    # --- Поиск ---
+
+    def last_order(self, phone: str) -> Optional[Dict[str, Any]]:
+        """
+        Последний по дате создания заказ клиентов с этим номером (номер нормализуется).
+        """
+        row = self._reader().execute(
+            "SELECT o.data FROM customer_phones p JOIN orders o ON o.customer_id = p.customer_id "
+            "WHERE p.phone = ? ORDER BY o.created_at DESC, o.id DESC LIMIT 1",
+            (normalize_phone(phone),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def order(self, order_id: int) -> Optional[Dict[str, Any]]:
+        row = self._reader().execute("SELECT data FROM orders WHERE id = ?", (order_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def customer_id(self, phone: str) -> Optional[int]:
+        row = self._reader().execute("SELECT MIN(customer_id) FROM customer_phones WHERE phone = ?",
+                                     (normalize_phone(phone),)).fetchone()
+        return row[0] if row else None
+
+    def user_first_name(self, user_id: Any) -> Optional[str]:
+        row = self._reader().execute("SELECT first_name FROM users WHERE id = ?", (int(user_id),)).fetchone()
+        return row[0] if row else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._connect() as conn:
+            counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                      for table in ("customers", "orders", "users")}
+            state = dict(conn.execute("SELECT key, value FROM sync_state").fetchall())
+        return {**counts, **state}
+
+    # --- Состояние синхронизации ---
+
+    def _get_state(self, key: str) -> Optional[str]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _set_state(conn, key: str, value: Any):
+        conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def synced_at(self) -> float:
+        """
+        Момент последней успешной синхронизации (0 — зеркало еще не заполнено).
+        """
+        return float(self._get_state("synced_at") or 0)
+
+    def age_minutes(self, interval_minutes: float = CRM_MIRROR_SYNC_MINUTES) -> float:
+        # Момент синхронизации перечитывается из базы, только когда по памяти пора синхронизировать:
+        # зеркало могли обновить другие процессы
+        if (time.time() - self._synced_at) / 60 >= interval_minutes:
+            self._synced_at = self.synced_at()
+        return (time.time() - self._synced_at) / 60
+
+    # --- Запросы к RetailCRM ---
+
+    def _get(self, path: str, operation: str, params: Any) -> Dict[str, Any]:
+        if isinstance(params, dict):
+            params = list(params.items())
+        with guarded_request("retailcrm", operation):
+            response = _session.get(f"{RETAILCRM_URL}{path}", params=[("apiKey", RETAILCRM_API_KEY)] + params,
+                                    timeout=30)
+            response.raise_for_status()
+        data = response.json()
+        if not data.get("success"):
+            raise RuntimeError(f"RetailCRM {path}: {data.get('errorMsg', 'неуспешный ответ')}")
+        return data
+
+    def _pages(self, path: str, operation: str, key: str) -> Iterable[List[Dict[str, Any]]]:
+        page = 1
+        while True:
+            data = self._get(path, operation, {"limit": PAGE_LIMIT, "page": page})
+            yield data.get(key) or []
+            if page >= (data.get("pagination") or {}).get("totalPageCount", 1):
+                return
+            page += 1
+
+    def _fetch_by_ids(self, entity: str, ids: List[int]) -> List[Dict[str, Any]]:
+        list_path, _, key, _ = ENTITIES[entity]
+        fetched = []
+        for start in range(0, len(ids), PAGE_LIMIT):
+            batch = ids[start:start + PAGE_LIMIT]
+            data = self._get(list_path, entity, [("limit", PAGE_LIMIT)] + [("filter[ids][]", i) for i in batch])
+            fetched.extend(data.get(key) or [])
+        return fetched
+
+    # --- Запись ---
+
+    @staticmethod
+    def _upsert(conn, entity: str, items: List[Dict[str, Any]]):
+        for item in items:
+            data = json.dumps(item, ensure_ascii=False)
+            if entity == "orders":
+                conn.execute(
+                    "INSERT OR REPLACE INTO orders (id, customer_id, status, manager_id, created_at, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (item["id"], _order_customer_id(item), item.get("status"), item.get("managerId"),
+                     item.get("createdAt", ""), data))
+                continue
+            conn.execute("INSERT OR REPLACE INTO customers (id, data) VALUES (?, ?)", (item["id"], data))
+            conn.execute("DELETE FROM customer_phones WHERE customer_id = ?", (item["id"],))
+            phones = {normalize_phone(phone.get("number") or "") for phone in item.get("phones") or []}
+            conn.executemany("INSERT OR IGNORE INTO customer_phones (phone, customer_id) VALUES (?, ?)",
+                             [(phone, item["id"]) for phone in phones if phone])
+
+    @staticmethod
+    def _delete(conn, entity: str, ids: Iterable[int]):
+        for entity_id in ids:
+            if entity == "orders":
+                conn.execute("DELETE FROM orders WHERE id = ?", (entity_id,))
+            else:
+                conn.execute("DELETE FROM customers WHERE id = ?", (entity_id,))
+                conn.execute("DELETE FROM customer_phones WHERE customer_id = ?", (entity_id,))
+
+    # --- Синхронизация ---
+
+    def _bootstrap(self, entity: str):
+        """
+        Первая выгрузка сущности целиком. Изменения, сделанные во время выгрузки, догоняются по истории
+        начиная с момента ее начала (курсор по дате до первой записи истории).
+        """
+        list_path, _, key, _ = ENTITIES[entity]
+        # Запас в сутки покрывает разницу часовых поясов сервера и CRM; повтор изменений из истории безвреден
+        started_at = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+        loaded = 0
+        for items in self._pages(list_path, entity, key):
+            with self._transaction() as conn:
+                self._upsert(conn, entity, items)
+            loaded += len(items)
+        with self._transaction() as conn:
+            self._set_state(conn, f"{entity}_since_date", started_at)
+        logger.info(f"🪞 Зеркало RetailCRM: выгружено {entity}: {loaded}.")
+
+    def _sync_history(self, entity: str) -> int:
+        """
+        Догоняет изменения сущности по истории. Возвращает число измененных сущностей.
+        """
+        _, history_path, _, history_key = ENTITIES[entity]
+        changed = 0
+        while True:
+            since_id = self._get_state(f"{entity}_since_id")
+            params = {"limit": PAGE_LIMIT}
+            if since_id:
+                params["filter[sinceId]"] = since_id
+            else:
+                params["filter[startDate]"] = self._get_state(f"{entity}_since_date")
+            history = self._get(history_path, f"{entity}_history", params).get("history") or []
+            if not history:
+                return changed
+
+            changed_ids: Set[int] = set()
+            deleted_ids: Set[int] = set()
+            for record in history:
+                entity_id = (record.get(history_key) or {}).get("id")
+                if entity_id is None:
+                    continue
+                if record.get("deleted"):
+                    deleted_ids.add(entity_id)
+                    changed_ids.discard(entity_id)
+                else:
+                    changed_ids.add(entity_id)
+                    deleted_ids.discard(entity_id)
+            items = self._fetch_by_ids(entity, sorted(changed_ids))
+
+            # Сущности и курсор пишутся вместе: курсор не уходит вперед незаписанных изменений
+            with self._transaction() as conn:
+                self._upsert(conn, entity, items)
+                self._delete(conn, entity, deleted_ids)
+                self._set_state(conn, f"{entity}_since_id", max(record["id"] for record in history))
+            changed += len(changed_ids) + len(deleted_ids)
+            inc("crm_mirror_changes_total", len(changed_ids) + len(deleted_ids), entity=entity)
+            if len(history) < PAGE_LIMIT:
+                return changed
+
+    def _sync_users(self):
+        users = [user for page in self._pages("/api/v5/users", "users", "users") for user in page]
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM users")
+            conn.executemany("INSERT INTO users (id, first_name, data) VALUES (?, ?, ?)",
+                             [(user["id"], user.get("firstName"), json.dumps(user, ensure_ascii=False))
+                              for user in users])
+
+    def sync(self, rebuild: bool = False):
+        """
+        Догоняет RetailCRM: при пустом зеркале (или rebuild) — полная выгрузка, иначе изменения по истории.
+        Ошибки запросов поднимаются: решение об использовании устаревшего зеркала принимает get_mirror().
+        """
+        with self._sync_lock:
+            started = time.monotonic()
+            if rebuild:
+                with self._transaction() as conn:
+                    conn.execute("DELETE FROM sync_state")
+            for entity in ENTITIES:
+                if not self._get_state(f"{entity}_since_id") and not self._get_state(f"{entity}_since_date"):
+                    self._bootstrap(entity)
+            changed = {entity: self._sync_history(entity) for entity in ENTITIES}
+            self._sync_users()
+            synced_at = time.time()
+            with self._transaction() as conn:
+                self._set_state(conn, "synced_at", synced_at)
+            self._synced_at = synced_at
+            inc("crm_mirror_syncs_total")
+            logger.info(f"🪞 Зеркало RetailCRM синхронизировано за {time.monotonic() - started:.1f} сек.: "
+                        + ", ".join(f"{entity} изменено {count}" for entity, count in changed.items()))
+
+    def _sync_due(self, interval_minutes: float, bootstrap: bool = False) -> bool:
+        age = self.age_minutes(interval_minutes)
+        # Первая полная выгрузка идет только явно (python crm_mirror.py, прогрев демона), а не внутри поиска заказа
+        if not self._synced_at and not bootstrap:
+            return False
+        # Синхронизацию, уже идущую в другом потоке, не ждем: поиск идет по текущему состоянию зеркала
+        return age >= interval_minutes and not self._sync_lock.locked() and time.monotonic() >= self._retry_at
+
+    def sync_if_due(self, interval_minutes: float = CRM_MIRROR_SYNC_MINUTES, bootstrap: bool = False):
+        if not self._sync_due(interval_minutes, bootstrap):
+            return
+        try:
+            self.sync()
+        except Exception:
+            # После неудачи следующая попытка — через интервал синхронизации, а не при каждом поиске
+            self._retry_at = time.monotonic() + interval_minutes * 60
+            raise
+
+    def start_sync_if_due(self, interval_minutes: float = CRM_MIRROR_SYNC_MINUTES) -> bool:
+        """
+        Запускает синхронизацию изменений в фоновом потоке, если пора. Поиск заказа ее не ждет.
+        Возвращает True, если поток запущен.
+        """
+        with self._thread_lock:
+            if self._sync_thread is not None and self._sync_thread.is_alive():
+                return False
+            if not self._sync_due(interval_minutes):
+                return False
+            self._sync_thread = threading.Thread(target=self._background_sync, args=(interval_minutes,),
+                                                 name="crm-mirror-sync", daemon=True)
+            self._sync_thread.start()
+            return True
+
+    def _background_sync(self, interval_minutes: float):
+        try:
+            self.sync_if_due(interval_minutes)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось синхронизировать зеркало RetailCRM: {e}")
+            inc("crm_mirror_sync_errors_total")
+
+
+_mirror: Optional[CrmMirror] = None
+_mirror_lock = threading.Lock()
+
+
+def get_mirror(bootstrap: bool = False) -> Optional[CrmMirror]:
+    """
+    Зеркало для поиска, синхронизированное не позднее CRM_MIRROR_SYNC_MINUTES назад, или None, если зеркало
+    выключено, еще ни разу не синхронизировано или не удается синхронизировать его дольше
+    CRM_MIRROR_MAX_STALENESS_MINUTES: тогда вызывающий код обращается к RetailCRM напрямую.
+    bootstrap=True — выполнить первую полную выгрузку, если ее еще не было (прогрев демона), в вызывающем потоке.
+    Без bootstrap зеркало только читается: изменения догружаются в фоновом потоке (start_sync_if_due).
+    """
+    global _mirror
+    if not CRM_MIRROR or not RETAILCRM_API_KEY:
+        return None
+    with _mirror_lock:
+        if _mirror is None:
+            _mirror = CrmMirror()
+    if bootstrap:
+        try:
+            _mirror.sync_if_due(bootstrap=True)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось синхронизировать зеркало RetailCRM: {e}")
+            inc("crm_mirror_sync_errors_total")
+    else:
+        _mirror.start_sync_if_due()
+    if _mirror.age_minutes() > CRM_MIRROR_MAX_STALENESS_MINUTES:
+        return None
+    return _mirror
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальное зеркало RetailCRM.")
+    parser.add_argument("--rebuild", action="store_true", help="Выгрузить клиентов и заказы заново целиком.")
+    parser.add_argument("--stats", action="store_true", help="Показать размер зеркала и курсоры синхронизации.")
+    args = parser.parse_args()
+
+    setup_logging()
+    mirror = CrmMirror()
+    if not args.stats:
+        mirror.sync(rebuild=args.rebuild)
+    for key, value in mirror.stats().items():
+        logger.info(f"{key}: {value}")
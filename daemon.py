@@ -0,0 +1,219 @@
+import os
+import json
+import signal
+import logging
+import threading
+from datetime import datetime, timedelta, time as dtime
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple
+
+import schedule
+from dotenv import load_dotenv
+
+from main import (MSK, parse_run_times, resolve_processing_window, process_period, OrderLinksCache,
+                  resume_incomplete_windows)
+from checkpoints import incomplete_checkpoints, prune_checkpoints
+from retention import start_background_retention
+from retailcrm_integration import get_analyzable_status_codes
+from crm_mirror import get_mirror
+from metrics import timed_stage, export_run_metrics, start_run_metrics, start_metrics_server, METRICS_PORT
+from model_router import routing_stats
+from cost_accounting import run_summary
+from circuit_breaker import circuit_states
+from log_config import setup_logging
+import artifacts
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Непрерывная обработка: каждые MICRO_BATCH_MINUTES минут обрабатываются звонки с конца прошлой пачки.
+# 0 — обработка только в запланированные окна (PROCESSING_RUN_TIMES).
+MICRO_BATCH_MINUTES = int(os.getenv("MICRO_BATCH_MINUTES", "0"))
+# Отставание конца пачки от текущего времени: звонок должен завершиться и попасть в отчет UIS
+MICRO_BATCH_LAG_MINUTES = int(os.getenv("MICRO_BATCH_LAG_MINUTES", "15"))
+# Если демон долго не работал, пачка не захватывает звонки старше этого срока
+MICRO_BATCH_MAX_LOOKBACK_HOURS = 24
+# Конец последней обработанной пачки — чтобы после перезапуска продолжить без пропусков и повторов
+DAEMON_STATE_PATH = Path(os.getenv("DAEMON_STATE_PATH", "cache/daemon_state.json"))
+
+MAX_IDLE_WAIT_SECONDS = 30
+
+
+def _next_run_at(run_time: dtime, now: datetime) -> datetime:
+    """
+    Ближайший момент запуска по МСК после now. Расписание ведется по МСК, а не в местном времени процесса:
+    переход местного времени на летнее и обратно не сдвигает запуски.
+    """
+    run_at = datetime.combine(now.astimezone(MSK).date(), run_time, tzinfo=MSK)
+    return run_at if run_at > now else run_at + timedelta(days=1)
+
+
+def _split_by_day(start_time_period: datetime, end_time_period: datetime) -> List[Tuple[datetime, datetime]]:
+    """
+    Делит период (МСК) на части в пределах одних суток МСК.
+    """
+    periods = []
+    day_start = start_time_period.astimezone(MSK)
+    end_time_period = end_time_period.astimezone(MSK)
+    while day_start <= end_time_period:
+        day_end = min(datetime.combine(day_start.date(), dtime(23, 59, 59), tzinfo=MSK), end_time_period)
+        periods.append((day_start, day_end))
+        day_start = datetime.combine(day_start.date() + timedelta(days=1), dtime(0), tzinfo=MSK)
+    return periods
+
+
+class PipelineDaemon:
+    """
+    Резидентный режим пайплайна: расписание запусков внутри процесса вместо cron.
+
+    Клиенты OpenAI/RetailCRM, справочник статусов, кэш последних заказов и набор уже проанализированных
+    заказов живут между запусками. По SIGTERM/SIGINT текущий запуск дорабатывает, новые не начинаются.
+    """
+
+    def __init__(self, micro_batch_minutes: int = MICRO_BATCH_MINUTES, state_path: Path = DAEMON_STATE_PATH):
+        self.micro_batch_minutes = micro_batch_minutes
+        self.state_path = state_path
+        self.scheduler = schedule.Scheduler()
+        # Время запуска по МСК -> ближайший момент запуска (см. run_due_windows)
+        self._window_runs: Dict[dtime, datetime] = {}
+        self._stop = threading.Event()
+        self.order_links = OrderLinksCache()
+
+    def warm_up(self):
+        """
+        Заранее загружает справочник статусов, ссылки из таблицы и зеркало RetailCRM (если включено),
+        чтобы первый запуск не тратил на это время. Первая полная выгрузка зеркала идет в фоне:
+        пока она не закончена, поиск заказов идет напрямую в RetailCRM.
+        """
+        logger.info("🔥 Прогрев кэшей: справочник статусов RetailCRM и ссылки на проанализированные заказы...")
+        get_analyzable_status_codes()
+        self.order_links.get()
+        threading.Thread(target=get_mirror, kwargs={"bootstrap": True}, name="crm-mirror-bootstrap",
+                         daemon=True).start()
+
+    def _run_period(self, start_time_period: datetime, end_time_period: datetime, target_folder_date_str: str):
+        start_run_metrics()
+        start_background_retention()
+        prune_checkpoints()
+
+        with timed_stage("total"):
+            # Окна, прерванные сбоем (в том числе до перезапуска демона), дорабатываются в первую очередь
+            if incomplete_checkpoints():
+                self.order_links.add(resume_incomplete_windows(self.order_links.get()))
+            sent_order_links = process_period(start_time_period, end_time_period, target_folder_date_str,
+                                              self.order_links.get())
+        self.order_links.add(sent_order_links)
+        export_run_metrics(extra={"model_routing": routing_stats(), "costs": run_summary(),
+                                  "circuits": circuit_states()})
+
+    def run_window(self, run_time: dtime, run_at: Optional[datetime] = None):
+        """
+        Запуск по расписанию: обрабатывает окно, которое заканчивается в run_time.
+        Окно считается от запланированного момента run_at, а не фактического времени, поэтому задержка запуска
+        его не сдвигает — даже если запуск, назначенный до полуночи, начался после нее.
+        """
+        run_at = run_at or datetime.combine(datetime.now(MSK).date(), run_time, tzinfo=MSK)
+        window = resolve_processing_window(run_at)
+        if not window:
+            logger.warning(f"⚠️ Для запуска в {run_time.strftime('%H:%M')} МСК не найдено окно обработки.")
+            return
+        logger.info(f"⏰ Запуск по расписанию ({run_time.strftime('%H:%M')} МСК).")
+        self._run_period(*window)
+        logger.info("✅ Пайплайн обработки звонков завершен.")
+
+    def run_micro_batch(self):
+        """
+        Обрабатывает звонки с конца прошлой пачки до (сейчас - MICRO_BATCH_LAG_MINUTES).
+        """
+        now = datetime.now(MSK)
+        end_time_period = (now - timedelta(minutes=MICRO_BATCH_LAG_MINUTES)).replace(microsecond=0)
+        last_end = self._load_last_end()
+        start_time_period = last_end + timedelta(seconds=1) if last_end else \
+            end_time_period - timedelta(minutes=self.micro_batch_minutes)
+        start_time_period = max(start_time_period, now - timedelta(hours=MICRO_BATCH_MAX_LOOKBACK_HOURS))
+        if start_time_period >= end_time_period:
+            return
+
+        logger.info("⏱ Микропакет звонков.")
+        # Пачка через полночь делится по дням начала звонков: каждый звонок попадает в папку своего дня
+        for day_start, day_end in _split_by_day(start_time_period, end_time_period):
+            self._run_period(day_start, day_end, day_start.strftime("%d.%m.%Y"))
+        self._save_last_end(end_time_period)
+
+    def _load_last_end(self) -> Optional[datetime]:
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return datetime.fromisoformat(json.load(f)["last_end"]).astimezone(MSK)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать состояние демона {self.state_path}: {e}")
+            return None
+
+    def _save_last_end(self, last_end: datetime):
+        artifacts.write_json(self.state_path, {"last_end": last_end.isoformat()}, checksum=False)
+
+    def _guarded(self, job, *args):
+        """
+        Ошибка одного запуска не должна останавливать демон.
+        """
+        def run():
+            if self._stop.is_set():
+                return
+            try:
+                job(*args)
+            except Exception:
+                logger.exception("❌ Запуск пайплайна завершился ошибкой.")
+        return run
+
+    def schedule_jobs(self):
+        if self.micro_batch_minutes > 0:
+            self.scheduler.every(self.micro_batch_minutes).minutes.do(self._guarded(self.run_micro_batch))
+            logger.info(f"📅 Микропакеты каждые {self.micro_batch_minutes} мин. (отставание {MICRO_BATCH_LAG_MINUTES} мин.).")
+            return
+        now = datetime.now(MSK)
+        for run_time in parse_run_times():
+            self._window_runs[run_time] = _next_run_at(run_time, now)
+            logger.info(f"📅 Запуск в {run_time.strftime('%H:%M')} МСК "
+                        f"(ближайший {self._window_runs[run_time].strftime('%d.%m %H:%M')} МСК).")
+        # Наступление запусков проверяется по часам МСК на каждом такте
+        self.scheduler.every(MAX_IDLE_WAIT_SECONDS).seconds.do(self.run_due_windows)
+
+    def run_due_windows(self):
+        """
+        Запускает окна, время которых по МСК наступило, и переносит их на следующий день.
+        """
+        now = datetime.now(MSK)
+        for run_time, run_at in sorted(self._window_runs.items()):
+            if now >= run_at:
+                self._window_runs[run_time] = _next_run_at(run_time, now)
+                self._guarded(self.run_window, run_time, run_at)()
+
+    def stop(self, signum=None, frame=None):
+        logger.info("🛑 Получен сигнал остановки: текущий запуск будет завершен, новые не начнутся.")
+        self._stop.set()
+
+    def run_forever(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.warm_up()
+        self.schedule_jobs()
+        if self.micro_batch_minutes > 0:
+            self._guarded(self.run_micro_batch)()
+
+        while not self._stop.is_set():
+            self.scheduler.run_pending()
+            idle_seconds = self.scheduler.idle_seconds
+            wait = MAX_IDLE_WAIT_SECONDS if idle_seconds is None else min(max(idle_seconds, 0), MAX_IDLE_WAIT_SECONDS)
+            self._stop.wait(wait)
+        logger.info("👋 Демон остановлен.")
+
+
+if __name__ == "__main__":
+    setup_logging()
+    logger.info("🚀 Запуск пайплайна в режиме демона...")
+    if METRICS_PORT:
+        start_metrics_server(int(METRICS_PORT))
+    PipelineDaemon().run_forever()
@@ -0,0 +1,143 @@
+import os
+import html
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import List, Dict, Any
+
+from dotenv import load_dotenv
+
+from analyzer import CRITERIA
+from telegram_bot_integration import TelegramDocument
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Отчеты в Telegram: "window" — одна сводка на окно обработки и документ со всеми звонками,
+# "per_call" — отдельный отчет на каждый звонок (как раньше)
+TELEGRAM_REPORT_MODE = os.getenv("TELEGRAM_REPORT_MODE", "window")
+# Сколько звонков на одной странице документа со звонками окна
+DIGEST_PAGE_SIZE = int(os.getenv("DIGEST_PAGE_SIZE", "20"))
+# Сколько самых частых невыполненных критериев показывать у каждого менеджера в сводке
+DIGEST_TOP_FAILURES = 3
+
+
+def summary_html(summary: str) -> str:
+    """
+    Резюме — ответ модели, в нем может быть речь клиента: все экранируется, кроме тегов <b> и </b>,
+    которые промпт разрешает для выделения.
+    """
+    return html.escape(summary).replace("&lt;b&gt;", "<b>").replace("&lt;/b&gt;", "</b>")
+
+
+def criterion_label(key: str) -> str:
+    return key.replace("_", " ")
+
+
+class DigestEntry:
+    """
+    Звонок окна в отчете: данные для сводки по менеджерам и для страницы документа.
+    """
+
+    def __init__(self, call_number: Any, category: str, manager: str, phone: str, start_time: str,
+                 call_type: str, order_link: str, record_link: str, summary: str, analysis: Dict[str, Any]):
+        self.call_number = call_number
+        self.category = category
+        self.manager = manager
+        self.phone = phone
+        self.start_time = start_time
+        self.call_type = call_type
+        self.order_link = order_link
+        self.record_link = record_link
+        self.summary = summary
+        self.failed_criteria = [key for key in CRITERIA if analysis.get(key) == -1] if category == "Заказ" else []
+
+
+class WindowDigest:
+    """
+    Отчет по окну обработки: одно короткое сообщение со сводкой (звонки по категориям, невыполненные критерии
+    по менеджерам) и HTML-документ с постраничным списком звонков окна (ссылки на заказ и запись, резюме).
+    Вместо отчета на каждый звонок каждому получателю уходят два запроса к Telegram на окно.
+    """
+
+    def __init__(self, title: str):
+        self.title = title
+        self.entries: List[DigestEntry] = []
+
+    def add(self, entry: DigestEntry):
+        self.entries.append(entry)
+
+    def render_message(self) -> str:
+        categories = Counter(entry.category for entry in self.entries)
+        lines = [f"📊 <b>{html.escape(self.title)}</b>",
+                 "📞 Звонков: <b>{}</b> ({})".format(
+                     len(self.entries), ", ".join(f"{category}: {count}" for category, count in categories.items())),
+                 ""]
+
+        by_manager: Dict[str, List[DigestEntry]] = {}
+        for entry in self.entries:
+            by_manager.setdefault(entry.manager, []).append(entry)
+        for manager, entries in sorted(by_manager.items(), key=lambda item: -len(item[1])):
+            orders = [entry for entry in entries if entry.category == "Заказ"]
+            failures = Counter(key for entry in orders for key in entry.failed_criteria)
+            line = f"👤 <b>{html.escape(manager)}</b> — звонков: {len(entries)}, заказов: {len(orders)}"
+            if failures:
+                top = ", ".join(f"{criterion_label(key)} ✗{count}"
+                                for key, count in failures.most_common(DIGEST_TOP_FAILURES))
+                line += f"\n    ❗ {top}"
+            elif orders:
+                line += "\n    ✅ без невыполненных критериев"
+            lines.append(line)
+
+        lines += ["", "📎 Звонки с резюме и ссылками — в документе ниже."]
+        return "\n".join(lines)
+
+    def render_document(self) -> bytes:
+        """
+        HTML-документ со звонками окна, по DIGEST_PAGE_SIZE звонков на страницу (разрыв страницы при печати
+        и навигация по страницам).
+        """
+        pages = [self.entries[start:start + DIGEST_PAGE_SIZE]
+                 for start in range(0, len(self.entries), DIGEST_PAGE_SIZE)] or [[]]
+        navigation = " ".join(f'<a href="#page{number}">{number}</a>' for number in range(1, len(pages) + 1))
+        parts = ['<!DOCTYPE html><html lang="ru"><head><meta charset="utf-8">',
+                 f"<title>{html.escape(self.title)}</title>",
+                 "<style>body{font-family:sans-serif;max-width:900px;margin:auto}"
+                 "section{page-break-after:always}article{border-bottom:1px solid #ccc;padding:8px 0}"
+                 ".failed{color:#b00}</style></head><body>",
+                 f"<h1>{html.escape(self.title)}</h1>"]
+        for number, page in enumerate(pages, start=1):
+            parts.append(f'<section id="page{number}"><p>Страница {number} из {len(pages)}: {navigation}</p>')
+            for entry in page:
+                links = []
+                if entry.order_link:
+                    links.append(f'<a href="{html.escape(entry.order_link)}">Посмотреть заказ</a>')
+                if entry.record_link:
+                    links.append(f'<a href="{html.escape(entry.record_link)}">Прослушать звонок</a>')
+                parts.append(
+                    f"<article><h3>Звонок №{html.escape(str(entry.call_number))} — {html.escape(entry.category)}</h3>"
+                    f"<p>🗓️ {html.escape(entry.start_time or 'Неизвестно')} | {html.escape(entry.call_type)}<br>"
+                    f"👤 Менеджер: <b>{html.escape(entry.manager)}</b><br>"
+                    f"📱 Телефон клиента: {html.escape(entry.phone or 'Неизвестен')}<br>"
+                    f"{' | '.join(links) or 'Ссылки не найдены'}</p>")
+                if entry.failed_criteria:
+                    parts.append(f'<p class="failed">Не выполнено: '
+                                 f'{html.escape(", ".join(map(criterion_label, entry.failed_criteria)))}</p>')
+                parts.append(f"<div>{summary_html(entry.summary)}</div></article>")
+            parts.append("</section>")
+        parts.append("</body></html>")
+        return "".join(parts).encode("utf-8")
+
+    def enqueue(self, telegram_queue) -> bool:
+        """
+        Ставит сводку и документ в очередь доставки Telegram. Возвращает False, если звонков в отчете нет.
+        """
+        if not self.entries:
+            return False
+        telegram_queue.enqueue(self.render_message())
+        filename = f"звонки_{datetime.now().strftime('%d.%m.%Y_%H%M')}.html"
+        telegram_queue.enqueue_document(TelegramDocument(filename, self.render_document(),
+                                                         caption=f"📎 {html.escape(self.title)}"))
+        logger.info(f"📰 Отчет по окну: {len(self.entries)} звонков в одной сводке и документе.")
+        return True
@@ -1,39 +1,66 @@
 import os
+import logging
 import json
+import threading
+import contextvars
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
+from typing import Dict, Any, Optional, Set
 import re
 
+from metrics import track_request, record_retry
+from circuit_breaker import get_breaker, ensure_available, CircuitOpenError
+from log_config import setup_logging, log_context
+import artifacts
+from call_store import CallStore
+
+logger = logging.getLogger(__name__)
+
 # Убедитесь, что telegram_bot_integration.py находится в той же директории или в PYTHONPATH
 try:
-    from telegram_bot_integration import send_telegram_message
+    from telegram_bot_integration import send_telegram_message, TelegramDeliveryQueue
+    from digest import WindowDigest, DigestEntry, TELEGRAM_REPORT_MODE
 except ImportError:
-    print("ВНИМАНИЕ: Модуль telegram_bot_integration не найден. Убедитесь, что он существует и доступен.")
+    logger.info("ВНИМАНИЕ: Модуль telegram_bot_integration не найден. Убедитесь, что он существует и доступен.")
 
 
     def send_telegram_message(message: str):
-        print(f"  ⚠️ Заглушка: send_telegram_message не реализована. Сообщение: {message}")
+        logger.warning(f"  ⚠️ Заглушка: send_telegram_message не реализована. Сообщение: {message}")
+
+
+    class TelegramDeliveryQueue:
+        def enqueue(self, message: str):
+            send_telegram_message(message)
+
+        def flush(self):
+            pass
+
+
+    TELEGRAM_REPORT_MODE = "per_call"
 
 # ИЗМЕНЕНИЕ: Добавлен импорт get_last_order_link_for_check
 try:
     from retailcrm_integration import get_manager_name_from_crm, get_last_order_link_for_check
 except ImportError:
-    print(
+    logger.info(
         "ВНИМАНИЕ: Модуль retailcrm_integration не найден или функции не определены. Убедитесь, что он существует и доступен.")
 
 
     def get_manager_name_from_crm(phone_number: str) -> str:
-        print("  ⚠️ Заглушка: retailcrm_integration.get_manager_name_from_crm не реализована. Возвращаем 'Неизвестно'.")
+        logger.warning("  ⚠️ Заглушка: retailcrm_integration.get_manager_name_from_crm не реализована. Возвращаем 'Неизвестно'.")
         return "Неизвестно"
 
     # ДОБАВЛЕНА ЗАГЛУШКА: для корректной работы новой логики
     def get_last_order_link_for_check(phone_number: str) -> str:
-        print("  ⚠️ Заглушка: retailcrm_integration.get_last_order_link_for_check не реализована. Возвращаем None.")
+        logger.warning("  ⚠️ Заглушка: retailcrm_integration.get_last_order_link_for_check не реализована. Возвращаем None.")
         return None
 
 # URL вашей Google Forms
-FORM_URL = "https://docs.google.com/forms/u/0/d/e/1FAIpQLSeI-BvmkSZgzGXeQB83KQLR0O-5_ALgdhWg9LoMV7DskLqBLQ/formResponse"
+FORM_URL = os.getenv("FORM_URL",
+                     "https://docs.google.com/forms/u/0/d/e/1FAIpQLSeI-BvmkSZgzGXeQB83KQLR0O-5_ALgdhWg9LoMV7DskLqBLQ/formResponse")
 
 # Соответствие полей анализа и названий полей в Google Forms
 ENTRY_MAP = {
@@ -62,6 +89,25 @@ ENTRY_MAP = {
     "ссылка_на_звонок": "entry.1098563992"
 }
 
+# --- ПАРАМЕТРЫ ОЧЕРЕДИ ОТПРАВКИ В GOOGLE FORMS ---
+# Небольшой пул потоков: Google Forms не любит большой параллелизм с одного IP
+FORM_SUBMIT_WORKERS = int(os.getenv("FORM_SUBMIT_WORKERS", "4"))
+# (connect, read) таймауты одного POST-запроса
+FORM_SUBMIT_TIMEOUT = (5, 20)
+FORM_SUBMIT_MAX_RETRIES = 3
+FORM_SUBMIT_RETRY_DELAY = 1  # Начальная задержка, удваивается с каждой попыткой
+# HTTP-статусы, при которых запись гарантированно не принята и её можно безопасно повторить
+FORM_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Куда писать строки анализа: "form" — по одной через Google Forms, "sheets_api" — одной пачкой через
+# spreadsheets.values.append (см. google_sheets_api.py)
+ANALYSIS_SINK = os.getenv("ANALYSIS_SINK", "form")
+
+# Локальный журнал отправленных записей: ключ идемпотентности -> время отправки.
+# Лежит в корне analyses/, т.к. эта папка смонтирована как volume и не удаляется очисткой (она удаляет только подпапки).
+FORM_SUBMISSIONS_LEDGER = Path("analyses") / "form_submissions.json"
+FORM_SUBMISSIONS_LEDGER_DAYS = 30
+
 # Расширения для менеджеров (больше не используются для поля 'phone', но оставлены, если нужны в другом месте)
 EXTENSIONS = {
     "Анастасия": "35",
@@ -76,12 +122,228 @@ EXTENSIONS = {
 }
 
 
-def get_call_number_from_filename(filename: str) -> int:
+class SubmissionLedger:
+    """
+    Локальный журнал отправленных записей: ключ идемпотентности -> время отправки.
+    Потокобезопасен, пишет файл атомарно (через временный файл с fsync и os.replace).
+    Запись может принадлежать владельцу (record(..., owner=...)): тогда значение — "<время> <владелец>".
+    """
+
+    def __init__(self, ledger_path: Path = FORM_SUBMISSIONS_LEDGER):
+        self.ledger_path = ledger_path
+        self._lock = threading.Lock()
+        self._entries = self._load() or {}
+
+    def _load(self) -> Optional[Dict[str, str]]:
+        """
+        Журнал с диска без устаревших записей; None, если файл не удалось прочитать.
+        """
+        if not self.ledger_path.exists():
+            return {}
+        try:
+            with open(self.ledger_path, "r", encoding="utf-8") as f:
+                ledger = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать журнал отправок {self.ledger_path}: {e}. Используем журнал в памяти.")
+            return None
+
+        # Удаляем устаревшие записи, чтобы журнал не рос бесконечно
+        cutoff = (datetime.now() - timedelta(days=FORM_SUBMISSIONS_LEDGER_DAYS)).isoformat()
+        return {key: sent_at for key, sent_at in ledger.items() if sent_at >= cutoff}
+
+    def _save(self):
+        # Вызывается под self._lock
+        artifacts.write_json(self.ledger_path, self._entries, checksum=False)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def reload(self):
+        """
+        Перечитывает журнал с диска: его могли дописать другие процессы (демон, приемник вебхуков).
+        """
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        # Вызывается под self._lock. Журнал на диске — источник истины: каждая запись сохраняется сразу,
+        # а удаленные другими процессами записи (release) не должны возвращаться из памяти
+        entries = self._load()
+        if entries is not None:
+            self._entries = entries
+
+    def owner(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key, "")
+        return value.split(" ", 1)[1] if " " in value else None
+
+    def record(self, *keys: str, owner: Optional[str] = None):
+        with self._lock:
+            sent_at = datetime.now().isoformat()
+            value = f"{sent_at} {owner}" if owner else sent_at
+            # Сначала подхватываем записи других процессов, чтобы не затереть их при сохранении
+            self._sync()
+            for key in keys:
+                self._entries[key] = value
+            self._save()
+
+    def release(self, owner: str) -> int:
+        """
+        Удаляет записи владельца. Возвращает число удаленных записей.
+        """
+        with self._lock:
+            self._sync()
+            keys = [key for key, value in self._entries.items() if value.endswith(f" {owner}")]
+            for key in keys:
+                del self._entries[key]
+            if keys:
+                self._save()
+            return len(keys)
+
+
+class FormSubmissionQueue:
+    """
+    Очередь отправки строк в Google Forms с небольшим пулом потоков, общей HTTP-сессией,
+    таймаутами и повторами с экспоненциальной задержкой.
+
+    Каждая запись имеет ключ идемпотентности (ссылка на заказ или communication_id).
+    Успешно отправленные ключи сохраняются в локальный журнал, поэтому ни повторная попытка,
+    ни следующий запуск не отправят ту же запись второй раз. После close() в confirmed — ключи записей,
+    которые точно есть в таблице: отправленные сейчас и пропущенные как отправленные ранее.
+    """
+
+    def __init__(self, ledger: Optional[SubmissionLedger] = None, workers: int = FORM_SUBMIT_WORKERS):
+        self.ledger = ledger if ledger is not None else SubmissionLedger()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="forms")
+        self._lock = threading.Lock()
+        self._futures = []
+        self.confirmed: Set[str] = set()
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def is_submitted(self, key: str) -> bool:
+        return key in self.ledger
+
+    def submit(self, key: str, payload: Dict[str, Any], label: str) -> bool:
+        """
+        Ставит запись в очередь на отправку. Возвращает False, если запись с таким ключом уже отправлялась.
+        """
+        if self.is_submitted(key):
+            logger.info(f"⏭ Запись {label} уже отправлена ранее (ключ {key}). Пропускаем повторную отправку в Google Forms.")
+            with self._lock:
+                self.skipped += 1
+                self.confirmed.add(key)
+            return False
+        # Контекст логирования (communication_id звонка) переносится в поток пула
+        context = contextvars.copy_context()
+        self._futures.append(self._executor.submit(context.run, self._post_with_retry, key, payload, label))
+        return True
+
+    def _count_failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def _post_with_retry(self, key: str, payload: Dict[str, Any], label: str) -> bool:
+        retry_delay = FORM_SUBMIT_RETRY_DELAY
+        breaker = get_breaker("google_forms")
+        for attempt in range(FORM_SUBMIT_MAX_RETRIES):
+            try:
+                breaker.before_request()
+                with track_request("google_forms", "submit"):
+                    response = self.session.post(FORM_URL, data=payload, timeout=FORM_SUBMIT_TIMEOUT)
+            except CircuitOpenError as e:
+                # Google Forms недоступен: запись не отправлена и не попала в журнал, ее отправит следующий запуск
+                logger.error(f"[✗] Запись {label} не отправлена: {e}.")
+                self._count_failure()
+                return False
+            except requests.exceptions.ReadTimeout as e:
+                breaker.record(failed=True)
+                # Запрос мог дойти до Google, поэтому не повторяем его: повтор может создать дубль.
+                # Если строка всё же записалась, следующий запуск увидит ссылку на заказ в таблице.
+                logger.error(f"[✗] Таймаут ответа Google Forms для {label}: {e}. Повтор не выполняется во избежание дубля.")
+                self._count_failure()
+                return False
+            except requests.exceptions.RequestException as e:
+                breaker.record(failed=True)
+                # Ошибки соединения: запрос не был доставлен, повтор безопасен
+                status_info = f"ошибка сети: {e}"
+            else:
+                breaker.record(failed=response.status_code >= 500)
+                if response.status_code == 200:
+                    self.ledger.record(key)
+                    with self._lock:
+                        self.sent += 1
+                        self.confirmed.add(key)
+                    logger.info(f"[✓] Отправлено в Google Forms: {label}")
+                    return True
+                if response.status_code not in FORM_RETRYABLE_STATUSES:
+                    logger.error(
+                        f"[✗] Ошибка отправки в Google Forms: {label} — Status {response.status_code}. Ответ: {response.text[:500]}")
+                    self._count_failure()
+                    return False
+                status_info = f"HTTP {response.status_code}"
+
+            if attempt < FORM_SUBMIT_MAX_RETRIES - 1:
+                record_retry("google_forms", "submit")
+                logger.warning(
+                    f"⚠️ Не удалось отправить {label} в Google Forms (попытка {attempt + 1}/{FORM_SUBMIT_MAX_RETRIES}): {status_info}. Повтор через {retry_delay} сек...")
+                time.sleep(retry_delay)
+                retry_delay *= 2
+
+        logger.error(f"[✗] Ошибка отправки в Google Forms: {label} после {FORM_SUBMIT_MAX_RETRIES} попыток.")
+        self._count_failure()
+        return False
+
+    def close(self):
+        """
+        Дожидается завершения всех отправок и освобождает ресурсы.
+        """
+        for future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"❌ Непредвиденная ошибка в очереди отправки Google Forms: {e}")
+                self._count_failure()
+        self._executor.shutdown(wait=True)
+        self.session.close()
+        logger.info(
+            f"📤 Google Forms: отправлено {self.sent}, ошибок {self.failed}, пропущено как уже отправленные {self.skipped}.")
+
+
+def create_analysis_sink():
+    """
+    Создаёт приёмник строк анализа согласно ANALYSIS_SINK.
+    """
+    ledger = SubmissionLedger()
+    if ANALYSIS_SINK == "sheets_api":
+        from google_sheets_api import SheetsApiSink
+        return SheetsApiSink(list(ENTRY_MAP.values()), ledger)
+    return FormSubmissionQueue(ledger)
+
+
+def get_submission_key(order_link: str, communication_id: Optional[Any], fallback: str) -> str:
     """
-    Извлекает числовой идентификатор звонка из имени файла.
-    Например, для 'call12_79163850107_analysis.json' вернет 12.
+    Формирует ключ идемпотентности записи: ссылка на заказ, иначе communication_id, иначе имя файла.
     """
-    match = re.match(r'call(\d+)_.*_analysis\.json', filename)
+    if order_link:
+        return order_link
+    if communication_id:
+        return f"call:{communication_id}"
+    return f"file:{fallback}"
+
+
+def get_call_number_from_stem(stem: str) -> int:
+    """
+    Извлекает числовой идентификатор звонка из базового имени его файлов.
+    Например, для 'call12_79163850107' вернет 12.
+    """
+    match = re.match(r'call(\d+)', stem)
     if match:
         return int(match.group(1))
     return 0
@@ -99,73 +361,77 @@ def format_duration(seconds: int) -> str:
 
 
 # ИЗМЕНЕНИЕ: Добавлен параметр existing_order_links
-def send_analyses_to_google_form(folder_path: Path, target_folder_date_str: str, existing_order_links: set):
+def send_analyses_to_google_form(target_folder_date_str: str, existing_order_links: set,
+                                 only_stems: Optional[set] = None, report_title: Optional[str] = None,
+                                 forms: bool = True, telegram: bool = True) -> set:
     """
     Отправляет данные анализа звонков в Google Forms и краткое резюме в Telegram,
     учитывая категорию звонка. Также выполняет финальную проверку на дублирование.
+    Анализы, информация о звонках и транскрипты читаются из хранилища за дату (call_store.py).
 
     Args:
-        folder_path (Path): Путь к папке с JSON-файлами анализа.
         target_folder_date_str (str): Строка с датой папки, которую обрабатываем (например, "25.06.2025").
         existing_order_links (set): Множество ссылок на заказы, уже проанализированные в прошлых циклах.
+        only_stems (set): Если задано — отправлять только анализы звонков с этими базовыми именами (звонки текущего запуска).
+        report_title (str): Заголовок отчета по окну в Telegram (режим TELEGRAM_REPORT_MODE=window).
+        forms (bool): Отправлять анализы в Google Forms (False — только отчет в Telegram).
+        telegram (bool): Отправлять отчеты в Telegram (False — только Google Forms; в режиме очереди
+            отчет по окну отправляется отдельной задачей, когда обработаны все звонки окна).
+
+    Returns:
+        set: Ссылки на заказы, запись которых в таблицу подтверждена в этом цикле (отправлена сейчас
+            или ранее). Ссылки неотправленных записей не возвращаются: их отправит следующий запуск.
     """
-    # НОВЫЙ НАБОР: для отслеживания отправленных ссылок в ТЕКУЩЕМ цикле
-    sent_order_links_in_current_run = set()
-
-    # Используем переданную дату для формирования пути к папкам audio и transcripts
-    audio_calls_folder = Path("audio") / f"звонки_{target_folder_date_str}"
-    transcripts_folder = Path("transcripts") / f"транскрибация_{target_folder_date_str}"
-
-    analysis_files = []
-    for filename in os.listdir(folder_path):
-        if filename.endswith("_analysis.json"):
-            analysis_files.append(filename)
-
-    analysis_files.sort(key=get_call_number_from_filename)
-
-    for filename in analysis_files:
-        base_name = filename.replace("_analysis.json", "")
-        analysis_path = folder_path / filename
-        info_path = audio_calls_folder / f"{base_name}_call_info.json"
-        # Путь к файлу транскрипции
-        transcript_file_path = transcripts_folder / f"{base_name}.txt"
-
-        call_summary = ""
-        analysis_data = {}
-        call_category = "Неизвестно"
-        call_number_from_file = get_call_number_from_filename(filename)
-        # Инициализируем ссылку на заказ здесь, чтобы использовать её ниже
-        order_link = ""
+    # НОВЫЙ НАБОР: для отслеживания поставленных в отправку ссылок в ТЕКУЩЕМ цикле (защита от дублей)
+    queued_order_links_in_current_run = set()
+    # Ключ идемпотентности -> ссылка на заказ, для отбора подтвержденных после отправки
+    order_links_by_key: Dict[str, str] = {}
+    # Записи всех этапов читаются из хранилища одним проходом по каждому журналу, а не по три файла на звонок
+    store = CallStore(target_folder_date_str)
+    communication_ids = store.ids_for_stems(only_stems) if only_stems is not None else None
+    try:
+        analyses = list(store.analyses.read(communication_ids))
+        call_infos = {record["communication_id"]: record for record in
+                      store.calls.read([record["communication_id"] for record in analyses])}
+        transcripts = {record["communication_id"]: record["text"] for record in
+                       store.transcripts.read([record["communication_id"] for record in analyses])}
+    except artifacts.ArtifactCorruptedError as e:
+        logger.error(f"Ошибка чтения хранилища {store.dir}: {e}. Отправка пропущена.")
+        return set()
+
+    analyses.sort(key=lambda record: get_call_number_from_stem(record["stem"]))
+
+    # Отправка идёт через очередь (Google Forms в фоне) или пачкой через Sheets API в конце,
+    # чтобы один медленный ответ не тормозил весь запуск
+    form_queue = create_analysis_sink() if forms else None
+    # Отчеты в Telegram копятся и рассылаются в конце: параллельно по получателям, с учётом лимитов Telegram
+    telegram_queue = TelegramDeliveryQueue()
+    # В режиме окна звонки собираются в один отчет (сводка + документ), а не отправляются по одному
+    window_digest = WindowDigest(report_title or f"Звонки за {target_folder_date_str}") \
+        if telegram and TELEGRAM_REPORT_MODE == "window" else None
+
+    for analysis_record in analyses:
+        base_name = analysis_record["stem"]
+        filename = f"{base_name}_analysis.json"
+        communication_id = analysis_record["communication_id"]
+
+        analysis_data = analysis_record["analysis"]
+        call_summary = analysis_data.get("summary", "")
+        call_category = analysis_data.get("call_category", "Неизвестно")
+        call_number_from_file = get_call_number_from_stem(base_name)
+        # НОВОЕ: Считываем ссылку на заказ прямо из анализа (должна быть там после шага 2)
+        order_link = analysis_data.get("order_link", "")
         contact_phone_number = ""
         phone_to_send = ""
 
-        try:
-            with open(analysis_path, "r", encoding="utf-8") as f:
-                analysis_data = json.load(f)
-                call_summary = analysis_data.get("summary", "")
-                call_category = analysis_data.get("call_category", "Неизвестно")
-                # НОВОЕ: Считываем ссылку на заказ прямо из файла анализа (должна быть там после шага 2)
-                order_link = analysis_data.get("order_link", "")
-
-        except FileNotFoundError:
-            print(f"Предупреждение: Файл анализа не найден для {base_name}: {analysis_path}. Пропуск.")
-            continue
-        except json.JSONDecodeError as e:
-            print(f"Ошибка декодирования JSON для {analysis_path}: {e}. Пропуск.")
-            continue
-        except Exception as e:
-            print(f"Ошибка при чтении или обработке {analysis_path}: {e}. Пропуск.")
-            continue
-
         start_time = ""
         call_type_with_duration = "Неизвестно"
         record_link = ""
         transcript_content = ""
 
-        if info_path.exists():
+        call_info = call_infos.get(communication_id)
+        if call_info:
             try:
-                with open(info_path, "r", encoding="utf-8") as f:
-                    call_info = json.load(f)
 
                 start_time = call_info.get("start_time", "")
                 direction = call_info.get("raw", {}).get("direction", "")
@@ -185,39 +451,32 @@ def send_analyses_to_google_form(folder_path: Path, target_folder_date_str: str,
                 if not contact_phone_number:
                     contact_phone_number = call_info.get("raw", {}).get("contact_phone_number", "")
 
-            except json.JSONDecodeError as e:
-                print(f"Ошибка декодирования JSON для {info_path}: {e}")
             except Exception as e:
-                print(f"Ошибка при чтении или обработке {info_path}: {e}")
+                logger.error(f"Ошибка при обработке информации о звонке {base_name}: {e}")
         else:
-            print(f"Предупреждение: Файл информации о звонке не найден для {base_name}: {info_path}")
+            logger.warning(f"Предупреждение: Информация о звонке не найдена для {base_name}")
 
-        # Чтение содержимого транскрипции
-        if transcript_file_path.exists():
-            try:
-                with open(transcript_file_path, "r", encoding="utf-8") as f:
-                    transcript_content = f.read()
-            except Exception as e:
-                print(f"Ошибка при чтении файла транскрипции {transcript_file_path}: {e}")
-        else:
-            print(f"Предупреждение: Файл транскрипции не найден для {base_name}: {transcript_file_path}")
+        # Содержимое транскрипции
+        transcript_content = transcripts.get(communication_id, "")
+        if not transcript_content:
+            logger.warning(f"Предупреждение: Транскрипт не найден для {base_name}")
 
         # --- Логика получения имени менеджера из CRM, если оно "Неизвестно" ---
         manager = analysis_data.get("manager_name", "Неизвестно")
         phone_to_send = contact_phone_number
 
-        phone_number_match = re.search(r'call\d+_(\d+)_analysis\.json', analysis_path.name)
+        phone_number_match = re.search(r'call\d+_(\d+)', base_name)
         phone_number_from_filename = phone_number_match.group(1) if phone_number_match else None
 
         if manager == "Неизвестно" and phone_number_from_filename:
-            print(
-                f"  🔍 Менеджер не определен для {analysis_path.name}. Попытка получить из RetailCRM по номеру {phone_number_from_filename}...")
+            logger.info(
+                f"  🔍 Менеджер не определен для {filename}. Попытка получить из RetailCRM по номеру {phone_number_from_filename}...")
             crm_manager_name = get_manager_name_from_crm(phone_number_from_filename)
             if crm_manager_name:
                 manager = crm_manager_name
-                print(f"  ✅ Имя менеджера обновлено на: {crm_manager_name} (из RetailCRM)")
+                logger.info(f"  ✅ Имя менеджера обновлено на: {crm_manager_name} (из RetailCRM)")
             else:
-                print(f"  ❌ Не удалось получить имя менеджера из RetailCRM для {analysis_path.name}")
+                logger.error(f"  ❌ Не удалось получить имя менеджера из RetailCRM для {filename}")
 
         # --- НОВАЯ ФИНАЛЬНАЯ ПРОВЕРКА ПЕРЕД ОТПРАВКОЙ (Проверка на дублирование) ---
 
@@ -231,20 +490,20 @@ def send_analyses_to_google_form(folder_path: Path, target_folder_date_str: str,
             # Проверка A (Безопасность): Была ли ссылка уже в таблице (из прошлых запусков)?
             # Этот звонок не должен был попасть сюда (фильтр на Шаге 2), но это гарантия.
             if order_link in existing_order_links:
-                print(
+                logger.info(
                     f"  ❌ ФИНАЛЬНЫЙ ФИЛЬТР (A): Заказ {order_link} УЖЕ ЕСТЬ в Google Sheets. Пропускаем анализ {filename}."
                 )
                 continue
 
             # Проверка B (ВАЖНО): Был ли заказ уже отправлен в ТЕКУЩЕМ цикле?
-            if order_link in sent_order_links_in_current_run:
-                print(
+            if order_link in queued_order_links_in_current_run:
+                logger.info(
                     f"  ❌ ФИНАЛЬНЫЙ ФИЛЬТР (B): Заказ {order_link} УЖЕ ОТПРАВЛЕН в этом цикле. Пропускаем анализ {filename}."
                 )
                 continue
 
         # --- Логика отправки в Google Forms ---
-        if call_category == "Заказ":
+        if call_category == "Заказ" and form_queue is not None:
             payload = {
                 ENTRY_MAP["number"]: call_number_from_file,
                 ENTRY_MAP["name"]: manager,
@@ -261,23 +520,28 @@ def send_analyses_to_google_form(folder_path: Path, target_folder_date_str: str,
                                                     "manager_name", "транскрибация", "ссылка_на_звонок"]:
                     payload[ENTRY_MAP[key]] = analysis_data[key]
 
-            response = requests.post(FORM_URL, data=payload)
-            if response.status_code == 200:
-                print(f"[✓] Отправлено в Google Forms: {filename} (Категория: {call_category})")
+            submission_key = get_submission_key(order_link, communication_id, f"{target_folder_date_str}/{filename}")
+            with log_context(communication_id=communication_id, phone=phone_to_send):
+                form_queue.submit(submission_key, payload, f"{filename} (Категория: {call_category})")
 
-                # ДОБАВЛЕНИЕ ССЫЛКИ В СПИСОК ОТПРАВЛЕННЫХ ЗА ТЕКУЩИЙ ЦИКЛ
-                if order_link:
-                    sent_order_links_in_current_run.add(order_link)
-                    print(f"  ✅ Ссылка {order_link} добавлена в список отправленных за текущий цикл.")
-
-            else:
-                print(
-                    f"[✗] Ошибка отправки в Google Forms: {filename} — Status {response.status_code}. Ответ: {response.text}")
-        else:
-            print(f"⏩ Звонок {filename} (Категория: {call_category}). Пропуск отправки в Google Forms.")
+            # ДОБАВЛЕНИЕ ССЫЛКИ В СПИСОК ПОСТАВЛЕННЫХ В ОТПРАВКУ ЗА ТЕКУЩИЙ ЦИКЛ
+            # Ссылка фиксируется при постановке в очередь, чтобы параллельная отправка не создала дубль;
+            # отправленной она считается только после подтверждения (см. конец функции)
+            if order_link:
+                queued_order_links_in_current_run.add(order_link)
+                order_links_by_key[submission_key] = order_link
+                logger.info(f"  ✅ Ссылка {order_link} добавлена в список отправляемых за текущий цикл.")
+        elif call_category != "Заказ":
+            logger.info(f"⏩ Звонок {filename} (Категория: {call_category}). Пропуск отправки в Google Forms.")
 
         # --- Логика отправки резюме в Telegram ---
-        if call_summary and call_category in ["Заказ", "Сотрудничество"]:
+        if not telegram:
+            continue
+        if call_summary and call_category in ["Заказ", "Сотрудничество"] and window_digest is not None:
+            window_digest.add(DigestEntry(call_number_from_file, call_category, manager, phone_to_send, start_time,
+                                          call_type_with_duration, order_link, record_link, call_summary,
+                                          analysis_data))
+        elif call_summary and call_category in ["Заказ", "Сотрудничество"]:
             order_link_formatted = f'<a href="{order_link}">Посмотреть заказ</a>' if order_link else 'Не найдена'
             record_link_formatted = f'<a href="{record_link}">Прослушать звонок</a>' if record_link else 'Не найдена'
 
@@ -290,17 +554,32 @@ def send_analyses_to_google_form(folder_path: Path, target_folder_date_str: str,
                                f"🎧 Ссылка на запись: {record_link_formatted}\n\n" \
                                f"📝 <b>Резюме для РОПа:</b>\n{call_summary}"
 
-            # Обновлено: теперь send_telegram_message сама решает, куда отправлять.
-            send_telegram_message(telegram_message)
+            # Получателей определяет очередь доставки (как раньше send_telegram_message)
+            telegram_queue.enqueue(telegram_message)
         elif not call_summary:
-            print(f"ℹ️ Резюме для {filename} не найдено в анализе, в Telegram не отправлено.")
+            logger.info(f"ℹ️ Резюме для {filename} не найдено в анализе, в Telegram не отправлено.")
         else:
-            print(f"⏩ Звонок {filename} (Категория: {call_category}). Пропуск отправки резюме в Telegram.")
+            logger.info(f"⏩ Звонок {filename} (Категория: {call_category}). Пропуск отправки резюме в Telegram.")
+
+    sent_order_links = set()
+    if form_queue is not None:
+        form_queue.close()
+        sent_order_links = {order_link for key, order_link in order_links_by_key.items() if key in form_queue.confirmed}
+        if len(sent_order_links) < len(order_links_by_key):
+            logger.warning(f"⚠️ Не подтверждена запись {len(order_links_by_key) - len(sent_order_links)} заказов: "
+                           f"они будут отправлены при следующем запуске.")
+        # Google Forms недоступен: отправка окна повторится при следующем запуске (журнал не даст дублей),
+        # поэтому отчет в Telegram отправляется только после полной отправки
+        ensure_available("google_forms")
+    if window_digest is not None:
+        window_digest.enqueue(telegram_queue)
+    telegram_queue.flush()
+    return sent_order_links
 
 
 if __name__ == "__main__":
+    setup_logging()
     # Для тестирования модуля отдельно, используйте текущую дату
     today_str = datetime.today().strftime("%d.%m.%Y")
-    folder_name = Path("analyses") / f"транскрибация_{today_str}"
     # ИЗМЕНЕНИЕ: Добавлен set() для соответствия новой сигнатуре
-    send_analyses_to_google_form(folder_name, today_str, set())
+    send_analyses_to_google_form(today_str, set())
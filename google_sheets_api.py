@@ -0,0 +1,223 @@
+import os
+import logging
+import json
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Set
+
+from dotenv import load_dotenv
+from metrics import track_request
+from log_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# ID таблицы с анализами и имя листа, куда пишет Google Form
+ANALYSIS_SHEET_ID = os.getenv("ANALYSIS_SHEET_ID", "1QhcIcPi3XMUPcKjwfM6983IkWn8Q-7xGoj49HzxC5BM")
+ANALYSIS_SHEET_NAME = os.getenv("ANALYSIS_SHEET_NAME", "Анализ звонков 12.15.19")
+# JSON-ключ сервисного аккаунта, у которого есть доступ на редактирование таблицы
+GOOGLE_SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE", "service_account.json")
+# Переопределение адреса API (например, http://127.0.0.1:8085/ для локальной заглушки Sheets).
+# Если задан, авторизация не используется.
+GOOGLE_SHEETS_API_ENDPOINT = os.getenv("GOOGLE_SHEETS_API_ENDPOINT")
+
+SHEETS_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+
+# Ограничения одного запроса values.append: Google рекомендует держать тело запроса в пределах ~2 МБ,
+# а в одной ячейке не может быть больше 50 000 символов (актуально для длинных транскрибаций).
+APPEND_MAX_ROWS_PER_REQUEST = 500
+APPEND_MAX_BYTES_PER_REQUEST = 2 * 1024 * 1024
+SHEET_CELL_MAX_CHARS = 50000
+APPEND_NUM_RETRIES = 3
+
+# Лист ответов формы начинается со столбца "Отметка времени", за ним идут поля формы в порядке ENTRY_MAP
+SHEET_INCLUDE_TIMESTAMP = True
+
+# Заголовок столбца со ссылкой на заказ (совпадает с google_sheets_integration.ORDER_LINK_COLUMN)
+ORDER_LINK_COLUMN = "Ссылка на заказ"
+
+
+def build_sheets_service():
+    """
+    Создаёт клиент Google Sheets API v4.
+    Для локальной заглушки (GOOGLE_SHEETS_API_ENDPOINT) используется анонимная авторизация.
+    """
+    from googleapiclient.discovery import build
+
+    if GOOGLE_SHEETS_API_ENDPOINT:
+        from google.auth.credentials import AnonymousCredentials
+        return build("sheets", "v4", credentials=AnonymousCredentials(), cache_discovery=False,
+                     static_discovery=True, client_options={"api_endpoint": GOOGLE_SHEETS_API_ENDPOINT})
+
+    from google.oauth2 import service_account
+    credentials = service_account.Credentials.from_service_account_file(GOOGLE_SERVICE_ACCOUNT_FILE,
+                                                                        scopes=SHEETS_SCOPES)
+    return build("sheets", "v4", credentials=credentials, cache_discovery=False)
+
+
+def _column_letter(index: int) -> str:
+    """
+    Переводит индекс столбца (с нуля) в буквенное обозначение A1-нотации: 0 -> A, 27 -> AB.
+    """
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def _to_cell(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, (int, float)):
+        return value
+    text = str(value)
+    if len(text) > SHEET_CELL_MAX_CHARS:
+        text = text[:SHEET_CELL_MAX_CHARS - 1] + "…"
+    return text
+
+
+def chunk_rows(rows: List[List[Any]], max_rows: int = APPEND_MAX_ROWS_PER_REQUEST,
+               max_bytes: int = APPEND_MAX_BYTES_PER_REQUEST) -> List[List[List[Any]]]:
+    """
+    Делит строки на пачки, укладывающиеся в ограничения одного запроса values.append.
+    """
+    chunks = []
+    current = []
+    current_bytes = 0
+    for row in rows:
+        row_bytes = len(json.dumps(row, ensure_ascii=False).encode("utf-8"))
+        if current and (len(current) >= max_rows or current_bytes + row_bytes > max_bytes):
+            chunks.append(current)
+            current = []
+            current_bytes = 0
+        current.append(row)
+        current_bytes += row_bytes
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class SheetsApiSink:
+    """
+    Альтернатива отправке через Google Forms: копит строки всего запуска и дописывает их
+    в лист одним вызовом spreadsheets.values.append (с разбиением на пачки по лимитам API).
+
+    Интерфейс совпадает с google_sheets.FormSubmissionQueue (submit/close/confirmed), поэтому
+    send_analyses_to_google_form может использовать любой из них.
+    """
+
+    def __init__(self, columns: List[str], ledger, spreadsheet_id: str = ANALYSIS_SHEET_ID,
+                 sheet_name: str = ANALYSIS_SHEET_NAME, service=None):
+        """
+        Args:
+            columns: Идентификаторы полей формы (значения ENTRY_MAP) в порядке столбцов листа.
+            ledger: Журнал отправленных записей (google_sheets.SubmissionLedger).
+        """
+        self.columns = columns
+        self.ledger = ledger
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self._service = service
+        self._pending = []  # [(ключ, строка, подпись)]
+        # Ключи записей, которые точно есть в листе: дописанные сейчас и отправленные ранее
+        self.confirmed: Set[str] = set()
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def submit(self, key: str, payload: Dict[str, Any], label: str) -> bool:
+        if key in self.ledger or any(pending_key == key for pending_key, _, _ in self._pending):
+            logger.info(f"⏭ Запись {label} уже отправлена ранее (ключ {key}). Пропускаем повторную запись в таблицу.")
+            self.skipped += 1
+            if key in self.ledger:
+                self.confirmed.add(key)
+            return False
+        self._pending.append((key, self.payload_to_row(payload), label))
+        return True
+
+    def payload_to_row(self, payload: Dict[str, Any]) -> List[Any]:
+        row = [_to_cell(payload.get(entry_id)) for entry_id in self.columns]
+        if SHEET_INCLUDE_TIMESTAMP:
+            # Формат совпадает с тем, что пишет сама форма в столбец "Отметка времени"
+            row.insert(0, datetime.now().strftime("%d.%m.%Y %H:%M:%S"))
+        return row
+
+    def close(self):
+        """
+        Дописывает все накопленные строки в лист. Обычно это один запрос на весь запуск.
+        """
+        if not self._pending:
+            logger.info(f"📤 Google Sheets API: новых строк нет, пропущено как уже отправленные {self.skipped}.")
+            return
+
+        try:
+            service = self._service or build_sheets_service()
+        except Exception as e:
+            logger.error(f"❌ Не удалось создать клиент Google Sheets API: {e}")
+            self.failed += len(self._pending)
+            self._pending = []
+            return
+
+        keys = [key for key, _, _ in self._pending]
+        rows = [row for _, row, _ in self._pending]
+        offset = 0
+        for chunk in chunk_rows(rows):
+            chunk_keys = keys[offset:offset + len(chunk)]
+            offset += len(chunk)
+            try:
+                with track_request("google_sheets", "values_append"):
+                    service.spreadsheets().values().append(
+                        spreadsheetId=self.spreadsheet_id,
+                        range=f"'{self.sheet_name}'!A1",
+                        valueInputOption="USER_ENTERED",
+                        insertDataOption="INSERT_ROWS",
+                        body={"values": chunk},
+                    ).execute(num_retries=APPEND_NUM_RETRIES)
+                self.ledger.record(*chunk_keys)
+                self.confirmed.update(chunk_keys)
+                self.sent += len(chunk)
+                logger.info(f"[✓] Дописано в Google Sheets: {len(chunk)} строк.")
+            except Exception as e:
+                self.failed += len(chunk)
+                logger.error(f"[✗] Ошибка записи пачки из {len(chunk)} строк в Google Sheets: {e}")
+
+        self._pending = []
+        logger.info(
+            f"📤 Google Sheets API: записано {self.sent}, ошибок {self.failed}, пропущено как уже отправленные {self.skipped}.")
+
+
+def load_analyzed_order_links_from_sheet(spreadsheet_id: str = ANALYSIS_SHEET_ID,
+                                         sheet_name: str = ANALYSIS_SHEET_NAME, service=None) -> Optional[Set[str]]:
+    """
+    Читает столбец 'Ссылка на заказ' напрямую через Sheets API, без выгрузки всего листа в XLSX.
+
+    Returns:
+        Множество ссылок или None, если прочитать таблицу не удалось.
+    """
+    try:
+        service = service or build_sheets_service()
+        values = service.spreadsheets().values()
+        header = values.get(spreadsheetId=spreadsheet_id, range=f"'{sheet_name}'!1:1").execute().get("values", [[]])
+        header_row = header[0] if header else []
+        if ORDER_LINK_COLUMN not in header_row:
+            logger.error(f"❌ Ошибка: В листе '{sheet_name}' не найден столбец '{ORDER_LINK_COLUMN}'.")
+            return None
+
+        column = _column_letter(header_row.index(ORDER_LINK_COLUMN))
+        column_values = values.get(spreadsheetId=spreadsheet_id, range=f"'{sheet_name}'!{column}2:{column}",
+                                   majorDimension="COLUMNS").execute().get("values", [[]])
+        cells = column_values[0] if column_values else []
+        links = {str(x).strip() for x in cells if str(x).strip()}
+        logger.info(f"✅ Успешно загружено {len(links)} уникальных ссылок на заказы через Sheets API.")
+        return links
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения ссылок на заказы через Sheets API: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    setup_logging()
+    links = load_analyzed_order_links_from_sheet()
+    logger.info(f"Ссылок в таблице: {len(links) if links is not None else 'ошибка чтения'}")
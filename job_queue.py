@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, List, Dict, Any
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Очередь задач для режима воркеров: SQLite-файл на общем томе (см. worker.py)
+JOB_QUEUE_PATH = Path(os.getenv("JOB_QUEUE_PATH", "cache/jobs.sqlite3"))
+# После стольких неудачных попыток задача остается в статусе failed и больше не выдается
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Задержка перед повтором: JOB_RETRY_DELAY_SECONDS * 2^(попытка - 1)
+JOB_RETRY_DELAY_SECONDS = 30
+# Выполненные задачи хранятся столько дней (для статистики), потом удаляются
+JOB_RETENTION_DAYS = 7
+
+STAGES = ["download", "transcribe", "analyze", "deliver"]
+# Отчет по окну в Telegram: одна задача на окно, ставится, когда у окна не осталось незавершенных задач.
+# Задачи этого этапа выполняет воркер этапа deliver.
+DIGEST_STAGE = "digest"
+
+STATUS_QUEUED = "queued"
+STATUS_LEASED = "leased"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (stage, key)
+);
+CREATE INDEX IF NOT EXISTS jobs_pick ON jobs (stage, status, available_at);
+"""
+
+
+class Job:
+    """
+    Задача очереди: этап, ключ идемпотентности (один ключ — одна задача на этапе) и данные.
+    """
+
+    def __init__(self, job_id: int, stage: str, key: str, payload: Dict[str, Any], attempts: int, owner: str):
+        self.id = job_id
+        self.stage = stage
+        self.key = key
+        self.payload = payload
+        self.attempts = attempts
+        self.owner = owner
+
+    def __repr__(self):
+        return f"Job({self.stage}:{self.key}, попытка {self.attempts})"
+
+
+class JobQueue:
+    """
+    Надежная локальная очередь задач на SQLite с арендой (lease) и таймаутом видимости.
+
+    Воркер берет задачу в аренду на visibility_timeout секунд. Если он упал и не подтвердил задачу
+    (complete/fail), по истечении аренды задача снова выдается другому воркеру. Выдача идет
+    под BEGIN IMMEDIATE, поэтому одну задачу не получат два процесса одновременно.
+    """
+
+    def __init__(self, path: Path = JOB_QUEUE_PATH, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # Отдельное соединение на операцию: очередь используют несколько потоков и процессов
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def enqueue(self, stage: str, key: str, payload: Dict[str, Any], delay: float = 0) -> bool:
+        """
+        Ставит задачу в очередь. Возвращает False, если задача с таким ключом на этом этапе уже есть.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO jobs (stage, key, payload, status, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (stage, key, json.dumps(payload, ensure_ascii=False), STATUS_QUEUED, now + delay, now, now))
+            return cursor.rowcount == 1
+
+    def lease(self, stage: str, owner: str, visibility_timeout: float, limit: int = 1) -> List[Job]:
+        """
+        Берет в аренду до limit задач этапа: готовые к выдаче и те, чья аренда истекла.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            # Задача, на которой воркер падает раз за разом, не должна выдаваться бесконечно
+            conn.execute("UPDATE jobs SET status = ?, lease_owner = NULL, last_error = ?, updated_at = ? "
+                         "WHERE stage = ? AND status = ? AND lease_expires_at <= ? AND attempts >= ?",
+                         (STATUS_FAILED, "Аренда истекла: воркер не завершил задачу", now, stage, STATUS_LEASED, now,
+                          self.max_attempts))
+            rows = conn.execute(
+                "SELECT id, stage, key, payload, attempts FROM jobs WHERE stage = ? AND "
+                "((status = ? AND available_at <= ?) OR (status = ? AND lease_expires_at <= ?)) "
+                "ORDER BY available_at, id LIMIT ?",
+                (stage, STATUS_QUEUED, now, STATUS_LEASED, now, limit)).fetchall()
+            jobs = []
+            for job_id, job_stage, key, payload, attempts in rows:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_expires_at = ?, "
+                    "updated_at = ? WHERE id = ?",
+                    (STATUS_LEASED, owner, now + visibility_timeout, now, job_id))
+                jobs.append(Job(job_id, job_stage, key, json.loads(payload), attempts + 1, owner))
+            return jobs
+
+    def extend(self, jobs: List[Job], visibility_timeout: float):
+        """
+        Продлевает аренду задач, которые еще выполняются (heartbeat долгих задач).
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            for job in jobs:
+                conn.execute("UPDATE jobs SET lease_expires_at = ?, updated_at = ? "
+                             "WHERE id = ? AND status = ? AND lease_owner = ?",
+                             (now + visibility_timeout, now, job.id, STATUS_LEASED, job.owner))
+
+    # complete/fail меняют задачу, только пока она в аренде у этого воркера: если аренда истекла
+    # и задачу уже взял другой воркер, результат опоздавшего игнорируется.
+
+    def complete(self, job: Job):
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires_at = NULL, "
+                         "last_error = NULL, updated_at = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                         (STATUS_DONE, time.time(), job.id, STATUS_LEASED, job.owner))
+
+    def fail(self, job: Job, error: str) -> bool:
+        """
+        Возвращает задачу в очередь с задержкой или, если попытки исчерпаны, помечает ее failed.
+        Возвращает True, если задача будет повторена.
+        """
+        now = time.time()
+        retry = job.attempts < self.max_attempts
+        status = STATUS_QUEUED if retry else STATUS_FAILED
+        available_at = now + JOB_RETRY_DELAY_SECONDS * 2 ** (job.attempts - 1)
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = ?, available_at = ?, lease_owner = NULL, lease_expires_at = NULL, "
+                         "last_error = ?, updated_at = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                         (status, available_at, error[:2000], now, job.id, STATUS_LEASED, job.owner))
+        return retry
+
+    def defer(self, job: Job, delay: float, reason: str):
+        """
+        Возвращает задачу в очередь через delay секунд, не засчитывая попытку (внешний сервис недоступен).
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = ?, attempts = attempts - 1, available_at = ?, lease_owner = NULL, "
+                         "lease_expires_at = NULL, last_error = ?, updated_at = ? "
+                         "WHERE id = ? AND status = ? AND lease_owner = ?",
+                         (STATUS_QUEUED, now + delay, reason[:2000], now, job.id, STATUS_LEASED, job.owner))
+
+    def retry_failed(self, stage: Optional[str] = None) -> int:
+        """
+        Возвращает в очередь задачи, исчерпавшие попытки (например, после исправления причины ошибки).
+        """
+        now = time.time()
+        query = "UPDATE jobs SET status = ?, attempts = 0, available_at = ?, updated_at = ? WHERE status = ?"
+        params = [STATUS_QUEUED, now, now, STATUS_FAILED]
+        if stage:
+            query += " AND stage = ?"
+            params.append(stage)
+        with self._transaction() as conn:
+            return conn.execute(query, params).rowcount
+
+    def purge(self, older_than_days: int = JOB_RETENTION_DAYS) -> int:
+        cutoff = time.time() - older_than_days * 86400
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM jobs WHERE status = ? AND updated_at < ?",
+                                (STATUS_DONE, cutoff)).rowcount
+
+    def window_pending(self, window: str) -> int:
+        """
+        Число задач окна (поле window в данных задачи), которые еще будут выполняться: в очереди или в аренде.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE stage != ? AND status IN (?, ?) AND json_extract(payload, '$.window') = ?",
+                (DIGEST_STAGE, STATUS_QUEUED, STATUS_LEASED, window)).fetchone()[0]
+
+    def window_payloads(self, stage: str, window: str, status: Optional[str] = STATUS_DONE) -> List[Dict[str, Any]]:
+        """
+        Данные задач окна на этапе в заданном статусе (None — в любом).
+        """
+        query = "SELECT payload FROM jobs WHERE stage = ? AND json_extract(payload, '$.window') = ?"
+        params = [stage, window]
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        with self._connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [json.loads(payload) for payload, in rows]
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Число задач по этапам и статусам.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT stage, status, COUNT(*) FROM jobs GROUP BY stage, status").fetchall()
+        result = {stage: {} for stage in STAGES + [DIGEST_STAGE]}
+        for stage, status, count in rows:
+            result.setdefault(stage, {})[status] = count
+        return result
+
+
+def enqueue_call_groups(queue: JobQueue, calls: List[Dict[str, Any]], merge_groups: Dict[Any, List[Any]],
+                        target_folder_date_str: str, window: Optional[str] = None,
+                        report_title: Optional[str] = None) -> int:
+    """
+    Ставит отобранные звонки в очередь на загрузку. Повторные звонки клиента (merge_groups, стратегия "concat")
+    идут одной задачей с основным звонком, чтобы их транскрипты склеивались в одном воркере.
+    window и report_title передаются по всем этапам: по ним воркеры отправляют один отчет на окно.
+    Возвращает число поставленных задач.
+    """
+    calls_by_id = {str(call.get("communication_id")): call for call in calls}
+    groups = {str(primary_id): [str(secondary_id) for secondary_id in ids] for primary_id, ids in merge_groups.items()}
+    secondary_ids = {secondary_id for ids in groups.values() for secondary_id in ids}
+    queued = 0
+    for communication_id, call in calls_by_id.items():
+        if communication_id in secondary_ids:
+            continue
+        group = groups.get(communication_id, [])
+        payload = {
+            "folder_date": target_folder_date_str,
+            "communication_id": communication_id,
+            "calls": [call] + [calls_by_id[secondary_id] for secondary_id in group if secondary_id in calls_by_id],
+            "merge_group": group,
+            "window": window,
+            "report_title": report_title,
+        }
+        if queue.enqueue("download", f"{target_folder_date_str}:{communication_id}", payload):
+            queued += 1
+    logger.info(f"📬 Поставлено в очередь на загрузку: {queued} задач.")
+    return queued
@@ -0,0 +1,36 @@
+import fcntl
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def file_lock(lock_path: Path):
+    """
+    Межпроцессная блокировка на файле (fcntl.flock): пайплайн по расписанию, демон и приемник
+    вебхуков могут работать одновременно и писать в одни и те же папки и журналы.
+    """
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def try_file_lock(lock_path: Path):
+    """
+    Неблокирующий вариант file_lock: отдает True, если блокировка взята, и False, если ее держит другой процесс.
+    """
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
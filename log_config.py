@@ -0,0 +1,177 @@
+import os
+import json
+import atexit
+import hashlib
+import logging
+import logging.handlers
+import queue
+import re
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Any
+
+# Уровень логирования (DEBUG, INFO, WARNING, ERROR), формат консоли ("text" или "json") и папка логов запусков
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_CONSOLE_FORMAT = os.getenv("LOG_CONSOLE_FORMAT", "text")
+LOG_DIR = Path(os.getenv("LOG_DIR", "logs"))
+# Ротация файла лога одного запуска и число хранимых файлов логов запусков
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUP_COUNT = 5
+LOG_KEEP_RUN_FILES = int(os.getenv("LOG_KEEP_RUN_FILES", "60"))
+
+# Контекст текущего звонка: добавляется к каждой записи лога, в том числе из пулов потоков и asyncio-задач
+_communication_id = contextvars.ContextVar("communication_id", default=None)
+_stage = contextvars.ContextVar("stage", default=None)
+_phone_hash = contextvars.ContextVar("phone_hash", default=None)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_run_log_path: Optional[Path] = None
+
+
+def phone_hash(phone_number: Optional[str]) -> Optional[str]:
+    """
+    Короткий хэш номера телефона: позволяет связать записи одного клиента, не сохраняя номер в логах.
+    """
+    if not phone_number:
+        return None
+    digits = re.sub(r"\D", "", str(phone_number))
+    if len(digits) == 11 and digits.startswith("8"):
+        digits = "7" + digits[1:]
+    return hashlib.sha256(digits.encode("utf-8")).hexdigest()[:12]
+
+
+@contextmanager
+def log_context(communication_id: Any = None, stage: Optional[str] = None, phone: Optional[str] = None):
+    """
+    Задает контекст (communication_id, этап, хэш телефона) для всех записей лога внутри блока.
+    Незаданные поля наследуются от внешнего контекста.
+    """
+    tokens = []
+    if communication_id is not None:
+        tokens.append((_communication_id, _communication_id.set(str(communication_id))))
+    if stage is not None:
+        tokens.append((_stage, _stage.set(stage)))
+    if phone:
+        tokens.append((_phone_hash, _phone_hash.set(phone_hash(phone))))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Добавляет к записи поля контекста. Работает в потоке, создавшем запись (до передачи в очередь).
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.communication_id = _communication_id.get()
+        record.stage = _stage.get()
+        record.phone_hash = _phone_hash.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Одна JSON-строка на запись: время, уровень, модуль, сообщение и контекст звонка.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in ("communication_id", "stage", "phone_hash"):
+            value = getattr(record, field, None)
+            if value:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Читаемый формат для консоли: время, уровень, [этап/ID звонка] и сообщение.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        context = "/".join(str(value) for value in (getattr(record, "stage", None),
+                                                    getattr(record, "communication_id", None)) if value)
+        prefix = f"{datetime.fromtimestamp(record.created).strftime('%H:%M:%S')} {record.levelname:<7}"
+        if context:
+            prefix += f" [{context}]"
+        message = f"{prefix} {record.getMessage()}"
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        return message
+
+
+def _prune_run_logs(log_dir: Path, keep: int):
+    run_logs = sorted(log_dir.glob("run_*.jsonl"))
+    for old_log in run_logs[:-keep] if keep > 0 else []:
+        for path in log_dir.glob(old_log.name + "*"):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def setup_logging(level: str = LOG_LEVEL, log_dir: Optional[Path] = LOG_DIR) -> Optional[Path]:
+    """
+    Настраивает логирование процесса: записи попадают в очередь (QueueHandler), а форматирование и запись
+    в консоль и в файл лога запуска (JSON Lines с ротацией) выполняет фоновый QueueListener.
+    Повторный вызов ничего не делает. Возвращает путь к файлу лога запуска (или None без файла).
+    """
+    global _listener, _run_log_path
+    if _listener is not None:
+        return _run_log_path
+
+    handlers = []
+    console = logging.StreamHandler()
+    console.setFormatter(JsonFormatter() if LOG_CONSOLE_FORMAT == "json" else TextFormatter())
+    handlers.append(console)
+
+    if log_dir is not None:
+        try:
+            log_dir.mkdir(parents=True, exist_ok=True)
+            _prune_run_logs(log_dir, LOG_KEEP_RUN_FILES - 1)
+            _run_log_path = log_dir / f"run_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+            file_handler = logging.handlers.RotatingFileHandler(_run_log_path, maxBytes=LOG_FILE_MAX_BYTES,
+                                                                backupCount=LOG_FILE_BACKUP_COUNT, encoding="utf-8")
+            file_handler.setFormatter(JsonFormatter())
+            handlers.append(file_handler)
+        except OSError as e:
+            logging.getLogger(__name__).warning(f"⚠️ Не удалось создать файл лога в {log_dir}: {e}")
+            _run_log_path = None
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(getattr(logging, level, logging.INFO))
+    # Подробные логи HTTP-клиентов не нужны на уровне INFO
+    for noisy in ("urllib3", "httpx", "openai", "googleapiclient"):
+        logging.getLogger(noisy).setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return _run_log_path
+
+
+def shutdown_logging():
+    """
+    Дописывает оставшиеся в очереди записи и останавливает фоновый поток логирования.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
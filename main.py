@@ -1,11 +1,13 @@
 import os
+import logging
 import sys
-import shutil
 import json
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta, timezone, time as dtime
 from pathlib import Path
 import re
 import time
+import argparse
+from typing import Optional, List, Set, Tuple, Dict, Any
 
 # Добавляем корневую директорию проекта в sys.path
 project_root = Path(__file__).resolve().parent
@@ -14,18 +16,54 @@ if str(project_root) not in sys.path:
 
 # Импортируем необходимые модули
 from uis_call_downloader import get_calls_report, download_record, download_calls
-from transcriber import transcribe_all
+from call_table import calls_to_frame, prefilter_calls, dedupe_calls, DUPLICATE_STRATEGY_LONGEST
+from call_store import CallStore
+from retention import start_background_retention
+from transcriber import transcribe_all, merge_duplicate_transcripts, _load_call_stems
 from analyzer import analyze_transcripts
-from google_sheets import send_analyses_to_google_form
+from google_sheets import send_analyses_to_google_form, ANALYSIS_SINK, SubmissionLedger
+from google_sheets_api import load_analyzed_order_links_from_sheet
 # НОВЫЙ ИМПОРТ: Функции для загрузки и скачивания ссылок из XLSX
 from google_sheets_integration import load_analyzed_order_links, download_google_sheet_as_xlsx
 
 # Обновленный импорт из retailcrm: удалены неиспользуемые функции, добавлена новая
 from retailcrm_integration import check_if_last_order_is_analyzable, get_last_order_link_for_check
+from metrics import timed_stage, inc, export_run_metrics, start_metrics_server, METRICS_PORT
+from model_router import routing_stats
+from cost_accounting import run_summary, start_run, stored_cost_usd
+from circuit_breaker import DependencyUnavailableError, circuit_states
+from log_config import setup_logging, log_context
+from locks import file_lock
+import artifacts
+from job_queue import JobQueue, enqueue_call_groups
+from checkpoints import (WindowCheckpoint, incomplete_checkpoints, prune_checkpoints, STATUS_ABANDONED,
+                         STAGE_SELECT, STAGE_DOWNLOAD, STAGE_TRANSCRIBE, STAGE_ANALYZE, STAGE_DELIVER)
+
+logger = logging.getLogger(__name__)
+
+# Повторные звонки одного клиента в окне: "longest" — только самый длинный, "concat" — склеить транскрипты
+DUPLICATE_CALLS_STRATEGY = os.getenv("DUPLICATE_CALLS_STRATEGY", DUPLICATE_STRATEGY_LONGEST)
 
 # Define Moscow timezone (UTC+3)
 MSK = timezone(timedelta(hours=3))
 
+# Время запусков по МСК. Каждый запуск обрабатывает звонки от предыдущего запуска до текущего
+# (первый запуск дня — от последнего запуска вчера).
+PROCESSING_RUN_TIMES = os.getenv("PROCESSING_RUN_TIMES", "12:00,15:00,19:00")
+
+# Журнал звонков, уже взятых в обработку (communication_id -> время). Общий для запусков по расписанию,
+# демона и приемника вебхуков: один звонок не обрабатывается дважды, каким бы путем он ни пришел.
+PROCESSED_CALLS_LEDGER_PATH = Path(os.getenv("PROCESSED_CALLS_LEDGER_PATH", "cache/processed_calls.json"))
+processed_calls = SubmissionLedger(PROCESSED_CALLS_LEDGER_PATH)
+
+# "inline" — все этапы выполняются в этом процессе; "queue" — отобранные звонки ставятся в очередь задач,
+# а загрузку, транскрибацию, анализ и отправку выполняют воркеры (worker.py)
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "inline")
+
+# Как часто перечитывать ссылки на уже проанализированные заказы из таблицы в резидентных режимах
+# (между перечитываниями набор пополняется ссылками, отправленными самим процессом)
+ORDER_LINKS_REFRESH_MINUTES = int(os.getenv("ORDER_LINKS_REFRESH_MINUTES", "60"))
+
 # КОНСТАНТА: Имя файла, в который будет скачиваться Google Sheet
 GS_XLSX_FILENAME = "анализ_звонков_gs.xlsx"
 
@@ -36,225 +74,472 @@ GS_SHEET_ID = "1QhcIcPi3XMUPcKjwfM6983IkWn8Q-7xGoj49HzxC5BM"
 GS_GID = "617179352"
 
 
-def clean_old_folders(base_dir: Path, days_to_keep: int):
+# ИЗМЕНЕНИЕ: Добавлен параметр existing_order_links
+def send_all_analyses_to_integrations(target_folder_date_str: str, existing_order_links: set,
+                                      only_stems: Optional[Set[str]] = None,
+                                      report_title: Optional[str] = None,
+                                      forms: bool = True, telegram: bool = True) -> Set[str]:
     """
-    Удаляет старые папки в указанной базовой директории.
+    Отправляет сохраненные в хранилище анализы за дату в Google Forms и отчеты в Telegram
+    (forms/telegram — см. send_analyses_to_google_form).
+    Возвращает ссылки на заказы, отправленные в этом запуске.
     """
-    print(f"\n🧹 Запускаем очистку старых папок в {base_dir} (сохраняем за последние {days_to_keep} дней)...")
-    current_time_msk = datetime.now(MSK)
-    cutoff_date = (current_time_msk - timedelta(days=days_to_keep)).date()
-    if not base_dir.exists():
-        print(f"Директория {base_dir} не существует. Пропускаем очистку.")
-        return
-    for folder in base_dir.iterdir():
-        if folder.is_dir():
-            try:
-                date_str_part = folder.name.split('_')[-1]
-                folder_date = datetime.strptime(date_str_part, "%d.%m.%Y").date()
-                if folder_date < cutoff_date:
-                    print(
-                        f"🗑️ Удаляем старую папку: {folder} (дата {folder_date.strftime('%d.%m.%Y')} старше {cutoff_date.strftime('%d.%m.%Y')})")
-                    shutil.rmtree(folder)
-                else:
-                    print(f"✅ Сохраняем папку: {folder} (дата {folder_date.strftime('%d.%m.%Y')})")
-            except ValueError:
-                print(f"⚠️ Пропускаем папку {folder.name}: не удалось извлечь дату из имени или неверный формат.")
-            except Exception as e:
-                print(f"❌ Ошибка при удалении папки {folder.name}: {e}")
-    print(f"Очистка в {base_dir} завершена.")
+    logger.info("--- Отправка анализов в Google Forms (и Telegram, если настроено) ---")
+    store = CallStore(target_folder_date_str)
+    if not len(store.analyses):
+        logger.info(f"Анализы за {target_folder_date_str} не найдены. Пропускаем отправку.")
+        return set()
+    logger.info(f"  ➡️ Запускаем отправку всех целевых анализов в Google Forms из {store.dir}.")
+    # ИЗМЕНЕНИЕ: Передаем набор ссылок дальше для финальной фильтрации
+    return send_analyses_to_google_form(target_folder_date_str, existing_order_links, only_stems, report_title,
+                                        forms=forms, telegram=telegram)
 
 
-# ИЗМЕНЕНИЕ: Добавлен параметр existing_order_links
-def send_all_analyses_to_integrations(analyses_folder_path: Path, target_folder_date_str: str, existing_order_links: set):
+def is_phone_analyzable(phone_number: str, existing_order_links: set) -> bool:
     """
-    Отправляет сгенерированные JSON-файлы анализов в Google Forms.
+    Проверяет номер по RetailCRM: последний заказ ещё не проанализирован (нет в Google Sheets)
+    и находится в статусе, разрешенном к анализу.
     """
-    print("\n--- Отправка анализов в Google Forms (и Telegram, если настроено) ---")
-    if not analyses_folder_path.exists():
-        print(f"Папка с анализами не найдена: {analyses_folder_path}. Пропускаем отправку.")
-        return
-    print(f"\n  ➡️ Запускаем отправку всех целевых анализов в Google Forms из {analyses_folder_path}.")
-    # ИЗМЕНЕНИЕ: Передаем набор ссылок дальше для финальной фильтрации
-    send_analyses_to_google_form(analyses_folder_path, target_folder_date_str, existing_order_links)
+    # --- ФИЛЬТРАЦИЯ: Проверка на повторный анализ заказа (Первое касание, из ПРЕДЫДУЩИХ запусков) ---
+    # Этот фильтр сохраняем для экономии ресурсов.
+    if existing_order_links:
+        last_order_link = get_last_order_link_for_check(phone_number)
+
+        if last_order_link:
+            if last_order_link in existing_order_links:
+                logger.info(
+                    f"  ❌ Номер {phone_number} НЕ прошел фильтр: Заказ {last_order_link} УЖЕ ЕСТЬ в таблице (повторный анализ). Пропускаем.")
+                return False
+            else:
+                logger.info(f"  ✅ Заказ {last_order_link} НЕТ в таблице. Продолжаем проверку по статусу.")
+        else:
+            # Если заказа нет, это, вероятно, новый клиент. Продолжаем проверку по статусу.
+            logger.info("  ℹ️ Заказ не найден в RetailCRM. Продолжаем проверку по статусу.")
+
+    # СУЩЕСТВУЮЩАЯ ЛОГИКА ФИЛЬТРАЦИИ (по статусу последнего заказа)
+    if check_if_last_order_is_analyzable(phone_number):
+        logger.info(f"✅ Звонки с/на номер {phone_number} прошли фильтр (статус последнего заказа разрешен к анализу).")
+        return True
+
+    # В новой логике False означает, что последний заказ в НЕанализируемом статусе (Закупка, Комплектация, Доставка и т.п.)
+    logger.info(f"❌ Звонки с/на номер {phone_number} НЕ прошли фильтр (последний заказ НЕ разрешен к анализу).")
+    return False
 
 
-def run_processing_pipeline():
+def parse_run_times(value: str = PROCESSING_RUN_TIMES) -> List[dtime]:
     """
-    Определяет текущий временной диапазон для обработки звонков
-    на основе текущего времени по МСК и запускает пайплайн.
+    Разбирает время запусков вида "12:00,15:00,19:00" в отсортированный список.
+    """
+    return sorted(datetime.strptime(item.strip(), "%H:%M").time() for item in value.split(",") if item.strip())
+
+
+def resolve_processing_window(now: datetime, run_times: Optional[List[dtime]] = None
+                              ) -> Optional[Tuple[datetime, datetime, str]]:
+    """
+    Определяет период обработки для момента запуска: если now попадает в час после одного из запусков,
+    период — от предыдущего запуска (для первого запуска дня — от последнего запуска вчера) до текущего.
+
+    Returns:
+        (начало периода, конец периода, дата папок ДД.ММ.ГГГГ) или None, если запуск не запланирован.
     """
-    current_time_msk = datetime.now(MSK)
-    current_hour_msk = current_time_msk.hour
+    run_times = run_times or parse_run_times()
+    current_time_msk = now.astimezone(MSK)
     current_date_msk = current_time_msk.date()
 
-    print(f"Текущее время по МСК: {current_time_msk.strftime('%Y-%m-%d %H:%M:%S')}")
-
-    # Очищаем старые папки
-    clean_old_folders(Path("audio"), 1)
-    clean_old_folders(Path("transcripts"), 1)
-    clean_old_folders(Path("analyses"), 1)
-
-    start_time_period = None
-    end_time_period = None
-    target_folder_date_str = current_date_msk.strftime("%d.%m.%Y")
-
-    # Определение периодов обработки по времени суток
-    if current_hour_msk == 12:
-        yesterday_date_msk = current_date_msk - timedelta(days=1)
-        print("Определен период обработки: утренние звонки (с вечера вчера до полудня сегодня)")
-        start_time_period = datetime.combine(yesterday_date_msk, datetime.min.time().replace(hour=19), tzinfo=MSK)
-        end_time_period = datetime.combine(current_date_msk, datetime.min.time().replace(hour=11, minute=59, second=59),
-                                           tzinfo=MSK)
-        target_folder_date_str = current_date_msk.strftime("%d.%m.%Y")
-
-    elif current_hour_msk == 15:
-        print("Определен период обработки: дневные звонки (с полудня сегодня до 15:00 сегодня)")
-        start_time_period = datetime.combine(current_date_msk, datetime.min.time().replace(hour=12), tzinfo=MSK)
-        end_time_period = datetime.combine(current_date_msk, datetime.min.time().replace(hour=14, minute=59, second=59),
-                                           tzinfo=MSK)
-        target_folder_date_str = current_date_msk.strftime("%d.%m.%Y")
-
-    elif current_hour_msk == 19:
-        print("Определен период обработки: вечерние звонки (с 15:00 сегодня до 19:00 сегодня)")
-        start_time_period = datetime.combine(current_date_msk, datetime.min.time().replace(hour=15), tzinfo=MSK)
-        end_time_period = datetime.combine(current_time_msk, datetime.min.time().replace(hour=18, minute=59, second=59),
-                                           tzinfo=MSK)
-        target_folder_date_str = current_date_msk.strftime("%d.%m.%Y")
-    else:
-        print(
-            "Текущее время не соответствует запланированным периодам обработки (12:00, 15:00, 19:00 МСК). Пропускаю выполнение.")
-        return
+    for i, run_time in enumerate(run_times):
+        run_at = datetime.combine(current_date_msk, run_time, tzinfo=MSK)
+        if run_at <= current_time_msk < run_at + timedelta(hours=1):
+            previous_date = current_date_msk if i > 0 else current_date_msk - timedelta(days=1)
+            start_time_period = datetime.combine(previous_date, run_times[i - 1], tzinfo=MSK)
+            end_time_period = run_at - timedelta(seconds=1)
+            return start_time_period, end_time_period, current_date_msk.strftime("%d.%m.%Y")
+    return None
+
+
+def load_existing_order_links() -> Set[str]:
+    """
+    Загружает ссылки на уже проанализированные заказы из таблицы анализов
+    (через Sheets API для ANALYSIS_SINK=sheets_api, иначе через выгрузку XLSX).
+    """
+    gs_file_path = Path(GS_XLSX_FILENAME)
+    existing_order_links = set()
 
-    if start_time_period and end_time_period:
-        print(
-            f"Обработка звонков за период: {start_time_period.strftime('%Y-%m-%d %H:%M:%S')} - {end_time_period.strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"Целевая дата папок для обработки: {target_folder_date_str}")
+    logger.info(f"--- Скачивание и загрузка ссылок из Google Sheets ({GS_XLSX_FILENAME}) ---")
 
-        # --- 0. СКАЧИВАНИЕ И ЗАГРУЗКА ССЫЛОК ИЗ GOOGLE SHEETS ---
-        gs_file_path = Path(GS_XLSX_FILENAME)
-        existing_order_links = set()
+    api_order_links = None
+    if ANALYSIS_SINK == "sheets_api":
+        # При записи через Sheets API читаем столбец ссылок напрямую, без выгрузки XLSX
+        api_order_links = load_analyzed_order_links_from_sheet()
 
-        print(f"\n--- Скачивание и загрузка ссылок из Google Sheets ({GS_XLSX_FILENAME}) ---")
+    if api_order_links is not None:
+        return api_order_links
 
-        # ИЗМЕНЕНИЕ: Добавлен GS_GID в вызов функции скачивания
+    # ИЗМЕНЕНИЕ: Добавлен GS_GID в вызов функции скачивания
+    with timed_stage("sheet_download"), log_context(stage="sheet_download"):
         download_success = download_google_sheet_as_xlsx(GS_SHEET_ID, GS_GID, gs_file_path)
 
-        # Для продолжения логики, загружаем ссылки, если файл есть И скачивание было успешным
-        if download_success and gs_file_path.exists():
-            existing_order_links = load_analyzed_order_links(gs_file_path)
-        else:
-            print("⚠️ Файл Google Sheets не был скачан или обработан. Проверка на повторный анализ будет пропущена.")
-            # Удаляем файл, если он был создан, но некорректен
-            if gs_file_path.exists():
-                os.remove(gs_file_path)
-        # ----------------------------------------------------------------------
-
-        # 1. Получаем список всех звонков с метаданными
-        print("\n--- Получение списка звонков с метаданными ---")
-        calls = get_calls_report(start_time_period.strftime("%Y-%m-%d %H:%M:%S"),
-                                 end_time_period.strftime("%Y-%m-%d %H:%M:%S"))
-
-        if not calls:
-            print("ℹ️ Нет звонков для обработки в указанном периоде.")
-            # 6. УДАЛЕНИЕ СКАЧАННОГО ФАЙЛА GOOGLE SHEETS
-            if gs_file_path.exists():
-                os.remove(gs_file_path)
-            print("\n✅ Пайплайн обработки звонков завершен.")
-            return
-
-        # 2. Фильтруем звонки по новым бизнес-правилам и готовим список к загрузке
-        print("\n--- Фильтрация звонков по правилам бизнеса ---")
-        calls_to_download_and_process = []
-        for call in calls:
-            phone_number = call.get("contact_phone_number") or call.get("raw", {}).get("contact_phone_number")
-            call_direction = call.get("direction") or call.get("raw", {}).get("direction")
-
-            # Если нет номера или направления - пропускаем звонок.
-            if not phone_number or not call_direction:
-                print(f"⚠️ Пропускаем звонок из-за отсутствия номера или направления: {call.get('communication_id')}")
-                continue
-
-            # --- ФИЛЬТРАЦИЯ: Проверка на повторный анализ заказа (Первое касание, из ПРЕДЫДУЩИХ запусков) ---
-            # Этот фильтр сохраняем для экономии ресурсов.
-            if existing_order_links:
-                last_order_link = get_last_order_link_for_check(phone_number)
-
-                if last_order_link:
-                    if last_order_link in existing_order_links:
-                        print(
-                            f"  ❌ Звонок НЕ прошел фильтр: Заказ {last_order_link} УЖЕ ЕСТЬ в таблице (повторный анализ). Пропускаем.")
-                        continue
-                    else:
-                        print(f"  ✅ Заказ {last_order_link} НЕТ в таблице. Продолжаем проверку по статусу.")
-                else:
-                    # Если заказа нет, это, вероятно, новый клиент. Продолжаем проверку по статусу.
-                    print("  ℹ️ Заказ не найден в RetailCRM. Продолжаем проверку по статусу.")
-            # ------------------------------------------------------------------------------
-
-            # СУЩЕСТВУЮЩАЯ ЛОГИКА ФИЛЬТРАЦИИ (по статусу последнего заказа)
-            if check_if_last_order_is_analyzable(phone_number):
-                if call_direction == "in":
-                    print(
-                        f"✅ Входящий звонок с номера {phone_number} прошел фильтр (статус последнего заказа разрешен к анализу или заказов нет).")
-                    calls_to_download_and_process.append(call)
-                elif call_direction == "out":
-                    # Исходящие звонки теперь фильтруются только по статусу заказа
-                    print(
-                        f"✅ Исходящий звонок на номер {phone_number} прошел фильтр (статус последнего заказа разрешен к анализу или заказов нет).")
-                    calls_to_download_and_process.append(call)
-            else:
-                # В новой логике False означает, что последний заказ в НЕанализируемом статусе (Закупка, Комплектация, Доставка и т.п.)
-                print(
-                    f"❌ Звонок ({call_direction}) с/на номер {phone_number} НЕ прошел фильтр (последний заказ НЕ разрешен к анализу).")
-
-        print(f"➡️ Итого к загрузке и обработке: {len(calls_to_download_and_process)} звонков.")
-
-        if not calls_to_download_and_process:
-            print("Нет звонков, соответствующих критериям фильтрации.")
-            # 6. УДАЛЕНИЕ СКАЧАННОГО ФАЙЛА GOOGLE SHEETS
-            if gs_file_path.exists():
-                os.remove(gs_file_path)
-            print("\n✅ Пайплайн обработки звонков завершен.")
-            return
-
-        # 3. Загружаем и обрабатываем только отфильтрованные звонки
-        audio_dir = Path("audio") / f"звонки_{target_folder_date_str}"
-        audio_dir.mkdir(parents=True, exist_ok=True)
-        print("\n--- Загрузка отфильтрованных звонков ---")
+    # Для продолжения логики, загружаем ссылки, если файл есть И скачивание было успешным
+    if download_success and gs_file_path.exists():
+        existing_order_links = load_analyzed_order_links(gs_file_path)
+    else:
+        logger.warning("⚠️ Файл Google Sheets не был скачан или обработан. Проверка на повторный анализ будет пропущена.")
+
+    # Файл нужен только для чтения ссылок
+    if gs_file_path.exists():
+        try:
+            artifacts.remove(gs_file_path)
+            logger.info(f"🧹 Файл {GS_XLSX_FILENAME} успешно удален.")
+        except Exception as e:
+            logger.error(f"❌ Ошибка при удалении файла {GS_XLSX_FILENAME}: {e}")
+    return existing_order_links
+
+
+class OrderLinksCache:
+    """
+    Ссылки на уже проанализированные заказы для резидентных режимов (демон, приемник вебхуков):
+    таблица перечитывается раз в ORDER_LINKS_REFRESH_MINUTES, а между перечитываниями набор
+    пополняется ссылками, отправленными самим процессом.
+    """
+
+    def __init__(self, refresh_minutes: int = ORDER_LINKS_REFRESH_MINUTES):
+        self.refresh_minutes = refresh_minutes
+        self._order_links: Optional[Set[str]] = None
+        self._loaded_at = 0.0
+
+    def get(self) -> Set[str]:
+        expired = time.monotonic() - self._loaded_at > self.refresh_minutes * 60
+        if self._order_links is None or expired:
+            self._order_links = load_existing_order_links()
+            self._loaded_at = time.monotonic()
+        return self._order_links
+
+    def add(self, order_links: Set[str]):
+        self.get().update(order_links)
+
+
+def _communication_id(call: dict) -> str:
+    return str(call.get("communication_id") or (call.get("raw") or {}).get("communication_id") or "")
+
+
+def _claimed_by_other(communication_id: str, owner: Optional[str]) -> bool:
+    # Звонок, взятый тем же окном до сбоя, остается за ним: повторный отбор окна его не теряет
+    return communication_id in processed_calls and (owner is None or processed_calls.owner(communication_id) != owner)
+
+
+def claim_calls(calls: List[dict], owner: Optional[str] = None) -> List[dict]:
+    """
+    Отбирает звонки, которые еще не взяты в обработку, и сразу отмечает их в журнале за владельцем (окном).
+    Проверка и отметка идут под межпроцессной блокировкой, поэтому звонок, пришедший и вебхуком,
+    и в отчете по расписанию, обрабатывает только один из процессов.
+    """
+    with file_lock(PROCESSED_CALLS_LEDGER_PATH.with_suffix(".lock")):
+        processed_calls.reload()
+        claimed = [call for call in calls if not _claimed_by_other(_communication_id(call), owner)]
+        if claimed:
+            processed_calls.record(*[_communication_id(call) for call in claimed if _communication_id(call)],
+                                   owner=owner)
+    if len(claimed) < len(calls):
+        logger.info(f"⏩ Пропущено {len(calls) - len(claimed)} звонков: уже обработаны другим запуском.")
+    return claimed
+
+
+def restrict_merge_groups(merge_groups: Dict[Any, List[Any]], claimed_calls: List[dict]) -> Dict[Any, List[Any]]:
+    """
+    Оставляет в группах повторных звонков только звонки, взятые этим запуском.
+    Если основной звонок взят другим запуском, основным становится первый из оставшихся.
+    Группы, в которых остался один звонок, отбрасываются: склеивать нечего.
+    """
+    claimed_ids = {_communication_id(call) for call in claimed_calls}
+    restricted = {}
+    for primary_id, secondary_ids in merge_groups.items():
+        group_ids = [communication_id for communication_id in [primary_id, *secondary_ids]
+                     if str(communication_id) in claimed_ids]
+        if len(group_ids) > 1:
+            restricted[group_ids[0]] = group_ids[1:]
+    return restricted
+
+
+def release_calls(owner: str):
+    """
+    Снимает отметки звонков окна, которое больше не будет обработано: их смогут взять другие запуски.
+    """
+    with file_lock(PROCESSED_CALLS_LEDGER_PATH.with_suffix(".lock")):
+        released = processed_calls.release(owner)
+    if released:
+        logger.info(f"↩️ Окно {owner}: снята отметка обработки с {released} звонков.")
+
+
+def process_period(start_time_period: datetime, end_time_period: datetime, target_folder_date_str: str,
+                   existing_order_links: Set[str], calls: Optional[List[dict]] = None) -> Set[str]:
+    """
+    Обрабатывает звонки за период: отчет UIS, отбор звонков, затем этапы обработки (run_call_stages).
+    Ход обработки сохраняется в контрольной точке окна: повторный запуск того же окна продолжает
+    с места остановки, не повторяя отчет, фильтрацию по CRM и платные запросы к OpenAI.
+    calls — уже известные звонки окна (уведомления UIS): тогда отчет UIS не запрашивается.
+
+    Returns:
+        Ссылки на заказы, отправленные в таблицу анализов за этот период.
+    """
+    logger.info(
+        f"Обработка звонков за период: {start_time_period.strftime('%Y-%m-%d %H:%M:%S')} - {end_time_period.strftime('%Y-%m-%d %H:%M:%S')}")
+    logger.info(f"Целевая дата папок для обработки: {target_folder_date_str}")
+
+    checkpoint = WindowCheckpoint.for_window(start_time_period, end_time_period, target_folder_date_str)
+    if not checkpoint.start_run():
+        logger.info(f"ℹ️ Окно {checkpoint.path.stem} уже обработано ({checkpoint.status}). Пропускаю.")
+        if checkpoint.status == STATUS_ABANDONED:
+            release_calls(checkpoint.path.stem)
+        return set()
+
+    # У каждого окна свой бюджет OpenAI (RUN_BUDGET_USD); при доработке окна учитываются его прошлые затраты
+    start_run(stored_cost_usd(CallStore(target_folder_date_str),
+                              [_communication_id(call) for call in checkpoint.calls])
+              if checkpoint.stage_done(STAGE_SELECT) else 0.0)
+
+    try:
+        if not checkpoint.stage_done(STAGE_SELECT):
+            if calls is None:
+                # 1. Получаем список всех звонков с метаданными
+                logger.info("--- Получение списка звонков с метаданными ---")
+                with timed_stage("calls_report"), log_context(stage="calls_report"):
+                    calls = get_calls_report(start_time_period.strftime("%Y-%m-%d %H:%M:%S"),
+                                             end_time_period.strftime("%Y-%m-%d %H:%M:%S"))
+                inc("pipeline_calls_total", len(calls), stage="reported")
+
+            if not calls:
+                logger.info("ℹ️ Нет звонков для обработки в указанном периоде.")
+                # Пустой отчет может означать и ошибку UIS: повторный запуск окна должен запросить отчет заново
+                checkpoint.discard()
+                return set()
+
+            # Звонки отмечаются за окном: если процесс упадет до сохранения отбора, повторный отбор окна их вернет
+            checkpoint.record_selection(*select_calls(calls, existing_order_links, owner=checkpoint.path.stem))
+
+        return run_call_stages(checkpoint.calls, checkpoint.merge_groups, target_folder_date_str,
+                               existing_order_links, checkpoint)
+    except DependencyUnavailableError as e:
+        # Пройденные этапы и проанализированные звонки сохранены в контрольной точке: следующий запуск продолжит
+        logger.warning(f"⏸ {e}: окно {checkpoint.path.stem} отложено до следующего запуска.")
+        checkpoint.defer()
+        return set()
+
+
+def select_calls(calls: List[dict], existing_order_links: Set[str],
+                 owner: Optional[str] = None) -> Tuple[List[dict], Dict[Any, List[Any]]]:
+    """
+    Отбирает звонки к обработке: фильтрация по правилам бизнеса и CRM, склейка повторных звонков клиента.
+    Отобранные звонки сразу отмечаются за владельцем (окном) как взятые в обработку (claim_calls),
+    уже взятые другим запуском пропускаются.
+
+    Returns:
+        (звонки к загрузке, группы повторных звонков для склейки транскриптов).
+    """
+    # Уже обработанные звонки отбрасываем до фильтрации, чтобы не тратить на них запросы в CRM
+    processed_calls.reload()
+    calls = [call for call in calls if not _claimed_by_other(_communication_id(call), owner)]
+    if not calls:
+        logger.info("ℹ️ Все звонки уже обработаны ранее.")
+        return [], {}
+
+    # 2. Фильтруем звонки по новым бизнес-правилам и готовим список к загрузке
+    logger.info("--- Фильтрация звонков по правилам бизнеса ---")
+    # Дешевые проверки (номер, направление, запись, длительность) выполняются векторно по всей таблице,
+    # а в CRM уходит только по одному запросу на каждый уникальный номер из оставшихся звонков.
+    with timed_stage("prefilter"), log_context(stage="prefilter"):
+        calls_frame = prefilter_calls(calls_to_frame(calls))
+    inc("pipeline_calls_total", len(calls_frame), stage="prefiltered")
+    phone_is_analyzable = {}
+    with timed_stage("crm_filter"), log_context(stage="crm_filter"):
+        for normalized_phone, phone_number in calls_frame.groupby("normalized_phone")["contact_phone_number"].first().items():
+            with log_context(phone=phone_number):
+                phone_is_analyzable[normalized_phone] = is_phone_analyzable(phone_number, existing_order_links)
+
+    passed = calls_frame["normalized_phone"].map(phone_is_analyzable).fillna(False).astype(bool)
+
+    # Повторные звонки одного клиента (тот же номер или тот же заказ) обрабатываются один раз.
+    # Последние заказы уже в кэше retailcrm_integration после проверки выше, поэтому новых запросов нет.
+    order_links = {normalized_phone: get_last_order_link_for_check(phone_number) or ""
+                   for normalized_phone, phone_number in
+                   calls_frame[passed].groupby("normalized_phone")["contact_phone_number"].first().items()}
+    deduped_frame, merge_groups = dedupe_calls(calls_frame[passed], order_links, DUPLICATE_CALLS_STRATEGY)
+    calls_to_download_and_process = claim_calls([calls[i] for i in deduped_frame.index], owner)
+    merge_groups = restrict_merge_groups(merge_groups, calls_to_download_and_process)
+    inc("pipeline_calls_total", int(passed.sum()), stage="crm_passed")
+    inc("pipeline_calls_total", len(calls_to_download_and_process), stage="to_download")
+
+    logger.info(f"➡️ Итого к загрузке и обработке: {len(calls_to_download_and_process)} звонков.")
+    return calls_to_download_and_process, merge_groups
+
+
+def window_report_title(checkpoint: WindowCheckpoint) -> str:
+    return f"Звонки {checkpoint.start.strftime('%d.%m %H:%M')}–{checkpoint.end.strftime('%d.%m %H:%M')}"
+
+
+def run_call_stages(calls_to_download_and_process: List[dict], merge_groups: Dict[Any, List[Any]],
+                    target_folder_date_str: str, existing_order_links: Set[str],
+                    checkpoint: Optional[WindowCheckpoint] = None) -> Set[str]:
+    """
+    Загрузка, транскрибация, анализ и отправка отобранных звонков.
+    С контрольной точкой пройденные этапы и уже проанализированные звонки пропускаются.
+
+    Returns:
+        Ссылки на заказы, отправленные в таблицу анализов.
+    """
+    if not calls_to_download_and_process:
+        logger.info("Нет звонков, соответствующих критериям фильтрации.")
+        if checkpoint:
+            checkpoint.complete()
+        return set()
+
+    if PIPELINE_MODE == "queue":
+        # Дальнейшие этапы выполнят воркеры; ссылки отправленных заказов они учитывают сами
+        # Отчет по окну в Telegram воркеры отправят один раз, когда будут обработаны все звонки окна
+        enqueue_call_groups(JobQueue(), calls_to_download_and_process, merge_groups, target_folder_date_str,
+                            window=checkpoint.path.stem if checkpoint else None,
+                            report_title=window_report_title(checkpoint) if checkpoint else None)
+        if checkpoint:
+            checkpoint.complete()
+        return set()
+
+    # 3. Загружаем и обрабатываем только отфильтрованные звонки
+    audio_dir = Path("audio") / f"звонки_{target_folder_date_str}"
+    audio_dir.mkdir(parents=True, exist_ok=True)
+    # Звонки, скачанные до сбоя, повторно не скачиваются
+    store = CallStore(target_folder_date_str)
+    call_ids = [_communication_id(call) for call in calls_to_download_and_process]
+    stems = _load_call_stems(store)
+    if not (checkpoint and checkpoint.stage_done(STAGE_DOWNLOAD)):
+        missing = [call for call in calls_to_download_and_process if _communication_id(call) not in stems]
+        logger.info("--- Загрузка отфильтрованных звонков ---")
         # Здесь мы используем существующую функцию download_calls, передавая ей только нужные звонки.
-        downloaded_call_info_paths = download_calls(calls_to_download_and_process, audio_dir)
-        print(f"Статус папки аудио: {audio_dir.exists()} (содержит {len(list(audio_dir.glob('*.mp3')))} mp3 файлов)")
-
-        # 4. Транскрибация и анализ
-        if downloaded_call_info_paths:
-            print("\n--- Транскрибация звонков ---")
-            transcribe_all(target_folder_date_str, assign_roles=True)
-            transcripts_dir = Path("transcripts") / f"транскрибация_{target_folder_date_str}"
-            print(
-                f"Статус папки транскриптов: {transcripts_dir.exists()} (содержит {len(list(transcripts_dir.glob('*.txt')))} txt файлов)")
-
-            print("\n--- Анализ транскриптов ---")
-            analyze_transcripts(target_folder_date_str)
-            analyses_dir = Path("analyses") / f"транскрибация_{target_folder_date_str}"
-            print(
-                f"Статус папки анализов: {analyses_dir.exists()} (содержит {len(list(analyses_dir.glob('*_analysis.json')))} json файлов)")
-
-            # 5. Отправка анализов
-            # ИЗМЕНЕНИЕ: Передаем набор уже существующих ссылок
-            send_all_analyses_to_integrations(analyses_dir, target_folder_date_str, existing_order_links)
-
-        # 6. УДАЛЕНИЕ СКАЧАННОГО ФАЙЛА GOOGLE SHEETS
-        if gs_file_path.exists():
-            try:
-                os.remove(gs_file_path)
-                print(f"\n🧹 Файл {GS_XLSX_FILENAME} успешно удален.")
-            except Exception as e:
-                print(f"❌ Ошибка при удалении файла {GS_XLSX_FILENAME}: {e}")
-
-    print("\n✅ Пайплайн обработки звонков завершен.")
+        with timed_stage("download"), log_context(stage="download"):
+            downloaded_ids = download_calls(missing, audio_dir, store)
+        inc("pipeline_calls_total", len(downloaded_ids), stage="downloaded")
+        logger.info(f"Статус папки аудио: {audio_dir.exists()} (содержит {len(list(audio_dir.glob('*.mp3')))} mp3 файлов)")
+        stems = _load_call_stems(store)
+        if checkpoint:
+            checkpoint.mark_stage(STAGE_DOWNLOAD)
+
+    # Анализируются и отправляются только звонки этого запуска: папка за день общая для всех запусков
+    run_stems = {stems[call_id][0] for call_id in call_ids if call_id in stems}
+    if not run_stems:
+        if checkpoint:
+            checkpoint.complete()
+        return set()
+
+    # 4. Транскрибация и анализ
+    if not (checkpoint and checkpoint.stage_done(STAGE_TRANSCRIBE)):
+        logger.info("--- Транскрибация звонков ---")
+        with timed_stage("transcribe"), log_context(stage="transcribe"):
+            transcribe_all(target_folder_date_str, assign_roles=True, only_ids=call_ids)
+        if merge_groups:
+            with log_context(stage="transcribe"):
+                merge_duplicate_transcripts(target_folder_date_str, merge_groups)
+        logger.info(f"Статус хранилища: {len(store.transcripts)} транскриптов за {target_folder_date_str}")
+        if checkpoint:
+            checkpoint.mark_stage(STAGE_TRANSCRIBE)
+
+    if not (checkpoint and checkpoint.stage_done(STAGE_ANALYZE)):
+        logger.info("--- Анализ транскриптов ---")
+        # Звонки, проанализированные до сбоя, повторно в OpenAI не отправляются
+        stems_to_analyze = run_stems - checkpoint.analyzed_stems if checkpoint else run_stems
+        with timed_stage("analyze"), log_context(stage="analyze"):
+            analyze_transcripts(target_folder_date_str, only_stems=stems_to_analyze,
+                                on_analyzed=checkpoint.mark_analyzed if checkpoint else None)
+        logger.info(f"Статус хранилища: {len(store.analyses)} анализов за {target_folder_date_str}")
+        if checkpoint:
+            checkpoint.mark_stage(STAGE_ANALYZE)
+
+    # 5. Отправка анализов
+    if checkpoint and checkpoint.stage_done(STAGE_DELIVER):
+        sent_order_links = checkpoint.sent_order_links
+    else:
+        # ИЗМЕНЕНИЕ: Передаем набор уже существующих ссылок
+        with timed_stage("deliver"), log_context(stage="deliver"):
+            report_title = window_report_title(checkpoint) if checkpoint else None
+            sent_order_links = send_all_analyses_to_integrations(target_folder_date_str, existing_order_links,
+                                                                 only_stems=run_stems, report_title=report_title)
+        if checkpoint:
+            checkpoint.record_sent(sent_order_links)
+
+    if checkpoint:
+        checkpoint.complete()
+    return sent_order_links
+
+
+def resume_incomplete_windows(existing_order_links: Optional[Set[str]] = None) -> Set[str]:
+    """
+    Дорабатывает окна, обработка которых была прервана (есть незавершенная контрольная точка).
+    """
+    checkpoints = incomplete_checkpoints()
+    if not checkpoints:
+        logger.info("ℹ️ Незавершенных окон нет.")
+        return set()
+
+    logger.info(f"♻️ Незавершенных окон: {len(checkpoints)}.")
+    if existing_order_links is None:
+        existing_order_links = load_existing_order_links()
+    sent_order_links = set()
+    for checkpoint in checkpoints:
+        with log_context(stage="resume"):
+            sent = process_period(checkpoint.start, checkpoint.end, checkpoint.folder_date, existing_order_links)
+        existing_order_links |= sent
+        sent_order_links |= sent
+    return sent_order_links
+
+
+def run_processing_pipeline(now: Optional[datetime] = None):
+    """
+    Определяет текущий временной диапазон для обработки звонков
+    на основе текущего времени по МСК и запускает пайплайн.
+
+    Args:
+        now: Момент запуска (по умолчанию — текущее время). Нужен для воспроизводимых прогонов, например в benchmarks/.
+    """
+    current_time_msk = now.astimezone(MSK) if now else datetime.now(MSK)
+
+    logger.info(f"Текущее время по МСК: {current_time_msk.strftime('%Y-%m-%d %H:%M:%S')}")
+
+    # Сроки хранения и квоты соблюдаются в фоне, не задерживая обработку (см. retention.py)
+    start_background_retention()
+    prune_checkpoints()
+
+    # Сначала дорабатываем окна, прерванные сбоем (в том числе текущее, если запуск перезапущен)
+    existing_order_links = None
+    if incomplete_checkpoints():
+        existing_order_links = load_existing_order_links()
+        resume_incomplete_windows(existing_order_links)
+
+    window = resolve_processing_window(current_time_msk)
+    if not window:
+        logger.info(
+            f"Текущее время не соответствует запланированным периодам обработки ({PROCESSING_RUN_TIMES} МСК). Пропускаю выполнение.")
+        return
+
+    start_time_period, end_time_period, target_folder_date_str = window
+    if existing_order_links is None:
+        existing_order_links = load_existing_order_links()
+    process_period(start_time_period, end_time_period, target_folder_date_str, existing_order_links)
+
+    logger.info("✅ Пайплайн обработки звонков завершен.")
 
 
 if __name__ == "__main__":
-    print("🚀 Запуск пайплайна...")
-    run_processing_pipeline()
-    print("\n✅ Скрипт успешно завершил работу.")
+    parser = argparse.ArgumentParser(description="Пайплайн обработки звонков.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Только доработать окна, обработка которых была прервана, и завершиться.")
+    args = parser.parse_args()
+
+    setup_logging()
+    logger.info("🚀 Запуск пайплайна...")
+    if METRICS_PORT:
+        start_metrics_server(int(METRICS_PORT))
+    with timed_stage("total"):
+        if args.resume:
+            resume_incomplete_windows()
+        else:
+            run_processing_pipeline()
+    # Выбор моделей, средние задержки, доли повышений уровня и затраты на OpenAI — в JSON-сводке запуска
+    export_run_metrics(extra={"model_routing": routing_stats(), "costs": run_summary(),
+                              "circuits": circuit_states()})
+    logger.info("✅ Скрипт успешно завершил работу.")
@@ -0,0 +1,309 @@
+import os
+import logging
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Dict, Tuple, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+# Куда выгружать метрики по окончании запуска:
+# METRICS_TEXTFILE — файл для textfile collector node_exporter (например, /var/lib/node_exporter/pipeline.prom),
+# METRICS_SUMMARY_DIR — папка для JSON-сводки каждого запуска,
+# METRICS_PORT — порт локального HTTP-эндпоинта /metrics (для долгоживущего процесса).
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE")
+METRICS_SUMMARY_DIR = Path(os.getenv("METRICS_SUMMARY_DIR", "metrics"))
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+# Границы корзин гистограмм длительности (секунды): от быстрых запросов CRM до Whisper на длинных звонках
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+HELP = {
+    "pipeline_stage_duration_seconds": "Длительность этапов пайплайна",
+    "external_request_duration_seconds": "Длительность запросов к внешним сервисам",
+    "external_requests_total": "Число запросов к внешним сервисам",
+    "external_request_retries_total": "Число повторов запросов к внешним сервисам",
+    "cache_requests_total": "Обращения к кэшам (hit/miss)",
+    "openai_tokens_total": "Токены OpenAI",
+    "pipeline_calls_total": "Звонки, прошедшие этапы пайплайна",
+    "uis_record_bytes_total": "Объем скачанных записей разговоров, байт",
+    "webhook_notifications_total": "Уведомления UIS о завершенных звонках",
+    "queue_jobs_total": "Задачи очереди воркеров по этапам и исходам",
+    "retention_actions_total": "Перекодированные и удаленные записи и папки результатов",
+    "retention_freed_bytes_total": "Объем, освобожденный очисткой хранилища, байт",
+    "rescore_calls_total": "Звонки, переоцененные под новую версию промпта",
+    "model_routing_total": "Запросы к моделям по этапам и исходам проверки ответа (accepted/escalated/error)",
+    "model_request_duration_seconds": "Длительность запросов к моделям по этапам",
+    "openai_cost_usd_total": "Затраты на OpenAI по этапам и моделям, USD",
+    "openai_audio_seconds_total": "Длительность аудио, отправленного в Whisper, секунд",
+    "budget_mode_changes_total": "Переключения режима по бюджету запуска (economy/minimal)",
+    "circuit_state_changes_total": "Переключения предохранителей внешних сервисов (open/half_open/closed)",
+    "circuit_rejected_total": "Запросы, отклоненные разомкнутым предохранителем",
+    "crm_mirror_syncs_total": "Синхронизации зеркала RetailCRM",
+    "crm_mirror_sync_errors_total": "Неудачные синхронизации зеркала RetailCRM",
+    "crm_mirror_changes_total": "Измененные и удаленные сущности, полученные зеркалом RetailCRM из истории",
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(label_key: LabelKey, extra: Optional[Dict[str, str]] = None) -> str:
+    pairs = list(label_key) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (f'{key}="{_escape_label_value(value)}"' for key, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class _Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    """
+    Потокобезопасное хранилище счетчиков и гистограмм с выводом в формате OpenMetrics/Prometheus
+    и в JSON-сводку запуска.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, _Histogram]] = {}
+        self.started_at = datetime.now()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            series.setdefault(key, _Histogram()).observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started_at = datetime.now()
+
+    def render(self) -> str:
+        """
+        Текстовый формат OpenMetrics (совместим с Prometheus text exposition).
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(series.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{_format_labels(key, {'le': str(bound)})} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(key, {'le': '+Inf'})} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {round(histogram.sum, 6)}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Сводка запуска: для гистограмм — count/sum/avg/max, для счетчиков — значения.
+        """
+        with self._lock:
+            histograms = {
+                name: [
+                    {"labels": dict(key), "count": h.count, "sum": round(h.sum, 3),
+                     "avg": round(h.sum / h.count, 3) if h.count else 0, "max": round(h.max, 3)}
+                    for key, h in sorted(series.items())
+                ]
+                for name, series in self._histograms.items()
+            }
+            counters = {
+                name: [{"labels": dict(key), "value": value} for key, value in sorted(series.items())]
+                for name, series in self._counters.items()
+            }
+        return {
+            "started_at": self.started_at.isoformat(),
+            "finished_at": datetime.now().isoformat(),
+            "histograms": histograms,
+            "counters": counters,
+        }
+
+
+# Метрики текущего запуска (окна) — для JSON-сводки; сбрасываются в начале каждого запуска (start_run_metrics)
+REGISTRY = MetricsRegistry()
+# Метрики с начала процесса — для /metrics и textfile: счетчики Prometheus должны только расти
+CUMULATIVE = MetricsRegistry()
+
+
+def inc(name: str, amount: float = 1, **labels):
+    REGISTRY.inc(name, amount, **labels)
+    CUMULATIVE.inc(name, amount, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    REGISTRY.observe(name, value, **labels)
+    CUMULATIVE.observe(name, value, **labels)
+
+
+def start_run_metrics():
+    """
+    Начинает сводку нового запуска: в долгоживущем процессе (демон, приемник вебхуков) у каждого окна
+    своя сводка со своим временем начала.
+    """
+    REGISTRY.reset()
+
+
+@contextmanager
+def timed_stage(stage: str):
+    """
+    Замеряет длительность этапа пайплайна (pipeline_stage_duration_seconds{stage=...}).
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("pipeline_stage_duration_seconds", time.perf_counter() - started, stage=stage)
+
+
+@contextmanager
+def track_request(service: str, operation: str):
+    """
+    Замеряет запрос к внешнему сервису: длительность и исход (ok/error — исключение внутри блока).
+    """
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        observe("external_request_duration_seconds", time.perf_counter() - started, service=service,
+                operation=operation)
+        inc("external_requests_total", service=service, operation=operation, outcome=outcome)
+
+
+def record_retry(service: str, operation: str):
+    inc("external_request_retries_total", service=service, operation=operation)
+
+
+def record_cache(cache: str, hit: bool):
+    inc("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+
+def record_openai_usage(stage: str, model: str, usage: Any):
+    """
+    Учитывает токены из поля usage ответа OpenAI (если оно есть).
+    """
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    inc("openai_tokens_total", prompt_tokens, stage=stage, model=model, kind="prompt")
+    inc("openai_tokens_total", completion_tokens, stage=stage, model=model, kind="completion")
+    if cached_tokens:
+        inc("openai_tokens_total", cached_tokens, stage=stage, model=model, kind="cached")
+
+
+def write_textfile(path: str):
+    """
+    Атомарно записывает метрики в файл для textfile collector node_exporter.
+    """
+    target = Path(path)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = target.with_suffix(target.suffix + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(CUMULATIVE.render())
+    os.replace(tmp_path, target)
+
+
+def write_run_summary(summary_dir: Path = METRICS_SUMMARY_DIR, extra: Optional[Dict[str, Any]] = None) -> Path:
+    """
+    Сохраняет JSON-сводку запуска в summary_dir/run_ГГГГММДД_ЧЧММСС.json (время начала запуска).
+    """
+    summary_dir.mkdir(parents=True, exist_ok=True)
+    summary = REGISTRY.summary()
+    if extra:
+        summary.update(extra)
+    path = summary_dir / f"run_{REGISTRY.started_at.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def export_run_metrics(extra: Optional[Dict[str, Any]] = None):
+    """
+    Выгружает метрики запуска: JSON-сводка всегда, textfile — если задан METRICS_TEXTFILE.
+    """
+    try:
+        summary_path = write_run_summary(extra=extra)
+        logger.info(f"📊 Сводка метрик запуска сохранена: {summary_path}")
+        if METRICS_TEXTFILE:
+            write_textfile(METRICS_TEXTFILE)
+            logger.info(f"📊 Метрики записаны для textfile collector: {METRICS_TEXTFILE}")
+    except OSError as e:
+        logger.warning(f"⚠️ Не удалось сохранить метрики запуска: {e}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = CUMULATIVE.render().encode("utf-8")
+        self.send_response(200)
+        # Формат Prometheus text exposition 0.0.4 (строка "# EOF" для него — обычный комментарий)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Не засоряем вывод пайплайна логами каждого опроса Prometheus
+        pass
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    """
+    Поднимает локальный эндпоинт /metrics в фоновом потоке.
+    """
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"📊 Эндпоинт метрик запущен: http://0.0.0.0:{port}/metrics")
+    return server
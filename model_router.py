@@ -0,0 +1,141 @@
+import os
+import time
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Callable, Tuple, TypeVar
+
+from dotenv import load_dotenv
+
+from metrics import inc, observe, record_retry
+from cost_accounting import budget_mode, BUDGET_MODE_NORMAL, BUDGET_MODE_MINIMAL
+from circuit_breaker import defer_if_unavailable
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+T = TypeVar("T")
+
+# Уровни моделей по этапам: от самой дешевой и быстрой к самой сильной (через запятую).
+# Короткие тексты начинают с первого уровня, длинные — со второго; при непрошедшей проверке ответа
+# запрос повторяется на следующем уровне.
+ANALYSIS_MODEL_TIERS = os.getenv("ANALYSIS_MODEL_TIERS", "gpt-5-nano,gpt-5-mini,gpt-5")
+ROLE_SPLIT_MODEL_TIERS = os.getenv("ROLE_SPLIT_MODEL_TIERS", "gpt-4o-mini,gpt-4o")
+# Текст короче стольких символов считается коротким звонком
+ROUTING_SHORT_TEXT_CHARS = int(os.getenv("ROUTING_SHORT_TEXT_CHARS", "2500"))
+# Всего попыток на один запрос (с учетом повышений уровня)
+ROUTING_MAX_ATTEMPTS = 3
+ROUTING_RETRY_DELAY = 2
+
+OUTCOME_ACCEPTED = "accepted"
+OUTCOME_ESCALATED = "escalated"
+OUTCOME_ERROR = "error"
+
+
+def _parse_tiers(value: str) -> List[str]:
+    return [model.strip() for model in value.split(",") if model.strip()]
+
+
+class ModelRouter:
+    """
+    Выбор модели для этапа по длине входного текста с повышением уровня, если ответ не прошел проверку.
+
+    run() вызывает request(model) и проверяет результат validate(result) — список найденных проблем.
+    Ответ с проблемами на последнем уровне принимается как есть (дальше его исправляет вызывающий код,
+    как и без маршрутизации). Когда бюджет запуска почти исчерпан (cost_accounting.budget_mode), уровень
+    не повышается, а после исчерпания все запросы идут на первый уровень. Выбор моделей, задержки и повышения уровня учитываются в метриках
+    (model_routing_total, model_request_duration_seconds) и в stats().
+    """
+
+    def __init__(self, stage: str, tiers: List[str], short_text_chars: int = ROUTING_SHORT_TEXT_CHARS):
+        if not tiers:
+            raise ValueError(f"Не заданы модели для этапа {stage}")
+        self.stage = stage
+        self.tiers = tiers
+        self.short_text_chars = short_text_chars
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, Any]] = {}
+
+    def start_tier(self, text_length: int) -> int:
+        if text_length < self.short_text_chars:
+            return 0
+        return min(1, len(self.tiers) - 1)
+
+    def _record(self, model: str, seconds: float, outcome: str):
+        inc("model_routing_total", stage=self.stage, model=model, outcome=outcome)
+        observe("model_request_duration_seconds", seconds, stage=self.stage, model=model)
+        with self._lock:
+            stats = self._stats.setdefault(model, {"requests": 0, "seconds": 0.0, OUTCOME_ACCEPTED: 0,
+                                                   OUTCOME_ESCALATED: 0, OUTCOME_ERROR: 0})
+            stats["requests"] += 1
+            stats["seconds"] += seconds
+            stats[outcome] += 1
+
+    def run(self, text_length: int, request: Callable[[str], T], validate: Callable[[T], List[str]],
+            label: str = "", model: Optional[str] = None) -> Tuple[Optional[T], Optional[str]]:
+        """
+        Выполняет запрос с выбором и повышением модели. С model — только эта модель, без маршрутизации.
+
+        Returns:
+            (результат или None, если все попытки завершились ошибкой; модель, чей результат возвращен)
+        """
+        mode = budget_mode()
+        tiers = [model] if model else self.tiers
+        tier = 0 if model or mode == BUDGET_MODE_MINIMAL else self.start_tier(text_length)
+        if mode != BUDGET_MODE_NORMAL:
+            tiers = tiers[:tier + 1]
+        result, result_model = None, None
+        for attempt in range(max(ROUTING_MAX_ATTEMPTS, len(tiers) - tier)):
+            current = tiers[tier]
+            if attempt > 0:
+                record_retry("openai", self.stage)
+            started = time.perf_counter()
+            try:
+                candidate = request(current)
+            except Exception as e:
+                self._record(current, time.perf_counter() - started, OUTCOME_ERROR)
+                # OpenAI недоступен: ни повтор, ни другая модель не помогут
+                defer_if_unavailable("openai", e)
+                logger.warning(f"⚠️ Ошибка запроса {self.stage} ({current}) для {label} (попытка {attempt + 1}): {e}")
+                if tier < len(tiers) - 1:
+                    tier += 1
+                time.sleep(ROUTING_RETRY_DELAY)
+                continue
+
+            seconds = time.perf_counter() - started
+            problems = validate(candidate)
+            result, result_model = candidate, current
+            if problems and tier < len(tiers) - 1:
+                self._record(current, seconds, OUTCOME_ESCALATED)
+                tier += 1
+                logger.info(f"⬆️ Ответ {current} для {label} не прошел проверку ({'; '.join(problems)}). "
+                            f"Повтор на {tiers[tier]}.")
+                continue
+            self._record(current, seconds, OUTCOME_ACCEPTED)
+            break
+        return result, result_model
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        По модели: число запросов, средняя задержка и доля повышений уровня.
+        """
+        with self._lock:
+            return {model: {"requests": stats["requests"],
+                            "avg_seconds": round(stats["seconds"] / stats["requests"], 3),
+                            "escalation_rate": round(stats[OUTCOME_ESCALATED] / stats["requests"], 3),
+                            "errors": stats[OUTCOME_ERROR]}
+                    for model, stats in self._stats.items()}
+
+
+ROUTERS = {
+    "analysis": ModelRouter("analysis", _parse_tiers(ANALYSIS_MODEL_TIERS)),
+    "role_split": ModelRouter("role_split", _parse_tiers(ROLE_SPLIT_MODEL_TIERS)),
+}
+
+
+def get_router(stage: str) -> ModelRouter:
+    return ROUTERS[stage]
+
+
+def routing_stats() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    return {stage: router.stats() for stage, router in ROUTERS.items()}
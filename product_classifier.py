@@ -0,0 +1,216 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Callable, Iterable
+
+import yaml
+from dotenv import load_dotenv
+
+from metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Правила категорий товаров (ключевые слова и группы каталога); файл перечитывается при изменении
+PRODUCT_CONFIG_PATH = Path(os.getenv("PRODUCT_CONFIG_PATH", "product_config.yaml"))
+# Группы товаров каталога RetailCRM по id торгового предложения
+CATALOG_GROUPS_CACHE_PATH = Path(os.getenv("CATALOG_GROUPS_CACHE_PATH", "cache/retailcrm_offer_groups.json"))
+DEFAULT_CATALOG_CACHE_TTL_HOURS = 24
+
+CATEGORY_PLANT = "plant"
+CATEGORY_CACHEPOT = "cachepot"
+
+# Правила по умолчанию, если product_config.yaml нет (совпадают с прежней эвристикой по названию)
+DEFAULT_KEYWORDS = {
+    CATEGORY_CACHEPOT: ["кашпо", "lechuza", "горшок"],
+    "accessory": ["грунт", "дренаж", "пересадка", "средство", "ламп"],
+}
+
+# Запрос групп каталога: id предложений -> {id предложения: [id и externalId групп товара]}.
+# Предложения, которых нет в ответе, не получены (ошибка запроса) и не кэшируются.
+FetchGroups = Callable[[List[str]], Dict[str, List[str]]]
+
+
+def load_product_config(config_path: Path = PRODUCT_CONFIG_PATH) -> Dict[str, Any]:
+    """
+    Загружает правила категорий товаров из YAML. Возвращает пустой словарь, если файла нет.
+    """
+    if not config_path.exists():
+        return {}
+    try:
+        with open(config_path, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f) or {}
+    except (yaml.YAMLError, OSError) as e:
+        logger.warning(f"⚠️ Не удалось прочитать {config_path}: {e}. Используем правила по умолчанию.")
+        return {}
+
+
+def _offer_key(item: Dict[str, Any]) -> Optional[str]:
+    offer = item.get("offer") or {}
+    key = offer.get("id") or offer.get("externalId") or offer.get("article")
+    return str(key) if key else None
+
+
+class CatalogGroupCache:
+    """
+    Дисковый кэш групп каталога по id торгового предложения с TTL: группы товара почти не меняются,
+    поэтому каталог запрашивается только для новых предложений.
+    """
+
+    def __init__(self, path: Path = CATALOG_GROUPS_CACHE_PATH, ttl_hours: float = DEFAULT_CATALOG_CACHE_TTL_HOURS):
+        self.path = path
+        self.ttl_seconds = ttl_hours * 3600
+        self._lock = threading.Lock()
+        self._entries: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self._entries is None:
+            self._entries = {}
+            if self.path.exists():
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        self._entries = json.load(f)
+                except (json.JSONDecodeError, OSError) as e:
+                    logger.warning(f"⚠️ Не удалось прочитать кэш групп каталога {self.path}: {e}")
+        return self._entries
+
+    def get_many(self, offer_ids: Iterable[str], fetch: FetchGroups) -> Dict[str, List[str]]:
+        """
+        Группы предложений из кэша; недостающие и устаревшие запрашиваются одним вызовом fetch.
+        Кэшируются только предложения из ответа fetch: после ошибки CRM они будут запрошены снова.
+        Предложений, групп которых нет ни в кэше, ни в ответе, в результате нет.
+        """
+        with self._lock:
+            entries = self._load()
+            now = time.time()
+            missing = [offer_id for offer_id in offer_ids
+                       if now - entries.get(offer_id, {}).get("fetched_at", 0) >= self.ttl_seconds]
+            if missing:
+                fetched = fetch(missing)
+                # Предложение без групп (пустой список в ответе) тоже кэшируется, чтобы не запрашивать его снова
+                for offer_id, groups in fetched.items():
+                    entries[offer_id] = {"groups": groups, "fetched_at": now}
+                if fetched:
+                    self._save()
+                if len(fetched) < len(missing):
+                    logger.warning(f"⚠️ Группы каталога не получены для {len(missing) - len(fetched)} предложений: "
+                                   f"они не кэшируются и будут запрошены снова.")
+            return {offer_id: entries[offer_id]["groups"] for offer_id in offer_ids if offer_id in entries}
+
+    def _save(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось сохранить кэш групп каталога: {e}")
+
+
+class ProductClassifier:
+    """
+    Категория товара заказа: по ключевым словам в названии (все правила собраны в одно регулярное выражение),
+    иначе по группам каталога RetailCRM (catalog_groups), иначе default_category.
+    Категория кэшируется по id торгового предложения.
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        keywords = config.get("keywords") or DEFAULT_KEYWORDS
+        # Порядок категорий в конфиге — их приоритет при совпадении слов нескольких категорий
+        self.categories = list(keywords)
+        alternatives = [f"(?P<c{index}>{'|'.join(re.escape(word) for word in words)})"
+                        for index, words in enumerate(keywords.values()) if words]
+        # Опережающая проверка не поглощает текст: слово категории внутри более длинного слова другой
+        # категории ("кашпо" в "для кашпо") тоже находится
+        self._pattern = re.compile(f"(?=(?:{'|'.join(alternatives)}))", re.IGNORECASE) if alternatives else None
+        self.default_category = config.get("default_category", CATEGORY_PLANT)
+        self.catalog_groups = {str(group): category for group, category in (config.get("catalog_groups") or {}).items()}
+        self.group_cache = CatalogGroupCache(
+            ttl_hours=float(config.get("catalog_cache_ttl_hours", DEFAULT_CATALOG_CACHE_TTL_HOURS)))
+        self._offer_categories: Dict[str, str] = {}
+
+    def classify_name(self, name: str) -> Optional[str]:
+        """
+        Категория по ключевым словам в названии или None, если ни одно слово не встретилось.
+        """
+        if not self._pattern or not name:
+            return None
+        best = None
+        for match in self._pattern.finditer(name):
+            index = int(match.lastgroup[1:])
+            if best is None or index < best:
+                best = index
+                if best == 0:
+                    break
+        return self.categories[best] if best is not None else None
+
+    def _category_by_groups(self, groups: List[str]) -> str:
+        for group in groups:
+            if group in self.catalog_groups:
+                return self.catalog_groups[group]
+        return self.default_category
+
+    def classify_items(self, items: List[Dict[str, Any]], fetch_groups: Optional[FetchGroups] = None) -> List[str]:
+        """
+        Категории позиций заказа (в том же порядке). Группы каталога для позиций, не распознанных по названию,
+        запрашиваются одним вызовом fetch_groups — только если в конфиге заданы catalog_groups.
+        """
+        categories: List[Optional[str]] = []
+        unresolved: Dict[str, List[int]] = {}
+        for position, item in enumerate(items):
+            key = _offer_key(item)
+            if key in self._offer_categories:
+                record_cache("product_category", hit=True)
+                categories.append(self._offer_categories[key])
+                continue
+            record_cache("product_category", hit=False)
+
+            category = self.classify_name((item.get("offer") or {}).get("name") or item.get("productName") or "")
+            if category is None and key and self.catalog_groups and fetch_groups:
+                unresolved.setdefault(key, []).append(position)
+            elif category is None:
+                category = self.default_category
+            if category is not None and key:
+                self._offer_categories[key] = category
+            categories.append(category)
+
+        if unresolved:
+            groups = self.group_cache.get_many(list(unresolved), fetch_groups)
+            for key, positions in unresolved.items():
+                category = self._category_by_groups(groups.get(key, []))
+                # Без групп из каталога (ошибка CRM) категория по умолчанию не запоминается
+                if key in groups:
+                    self._offer_categories[key] = category
+                for position in positions:
+                    categories[position] = category
+        return categories
+
+
+_classifier: Optional[ProductClassifier] = None
+_classifier_mtime: Optional[float] = None
+_classifier_lock = threading.Lock()
+
+
+def get_classifier(config_path: Path = PRODUCT_CONFIG_PATH) -> ProductClassifier:
+    """
+    Классификатор по текущему product_config.yaml: правила компилируются один раз и пересобираются
+    при изменении файла (вместе с кэшем категорий по предложениям).
+    """
+    global _classifier, _classifier_mtime
+    try:
+        mtime = config_path.stat().st_mtime
+    except OSError:
+        mtime = None
+    with _classifier_lock:
+        if _classifier is None or mtime != _classifier_mtime:
+            _classifier = ProductClassifier(load_product_config(config_path))
+            _classifier_mtime = mtime
+            logger.info(f"ℹ️ Правила категорий товаров: {', '.join(_classifier.categories)} "
+                        f"(по умолчанию {_classifier.default_category}).")
+        return _classifier
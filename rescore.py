@@ -0,0 +1,311 @@
+import os
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Tuple
+
+from dotenv import load_dotenv
+
+import analyzer
+import artifacts
+from call_store import CallStore, StageStore, CALL_STORE_DIR
+from metrics import inc
+from cost_accounting import usage_cost_usd
+from log_config import setup_logging, log_context
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Число параллельных запросов к OpenAI при переоценке
+RESCORE_WORKERS = int(os.getenv("RESCORE_WORKERS", "8"))
+# Лимит затрат одного запуска переоценки, USD (0 — без лимита)
+RESCORE_MAX_COST_USD = float(os.getenv("RESCORE_MAX_COST_USD", "0"))
+# Прогресс и пропускная способность выводятся каждые столько звонков
+RESCORE_PROGRESS_EVERY = 25
+# Оценка стоимости запроса до его отправки (резерв под лимит затрат): символов текста на токен
+# и выходных токенов (с рассуждениями модели) на запрос
+RESCORE_CHARS_PER_TOKEN = 3
+RESCORE_COMPLETION_TOKENS_ESTIMATE = 1000
+
+DATE_FORMAT = "%d.%m.%Y"
+
+
+class RescoreJob:
+    """
+    Один звонок для переоценки: транскрипт и анализ, с которым будет сравниваться новая оценка.
+    """
+
+    def __init__(self, target: StageStore, communication_id: str, stem: str, transcript: str,
+                 base_record: Dict[str, Any], initial_category: str):
+        self.target = target
+        self.communication_id = communication_id
+        self.stem = stem
+        self.transcript = transcript
+        self.base_record = base_record
+        self.initial_category = initial_category
+
+    @property
+    def base_analysis(self) -> Dict[str, Any]:
+        return self.base_record["analysis"]
+
+
+class Rescorer:
+    """
+    Переоценка сохраненных транскриптов под новую версию промпта и критериев.
+
+    Новые оценки пишутся в хранилище рядом со старыми (store/звонки_<дата>/analyses.<версия>.jsonl),
+    основные анализы не меняются. Уже переоцененные под эту версию звонки пропускаются, поэтому
+    прерванный запуск продолжается с места остановки.
+
+    Если заданы criteria (или stale — устаревшие критерии каждого звонка), оцениваются только они,
+    короткими запросами по группам критериев (analyzer.score_criteria); остальные оценки, резюме
+    и категория переносятся из старого анализа. Звонки, которые в старом анализе не были заказами,
+    в этом режиме в OpenAI не отправляются (критерии продаж у них нулевые).
+    """
+
+    def __init__(self, dates: List[str], prompt_version: str = analyzer.PROMPT_VERSION,
+                 criteria: Optional[List[str]] = None, stale: bool = False, workers: int = RESCORE_WORKERS,
+                 max_cost_usd: float = RESCORE_MAX_COST_USD, model: str = analyzer.ANALYSIS_MODEL):
+        unknown = [key for key in criteria or [] if key not in analyzer.CRITERIA]
+        if unknown:
+            raise ValueError(f"Неизвестные критерии: {', '.join(unknown)}")
+        self.dates = dates
+        self.prompt_version = prompt_version
+        self.criteria = criteria
+        self.stale = stale
+        self.workers = workers
+        self.max_cost_usd = max_cost_usd
+        self.model = model
+
+        self._lock = threading.Lock()
+        self.cost_usd = 0.0
+        # Зарезервировано под выполняющиеся запросы: лимит затрат учитывает и их
+        self.reserved_usd = 0.0
+        self.tokens = 0
+        self.done = 0
+        self.failed = 0
+        self.skipped_by_budget = 0
+        self.skipped_corrupted = 0
+        self.changed: Dict[str, int] = {key: 0 for key in analyzer.CRITERIA}
+
+    def collect(self) -> Tuple[List[RescoreJob], int]:
+        """
+        Звонки за период, которые еще не переоценены под prompt_version, и число уже переоцененных.
+        """
+        jobs = []
+        already_done = 0
+        for date_str in self.dates:
+            if not (CALL_STORE_DIR / f"звонки_{date_str}").exists():
+                continue
+            store = CallStore(date_str)
+            rescored = store.versioned_analyses(self.prompt_version)
+            base_ids = set(store.analyses.keys())
+            # Поврежденная запись хранилища пропускает один звонок, а не весь запуск
+            for transcript_record in store.transcripts.read(base_ids, skip_corrupted=True):
+                # Склеенные транскрипты анализируются в составе основного звонка клиента
+                if transcript_record["merged"] or transcript_record["text"].startswith("[Ошибка транскрибации]"):
+                    continue
+                communication_id = transcript_record["communication_id"]
+                try:
+                    base_record = store.analyses.get(communication_id)
+                except artifacts.ArtifactCorruptedError as e:
+                    logger.warning(f"⚠️ {e}. Звонок {transcript_record['stem']} пропущен.")
+                    self.skipped_corrupted += 1
+                    continue
+                if base_record.get("prompt_version") == self.prompt_version or communication_id in rescored or \
+                        (self.stale and not analyzer.stale_criteria(base_record)):
+                    already_done += 1
+                    continue
+                try:
+                    call_info = store.calls.get(communication_id)
+                except artifacts.ArtifactCorruptedError as e:
+                    logger.warning(f"⚠️ {e}. Категория по данным звонка не определена.")
+                    call_info = None
+                initial_category = (analyzer.categorize_call_by_metadata(call_info.get("raw", {}))
+                                    if call_info else "Неизвестно")
+                jobs.append(RescoreJob(rescored, communication_id, transcript_record["stem"],
+                                       transcript_record["text"], base_record, initial_category))
+        return jobs, already_done
+
+    def estimate_cost_usd(self, job: RescoreJob) -> float:
+        """
+        Оценка стоимости переоценки звонка до отправки запросов: по длине промпта и транскрипта.
+        """
+        if self.criteria or self.stale:
+            if job.base_analysis.get("call_category") != "Заказ":
+                return 0.0
+            requests = len(analyzer.criteria_groups(self.criteria or analyzer.stale_criteria(job.base_record)))
+            prompt_chars = requests * (len(analyzer.GROUP_PROMPT_TEMPLATE) + len(job.transcript))
+        else:
+            requests = 1
+            prompt_chars = len(analyzer.PROMPT_TEMPLATE) + len(job.transcript)
+        return usage_cost_usd(self.model, {"prompt_tokens": prompt_chars // RESCORE_CHARS_PER_TOKEN,
+                                           "completion_tokens": requests * RESCORE_COMPLETION_TOKENS_ESTIMATE})
+
+    def _account(self, usage: Dict[str, int]):
+        with self._lock:
+            self.cost_usd += usage_cost_usd(self.model, usage)
+            self.tokens += usage["prompt_tokens"] + usage["completion_tokens"]
+
+    def _score(self, job: RescoreJob) -> Optional[Tuple[Dict[str, Any], Dict[str, str]]]:
+        """
+        Новый анализ звонка и версии его критериев; None, если оценить не удалось.
+        """
+        base = job.base_analysis
+        # Статус позиций заказа берется из старого анализа: CRM при переоценке не запрашивается
+        items_status = base.get("order_items_status") or {"has_plant": False, "has_cachepot": False}
+
+        if self.criteria or self.stale:
+            criteria = self.criteria or analyzer.stale_criteria(job.base_record)
+            if base.get("call_category") != "Заказ":
+                scores = {key: 0 for key in criteria}
+            else:
+                scores, success, usage = analyzer.score_criteria(job.transcript, criteria, items_status,
+                                                                 f"{job.stem}.txt", model=self.model)
+                self._account(usage)
+                if not success:
+                    return None
+            merged = analyzer.merge_criteria_scores(job.base_record, scores)
+            return merged["analysis"], merged["criteria_versions"]
+
+        result, success, usage = analyzer.score_transcript(job.transcript, job.initial_category, items_status,
+                                                           f"{job.stem}.txt", model=self.model)
+        self._account(usage)
+        if not success:
+            return None
+
+        analysis = {**base, **result}
+        if result["manager_name"] == "Неизвестно":
+            # Имя, полученное прежним анализом из CRM, сохраняется
+            analysis["manager_name"] = base.get("manager_name", "Неизвестно")
+        return analysis, analyzer.CRITERIA_VERSIONS
+
+    def _process(self, job: RescoreJob):
+        # Стоимость резервируется до отправки: параллельные запросы в сумме не превысят лимит затрат
+        reserved = 0.0
+        if self.max_cost_usd:
+            with self._lock:
+                processed = self.done + self.failed
+                # Когда есть переоцененные звонки, резерв — их средняя фактическая стоимость
+                reserved = self.cost_usd / processed if processed else self.estimate_cost_usd(job)
+                if self.cost_usd + self.reserved_usd + reserved > self.max_cost_usd:
+                    self.skipped_by_budget += 1
+                    return
+                self.reserved_usd += reserved
+        try:
+            self._process_reserved(job)
+        finally:
+            if reserved:
+                with self._lock:
+                    self.reserved_usd -= reserved
+
+    def _process_reserved(self, job: RescoreJob):
+        with log_context(communication_id=job.communication_id):
+            try:
+                scored = self._score(job)
+            except Exception as e:
+                logger.error(f"❌ Ошибка переоценки {job.stem}: {e}")
+                scored = None
+            if scored is None:
+                with self._lock:
+                    self.failed += 1
+                inc("rescore_calls_total", status="failed")
+                return
+
+            analysis, criteria_versions = scored
+            job.target.append(job.communication_id, {
+                "stem": job.stem,
+                "prompt_version": self.prompt_version,
+                "previous_prompt_version": job.base_record.get("prompt_version"),
+                "criteria_versions": criteria_versions,
+                "analysis": analysis,
+            })
+        inc("rescore_calls_total", status="rescored")
+
+        with self._lock:
+            self.done += 1
+            for key in analyzer.CRITERIA:
+                if job.base_analysis.get(key, 0) != analysis.get(key, 0):
+                    self.changed[key] += 1
+
+    def _log_progress(self, total: int, started: float):
+        elapsed = time.monotonic() - started
+        processed = self.done + self.failed
+        per_minute = processed / elapsed * 60 if elapsed else 0.0
+        eta = (total - processed) / per_minute if per_minute else 0.0
+        logger.info(f"📈 Переоценено {processed}/{total} ({self.failed} с ошибкой): {per_minute:.1f} звонков/мин, "
+                    f"{self.tokens} токенов, ${self.cost_usd:.2f}, осталось ~{eta:.0f} мин")
+
+    def run(self, dry_run: bool = False) -> Dict[str, Any]:
+        jobs, already_done = self.collect()
+        if self.criteria:
+            mode = f"критерии: {', '.join(self.criteria)}"
+        else:
+            mode = "устаревшие критерии" if self.stale else "все критерии"
+        logger.info(f"🔁 Переоценка под версию {self.prompt_version} ({mode}): к переоценке {len(jobs)} звонков, "
+                    f"уже переоценено {already_done}, дат в периоде {len(self.dates)}.")
+        if dry_run or not jobs:
+            return {"pending": len(jobs), "already_done": already_done, "skipped_corrupted": self.skipped_corrupted}
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._process, job) for job in jobs]
+            for number, future in enumerate(futures, start=1):
+                future.result()
+                if number % RESCORE_PROGRESS_EVERY == 0:
+                    self._log_progress(len(jobs), started)
+        self._log_progress(len(jobs), started)
+
+        if self.skipped_by_budget:
+            logger.warning(f"⚠️ Достигнут лимит затрат ${self.max_cost_usd:.2f}: не переоценено "
+                           f"{self.skipped_by_budget} звонков. Повторный запуск продолжит с них.")
+        if self.skipped_corrupted:
+            logger.warning(f"⚠️ Пропущено звонков с поврежденными записями хранилища: {self.skipped_corrupted}.")
+        if self.done:
+            logger.info(f"📊 Изменение оценок относительно прежних анализов ({self.done} звонков):")
+            for key in analyzer.CRITERIA:
+                logger.info(f"  {key}: изменено {self.changed[key]} ({self.changed[key] / self.done:.0%})")
+        return {
+            "pending": len(jobs),
+            "already_done": already_done,
+            "rescored": self.done,
+            "failed": self.failed,
+            "skipped_by_budget": self.skipped_by_budget,
+            "skipped_corrupted": self.skipped_corrupted,
+            "tokens": self.tokens,
+            "cost_usd": round(self.cost_usd, 4),
+            "changed": self.changed,
+        }
+
+
+def date_range(date_from: str, date_to: str) -> List[str]:
+    start = datetime.strptime(date_from, DATE_FORMAT)
+    end = datetime.strptime(date_to, DATE_FORMAT)
+    return [(start + timedelta(days=offset)).strftime(DATE_FORMAT) for offset in range((end - start).days + 1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Переоценка сохраненных транскриптов под новую версию промпта и критериев.")
+    parser.add_argument("--from", dest="date_from", required=True, help="Первая дата периода, ДД.ММ.ГГГГ.")
+    parser.add_argument("--to", dest="date_to", help="Последняя дата периода, ДД.ММ.ГГГГ (по умолчанию = --from).")
+    parser.add_argument("--criteria", help="Переоценить только эти критерии (через запятую), остальное — из старого анализа.")
+    parser.add_argument("--stale", action="store_true",
+                        help="Переоценить только отсутствующие и устаревшие критерии каждого звонка.")
+    parser.add_argument("--version", default=analyzer.PROMPT_VERSION,
+                        help=f"Версия результатов (по умолчанию текущая версия промпта {analyzer.PROMPT_VERSION}).")
+    parser.add_argument("--workers", type=int, default=RESCORE_WORKERS, help="Число параллельных запросов.")
+    parser.add_argument("--max-cost-usd", type=float, default=RESCORE_MAX_COST_USD,
+                        help="Остановиться, когда затраты достигнут этой суммы (0 — без лимита).")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, сколько звонков будет переоценено.")
+    args = parser.parse_args()
+
+    setup_logging()
+    criteria = [key.strip() for key in args.criteria.split(",") if key.strip()] if args.criteria else None
+    rescorer = Rescorer(date_range(args.date_from, args.date_to or args.date_from), prompt_version=args.version,
+                        criteria=criteria, stale=args.stale, workers=args.workers, max_cost_usd=args.max_cost_usd)
+    rescorer.run(dry_run=args.dry_run)
@@ -1,19 +1,40 @@
 import os
+import logging
 import json
+import time
 import requests
 import re
+import yaml
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Any, List, Optional  # Добавлены необходимые типы
+from pathlib import Path
+from typing import Dict, Any, List, Optional, FrozenSet  # Добавлены необходимые типы
+from metrics import record_cache
+from product_classifier import get_classifier, CATEGORY_PLANT, CATEGORY_CACHEPOT
+from circuit_breaker import (guarded_request, is_unavailable, is_outage_error, defer_if_unavailable, fallback_policy,
+                             DependencyUnavailableError, FALLBACK_DEFER)
+from log_config import setup_logging
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-RETAILCRM_URL = "https://tropichouse.retailcrm.ru"
+RETAILCRM_URL = os.getenv("RETAILCRM_URL", "https://tropichouse.retailcrm.ru")
 RETAILCRM_API_KEY = os.getenv("RETAILCRM_API_KEY")
-
-# --- НОВЫЕ СТАТУСЫ ДЛЯ АНАЛИЗА ---
+# Общая HTTP-сессия: соединения с RetailCRM переиспользуются между запросами (и между запусками в режиме демона)
+_session = requests.Session()
+
+# --- НАСТРОЙКА СТАТУСОВ ДЛЯ АНАЛИЗА ---
+# Набор статусов строится из status_config.yaml: по группам статусов из справочника RetailCRM
+# (/api/v5/reference/statuses, кэшируется на диске с TTL) или по явному списку.
+STATUS_CONFIG_PATH = Path(os.getenv("STATUS_CONFIG_PATH", "status_config.yaml"))
+STATUS_REFERENCE_CACHE_PATH = Path(os.getenv("STATUS_REFERENCE_CACHE_PATH", "cache/retailcrm_statuses.json"))
+DEFAULT_STATUS_CACHE_TTL_HOURS = 24
+# Если справочник статусов недоступен, список по умолчанию держится недолго, чтобы следующий вызов повторил запрос
+STATUS_FALLBACK_CACHE_SECONDS = int(os.getenv("STATUS_FALLBACK_CACHE_SECONDS", "300"))
+
+# Запасной набор на случай, если ни конфиг, ни справочник (ни его кэш) недоступны.
 # Объединяем статусы из групп "Новый", "Согласование", "Выполнен", "Отмена".
-# Звонок подлежит анализу, если последний заказ в ОДНОМ из этих статусов, ИЛИ если заказов нет.
 ANALYZABLE_STATUS_CODES = [
     # Группа "Новый" (new)
     "new", "gotovo-k-soglasovaniiu", "soglasovat-sostav", "agree-absence", "novyi-predoplachen", "novyi-oplachen",
@@ -43,6 +64,149 @@ ANALYZABLE_STATUS_CODES = [
     "test", "tropik-doktor", "klient-v-chiornom-spiske", "sozdan-zakaz", "spam"
 ]
 
+# Кэш последних заказов: нормализованный номер -> (заказ или None, момент получения).
+# Один и тот же номер проверяется несколькими функциями за запуск (фильтр, ссылка, состав заказа, менеджер).
+LAST_ORDER_CACHE_TTL_SECONDS = 600
+_last_order_cache: Dict[str, Any] = {}
+
+# Кэш итогового набора статусов в памяти процесса: (набор, момент истечения)
+_analyzable_status_codes_cache = None
+# Справочник статусов: код статуса -> код группы
+_status_groups_by_code: Dict[str, str] = {}
+
+
+def load_status_config(config_path: Path = STATUS_CONFIG_PATH) -> Dict[str, Any]:
+    """
+    Загружает настройки фильтра статусов из YAML. Возвращает пустой словарь, если файла нет.
+    """
+    if not config_path.exists():
+        return {}
+    try:
+        with open(config_path, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f) or {}
+    except (yaml.YAMLError, OSError) as e:
+        logger.warning(f"⚠️ Не удалось прочитать {config_path}: {e}. Используем статусы по умолчанию.")
+        return {}
+
+
+def _fetch_status_reference() -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    Запрашивает справочник статусов заказов RetailCRM: {код статуса: {code, name, group, active, ...}}.
+    """
+    if not RETAILCRM_API_KEY:
+        return None
+    try:
+        with guarded_request("retailcrm", "reference_statuses"):
+            response = _session.get(f"{RETAILCRM_URL}/api/v5/reference/statuses",
+                                    params={"apiKey": RETAILCRM_API_KEY}, timeout=10)
+            response.raise_for_status()
+        data = response.json()
+        if data.get("success") and data.get("statuses"):
+            return data["statuses"]
+        logger.info("ℹ️ Не удалось получить справочник статусов заказов из RetailCRM.")
+        return None
+    except (requests.exceptions.RequestException, DependencyUnavailableError) as e:
+        logger.error(f"❌ Ошибка при получении справочника статусов из RetailCRM: {e}")
+        return None
+    except ValueError as e:
+        logger.error(f"❌ Некорректный ответ справочника статусов RetailCRM: {e}")
+        return None
+
+
+def load_status_reference(ttl_hours: float = DEFAULT_STATUS_CACHE_TTL_HOURS,
+                          cache_path: Path = STATUS_REFERENCE_CACHE_PATH) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    Возвращает справочник статусов из дискового кэша, если он моложе ttl_hours, иначе обновляет его из API.
+    Если API недоступен, используется устаревший кэш (лучше старые данные, чем никаких).
+    """
+    cached = None
+    if cache_path.exists():
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            age_hours = (time.time() - cache_path.stat().st_mtime) / 3600
+            if age_hours < ttl_hours:
+                return cached
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"⚠️ Не удалось прочитать кэш справочника статусов {cache_path}: {e}")
+
+    reference = _fetch_status_reference()
+    if reference is None:
+        if cached:
+            logger.warning("⚠️ Справочник статусов RetailCRM недоступен. Используем устаревший кэш.")
+        return cached
+
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(reference, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+        logger.info(f"✅ Справочник статусов RetailCRM обновлен: {len(reference)} статусов.")
+    except OSError as e:
+        logger.warning(f"⚠️ Не удалось сохранить кэш справочника статусов: {e}")
+    return reference
+
+
+def build_analyzable_status_codes(config: Dict[str, Any],
+                                  reference: Optional[Dict[str, Dict[str, Any]]]) -> FrozenSet[str]:
+    """
+    Строит набор анализируемых статусов: явный список из конфига, иначе все статусы
+    разрешенных групп из справочника (плюс extra_statuses, минус excluded_statuses).
+    Если ни того, ни другого нет, возвращает ANALYZABLE_STATUS_CODES.
+    """
+    extra = set(config.get("extra_statuses") or [])
+    excluded = set(config.get("excluded_statuses") or [])
+
+    if config.get("analyzable_statuses"):
+        codes = set(config["analyzable_statuses"])
+    elif reference and config.get("analyzable_groups"):
+        groups = set(config["analyzable_groups"])
+        codes = {code for code, status in reference.items() if status.get("group") in groups}
+    else:
+        codes = set(ANALYZABLE_STATUS_CODES)
+
+    return frozenset((codes | extra) - excluded)
+
+
+def get_analyzable_status_codes(force_refresh: bool = False) -> FrozenSet[str]:
+    """
+    Возвращает набор анализируемых статусов (frozenset, проверка за O(1)).
+    Набор строится один раз и перестраивается по истечении TTL из status_config.yaml.
+    Список по умолчанию, взятый из-за недоступного справочника, кэшируется только на STATUS_FALLBACK_CACHE_SECONDS.
+    """
+    global _analyzable_status_codes_cache, _status_groups_by_code
+
+    if _analyzable_status_codes_cache and not force_refresh:
+        codes, expires_at = _analyzable_status_codes_cache
+        if time.time() < expires_at:
+            return codes
+
+    config = load_status_config()
+    ttl_hours = float(config.get("reference_cache_ttl_hours", DEFAULT_STATUS_CACHE_TTL_HOURS))
+
+    reference = None
+    if not config.get("analyzable_statuses") and config.get("analyzable_groups"):
+        reference = load_status_reference(ttl_hours)
+    if reference:
+        _status_groups_by_code = {code: status.get("group", "") for code, status in reference.items()}
+
+    codes = build_analyzable_status_codes(config, reference)
+    reference_missing = not config.get("analyzable_statuses") and config.get("analyzable_groups") and not reference
+    cache_seconds = STATUS_FALLBACK_CACHE_SECONDS if reference_missing else ttl_hours * 3600
+    _analyzable_status_codes_cache = (codes, time.time() + cache_seconds)
+    source = "явный список" if config.get("analyzable_statuses") else \
+        ("справочник RetailCRM" if reference else "список по умолчанию")
+    logger.info(f"ℹ️ Набор статусов для анализа: {len(codes)} статусов (источник: {source}).")
+    return codes
+
+
+def get_status_group(status_code: str) -> str:
+    """
+    Возвращает код группы статуса по справочнику RetailCRM или пустую строку, если справочник не загружен.
+    """
+    return _status_groups_by_code.get(status_code, "")
+
 
 def normalize_phone(phone_str: str) -> str:
     """
@@ -60,19 +224,39 @@ def normalize_phone(phone_str: str) -> str:
     return digits_only
 
 
+def _get_mirror():
+    """
+    Локальное зеркало RetailCRM или None, если оно выключено или устарело (см. crm_mirror.get_mirror).
+    """
+    # Импорт внутри функции: crm_mirror сам использует настройки и normalize_phone этого модуля
+    from crm_mirror import get_mirror
+    return get_mirror()
+
+
 def _get_last_order(phone_number: str) -> Optional[Dict[str, Any]]:
     """
     Вспомогательная функция для получения данных о последнем заказе.
     ИСПРАВЛЕНО: Теперь использует поиск по ID клиента, что надежнее, чем прямой поиск заказа по телефону.
     """
     if not RETAILCRM_API_KEY:
-        print("❗ Ошибка: RETAILCRM_API_KEY не найден. Невозможно получить данные о заказе.")
+        logger.error("❗ Ошибка: RETAILCRM_API_KEY не найден. Невозможно получить данные о заказе.")
         return None
 
     normalized_phone = normalize_phone(phone_number)
     if not normalized_phone:
         return None
 
+    # Зеркало отвечает по индексу без запросов к API
+    mirror = _get_mirror()
+    if mirror is not None:
+        return mirror.last_order(normalized_phone)
+
+    cached = _last_order_cache.get(normalized_phone)
+    if cached and time.time() - cached[1] < LAST_ORDER_CACHE_TTL_SECONDS:
+        record_cache("last_order", hit=True)
+        return cached[0]
+    record_cache("last_order", hit=False)
+
     # --- ШАГ 1: ПОЛУЧЕНИЕ ID КЛИЕНТА (наиболее надежный способ) ---
     customer_id = None
     customers_api_endpoint = f"{RETAILCRM_URL}/api/v5/customers"
@@ -83,8 +267,9 @@ def _get_last_order(phone_number: str) -> Optional[Dict[str, Any]]:
     }
 
     try:
-        customers_response = requests.get(customers_api_endpoint, params=customers_params, timeout=5)
-        customers_response.raise_for_status()
+        with guarded_request("retailcrm", "customers"):
+            customers_response = _session.get(customers_api_endpoint, params=customers_params, timeout=5)
+            customers_response.raise_for_status()
         customers_data = customers_response.json()
 
         if customers_data.get('success') and customers_data.get('customers'):
@@ -92,10 +277,16 @@ def _get_last_order(phone_number: str) -> Optional[Dict[str, Any]]:
             customer_id = customers_data["customers"][0].get("id")
 
         if not customer_id:
+            _last_order_cache[normalized_phone] = (None, time.time())
             return None  # Клиент не найден
 
-    except Exception:
-        # При любой ошибке на шаге 1, считаем, что заказов нет.
+    except Exception as e:
+        # Недоступность CRM — не то же самое, что отсутствие заказов: решение принимает вызывающий код.
+        # Любой сбой соединения считается недоступностью, даже пока цепь не разомкнута: иначе первые сбои
+        # отбросили бы звонки как "заказов нет"
+        if is_outage_error(e) or is_unavailable("retailcrm", e):
+            raise DependencyUnavailableError("retailcrm") from e
+        # При любой другой ошибке на шаге 1 считаем, что заказов нет.
         return None
 
     # --- ШАГ 2: ПОЛУЧЕНИЕ ЗАКАЗОВ ПО ID КЛИЕНТА ---
@@ -106,17 +297,23 @@ def _get_last_order(phone_number: str) -> Optional[Dict[str, Any]]:
     }
 
     try:
-        response = requests.get(orders_api_endpoint, params=orders_params, timeout=5)
-        response.raise_for_status()
+        with guarded_request("retailcrm", "orders"):
+            response = _session.get(orders_api_endpoint, params=orders_params, timeout=5)
+            response.raise_for_status()
         data = response.json()
 
         if data.get('success') and data.get('orders'):
             # Сортируем заказы по дате создания в убывающем порядке, чтобы получить самый новый
             sorted_orders = sorted(data["orders"], key=lambda x: x.get("createdAt", ""), reverse=True)
+            _last_order_cache[normalized_phone] = (sorted_orders[0], time.time())
             return sorted_orders[0]
+        _last_order_cache[normalized_phone] = (None, time.time())
         return None
     except Exception as e:
+        if is_outage_error(e) or is_unavailable("retailcrm", e):
+            raise DependencyUnavailableError("retailcrm") from e
         # Не выводим ошибку при поиске, так как это может быть нормальным поведением
+        # Ошибки не кэшируем: следующий вызов повторит запрос
         return None
 
 
@@ -132,7 +329,11 @@ def get_last_order_link_for_check(phone_number: str) -> Optional[str]:
     Returns:
         Прямая ссылка на последний заказ в RetailCRM или None, если заказ не найден.
     """
-    last_order = _get_last_order(phone_number)
+    try:
+        last_order = _get_last_order(phone_number)
+    except DependencyUnavailableError as e:
+        defer_if_unavailable("retailcrm", e)
+        return None
 
     if last_order and isinstance(last_order, dict):
         order_id = last_order.get('id')
@@ -155,67 +356,89 @@ def _get_order_details_by_id(order_id: int) -> Optional[Dict[str, Any]]:
         # Для получения полного состава заказа используем запрос /api/v5/orders/{externalId}
         # У нас есть id, поэтому используем его.
         url = f"{RETAILCRM_URL}/api/v5/orders/{order_id}?by=id&apiKey={RETAILCRM_API_KEY}"
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
+        with guarded_request("retailcrm", "order_details"):
+            response = _session.get(url, timeout=5)
+            response.raise_for_status()
         data = response.json()
 
         if data.get('success') and data.get('order'):
             return data['order']
         return None
     except Exception as e:
-        print(f"❌ Ошибка при получении деталей заказа {order_id}: {e}")
+        defer_if_unavailable("retailcrm", e)
+        logger.error(f"❌ Ошибка при получении деталей заказа {order_id}: {e}")
         return None
 
 
+def _fetch_offer_groups(offer_ids: List[str]) -> Dict[str, List[str]]:
+    """
+    Группы каталога товаров по id торговых предложений: {id предложения: [id и externalId групп товара]}.
+    Предложения из успешных ответов, которых нет в каталоге, возвращаются с пустым списком групп;
+    предложений, запрос которых завершился ошибкой, в результате нет (они не кэшируются).
+    """
+    groups_by_offer: Dict[str, List[str]] = {}
+    if not RETAILCRM_API_KEY:
+        return groups_by_offer
+
+    try:
+        for start in range(0, len(offer_ids), 100):
+            params = [("apiKey", RETAILCRM_API_KEY), ("limit", 100)] + \
+                     [("filter[offerIds][]", offer_id) for offer_id in offer_ids[start:start + 100]]
+            with guarded_request("retailcrm", "store_products"):
+                response = _session.get(f"{RETAILCRM_URL}/api/v5/store/products", params=params, timeout=10)
+                response.raise_for_status()
+            data = response.json()
+            page = {offer_id: [] for offer_id in offer_ids[start:start + 100]}
+            for product in data.get("products") or []:
+                groups = [str(group[key]) for group in product.get("groups") or []
+                          for key in ("id", "externalId") if group.get(key)]
+                for offer in product.get("offers") or []:
+                    page[str(offer.get("id"))] = groups
+            groups_by_offer.update(page)
+    except Exception as e:
+        defer_if_unavailable("retailcrm", e)
+        logger.error(f"❌ Ошибка при получении групп каталога товаров: {e}")
+    return groups_by_offer
+
+
 # --- НОВАЯ ОСНОВНАЯ ФУНКЦИЯ ДЛЯ АНАЛИЗА ДОКОМПЛЕКТА ---
 def get_order_items_status(phone_number: str) -> Dict[str, bool]:
     """
     Проверяет состав последнего заказа клиента по номеру телефона
     на предмет наличия и растений, и кашпо.
 
+    Категории позиций определяет product_classifier по правилам из product_config.yaml.
+    Состав берется из того же ответа списка заказов (или зеркала), что и последний заказ.
+
     Возвращает словарь: {'has_plant': bool, 'has_cachepot': bool}
     Если заказа нет или произошла ошибка, возвращает {'has_plant': False, 'has_cachepot': False}.
     """
     items_status = {'has_plant': False, 'has_cachepot': False}
 
-    last_order = _get_last_order(phone_number)
-    if not last_order:
+    try:
+        last_order = _get_last_order(phone_number)
+    except DependencyUnavailableError as e:
+        defer_if_unavailable("retailcrm", e)
+        logger.warning("⚠️ RetailCRM недоступен: состав заказа не проверен.")
         return items_status
-
-    order_id = last_order.get('id')
-    if not order_id:
+    if not last_order:
         return items_status
 
-    order_details = _get_order_details_by_id(order_id)
-    if not order_details or not order_details.get('items'):
+    items = last_order.get('items')
+    if items is None and last_order.get('id'):
+        # Ответ без состава заказа: запрашиваем заказ целиком
+        order_details = _get_order_details_by_id(last_order['id'])
+        items = (order_details or {}).get('items')
+    if not items:
         return items_status
 
-    has_plant = False
-    has_cachepot = False
-
-    # Эвристика для определения типа товара
-    for item in order_details['items']:
-        item_name = item.get('offer', {}).get('name', '').lower()
+    categories = set(get_classifier().classify_items(items, fetch_groups=_fetch_offer_groups))
+    return {'has_plant': CATEGORY_PLANT in categories, 'has_cachepot': CATEGORY_CACHEPOT in categories}
 
-        # 1. Поиск Кашпо
-        if 'кашпо' in item_name or 'lechuza' in item_name or 'горшок' in item_name:
-            has_cachepot = True
 
-        # 2. Поиск Растений (игнорируем грунт, дренаж, пересадку, которые являются докомплектом)
-        # Если это не кашпо/горшок, и не расходник, то считаем, что это растение
-        if not has_cachepot and \
-                'грунт' not in item_name and \
-                'дренаж' not in item_name and \
-                'пересадка' not in item_name and \
-                'средство' not in item_name and \
-                'ламп' not in item_name:  # Лампа - скорее допродажа, но исключим ее
-            has_plant = True
-
-        # Оптимизация: если уже найдены оба, можно прервать цикл
-        if has_plant and has_cachepot:
-            break
-
-    return {'has_plant': has_plant, 'has_cachepot': has_cachepot}
+def _format_status_group(status_code: str) -> str:
+    group = get_status_group(status_code)
+    return f"[группа '{group}'] " if group else ""
 
 
 def check_if_last_order_is_analyzable(phone_number: str) -> bool:
@@ -223,32 +446,38 @@ def check_if_last_order_is_analyzable(phone_number: str) -> bool:
     Проверяет, подлежит ли звонок клиента анализу на основе статуса ЕГО ПОСЛЕДНЕГО заказа.
     Звонок анализируется ТОЛЬКО, если:
     1. Заказ найден.
-    2. Статус последнего заказа находится в списке ANALYZABLE_STATUS_CODES.
+    2. Статус последнего заказа находится в наборе get_analyzable_status_codes().
 
     Returns:
         True, если звонок подлежит анализу, иначе False.
     """
     if not RETAILCRM_API_KEY:
-        print("❗ Ошибка: RETAILCRM_API_KEY не найден. Проверка статуса заказа невозможна. Возвращаем True.")
+        logger.error("❗ Ошибка: RETAILCRM_API_KEY не найден. Проверка статуса заказа невозможна. Возвращаем True.")
         return True # В случае ошибки API лучше анализировать, чтобы не пропустить
 
-    last_order = _get_last_order(phone_number)
+    try:
+        last_order = _get_last_order(phone_number)
+    except DependencyUnavailableError:
+        if fallback_policy("retailcrm") == FALLBACK_DEFER:
+            raise
+        logger.warning("⚠️ Статус для анализа: RetailCRM недоступен. Звонок анализируется без проверки статуса.")
+        return True
 
     if last_order:
         order_status = last_order.get("status")
 
-        if order_status and order_status in ANALYZABLE_STATUS_CODES:
-            print(f"✅ Статус для анализа: Последний заказ со статусом '{order_status}' (РАЗРЕШЕН).")
+        if order_status and order_status in get_analyzable_status_codes():
+            logger.info(f"✅ Статус для анализа: Последний заказ со статусом '{order_status}' {_format_status_group(order_status)}(РАЗРЕШЕН).")
             return True
         elif order_status:
-            print(f"❌ Статус для анализа: Последний заказ со статусом '{order_status}' (НЕ РАЗРЕШЕН).")
+            logger.info(f"❌ Статус для анализа: Последний заказ со статусом '{order_status}' {_format_status_group(order_status)}(НЕ РАЗРЕШЕН).")
             return False
         else:
-            print("❌ Статус для анализа: У последнего заказа отсутствует поле 'status'. Возвращаем False (поскольку нет четкого статуса).")
+            logger.info("❌ Статус для анализа: У последнего заказа отсутствует поле 'status'. Возвращаем False (поскольку нет четкого статуса).")
             return False # Если нет статуса, не анализируем
     else:
         # ИСПРАВЛЕНО: Клиенты без заказов теперь НЕ анализируются
-        print(
+        logger.info(
             "❌ Статус для анализа: Заказы не найдены. Звонок НЕ анализируется (исключаем новых потенциальных клиентов).")
         return False # <--- ГЛАВНОЕ ИЗМЕНЕНИЕ: ВОЗВРАЩАЕМ FALSE
 
@@ -263,7 +492,7 @@ def check_if_phone_has_recent_order(phone_number: str, hours: int = 36) -> bool:
         True, если найден хотя бы один недавний заказ, иначе False.
     """
     if not RETAILCRM_API_KEY:
-        print("❗ Ошибка: RETAILCRM_API_KEY не найден. Проверка недавних заказов невозможна.")
+        logger.error("❗ Ошибка: RETAILCRM_API_KEY не найден. Проверка недавних заказов невозможна.")
         return False
 
     normalized_phone = normalize_phone(phone_number)
@@ -276,11 +505,12 @@ def check_if_phone_has_recent_order(phone_number: str, hours: int = 36) -> bool:
         "filter[customer]": normalized_phone,
     }
 
-    print(f"🔍 Проверка недавних заказов: Ищем заказы для номера: {normalized_phone} за последние {hours} ч...")
+    logger.info(f"🔍 Проверка недавних заказов: Ищем заказы для номера: {normalized_phone} за последние {hours} ч...")
 
     try:
-        response = requests.get(api_endpoint, params=params, timeout=10)
-        response.raise_for_status()
+        with guarded_request("retailcrm", "orders"):
+            response = _session.get(api_endpoint, params=params, timeout=10)
+            response.raise_for_status()
         data = response.json()
 
         if data.get("success") and data.get("orders"):
@@ -292,18 +522,18 @@ def check_if_phone_has_recent_order(phone_number: str, hours: int = 36) -> bool:
                 if created_at_str:
                     created_at_dt = datetime.fromisoformat(created_at_str)
                     if created_at_dt.astimezone(timezone.utc) >= time_cutoff:
-                        print(f"✅ Проверка недавних заказов: Найден заказ, созданный в {created_at_dt}. Соответствует.")
+                        logger.info(f"✅ Проверка недавних заказов: Найден заказ, созданный в {created_at_dt}. Соответствует.")
                         return True
-            print("✅ Проверка недавних заказов: Заказы найдены, но ни один не создан за последние 36 часов.")
+            logger.info("✅ Проверка недавних заказов: Заказы найдены, но ни один не создан за последние 36 часов.")
             return False
         else:
-            print(f"ℹ️ Проверка недавних заказов: Заказы для номера {normalized_phone} не найдены.")
+            logger.info(f"ℹ️ Проверка недавних заказов: Заказы для номера {normalized_phone} не найдены.")
             return False
     except requests.exceptions.RequestException as e:
-        print(f"❌ Проверка недавних заказов: Ошибка при поиске заказа: {e}")
+        logger.error(f"❌ Проверка недавних заказов: Ошибка при поиске заказа: {e}")
         return False
     except Exception as e:
-        print(f"❌ Проверка недавних заказов: Непредвиденная ошибка: {e}")
+        logger.error(f"❌ Проверка недавних заказов: Непредвиденная ошибка: {e}")
         return False
 
 
@@ -320,13 +550,25 @@ def get_order_link_by_phone(phone_number: str) -> str:
         или пустая строка в случае ошибки.
     """
     if not RETAILCRM_API_KEY:
-        print("❗ Ошибка: RETAILCRM_API_KEY не найден в .env. Невозможно подключиться к RetailCRM.")
+        logger.error("❗ Ошибка: RETAILCRM_API_KEY не найден в .env. Невозможно подключиться к RetailCRM.")
         return ""
 
     normalized_input_phone = normalize_phone(phone_number)
     customer_id = None
     customer_card_link = ""  # Инициализируем ссылку на карточку клиента
 
+    mirror = _get_mirror()
+    if mirror is not None:
+        customer_id = mirror.customer_id(normalized_input_phone)
+        if not customer_id:
+            logger.info(f"ℹ️ Клиент для номера {normalized_input_phone} не найден в зеркале RetailCRM.")
+            return ""
+        last_order = mirror.last_order(normalized_input_phone)
+        if last_order and last_order.get("id"):
+            return f"{RETAILCRM_URL}/orders/{last_order['id']}/edit"
+        # Заказов нет — ссылка на карточку клиента
+        return f"{RETAILCRM_URL}/customers/{customer_id}#t-log-orders"
+
     # --- Шаг 1: Ищем клиента по номеру телефона (используем filter[name]) ---
     customers_api_endpoint = f"{RETAILCRM_URL}/api/v5/customers"
     customers_params = {
@@ -334,11 +576,12 @@ def get_order_link_by_phone(phone_number: str) -> str:
         "filter[name]": normalized_input_phone  # Используем filter[name]
     }
 
-    print(f"🔍 Шаг 1: Ищем клиента в RetailCRM для номера: {normalized_input_phone} (фильтр по имени)...")
+    logger.info(f"🔍 Шаг 1: Ищем клиента в RetailCRM для номера: {normalized_input_phone} (фильтр по имени)...")
 
     try:
-        customers_response = requests.get(customers_api_endpoint, params=customers_params, timeout=10)
-        customers_response.raise_for_status()
+        with guarded_request("retailcrm", "customers"):
+            customers_response = _session.get(customers_api_endpoint, params=customers_params, timeout=10)
+            customers_response.raise_for_status()
         data = customers_response.json()
 
         if data.get("success") and data.get("customers"):
@@ -347,17 +590,18 @@ def get_order_link_by_phone(phone_number: str) -> str:
             if customer_id:
                 # Генерируем ссылку на карточку клиента как запасной вариант
                 customer_card_link = f"{RETAILCRM_URL}/customers/{customer_id}#t-log-orders"
-                print(
+                logger.info(
                     f"✅ Шаг 1: Клиент найден. ID клиента: {customer_id}. Запасная ссылка на карточку: {customer_card_link}")
             else:
-                print(f"ℹ️ Шаг 1: Клиент найден, но не удалось извлечь ID.")
+                logger.info(f"ℹ️ Шаг 1: Клиент найден, но не удалось извлечь ID.")
                 return ""  # Если ID клиента нет, то и заказы не найти
         else:
-            print(f"ℹ️ Шаг 1: Клиент для номера {normalized_input_phone} не найден в RetailCRM.")
+            logger.info(f"ℹ️ Шаг 1: Клиент для номера {normalized_input_phone} не найден в RetailCRM.")
             return ""  # Если клиент не найден, то и заказы не найти
 
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Шаг 1: Ошибка при поиске клиента в RetailCRM: {e}")
+    except (requests.exceptions.RequestException, DependencyUnavailableError) as e:
+        defer_if_unavailable("retailcrm", e)
+        logger.error(f"❌ Шаг 1: Ошибка при поиске клиента в RetailCRM: {e}")
         return ""  # В случае ошибки возвращаем пустую строку
 
     # --- Шаг 2: Ищем заказы по ID клиента (упрощенный запрос) ---
@@ -368,11 +612,12 @@ def get_order_link_by_phone(phone_number: str) -> str:
             "filter[customerId]": customer_id,  # Используем filter[customerId]
         }
 
-        print(f"🔍 Шаг 2: Ищем заказы в RetailCRM для клиента ID: {customer_id} (упрощенный запрос)...")
+        logger.info(f"🔍 Шаг 2: Ищем заказы в RetailCRM для клиента ID: {customer_id} (упрощенный запрос)...")
 
         try:
-            orders_response = requests.get(orders_api_endpoint, params=orders_params, timeout=10)
-            orders_response.raise_for_status()
+            with guarded_request("retailcrm", "orders"):
+                orders_response = _session.get(orders_api_endpoint, params=orders_params, timeout=10)
+                orders_response.raise_for_status()
             orders_data = orders_response.json()
 
             if orders_data.get("success") and orders_data.get("orders"):
@@ -383,21 +628,22 @@ def get_order_link_by_phone(phone_number: str) -> str:
 
                 if order_id:
                     order_link = f"{RETAILCRM_URL}/orders/{order_id}/edit"
-                    print(f"✅ Шаг 2: Найден прямой заказ. Ссылка на заказ: {order_link}")
+                    logger.info(f"✅ Шаг 2: Найден прямой заказ. Ссылка на заказ: {order_link}")
                     return order_link  # Возвращаем прямую ссылку на заказ
                 else:
-                    print(f"ℹ️ Шаг 2: Заказ найден, но не удалось извлечь ID заказа.")
+                    logger.info(f"ℹ️ Шаг 2: Заказ найден, но не удалось извлечь ID заказа.")
                     return customer_card_link  # Возвращаем запасную ссылку
             else:
-                print(
+                logger.info(
                     f"ℹ️ Шаг 2: Заказы для клиента ID {customer_id} не найдены в RetailCRM. Возвращаем ссылку на карточку клиента.")
                 return customer_card_link  # Если заказы не найдены, возвращаем запасную ссылку
 
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Шаг 2: Ошибка при поиске заказа в RetailCRM: {e}. Возвращаем ссылку на карточку клиента.")
+        except (requests.exceptions.RequestException, DependencyUnavailableError) as e:
+            defer_if_unavailable("retailcrm", e)
+            logger.error(f"❌ Шаг 2: Ошибка при поиске заказа в RetailCRM: {e}. Возвращаем ссылку на карточку клиента.")
             return customer_card_link  # В случае ошибки возвращаем запасную ссылку
     else:
-        print("ℹ️ Шаг 2 пропущен: ID клиента не был найден на Шаге 1.")
+        logger.info("ℹ️ Шаг 2 пропущен: ID клиента не был найден на Шаге 1.")
         return ""  # Если ID клиента не найден на Шаге 1, возвращаем пустую строку
 
 
@@ -411,24 +657,37 @@ def get_manager_name_from_crm(phone_number: str) -> str | None:
     Returns:
         Имя менеджера (firstName) или None, если менеджер не найден или произошла ошибка.
     """
-    last_order = _get_last_order(phone_number)
+    try:
+        last_order = _get_last_order(phone_number)
+    except DependencyUnavailableError as e:
+        defer_if_unavailable("retailcrm", e)
+        logger.warning("⚠️ CRM-поиск менеджера: RetailCRM недоступен.")
+        return None
     manager_id = last_order.get("managerId") if last_order else None
 
     if not manager_id:
-        print(f"ℹ️ CRM-поиск менеджера: Заказы или managerId не найдены для номера {normalize_phone(phone_number)}.")
+        logger.info(f"ℹ️ CRM-поиск менеджера: Заказы или managerId не найдены для номера {normalize_phone(phone_number)}.")
         return None
 
+    mirror = _get_mirror()
+    if mirror is not None:
+        manager_name = mirror.user_first_name(manager_id)
+        if not manager_name:
+            logger.info(f"ℹ️ CRM-поиск менеджера: Пользователь с ID {manager_id} не найден в зеркале RetailCRM.")
+        return manager_name
+
     # --- Шаг 2: Получаем имя менеджера по managerId ---
     users_api_endpoint = f"{RETAILCRM_URL}/api/v5/users"
     users_params = {
         "apiKey": RETAILCRM_API_KEY
     }
 
-    print(f"🔍 CRM-поиск менеджера: Получаем информацию о пользователе с ID: {manager_id}...")
+    logger.info(f"🔍 CRM-поиск менеджера: Получаем информацию о пользователе с ID: {manager_id}...")
 
     try:
-        users_response = requests.get(users_api_endpoint, params=users_params, timeout=10)
-        users_response.raise_for_status()
+        with guarded_request("retailcrm", "users"):
+            users_response = _session.get(users_api_endpoint, params=users_params, timeout=10)
+            users_response.raise_for_status()
         users_data = users_response.json()
 
         if users_data.get("success") and users_data.get("users"):
@@ -441,22 +700,24 @@ def get_manager_name_from_crm(phone_number: str) -> str | None:
             if found_user:
                 manager_name = found_user.get("firstName")
                 if manager_name:
-                    print(f"✅ CRM-поиск менеджера: Найдено имя менеджера: {manager_name}")
+                    logger.info(f"✅ CRM-поиск менеджера: Найдено имя менеджера: {manager_name}")
                     return manager_name
                 else:
-                    print(f"ℹ️ CRM-поиск менеджера: Имя менеджера для ID {manager_id} не найдено.")
+                    logger.info(f"ℹ️ CRM-поиск менеджера: Имя менеджера для ID {manager_id} не найдено.")
                     return None
-            print(f"ℹ️ CRM-поиск менеджера: Пользователь с ID {manager_id} не найден в списке пользователей.")
+            logger.info(f"ℹ️ CRM-поиск менеджера: Пользователь с ID {manager_id} не найден в списке пользователей.")
             return None
         else:
-            print("ℹ️ CRM-поиск менеджера: Не удалось получить список пользователей.")
+            logger.info("ℹ️ CRM-поиск менеджера: Не удалось получить список пользователей.")
             return None
 
     except requests.exceptions.RequestException as e:
-        print(f"❌ CRM-поиск менеджера: Ошибка при получении списка пользователей: {e}")
+        defer_if_unavailable("retailcrm", e)
+        logger.error(f"❌ CRM-поиск менеджера: Ошибка при получении списка пользователей: {e}")
         return None
     except Exception as e:
-        print(f"❌ CRM-поиск менеджера: Непредвиденная ошибка при получении списка пользователей: {e}")
+        defer_if_unavailable("retailcrm", e)
+        logger.error(f"❌ CRM-поиск менеджера: Непредвиденная ошибка при получении списка пользователей: {e}")
         return None
 
 
@@ -466,7 +727,7 @@ def get_all_order_status_groups() -> list:
     Эта функция больше не используется для фильтрации заказов, но может быть полезной для отладки.
     """
     if not RETAILCRM_API_KEY:
-        print("❗ Ошибка: RETAILCRM_API_KEY не найден. Невозможно получить группы статусов.")
+        logger.error("❗ Ошибка: RETAILCRM_API_KEY не найден. Невозможно получить группы статусов.")
         return []
 
     status_groups_api_endpoint = f"{RETAILCRM_URL}/api/v5/reference/status-groups"
@@ -475,25 +736,27 @@ def get_all_order_status_groups() -> list:
     }
 
     try:
-        response = requests.get(status_groups_api_endpoint, params=status_groups_params, timeout=10)
-        response.raise_for_status()
+        with guarded_request("retailcrm", "reference_status_groups"):
+            response = _session.get(status_groups_api_endpoint, params=status_groups_params, timeout=10)
+            response.raise_for_status()
         data = response.json()
 
         if data.get("success") and data.get("statusGroups"):
             group_codes = [group.get("code") for group in data["statusGroups"].values() if group.get("code")]
             return group_codes
         else:
-            print("ℹ️ Не удалось получить группы статусов заказов из RetailCRM.")
+            logger.info("ℹ️ Не удалось получить группы статусов заказов из RetailCRM.")
             return []
     except requests.exceptions.RequestException as e:
-        print(f"❌ Ошибка при получении групп статусов из RetailCRM: {e}")
+        logger.error(f"❌ Ошибка при получении групп статусов из RetailCRM: {e}")
         return []
     except Exception as e:
-        print(f"❌ Непредвиденная ошибка при получении групп статусов: {e}")
+        logger.error(f"❌ Непредвиденная ошибка при получении групп статусов: {e}")
         return []
 
 
 if __name__ == "__main__":
+    setup_logging()
     # Для целей тестирования замените на актуальные номера, которые есть в вашей CRM
     # В идеале: 1) Номер с заказом, где есть и растение, и кашпо. 2) Номер, где есть только растение. 3) Номер без заказов.
     test_phones = [
@@ -501,36 +764,36 @@ if __name__ == "__main__":
         "79991234567"  # Измените на номер, у которого нет заказов (Тест 2)
     ]
 
-    print("\n" + "=" * 50)
-    print("=== ЗАПУСК ТЕСТИРОВАНИЯ RETAILCRM_INTEGRATION ===")
-    print("=" * 50 + "\n")
+    logger.info("" + "=" * 50)
+    logger.info("=== ЗАПУСК ТЕСТИРОВАНИЯ RETAILCRM_INTEGRATION ===")
+    logger.info("=" * 50 + "\n")
 
     for i, phone in enumerate(test_phones):
-        print(f"\n--- Тестирование для номера {phone} (Тест {i + 1}/{len(test_phones)}) ---")
+        logger.info(f"--- Тестирование для номера {phone} (Тест {i + 1}/{len(test_phones)}) ---")
 
         # 1. Проверка анализируемости
-        print(">> 1. Проверка статуса для анализа (check_if_last_order_is_analyzable):")
+        logger.info(">> 1. Проверка статуса для анализа (check_if_last_order_is_analyzable):")
         is_analyzable = check_if_last_order_is_analyzable(phone)
-        print(f"   Результат: Подлежит ли звонок анализу: {is_analyzable}")
+        logger.info(f"   Результат: Подлежит ли звонок анализу: {is_analyzable}")
 
         # 2. Проверка состава заказа (НОВАЯ ФУНКЦИЯ)
-        print(">> 2. Проверка состава последнего заказа (get_order_items_status):")
+        logger.info(">> 2. Проверка состава последнего заказа (get_order_items_status):")
         items_status = get_order_items_status(phone)
-        print(f"   Результат: {items_status}")
+        logger.info(f"   Результат: {items_status}")
 
         # 3. Проверка ссылки на заказ
-        print(">> 3. Проверка ссылки на заказ (get_order_link_by_phone):")
+        logger.info(">> 3. Проверка ссылки на заказ (get_order_link_by_phone):")
         link = get_order_link_by_phone(phone)
-        print(f"   Результат: Ссылка: {link or 'Не найдена'}")
+        logger.info(f"   Результат: Ссылка: {link or 'Не найдена'}")
 
         # 4. Проверка менеджера
-        print(">> 4. Проверка менеджера из CRM (get_manager_name_from_crm):")
+        logger.info(">> 4. Проверка менеджера из CRM (get_manager_name_from_crm):")
         manager_name = get_manager_name_from_crm(phone)
-        print(f"   Результат: Менеджер из CRM: {manager_name or 'Не найден'}")
+        logger.info(f"   Результат: Менеджер из CRM: {manager_name or 'Не найден'}")
 
         # 5. Проверка недавних заказов (для отладки)
-        print(">> 5. Проверка недавних заказов (check_if_phone_has_recent_order):")
+        logger.info(">> 5. Проверка недавних заказов (check_if_phone_has_recent_order):")
         has_recent_order = check_if_phone_has_recent_order(phone)
-        print(f"   Результат: Есть ли недавний заказ: {has_recent_order}")
+        logger.info(f"   Результат: Есть ли недавний заказ: {has_recent_order}")
 
-        print("\n" + "-" * 40)
+        logger.info("" + "-" * 40)
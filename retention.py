@@ -0,0 +1,309 @@
+import os
+import shutil
+import logging
+import argparse
+import threading
+import subprocess
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional, List, Dict, Set
+
+from dotenv import load_dotenv
+
+import artifacts
+from call_store import CALL_STORE_DIR
+from checkpoints import protected_folder_dates
+from locks import try_file_lock
+from metrics import inc
+from log_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+MSK = timezone(timedelta(hours=3))
+
+AUDIO_DIR = Path("audio")
+# Результаты этапов и папки прежних версий (transcripts/, analyses/) хранятся дольше записей
+TEXT_DIRS = [CALL_STORE_DIR, Path("transcripts"), Path("analyses")]
+
+# Записи младше стольких дней хранятся в MP3 как есть (горячее хранение)
+AUDIO_HOT_DAYS = int(os.getenv("AUDIO_HOT_DAYS", "1"))
+# Дальше — в Opus (теплое хранение, если есть ffmpeg), старше AUDIO_WARM_DAYS записи удаляются
+AUDIO_WARM_DAYS = int(os.getenv("AUDIO_WARM_DAYS", "30"))
+# Предельный объем записей, МБ: сверх него удаляются записи, к которым дольше всего не обращались (0 — без предела)
+AUDIO_QUOTA_MB = int(os.getenv("AUDIO_QUOTA_MB", "10240"))
+# Информация о звонках, транскрипты и анализы
+STORE_RETENTION_DAYS = int(os.getenv("STORE_RETENTION_DAYS", "180"))
+STORE_QUOTA_MB = int(os.getenv("STORE_QUOTA_MB", "0"))
+# Битрейт Opus: для речи 24 кбит/с достаточно
+OPUS_BITRATE = os.getenv("OPUS_BITRATE", "24k")
+# Очистка из пайплайна запускается не чаще, чем раз в столько минут
+RETENTION_INTERVAL_MINUTES = int(os.getenv("RETENTION_INTERVAL_MINUTES", "60"))
+
+RETENTION_LOCK_PATH = Path("cache") / "retention.lock"
+RETENTION_STATE_PATH = Path("cache") / "retention_last_run"
+
+ACTION_TRANSCODE = "transcode"
+ACTION_DELETE = "delete"
+
+AUDIO_SUFFIXES = (".mp3", ".opus")
+
+
+class RetentionItem:
+    """
+    Единица хранения: запись разговора (файл) или папка результатов за дату.
+    """
+
+    def __init__(self, path: Path, tier: str, folder_date: Optional[str], size: int, last_access: float):
+        self.path = path
+        self.tier = tier
+        self.folder_date = folder_date
+        self.size = size
+        self.last_access = last_access
+
+    def age_days(self, today) -> Optional[int]:
+        if not self.folder_date:
+            return None
+        return (today - datetime.strptime(self.folder_date, "%d.%m.%Y").date()).days
+
+
+class RetentionAction:
+    def __init__(self, action: str, item: RetentionItem, reason: str):
+        self.action = action
+        self.item = item
+        self.reason = reason
+
+
+def _folder_date(folder: Path) -> Optional[str]:
+    date_str_part = folder.name.split("_")[-1]
+    try:
+        datetime.strptime(date_str_part, "%d.%m.%Y")
+    except ValueError:
+        return None
+    return date_str_part
+
+
+def _last_access(path: Path) -> float:
+    stat = path.stat()
+    return max(stat.st_atime, stat.st_mtime)
+
+
+def _dir_size(path: Path) -> int:
+    return sum(item.stat().st_size for item in path.rglob("*") if item.is_file())
+
+
+class RetentionManager:
+    """
+    Хранение по уровням вместо удаления всего старше дня:
+
+    - записи разговоров младше AUDIO_HOT_DAYS — в MP3, до AUDIO_WARM_DAYS — в Opus, старше — удаляются;
+    - информация о звонках, транскрипты и анализы хранятся STORE_RETENTION_DAYS дней;
+    - сверх квоты (AUDIO_QUOTA_MB, STORE_QUOTA_MB) удаляется то, к чему дольше всего не обращались (LRU по atime,
+      см. artifacts.touch).
+
+    Папки незавершенных окон (см. checkpoints.py) не трогаются, чтобы окно можно было доработать.
+    """
+
+    def __init__(self, today=None):
+        self.today = today or datetime.now(MSK).date()
+        self.ffmpeg = shutil.which("ffmpeg")
+        # Пониженный приоритет ffmpeg задается через nice, а не preexec_fn: очистка идет в фоновом потоке,
+        # а preexec_fn небезопасен в процессе с потоками (дочерний процесс может зависнуть после fork)
+        nice = shutil.which("nice")
+        self._nice_prefix = [nice, "-n", "10"] if nice else []
+        self.protected_dates: Set[str] = protected_folder_dates()
+
+    def _audio_items(self) -> List[RetentionItem]:
+        items = []
+        if not AUDIO_DIR.exists():
+            return items
+        for folder in AUDIO_DIR.iterdir():
+            folder_date = _folder_date(folder)
+            if not folder.is_dir() or folder_date in self.protected_dates:
+                continue
+            for path in folder.iterdir():
+                if path.suffix in AUDIO_SUFFIXES and path.is_file():
+                    items.append(RetentionItem(path, "audio", folder_date, path.stat().st_size, _last_access(path)))
+        return items
+
+    def _text_items(self) -> List[RetentionItem]:
+        items = []
+        for base_dir in TEXT_DIRS:
+            if not base_dir.exists():
+                continue
+            for folder in base_dir.iterdir():
+                folder_date = _folder_date(folder)
+                # Без даты в имени (например, журнал отправок в analyses/) не трогаем
+                if not folder.is_dir() or folder_date is None or folder_date in self.protected_dates:
+                    continue
+                items.append(RetentionItem(folder, "store", folder_date, _dir_size(folder), _last_access(folder)))
+        return items
+
+    def plan(self) -> List[RetentionAction]:
+        actions = []
+        audio = self._audio_items()
+        remaining = []
+        for item in audio:
+            age = item.age_days(self.today)
+            if age is not None and age > AUDIO_WARM_DAYS:
+                actions.append(RetentionAction(ACTION_DELETE, item, f"старше {AUDIO_WARM_DAYS} дн."))
+                continue
+            if age is not None and age > AUDIO_HOT_DAYS and item.path.suffix == ".mp3" and self.ffmpeg:
+                actions.append(RetentionAction(ACTION_TRANSCODE, item, f"старше {AUDIO_HOT_DAYS} дн."))
+            remaining.append(item)
+        actions += self._over_quota(remaining, AUDIO_QUOTA_MB)
+
+        remaining = []
+        for item in self._text_items():
+            age = item.age_days(self.today)
+            if age is not None and age > STORE_RETENTION_DAYS:
+                actions.append(RetentionAction(ACTION_DELETE, item, f"старше {STORE_RETENTION_DAYS} дн."))
+            else:
+                remaining.append(item)
+        actions += self._over_quota(remaining, STORE_QUOTA_MB)
+        return actions
+
+    @staticmethod
+    def _over_quota(items: List[RetentionItem], quota_mb: int) -> List[RetentionAction]:
+        if not quota_mb:
+            return []
+        excess = sum(item.size for item in items) - quota_mb * 1024 * 1024
+        actions = []
+        # Размер после перекодирования заранее неизвестен, поэтому квота считается по текущему размеру
+        for item in sorted(items, key=lambda item: item.last_access):
+            if excess <= 0:
+                break
+            actions.append(RetentionAction(ACTION_DELETE, item, f"квота {quota_mb} МБ"))
+            excess -= item.size
+        return actions
+
+    def report(self, actions: List[RetentionAction]) -> Dict[str, Dict[str, int]]:
+        """
+        Сводка по уровням: сколько элементов и байт будет перекодировано и удалено.
+        """
+        summary: Dict[str, Dict[str, int]] = {}
+        deleted = {id(action.item) for action in actions if action.action == ACTION_DELETE}
+        for action in actions:
+            if action.action == ACTION_TRANSCODE and id(action.item) in deleted:
+                continue
+            counts = summary.setdefault(action.item.tier, {})
+            counts[f"{action.action}_items"] = counts.get(f"{action.action}_items", 0) + 1
+            counts[f"{action.action}_bytes"] = counts.get(f"{action.action}_bytes", 0) + action.item.size
+        return summary
+
+    def _transcode(self, path: Path) -> int:
+        """
+        Перекодирует MP3 в Opus рядом с исходным файлом и удаляет MP3. Возвращает освобожденный объем, байт.
+        """
+        opus_path = path.with_suffix(".opus")
+        # Исходная запись сверяется с контрольной суммой: поврежденную нет смысла сохранять
+        artifacts.read_bytes(path)
+        completed = subprocess.run(
+            self._nice_prefix + [self.ffmpeg, "-nostdin", "-loglevel", "error", "-i", str(path), "-c:a", "libopus",
+                                 "-b:a", OPUS_BITRATE, "-ac", "1", "-f", "ogg", "pipe:1"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        if not completed.stdout:
+            raise RuntimeError(f"ffmpeg не вернул данных для {path}")
+        stat = path.stat()
+        artifacts.write_bytes(opus_path, completed.stdout)
+        # Перекодирование — не обращение: время последнего доступа сохраняется для LRU
+        os.utime(opus_path, (stat.st_atime, stat.st_mtime))
+        artifacts.remove(path)
+        return stat.st_size - len(completed.stdout)
+
+    @staticmethod
+    def _delete(item: RetentionItem):
+        if item.path.is_dir():
+            shutil.rmtree(item.path)
+            return
+        artifacts.remove(item.path)
+        folder = item.path.parent
+        if not any(path.suffix in AUDIO_SUFFIXES for path in folder.iterdir()):
+            shutil.rmtree(folder)
+
+    def apply(self, actions: List[RetentionAction]):
+        freed = 0
+        deleted = set()
+        # Сначала удаление: не нужно перекодировать то, что будет удалено
+        for action in sorted(actions, key=lambda action: action.action != ACTION_DELETE):
+            item = action.item
+            if id(item) in deleted or not item.path.exists():
+                continue
+            try:
+                if action.action == ACTION_DELETE:
+                    self._delete(item)
+                    deleted.add(id(item))
+                    freed += item.size
+                else:
+                    freed += self._transcode(item.path)
+                inc("retention_actions_total", tier=item.tier, action=action.action)
+                logger.debug(f"{action.action}: {item.path} ({action.reason})")
+            except Exception as e:
+                logger.error(f"❌ Не удалось выполнить {action.action} для {item.path}: {e}")
+        inc("retention_freed_bytes_total", max(freed, 0))
+        return freed
+
+    def run(self, dry_run: bool = False) -> Dict[str, Dict[str, int]]:
+        if not self.ffmpeg:
+            logger.info("ℹ️ ffmpeg не найден: записи хранятся в MP3 до удаления, без перекодирования в Opus.")
+        actions = self.plan()
+        summary = self.report(actions)
+        for tier, counts in sorted(summary.items()):
+            logger.info(f"🧹 {'[dry-run] ' if dry_run else ''}{tier}: "
+                        f"перекодировать {counts.get('transcode_items', 0)} "
+                        f"({counts.get('transcode_bytes', 0) / 1024 / 1024:.1f} МБ), "
+                        f"удалить {counts.get('delete_items', 0)} ({counts.get('delete_bytes', 0) / 1024 / 1024:.1f} МБ)")
+        if not summary:
+            logger.info(f"🧹 {'[dry-run] ' if dry_run else ''}Хранилище в пределах сроков и квот, очистка не нужна.")
+        if dry_run:
+            for action in actions:
+                logger.info(f"  {action.action}: {action.item.path} ({action.item.size / 1024:.0f} КБ, {action.reason})")
+        if dry_run or not actions:
+            return summary
+        freed = self.apply(actions)
+        logger.info(f"🧹 Очистка завершена: освобождено {freed / 1024 / 1024:.1f} МБ.")
+        return summary
+
+
+def run_retention(dry_run: bool = False, force: bool = False):
+    """
+    Одна очистка по правилам RetentionManager. Одновременно выполняется только в одном процессе;
+    без force — не чаще RETENTION_INTERVAL_MINUTES.
+    """
+    with try_file_lock(RETENTION_LOCK_PATH) as acquired:
+        if not acquired:
+            logger.debug("Очистка уже выполняется другим процессом.")
+            return
+        if not force and not dry_run and RETENTION_STATE_PATH.exists():
+            elapsed = datetime.now().timestamp() - RETENTION_STATE_PATH.stat().st_mtime
+            if elapsed < RETENTION_INTERVAL_MINUTES * 60:
+                return
+        RetentionManager().run(dry_run=dry_run)
+        if not dry_run:
+            RETENTION_STATE_PATH.touch()
+
+
+def start_background_retention() -> threading.Thread:
+    """
+    Запускает очистку в фоновом потоке, чтобы она не задерживала обработку звонков.
+    Поток не демонический: разовый запуск из cron дождется окончания очистки перед выходом.
+    """
+    def target():
+        try:
+            run_retention()
+        except Exception:
+            logger.exception("❌ Ошибка фоновой очистки хранилища.")
+
+    thread = threading.Thread(target=target, name="retention")
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Очистка записей и результатов по срокам хранения и квотам.")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, что будет перекодировано и удалено.")
+    args = parser.parse_args()
+
+    setup_logging()
+    run_retention(dry_run=args.dry_run, force=True)
@@ -1,6 +1,16 @@
 import os
+import re
+import logging
+import time
+import asyncio
 import requests
+from typing import List, Dict, Optional, Union, Tuple
 from dotenv import load_dotenv
+from metrics import observe, inc, record_retry
+from circuit_breaker import get_breaker, is_outage_error, CircuitOpenError
+from log_config import setup_logging
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
@@ -9,18 +19,37 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ROP_CHAT_IDS = os.getenv("ROP_CHAT_IDS", "").split(',')
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 TELEGRAM_TOPIC_ID = os.getenv("TELEGRAM_TOPIC_ID")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
 
+# Режим дайджеста: несколько отчетов упаковываются в одно сообщение (до лимита в 4096 символов)
+TELEGRAM_DIGEST_MODE = os.getenv("TELEGRAM_DIGEST_MODE", "0") == "1"
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+DIGEST_SEPARATOR = "\n\n〰️〰️〰️〰️〰️\n\n"
 
-def send_telegram_message(message: str):
+# Ограничения Telegram Bot API: ~30 сообщений в секунду суммарно, 1 сообщение в секунду в личный чат
+# и ~20 сообщений в минуту в группу. Берём с небольшим запасом.
+TELEGRAM_GLOBAL_RATE_PER_SEC = float(os.getenv("TELEGRAM_GLOBAL_RATE_PER_SEC", "25"))
+TELEGRAM_PRIVATE_CHAT_INTERVAL = float(os.getenv("TELEGRAM_PRIVATE_CHAT_INTERVAL", "1.0"))
+TELEGRAM_GROUP_CHAT_INTERVAL = float(os.getenv("TELEGRAM_GROUP_CHAT_INTERVAL", "3.0"))
+TELEGRAM_MAX_RETRIES = 5
+TELEGRAM_REQUEST_TIMEOUT = 10
+
+
+class TelegramDocument:
     """
-    Отправляет HTML-сообщение в Telegram-чаты, указанные в .env.
-    Теперь также поддерживает отправку в супергруппы с темами.
+    Файл для отправки через sendDocument (например, постраничный отчет по звонкам окна).
     """
-    if not TELEGRAM_BOT_TOKEN:
-        print("❗ TELEGRAM_BOT_TOKEN не найден в .env. Отправка в Telegram невозможна.")
-        return
 
-    # Список получателей: основная супергруппа + отдельные чаты (если есть)
+    def __init__(self, filename: str, content: bytes, caption: str = ""):
+        self.filename = filename
+        self.content = content
+        self.caption = caption
+
+
+def _get_recipients() -> List[Dict[str, Optional[str]]]:
+    """
+    Список получателей: основная супергруппа (с темой) + отдельные чаты РОПов.
+    """
     recipients = []
     # Если указана супергруппа, добавляем её в список получателей
     if TELEGRAM_CHAT_ID:
@@ -35,32 +64,320 @@ def send_telegram_message(message: str):
                 "chat_id": chat_id.strip(),
                 "topic_id": None
             })
+    return recipients
+
+
+# Теги разметки HTML Telegram и HTML-сущности (&amp; и т. п.): резать сообщение внутри них нельзя
+HTML_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^>]*>")
+HTML_ENTITY_RE = re.compile(r"&#?[a-zA-Z0-9]+;")
+
+
+def _cut_points(text: str):
+    """
+    Места, где можно разрезать HTML-сообщение: вне тегов и сущностей. Для каждого места — приоритет
+    (2 — граница абзаца, 1 — перевод строки, 0 — любое место) и открытые в нем теги (имя, открывающий тег).
+    """
+    blocked = set()
+    for match in HTML_ENTITY_RE.finditer(text):
+        blocked.update(range(match.start() + 1, match.end()))
+    open_tags: List[Tuple[str, str]] = []
+    position = 0
+    for match in list(HTML_TAG_RE.finditer(text)) + [None]:
+        end = match.start() if match else len(text)
+        for index in range(max(position, 1), end + 1):
+            if index in blocked:
+                continue
+            if text.startswith("\n\n", index):
+                priority = 2
+            elif text.startswith("\n", index):
+                priority = 1
+            else:
+                priority = 0
+            yield index, priority, list(open_tags)
+        if match is None:
+            break
+        closing, name = match.group(1), match.group(2).lower()
+        if not closing:
+            open_tags.append((name, match.group(0)))
+        else:
+            for depth in range(len(open_tags) - 1, -1, -1):
+                if open_tags[depth][0] == name:
+                    del open_tags[depth:]
+                    break
+        position = match.end()
+
+
+def split_long_message(message: str, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Делит слишком длинное сообщение на части не длиннее limit, стараясь резать по абзацам и строкам.
+    Граница абзаца или строки выбирается только во второй половине части, иначе режется как можно дальше:
+    ранний разрез (например, после короткого заголовка) дал бы лишнее короткое сообщение.
+    Сообщения отправляются с parse_mode=HTML, поэтому режется только вне тегов и сущностей, а теги,
+    открытые в месте разреза, закрываются в конце части и открываются заново в начале следующей:
+    иначе Telegram отклонит часть с ответом 400.
+    """
+    parts = []
+    # Длина заново открытых в начале части тегов: разрез до них не продвинул бы сообщение
+    reopened = 0
+    while len(message) > limit:
+        # Лучший разрез во второй половине части и самый дальний разрез вообще
+        best, longest = None, None
+        for index, priority, open_tags in _cut_points(message):
+            closing = "".join(f"</{name}>" for name, _ in reversed(open_tags))
+            if len(message[:index].rstrip()) + len(closing) > limit:
+                break
+            if index <= reopened:
+                continue
+            longest = (index, priority, open_tags, closing)
+            if index >= limit // 2 and (best is None or priority >= best[1]):
+                best = longest
+        best = best or longest
+        if best is None:
+            # Разрезать по разметке невозможно (например, очень длинный тег): режем по длине
+            parts.append(message[:limit])
+            message, reopened = message[limit:], 0
+            continue
+        index, _, open_tags, closing = best
+        parts.append(message[:index].rstrip() + closing)
+        reopening = "".join(tag for _, tag in open_tags)
+        message, reopened = reopening + message[index:].lstrip(), len(reopening)
+    if message:
+        parts.append(message)
+    return parts
+
+
+def pack_digest(messages: List[str], limit: int = TELEGRAM_MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Упаковывает несколько отчетов в минимальное число сообщений, каждое не длиннее limit.
+    Порядок отчетов сохраняется.
+    """
+    packed = []
+    current = ""
+    for message in messages:
+        for part in split_long_message(message, limit):
+            if not current:
+                current = part
+            elif len(current) + len(DIGEST_SEPARATOR) + len(part) <= limit:
+                current += DIGEST_SEPARATOR + part
+            else:
+                packed.append(current)
+                current = part
+    if current:
+        packed.append(current)
+    return packed
+
+
+class AsyncRateLimiter:
+    """
+    Простой ограничитель частоты: не чаще одного разрешения в min_interval секунд.
+    """
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._lock = asyncio.Lock()
+        self._next_allowed = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            if now < self._next_allowed:
+                await asyncio.sleep(self._next_allowed - now)
+                now = time.monotonic()
+            self._next_allowed = now + self.min_interval
+
+    def delay(self, seconds: float):
+        """
+        Отодвигает следующее разрешение (используется после ответа 429 с retry_after).
+        """
+        self._next_allowed = max(self._next_allowed, time.monotonic() + seconds)
 
-    # Отправляем сообщение каждому получателю
-    for recipient in recipients:
+
+class TelegramDeliveryQueue:
+    """
+    Очередь доставки сообщений в Telegram.
+
+    Сообщения копятся через enqueue() и отправляются в flush(): всем получателям параллельно,
+    каждому — по порядку, с глобальным и поштучным (на чат) ограничением частоты и повтором
+    после 429 с учётом retry_after. В режиме дайджеста отчеты упаковываются в сообщения до 4096 символов.
+    Документы (enqueue_document) отправляются после сообщений, каждому получателю.
+    """
+
+    def __init__(self, digest_mode: bool = TELEGRAM_DIGEST_MODE, recipients: Optional[List[Dict]] = None):
+        self.digest_mode = digest_mode
+        self.recipients = recipients if recipients is not None else _get_recipients()
+        self._messages = []
+        self._documents: List[TelegramDocument] = []
+        self.sent = 0
+        self.failed = 0
+
+    def enqueue(self, message: str):
+        self._messages.append(message)
+
+    def enqueue_document(self, document: TelegramDocument):
+        self._documents.append(document)
+
+    def _take_messages(self) -> List[Union[str, TelegramDocument]]:
+        """
+        Забирает накопленные сообщения (разбитые или упакованные до лимита Telegram) и документы.
+        """
+        if not self._messages and not self._documents:
+            return []
+        if not TELEGRAM_BOT_TOKEN:
+            logger.error("❗ TELEGRAM_BOT_TOKEN не найден в .env. Отправка в Telegram невозможна.")
+            self._messages, self._documents = [], []
+            return []
+
+        messages = pack_digest(self._messages) if self.digest_mode else \
+            [part for message in self._messages for part in split_long_message(message)]
+        messages += self._documents
+        self._messages, self._documents = [], []
+
+        if self.digest_mode:
+            logger.info(f"📦 Режим дайджеста: отчеты упакованы в {len(messages)} сообщений.")
+        return messages
+
+    def flush(self):
+        """
+        Отправляет все накопленные сообщения и очищает очередь.
+        Синхронный вызов: отправка идет в собственном цикле asyncio (asyncio.run), поэтому из корутины
+        в уже работающем цикле его вызывать нельзя — там используется await flush_async().
+        """
+        messages = self._take_messages()
+        if messages:
+            asyncio.run(self._deliver(messages))
+            logger.info(f"📨 Telegram: доставлено {self.sent}, ошибок {self.failed}.")
+
+    async def flush_async(self):
+        """
+        То же, что flush(), в цикле asyncio вызывающего кода.
+        """
+        messages = self._take_messages()
+        if messages:
+            await self._deliver(messages)
+            logger.info(f"📨 Telegram: доставлено {self.sent}, ошибок {self.failed}.")
+
+    async def _deliver(self, messages: List[Union[str, TelegramDocument]]):
+        global_limiter = AsyncRateLimiter(1.0 / TELEGRAM_GLOBAL_RATE_PER_SEC)
+        with requests.Session() as session:
+            await asyncio.gather(*(
+                self._deliver_to_recipient(session, recipient, messages, global_limiter)
+                for recipient in self.recipients
+            ))
+
+    async def _deliver_to_recipient(self, session: requests.Session, recipient: Dict,
+                                    messages: List[Union[str, TelegramDocument]],
+                                    global_limiter: AsyncRateLimiter):
         chat_id = recipient["chat_id"]
-        topic_id = recipient["topic_id"]
+        # Отрицательные ID — группы и супергруппы, для них лимит строже
+        is_group = str(chat_id).startswith("-")
+        chat_limiter = AsyncRateLimiter(TELEGRAM_GROUP_CHAT_INTERVAL if is_group else TELEGRAM_PRIVATE_CHAT_INTERVAL)
 
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        payload = {
-            "chat_id": chat_id,
-            "text": message,
-            "parse_mode": "HTML"
-        }
+        for message in messages:
+            if await self._send_with_retry(session, recipient, message, chat_limiter, global_limiter):
+                self.sent += 1
+            else:
+                self.failed += 1
 
+    async def _send_with_retry(self, session: requests.Session, recipient: Dict,
+                               message: Union[str, TelegramDocument], chat_limiter: AsyncRateLimiter,
+                               global_limiter: AsyncRateLimiter) -> bool:
+        chat_id = recipient["chat_id"]
+        topic_id = recipient["topic_id"]
+
+        if isinstance(message, TelegramDocument):
+            operation = "send_document"
+            url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendDocument"
+            payload = {
+                "chat_id": chat_id,
+                "caption": message.caption,
+                "parse_mode": "HTML"
+            }
+            files = {"document": (message.filename, message.content)}
+        else:
+            operation = "send_message"
+            url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+            payload = {
+                "chat_id": chat_id,
+                "text": message,
+                "parse_mode": "HTML"
+            }
+            files = None
         # Добавляем message_thread_id только если topic_id существует
         if topic_id:
             payload["message_thread_id"] = topic_id
 
-        try:
-            response = requests.post(url, data=payload, timeout=10)
-            response.raise_for_status()
-            print(f"✅ Сообщение в Telegram успешно отправлено в чат ID: {chat_id}")
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Ошибка сетевого запроса при отправке в Telegram в чат ID: {chat_id} — {e}")
+        loop = asyncio.get_running_loop()
+        breaker = get_breaker("telegram")
+        retry_delay = 1
+        for attempt in range(TELEGRAM_MAX_RETRIES):
+            await chat_limiter.acquire()
+            await global_limiter.acquire()
+            if attempt > 0:
+                record_retry("telegram", operation)
+            try:
+                breaker.before_request()
+            except CircuitOpenError as e:
+                logger.error(f"❌ Сообщение в чат ID: {chat_id} не отправлено: {e}.")
+                return False
+            started = time.perf_counter()
+            try:
+                response = await loop.run_in_executor(
+                    None, lambda: session.post(url, data=payload, files=files, timeout=TELEGRAM_REQUEST_TIMEOUT))
+            except requests.exceptions.RequestException as e:
+                breaker.record(failed=is_outage_error(e))
+                inc("external_requests_total", service="telegram", operation=operation, outcome="error")
+                logger.warning(f"⚠️ Ошибка сетевого запроса при отправке в Telegram в чат ID: {chat_id} — {e}")
+                await asyncio.sleep(retry_delay)
+                retry_delay *= 2
+                continue
+
+            # Время ожидания лимитов не входит в замер: считаем только сам HTTP-запрос
+            observe("external_request_duration_seconds", time.perf_counter() - started, service="telegram",
+                    operation=operation)
+            inc("external_requests_total", service="telegram", operation=operation,
+                outcome="ok" if response.status_code == 200 else f"http_{response.status_code}")
+            breaker.record(failed=response.status_code >= 500)
+
+            if response.status_code == 200:
+                logger.info(f"✅ Сообщение в Telegram успешно отправлено в чат ID: {chat_id}")
+                return True
+
+            if response.status_code == 429:
+                try:
+                    retry_after = int(response.json().get("parameters", {}).get("retry_after", retry_delay))
+                except ValueError:
+                    retry_after = retry_delay
+                logger.info(f"⏳ Telegram ограничил частоту для чата ID: {chat_id}. Повтор через {retry_after} сек...")
+                # Лимит флуда Telegram действует на бота целиком: паузу держат и остальные получатели
+                chat_limiter.delay(retry_after)
+                global_limiter.delay(retry_after)
+                continue
+
+            if response.status_code >= 500:
+                logger.warning(f"⚠️ Ошибка сервера Telegram (HTTP {response.status_code}) для чата ID: {chat_id}. Повтор через {retry_delay} сек...")
+                await asyncio.sleep(retry_delay)
+                retry_delay *= 2
+                continue
+
+            logger.error(f"❌ Ошибка отправки в Telegram в чат ID: {chat_id} — HTTP {response.status_code}: {response.text[:300]}")
+            return False
+
+        logger.error(f"❌ Не удалось отправить сообщение в Telegram в чат ID: {chat_id} после {TELEGRAM_MAX_RETRIES} попыток.")
+        return False
+
+
+def send_telegram_message(message: str):
+    """
+    Отправляет HTML-сообщение в Telegram-чаты, указанные в .env.
+    Теперь также поддерживает отправку в супергруппы с темами.
+    """
+    queue = TelegramDeliveryQueue(digest_mode=False)
+    queue.enqueue(message)
+    queue.flush()
 
 
 if __name__ == '__main__':
+    setup_logging()
     # Пример использования для теста
     test_message = "<b>Тестовое сообщение из скрипта</b>\n\nПроверка отправки в Telegram."
     send_telegram_message(test_message)
@@ -0,0 +1,51 @@
+"""
+Общие фикстуры тестов: модули пайплайна читают настройки из окружения при импорте, поэтому локальные
+заглушки внешних сервисов (benchmarks.stand_ins) запускаются и подставляются в окружение до импорта тестов,
+а рабочая папка переносится во временную — кэши, журналы и контрольные точки не попадают в проект.
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from benchmarks.fixtures import Scenario
+from benchmarks.stand_ins import StandInServer, ServiceProfile
+
+MSK = timezone(timedelta(hours=3))
+WINDOW_START = datetime(2025, 1, 15, 12, 0, tzinfo=MSK)
+WINDOW_END = datetime(2025, 1, 15, 14, 59, 59, tzinfo=MSK)
+
+WORK_DIR = tempfile.mkdtemp(prefix="call-analytics-tests-")
+os.chdir(WORK_DIR)
+
+STAND_INS = StandInServer().start()
+STAND_INS.set_scenario(Scenario(10, WINDOW_START, WINDOW_END, seed=1))
+os.environ.update(STAND_INS.env())
+
+
+@pytest.fixture
+def stand_ins():
+    """
+    Заглушки внешних сервисов со сброшенными счетчиками запросов и без внедренных ошибок.
+    """
+    STAND_INS.profiles.clear()
+    STAND_INS.reset_counts()
+    yield STAND_INS
+    STAND_INS.profiles.clear()
+
+
+@pytest.fixture
+def failing_service(stand_ins):
+    """
+    Переводит заглушку сервиса в режим, когда она отвечает 503 на каждый запрос.
+    """
+    def fail(service: str):
+        stand_ins.profiles[service] = ServiceProfile(error_rate=1.0)
+    return fail
@@ -0,0 +1,42 @@
+from analytics import ManagerAnalytics
+from call_store import StageStore
+
+CRITERION = "возражение"
+
+
+def _write_day(store_dir, folder_date, records):
+    store = StageStore(store_dir / f"звонки_{folder_date}" / "analyses.jsonl")
+    for communication_id, analysis in records:
+        store.append(communication_id, {"stem": f"call{communication_id}", "analysis": analysis})
+    return store
+
+
+def _analysis(manager, score, category="Заказ"):
+    return {"manager_name": manager, "call_category": category, "summary": "Резюме", CRITERION: score}
+
+
+def test_summary_counts_calls_and_rates(tmp_path):
+    _write_day(tmp_path / "store", "15.01.2025", [(1, _analysis("Анна", 1)), (2, _analysis("Анна", -1)),
+                                                 (3, _analysis("Олег", 1, category="Сотрудничество"))])
+    analytics = ManagerAnalytics(store_dir=tmp_path / "store", cache_dir=tmp_path / "cache")
+    assert analytics.refresh() == 1
+    summary = analytics.manager_summary()
+    assert summary.loc["Анна", "звонков"] == 2
+    assert summary.loc["Олег", "звонков: Сотрудничество"] == 1
+    assert analytics.criterion_rates().loc["Анна", CRITERION] == 0.5
+
+    assert ManagerAnalytics(store_dir=tmp_path / "store", cache_dir=tmp_path / "cache").refresh() == 0
+
+
+def test_corrupted_record_does_not_break_refresh(tmp_path):
+    store = _write_day(tmp_path / "store", "15.01.2025", [(1, _analysis("Анна", 1)), (2, _analysis("Анна", -1))])
+    store._save_index()
+    offset, length = store._offsets["2"]
+    with open(store.path, "r+b") as f:
+        f.seek(offset)
+        f.write(b"#" * (length - 1))
+    _write_day(tmp_path / "store", "16.01.2025", [(3, _analysis("Олег", 1))])
+
+    analytics = ManagerAnalytics(store_dir=tmp_path / "store", cache_dir=tmp_path / "cache")
+    assert analytics.refresh() == 2
+    assert analytics.manager_summary()["звонков"].to_dict() == {"Анна": 1, "Олег": 1}
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+import analyzer
+from analyzer import score_criteria, criteria_groups, GROUP_PROMPT_TEMPLATE
+
+ITEMS_STATUS = {"has_plant": False, "has_cachepot": False}
+OBJECTION_KEYS = ["возражение", "отработка_возражения"]
+
+
+class FakeCompletions:
+    def __init__(self, content):
+        self.content = content
+        self.prompts = []
+
+    def create(self, model, messages):
+        self.prompts.append(messages[-1]["content"])
+        message = type("Message", (), {"content": self.content})
+        choice = type("Choice", (), {"message": message})
+        return type("Response", (), {"choices": [choice], "usage": None})
+
+
+@pytest.fixture
+def completions(monkeypatch):
+    monkeypatch.setattr(analyzer.time, "sleep", lambda seconds: None)
+
+    def answer(content):
+        fake = FakeCompletions(content)
+        monkeypatch.setattr(analyzer.client.chat, "completions", fake)
+        return fake
+    return answer
+
+
+def test_group_prompt_names_key_of_each_criterion():
+    prompt = GROUP_PROMPT_TEMPLATE.format(sections="\n\n".join(analyzer._keyed_section(key) for key in OBJECTION_KEYS),
+                                          keys=", ".join(f'"{key}"' for key in OBJECTION_KEYS), transcript="")
+    for key in OBJECTION_KEYS:
+        heading = next(line for line in prompt.splitlines() if f'→ ключ "{key}"' in line)
+        assert heading.lstrip()[0].isdigit()
+
+
+def test_criteria_are_scored_by_group_on_stand_in(stand_ins):
+    scores, success, _ = score_criteria("Текст", OBJECTION_KEYS + ["докомплект"], ITEMS_STATUS, "call1")
+    assert success
+    assert scores == {"возражение": 1, "отработка_возражения": 1, "докомплект": 1}
+    assert stand_ins.counts["openai"] == len(criteria_groups(OBJECTION_KEYS + ["докомплект"]))
+
+
+def test_response_with_other_keys_is_rejected(completions):
+    fake = completions(json.dumps({"возражение": 1, "допродажа": -1}))
+    scores, success, _ = score_criteria("Текст", OBJECTION_KEYS, ITEMS_STATUS, "call1")
+    assert not success
+    assert scores == {}
+    assert len(fake.prompts) == 3
+
+
+def test_response_with_exact_keys_is_accepted(completions):
+    completions(json.dumps({"возражение": -1, "отработка_возражения": 5}))
+    scores, success, _ = score_criteria("Текст", OBJECTION_KEYS, ITEMS_STATUS, "call1")
+    assert success
+    assert scores == {"возражение": -1, "отработка_возражения": 0}
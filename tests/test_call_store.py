@@ -0,0 +1,73 @@
+import pytest
+
+import artifacts
+from call_store import StageStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return StageStore(tmp_path / "analyses.jsonl")
+
+
+def test_append_and_read_latest_records(store, tmp_path):
+    store.append(1, {"summary": "первый"})
+    store.append("2", {"summary": "второй"})
+    store.append(1, {"summary": "первый, повторно"})
+
+    assert len(store) == 2
+    assert 1 in store and "2" in store and 3 not in store
+    assert store.get(1) == {"communication_id": "1", "summary": "первый, повторно"}
+    assert store.get(3) is None
+    assert [record["summary"] for record in store.read()] == ["второй", "первый, повторно"]
+    assert [record["summary"] for record in store.read([2, 3])] == ["второй"]
+
+    reopened = StageStore(tmp_path / "analyses.jsonl")
+    assert sorted(reopened.keys()) == ["1", "2"]
+    assert reopened.get(1)["summary"] == "первый, повторно"
+
+
+def test_reads_records_appended_by_another_instance(store, tmp_path):
+    store.append(1, {"summary": "a"})
+    assert len(store) == 1
+    StageStore(tmp_path / "analyses.jsonl").append(2, {"summary": "b"})
+    assert store.get(2) == {"communication_id": "2", "summary": "b"}
+
+
+def test_partial_trailing_line_is_dropped_on_append(store):
+    store.append(1, {"summary": "a"})
+    with open(store.path, "ab") as f:
+        f.write(b'{"communication_id": "2", "summ')
+    assert 2 not in store
+    store.append(3, {"summary": "c"})
+
+    reopened = StageStore(store.path)
+    assert sorted(reopened.keys()) == ["1", "3"]
+    assert reopened.get(3)["summary"] == "c"
+
+
+def test_corrupted_line_is_skipped_when_indexing(store):
+    store.append(1, {"summary": "a"})
+    with open(store.path, "ab") as f:
+        f.write(b"not json\n")
+    store.append(2, {"summary": "b"})
+
+    reopened = StageStore(store.path)
+    assert sorted(reopened.keys()) == ["1", "2"]
+
+
+def test_corrupted_indexed_record_raises_or_is_skipped(store):
+    store.append(1, {"summary": "a"})
+    store.append(2, {"summary": "b"})
+    store._save_index()
+    offset, length = store._offsets["1"]
+    with open(store.path, "r+b") as f:
+        f.seek(offset)
+        f.write(b"#" * (length - 1))
+
+    reopened = StageStore(store.path)
+    with pytest.raises(artifacts.ArtifactCorruptedError):
+        reopened.get(1)
+    with pytest.raises(artifacts.ArtifactCorruptedError):
+        list(reopened.read())
+    assert [record["communication_id"] for record in reopened.read(skip_corrupted=True)] == ["2"]
+
@@ -0,0 +1,90 @@
+import pytest
+
+import checkpoints
+from checkpoints import (WindowCheckpoint, incomplete_checkpoints, STATUS_IN_PROGRESS, STATUS_COMPLETE,
+                         STATUS_ABANDONED, STAGE_SELECT, STAGE_DOWNLOAD, STAGE_DELIVER, CHECKPOINT_MAX_RESUMES)
+from conftest import WINDOW_START, WINDOW_END
+
+FOLDER_DATE = "15.01.2025"
+
+
+@pytest.fixture(autouse=True)
+def checkpoints_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoints, "CHECKPOINTS_DIR", tmp_path / "checkpoints")
+    return tmp_path / "checkpoints"
+
+
+def _checkpoint():
+    return WindowCheckpoint.for_window(WINDOW_START, WINDOW_END, FOLDER_DATE)
+
+
+def test_new_window_starts_from_scratch(checkpoints_dir):
+    checkpoint = _checkpoint()
+    assert not checkpoint.path.exists()
+    assert checkpoint.start_run()
+    assert checkpoint.path.parent == checkpoints_dir
+    assert checkpoint.status == STATUS_IN_PROGRESS
+    assert (checkpoint.start, checkpoint.end) == (WINDOW_START, WINDOW_END)
+
+
+def test_resume_continues_from_saved_progress():
+    checkpoint = _checkpoint()
+    checkpoint.start_run()
+    checkpoint.record_selection([{"communication_id": 1}], {1: [2, 3]})
+    checkpoint.mark_stage(STAGE_DOWNLOAD)
+    checkpoint.mark_analyzed("call_1")
+    checkpoint.mark_analyzed("call_1")
+    checkpoint.record_sent(["https://crm/orders/1"])
+
+    resumed = _checkpoint()
+    assert resumed.start_run()
+    assert resumed.data["runs"] == 2
+    assert resumed.calls == [{"communication_id": 1}]
+    assert resumed.merge_groups == {"1": ["2", "3"]}
+    assert all(resumed.stage_done(stage) for stage in (STAGE_SELECT, STAGE_DOWNLOAD, STAGE_DELIVER))
+    assert resumed.data["analyzed_stems"] == ["call_1"]
+    assert resumed.sent_order_links == {"https://crm/orders/1"}
+    assert [item.path for item in incomplete_checkpoints()] == [resumed.path]
+
+
+def test_window_is_abandoned_after_max_resumes():
+    for _ in range(CHECKPOINT_MAX_RESUMES):
+        assert _checkpoint().start_run()
+    checkpoint = _checkpoint()
+    assert not checkpoint.start_run()
+    assert checkpoint.status == STATUS_ABANDONED
+    assert not _checkpoint().start_run()
+    assert incomplete_checkpoints() == []
+
+
+def test_deferred_run_is_not_counted():
+    for _ in range(CHECKPOINT_MAX_RESUMES + 2):
+        checkpoint = _checkpoint()
+        assert checkpoint.start_run()
+        checkpoint.defer()
+    assert _checkpoint().data["runs"] == 0
+
+
+def test_completed_window_is_not_resumed():
+    checkpoint = _checkpoint()
+    checkpoint.start_run()
+    checkpoint.complete()
+    reloaded = _checkpoint()
+    assert reloaded.status == STATUS_COMPLETE
+    assert not reloaded.start_run()
+    assert incomplete_checkpoints() == []
+
+
+def test_discard_removes_checkpoint():
+    checkpoint = _checkpoint()
+    checkpoint.start_run()
+    checkpoint.discard()
+    assert not checkpoint.path.exists()
+    assert _checkpoint().data["runs"] == 0
+
+
+def test_unreadable_checkpoint_is_processed_again():
+    checkpoint = _checkpoint()
+    checkpoint.start_run()
+    checkpoint.path.write_text("{не json", encoding="utf-8")
+    assert _checkpoint().data["runs"] == 0
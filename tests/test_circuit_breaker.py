@@ -0,0 +1,105 @@
+import os
+import time
+
+import pytest
+import requests
+
+import circuit_breaker
+from circuit_breaker import (CircuitBreaker, CircuitOpenError, DependencyUnavailableError, STATE_CLOSED, STATE_OPEN,
+                             STATE_HALF_OPEN, guarded_request, is_unavailable, defer_if_unavailable)
+
+RESET_SECONDS = 0.1
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = CircuitBreaker("retailcrm", failure_threshold=2, reset_seconds=RESET_SECONDS)
+    monkeypatch.setitem(circuit_breaker.BREAKERS, "retailcrm", breaker)
+    return breaker
+
+
+def _request_users():
+    with guarded_request("retailcrm", "users"):
+        response = requests.get(f"{os.environ['RETAILCRM_URL']}/api/v5/users", timeout=5)
+        response.raise_for_status()
+    return response.json()
+
+
+def test_opens_after_consecutive_outages_and_rejects_without_request(breaker, stand_ins, failing_service):
+    failing_service("retailcrm")
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.HTTPError):
+            _request_users()
+    assert breaker.state == STATE_OPEN
+    assert stand_ins.counts["retailcrm"] == 2
+
+    with pytest.raises(CircuitOpenError):
+        _request_users()
+    assert stand_ins.counts["retailcrm"] == 2
+    assert breaker.rejected == 1
+
+
+def test_success_resets_failure_count(breaker, stand_ins, failing_service):
+    failing_service("retailcrm")
+    with pytest.raises(requests.exceptions.HTTPError):
+        _request_users()
+    stand_ins.profiles.clear()
+    assert _request_users()["success"]
+    failing_service("retailcrm")
+    with pytest.raises(requests.exceptions.HTTPError):
+        _request_users()
+    assert breaker.state == STATE_CLOSED
+
+
+def test_client_errors_do_not_open_circuit(breaker):
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            with guarded_request("retailcrm", "users"):
+                raise ValueError("неверный ответ")
+    assert breaker.state == STATE_CLOSED
+
+
+def test_half_open_probe_closes_circuit(breaker, stand_ins, failing_service):
+    failing_service("retailcrm")
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.HTTPError):
+            _request_users()
+    stand_ins.profiles.clear()
+    time.sleep(RESET_SECONDS * 1.5)
+
+    breaker.before_request()
+    assert breaker.state == STATE_HALF_OPEN
+    # Пока идет пробный запрос, остальные отклоняются
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    breaker.record(failed=False)
+    assert breaker.state == STATE_CLOSED
+    assert _request_users()["success"]
+
+
+def test_failed_probe_opens_circuit_again(breaker, failing_service):
+    failing_service("retailcrm")
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.HTTPError):
+            _request_users()
+    time.sleep(RESET_SECONDS * 1.5)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        _request_users()
+    assert breaker.state == STATE_OPEN
+    with pytest.raises(CircuitOpenError):
+        _request_users()
+
+
+def test_unavailability_is_deferred_only_when_circuit_is_open(breaker, failing_service):
+    failing_service("retailcrm")
+    with pytest.raises(requests.exceptions.HTTPError) as first:
+        _request_users()
+    assert not is_unavailable("retailcrm", first.value)
+    defer_if_unavailable("retailcrm", first.value)
+
+    with pytest.raises(requests.exceptions.HTTPError) as second:
+        _request_users()
+    assert is_unavailable("retailcrm", second.value)
+    with pytest.raises(DependencyUnavailableError):
+        defer_if_unavailable("retailcrm", second.value)
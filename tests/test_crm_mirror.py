@@ -0,0 +1,49 @@
+import threading
+import time
+
+import pytest
+
+from crm_mirror import CrmMirror
+
+
+@pytest.fixture
+def mirror(tmp_path, monkeypatch):
+    mirror = CrmMirror(tmp_path / "mirror.sqlite3")
+    # Зеркало синхронизировалось час назад: пора догонять изменения
+    mirror._synced_at = time.time() - 3600
+    monkeypatch.setattr(mirror, "synced_at", lambda: mirror._synced_at)
+    return mirror
+
+
+def test_lookup_does_not_wait_for_sync(mirror, monkeypatch):
+    release, finished = threading.Event(), threading.Event()
+
+    def slow_sync():
+        with mirror._sync_lock:
+            release.wait(5)
+            mirror._synced_at = time.time()
+        finished.set()
+
+    monkeypatch.setattr(mirror, "sync", slow_sync)
+    assert mirror.start_sync_if_due()
+    # Синхронизация еще идет: второй поток не запускается, поиск не блокируется
+    assert not mirror.start_sync_if_due()
+    assert mirror.last_order("79160000001") is None
+    release.set()
+    assert finished.wait(5)
+    mirror._sync_thread.join(5)
+    assert not mirror.start_sync_if_due()
+
+
+def test_failed_background_sync_is_retried_after_interval(mirror, monkeypatch):
+    calls = []
+
+    def failing_sync():
+        calls.append(1)
+        raise RuntimeError("RetailCRM недоступен")
+
+    monkeypatch.setattr(mirror, "sync", failing_sync)
+    assert mirror.start_sync_if_due()
+    mirror._sync_thread.join(5)
+    assert not mirror.start_sync_if_due()
+    assert calls == [1]
@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta, time as dtime
+
+import daemon
+from daemon import PipelineDaemon, _split_by_day, _next_run_at
+from main import MSK
+
+
+def test_period_is_split_at_midnight():
+    start = datetime(2025, 1, 15, 23, 50, 1, tzinfo=MSK)
+    end = datetime(2025, 1, 16, 0, 10, 0, tzinfo=MSK)
+    assert _split_by_day(start, end) == [
+        (start, datetime(2025, 1, 15, 23, 59, 59, tzinfo=MSK)),
+        (datetime(2025, 1, 16, 0, 0, 0, tzinfo=MSK), end),
+    ]
+    assert _split_by_day(start, start + timedelta(minutes=5)) == [(start, start + timedelta(minutes=5))]
+
+
+def test_next_run_is_in_msk():
+    now = datetime(2025, 1, 15, 15, 0, 1, tzinfo=MSK)
+    assert _next_run_at(dtime(15, 0), now) == datetime(2025, 1, 16, 15, 0, tzinfo=MSK)
+    assert _next_run_at(dtime(18, 0), now) == datetime(2025, 1, 15, 18, 0, tzinfo=MSK)
+
+
+def test_overdue_window_is_taken_from_scheduled_run(tmp_path, monkeypatch):
+    runs = []
+    monkeypatch.setattr(PipelineDaemon, "_run_period", lambda self, *window: runs.append(window))
+    pipeline = PipelineDaemon(state_path=tmp_path / "state.json")
+    run_time = dtime(23, 0)
+    # Запуск был назначен на вчера 23:00, а начинается только сейчас (после полуночи)
+    run_at = datetime.combine(datetime.now(MSK).date() - timedelta(days=1), run_time, tzinfo=MSK)
+    pipeline._window_runs[run_time] = run_at
+    monkeypatch.setattr(daemon, "resolve_processing_window", lambda moment: (moment, moment, moment.strftime("%d.%m.%Y")))
+
+    pipeline.run_due_windows()
+    assert runs == [(run_at, run_at, run_at.strftime("%d.%m.%Y"))]
+    assert pipeline._window_runs[run_time] > datetime.now(MSK)
@@ -0,0 +1,67 @@
+import pytest
+
+import circuit_breaker
+import google_sheets
+from call_store import CallStore
+from circuit_breaker import CircuitBreaker
+from google_sheets import FormSubmissionQueue, SubmissionLedger, send_analyses_to_google_form
+
+FOLDER_DATE = "15.01.2025"
+ORDER_LINKS = ["https://crm.example/orders/1", "https://crm.example/orders/2"]
+
+
+@pytest.fixture(autouse=True)
+def forms(monkeypatch, tmp_path):
+    monkeypatch.setattr(google_sheets, "FORM_SUBMIT_RETRY_DELAY", 0)
+    monkeypatch.setattr(google_sheets, "create_analysis_sink",
+                        lambda: FormSubmissionQueue(SubmissionLedger(tmp_path / "form_submissions.json")))
+    # Цепь не размыкается: проверяется потеря записи при доступном в целом Google Forms
+    monkeypatch.setitem(circuit_breaker.BREAKERS, "google_forms", CircuitBreaker("google_forms", failure_threshold=100))
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(google_sheets, "CallStore", lambda folder_date: CallStore(folder_date, base_dir=tmp_path))
+    store = CallStore(FOLDER_DATE, base_dir=tmp_path)
+    for number, order_link in enumerate(ORDER_LINKS, start=1):
+        stem = f"call{number}_7916000000{number}"
+        store.calls.append(number, {"stem": stem, "start_time": "2025-01-15 12:00:00",
+                                    "contact_phone_number": f"7916000000{number}", "record_link": "",
+                                    "raw": {"direction": "in", "total_duration": 60}})
+        store.transcripts.append(number, {"stem": stem, "text": "Текст звонка"})
+        store.analyses.append(number, {"stem": stem, "analysis": {"call_category": "Заказ", "order_link": order_link,
+                                                                  "manager_name": "Анна", "summary": ""}})
+    return store
+
+
+def test_queue_confirms_sent_and_previously_sent_keys(tmp_path, stand_ins):
+    ledger = SubmissionLedger(tmp_path / "ledger.json")
+    ledger.record("old")
+    queue = FormSubmissionQueue(ledger, workers=2)
+    assert not queue.submit("old", {}, "#0")
+    assert queue.submit("new", {}, "#1")
+    queue.close()
+    assert queue.confirmed == {"old", "new"}
+    assert stand_ins.counts["google_forms"] == 1
+
+
+def test_queue_does_not_confirm_failed_post(tmp_path, stand_ins, failing_service):
+    failing_service("google_forms")
+    queue = FormSubmissionQueue(SubmissionLedger(tmp_path / "ledger.json"))
+    queue.submit("key", {}, "#1")
+    queue.close()
+    assert queue.confirmed == set()
+    assert queue.failed == 1
+    assert stand_ins.counts["google_forms"] == google_sheets.FORM_SUBMIT_MAX_RETRIES
+
+
+def test_only_confirmed_order_links_are_returned(store, stand_ins, failing_service):
+    failing_service("google_forms")
+    assert send_analyses_to_google_form(FOLDER_DATE, set(), telegram=False) == set()
+
+    stand_ins.profiles.clear()
+    assert send_analyses_to_google_form(FOLDER_DATE, set(), telegram=False) == set(ORDER_LINKS)
+    # Повторный запуск не отправляет записи снова, но подтверждает их по журналу
+    stand_ins.reset_counts()
+    assert send_analyses_to_google_form(FOLDER_DATE, set(), telegram=False) == set(ORDER_LINKS)
+    assert stand_ins.counts["google_forms"] == 0
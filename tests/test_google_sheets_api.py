@@ -0,0 +1,123 @@
+import json
+
+import pytest
+
+import google_sheets_api
+from google_sheets import SubmissionLedger
+from google_sheets_api import chunk_rows, SheetsApiSink, SHEET_CELL_MAX_CHARS
+
+COLUMNS = ["entry.1", "entry.2"]
+
+
+class FakeSheetsService:
+    """
+    Клиент Google Sheets API в памяти: запоминает тела запросов values.append, отказывает на заданных по счету.
+    """
+
+    def __init__(self, fail_requests=()):
+        self.bodies = []
+        self.fail_requests = set(fail_requests)
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def append(self, spreadsheetId, range, valueInputOption, insertDataOption, body):
+        self.bodies.append(body)
+        return self
+
+    def execute(self, num_retries=0):
+        if len(self.bodies) in self.fail_requests:
+            raise RuntimeError("Sheets API недоступен")
+        return {}
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return SubmissionLedger(tmp_path / "ledger.json")
+
+
+@pytest.fixture(autouse=True)
+def no_timestamp(monkeypatch):
+    monkeypatch.setattr(google_sheets_api, "SHEET_INCLUDE_TIMESTAMP", False)
+
+
+def test_chunk_rows_splits_by_row_count():
+    rows = [[index] for index in range(7)]
+    chunks = chunk_rows(rows, max_rows=3)
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+    assert [row for chunk in chunks for row in chunk] == rows
+
+
+def test_chunk_rows_splits_by_request_size():
+    row = ["ж" * 100]
+    row_bytes = len(json.dumps(row, ensure_ascii=False).encode("utf-8"))
+    chunks = chunk_rows([row] * 5, max_bytes=row_bytes * 2)
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+
+def test_chunk_rows_keeps_oversized_row_in_own_chunk():
+    chunks = chunk_rows([["x" * 50], ["y"]], max_bytes=10)
+    assert chunks == [[["x" * 50]], [["y"]]]
+
+
+def test_chunk_rows_empty():
+    assert chunk_rows([]) == []
+
+
+def test_sink_appends_chunks_and_records_keys(monkeypatch, ledger):
+    monkeypatch.setattr(google_sheets_api, "chunk_rows", lambda rows: chunk_rows(rows, max_rows=2))
+    service = FakeSheetsService()
+    sink = SheetsApiSink(COLUMNS, ledger, service=service)
+    for index in range(5):
+        assert sink.submit(f"key-{index}", {"entry.1": f"звонок {index}", "entry.2": index}, f"#{index}")
+    sink.close()
+
+    assert [len(body["values"]) for body in service.bodies] == [2, 2, 1]
+    assert service.bodies[0]["values"][0] == ["звонок 0", 0]
+    assert sink.sent == 5 and sink.failed == 0
+    assert all(f"key-{index}" in ledger for index in range(5))
+
+
+def test_sink_skips_sent_and_duplicate_keys(ledger):
+    ledger.record("key-0")
+    service = FakeSheetsService()
+    sink = SheetsApiSink(COLUMNS, ledger, service=service)
+    assert not sink.submit("key-0", {"entry.1": "a"}, "#0")
+    assert sink.submit("key-1", {"entry.1": "b"}, "#1")
+    assert not sink.submit("key-1", {"entry.1": "b"}, "#1")
+    sink.close()
+
+    assert sink.skipped == 2
+    assert service.bodies == [{"values": [["b", ""]]}]
+    assert sink.confirmed == {"key-0", "key-1"}
+
+
+def test_sink_does_not_record_failed_chunk(monkeypatch, ledger):
+    monkeypatch.setattr(google_sheets_api, "chunk_rows", lambda rows: chunk_rows(rows, max_rows=1))
+    service = FakeSheetsService(fail_requests={1})
+    sink = SheetsApiSink(COLUMNS, ledger, service=service)
+    sink.submit("key-0", {"entry.1": "a"}, "#0")
+    sink.submit("key-1", {"entry.1": "b"}, "#1")
+    sink.close()
+
+    assert sink.sent == 1 and sink.failed == 1
+    assert "key-0" not in ledger
+    assert "key-1" in ledger
+    assert sink.confirmed == {"key-1"}
+
+
+def test_sink_without_pending_rows_sends_nothing(ledger):
+    service = FakeSheetsService()
+    SheetsApiSink(COLUMNS, ledger, service=service).close()
+    assert service.bodies == []
+
+
+def test_long_cell_is_truncated(ledger):
+    sink = SheetsApiSink(COLUMNS, ledger, service=FakeSheetsService())
+    row = sink.payload_to_row({"entry.1": "а" * (SHEET_CELL_MAX_CHARS + 10), "entry.2": None})
+    assert len(row[0]) == SHEET_CELL_MAX_CHARS
+    assert row[0].endswith("…")
+    assert row[1] == ""
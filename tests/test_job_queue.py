@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+import job_queue
+from job_queue import JobQueue, STATUS_QUEUED, STATUS_LEASED, STATUS_DONE, STATUS_FAILED
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(tmp_path / "jobs.sqlite3", max_attempts=2)
+
+
+def _status(queue, stage="transcribe"):
+    return queue.stats()[stage]
+
+
+def test_enqueue_is_unique_per_stage_and_key(queue):
+    assert queue.enqueue("transcribe", "call-1", {"stem": "a"})
+    assert not queue.enqueue("transcribe", "call-1", {"stem": "b"})
+    assert queue.enqueue("analyze", "call-1", {"stem": "a"})
+    assert _status(queue) == {STATUS_QUEUED: 1}
+
+
+def test_lease_hands_job_to_one_owner(queue):
+    queue.enqueue("transcribe", "call-1", {"stem": "a"})
+    jobs = queue.lease("transcribe", "worker-1", visibility_timeout=60)
+    assert [(job.key, job.payload, job.attempts) for job in jobs] == [("call-1", {"stem": "a"}, 1)]
+    assert queue.lease("transcribe", "worker-2", visibility_timeout=60) == []
+
+    queue.complete(jobs[0])
+    assert _status(queue) == {STATUS_DONE: 1}
+
+
+def test_delayed_job_is_not_leased_early(queue):
+    queue.enqueue("transcribe", "call-1", {}, delay=60)
+    assert queue.lease("transcribe", "worker-1", visibility_timeout=60) == []
+
+
+def test_fail_requeues_with_backoff_then_fails(queue, monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_RETRY_DELAY_SECONDS", 0)
+    queue.enqueue("transcribe", "call-1", {})
+    job = queue.lease("transcribe", "worker-1", visibility_timeout=60)[0]
+    assert queue.fail(job, "ошибка 1")
+    assert _status(queue) == {STATUS_QUEUED: 1}
+
+    job = queue.lease("transcribe", "worker-1", visibility_timeout=60)[0]
+    assert job.attempts == 2
+    assert not queue.fail(job, "ошибка 2")
+    assert _status(queue) == {STATUS_FAILED: 1}
+
+    assert queue.retry_failed("transcribe") == 1
+    assert queue.lease("transcribe", "worker-1", visibility_timeout=60)[0].attempts == 1
+
+
+def test_fail_backoff_delays_next_lease(queue):
+    queue.enqueue("transcribe", "call-1", {})
+    job = queue.lease("transcribe", "worker-1", visibility_timeout=60)[0]
+    queue.fail(job, "ошибка")
+    assert queue.lease("transcribe", "worker-1", visibility_timeout=60) == []
+
+
+def test_defer_does_not_count_attempt(queue):
+    queue.enqueue("transcribe", "call-1", {})
+    for _ in range(3):
+        job = queue.lease("transcribe", "worker-1", visibility_timeout=60)[0]
+        assert job.attempts == 1
+        queue.defer(job, delay=0, reason="OpenAI недоступен")
+    assert _status(queue) == {STATUS_QUEUED: 1}
+
+
+def test_expired_lease_is_leased_again_and_late_result_ignored(queue):
+    queue.enqueue("transcribe", "call-1", {})
+    stale = queue.lease("transcribe", "worker-1", visibility_timeout=0.05)[0]
+    time.sleep(0.1)
+    job = queue.lease("transcribe", "worker-2", visibility_timeout=60)[0]
+    assert job.id == stale.id and job.attempts == 2
+
+    queue.complete(stale)
+    assert _status(queue) == {STATUS_LEASED: 1}
+    queue.complete(job)
+    assert _status(queue) == {STATUS_DONE: 1}
+
+
+def test_extend_keeps_lease(queue):
+    queue.enqueue("transcribe", "call-1", {})
+    jobs = queue.lease("transcribe", "worker-1", visibility_timeout=0.05)
+    queue.extend(jobs, visibility_timeout=60)
+    time.sleep(0.1)
+    assert queue.lease("transcribe", "worker-2", visibility_timeout=60) == []
+
+
+def test_expired_lease_fails_after_max_attempts(queue):
+    queue.enqueue("transcribe", "call-1", {})
+    for _ in range(2):
+        assert queue.lease("transcribe", "worker-1", visibility_timeout=0.05)
+        time.sleep(0.1)
+    assert queue.lease("transcribe", "worker-1", visibility_timeout=60) == []
+    assert _status(queue) == {STATUS_FAILED: 1}
+
+
+def test_window_pending_and_payloads(queue):
+    queue.enqueue("analyze", "call-1", {"window": "w1", "stem": "a"})
+    queue.enqueue("analyze", "call-2", {"window": "w1", "stem": "b"})
+    queue.enqueue("analyze", "call-3", {"window": "w2", "stem": "c"})
+    assert queue.window_pending("w1") == 2
+
+    for job in queue.lease("analyze", "worker-1", visibility_timeout=60, limit=3):
+        if job.payload["window"] == "w1" and job.payload["stem"] == "a":
+            queue.complete(job)
+    assert queue.window_pending("w1") == 1
+    assert queue.window_payloads("analyze", "w1") == [{"window": "w1", "stem": "a"}]
+    assert len(queue.window_payloads("analyze", "w1", status=None)) == 2
@@ -0,0 +1,20 @@
+from main import restrict_merge_groups
+
+MERGE_GROUPS = {1: [2, 3], 4: [5]}
+
+
+def _calls(*communication_ids):
+    return [{"communication_id": communication_id} for communication_id in communication_ids]
+
+
+def test_groups_of_claimed_calls_are_kept():
+    assert restrict_merge_groups(MERGE_GROUPS, _calls(1, 2, 3, 4, 5)) == MERGE_GROUPS
+
+
+def test_secondary_is_promoted_when_primary_is_claimed_elsewhere():
+    assert restrict_merge_groups(MERGE_GROUPS, _calls(2, 3, 4, 5)) == {2: [3], 4: [5]}
+
+
+def test_calls_of_other_runs_are_dropped_from_groups():
+    assert restrict_merge_groups(MERGE_GROUPS, _calls(1, 3, 5)) == {1: [3]}
+    assert restrict_merge_groups(MERGE_GROUPS, _calls(4)) == {}
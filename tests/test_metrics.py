@@ -0,0 +1,26 @@
+import json
+
+from metrics import inc, start_run_metrics, write_run_summary, REGISTRY, CUMULATIVE
+
+
+def _value(registry, name):
+    return sum(item["value"] for item in registry.summary()["counters"].get(name, []))
+
+
+def test_run_summary_is_per_run_and_exporters_are_cumulative(tmp_path):
+    start_run_metrics()
+    inc("pipeline_calls_total", 2, stage="downloaded")
+    cumulative_before = _value(CUMULATIVE, "pipeline_calls_total")
+    first_started = REGISTRY.started_at
+
+    start_run_metrics()
+    inc("pipeline_calls_total", 3, stage="downloaded")
+    assert REGISTRY.started_at >= first_started
+    assert _value(REGISTRY, "pipeline_calls_total") == 3
+    assert _value(CUMULATIVE, "pipeline_calls_total") == cumulative_before + 3
+    assert 'pipeline_calls_total{stage="downloaded"}' in CUMULATIVE.render()
+
+    path = write_run_summary(tmp_path)
+    assert path.name == f"run_{REGISTRY.started_at.strftime('%Y%m%d_%H%M%S')}.json"
+    summary = json.loads(path.read_text(encoding="utf-8"))
+    assert summary["counters"]["pipeline_calls_total"] == [{"labels": {"stage": "downloaded"}, "value": 3}]
@@ -0,0 +1,117 @@
+import pytest
+from openai import OpenAI
+
+import circuit_breaker
+import cost_accounting
+import model_router
+from circuit_breaker import CircuitBreaker, DependencyUnavailableError
+from cost_accounting import RunLedger, BUDGET_MODE_NORMAL, BUDGET_MODE_ECONOMY, BUDGET_MODE_MINIMAL
+from model_router import ModelRouter
+
+TIERS = ["model-nano", "model-mini", "model-full"]
+SHORT_TEXT_CHARS = 100
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(model_router, "ROUTING_RETRY_DELAY", 0)
+
+
+@pytest.fixture
+def router():
+    return ModelRouter("analysis", TIERS, short_text_chars=SHORT_TEXT_CHARS)
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    """
+    Бюджет запуска $1 с заданными уже потраченными средствами.
+    """
+    def spend(spent_usd: float):
+        monkeypatch.setattr(cost_accounting, "RUN_LEDGER", RunLedger(budget_usd=1.0, spent_usd=spent_usd))
+    return spend
+
+
+@pytest.fixture
+def chat(stand_ins):
+    """
+    Запрос к заглушке OpenAI; возвращает модель, указанную в ответе.
+    """
+    client = OpenAI(max_retries=0)
+
+    def request(model: str) -> str:
+        response = client.chat.completions.create(model=model, messages=[{"role": "user", "content": "Звонок"}])
+        return response.model
+    return request
+
+
+def _reject(*models):
+    return lambda model: [f"ответ {model} не прошел проверку"] if model in models else []
+
+
+def test_short_text_starts_on_first_tier(router, chat, stand_ins):
+    assert router.run(10, chat, _reject()) == ("model-nano", "model-nano")
+    assert stand_ins.counts["openai"] == 1
+
+
+def test_long_text_starts_on_second_tier(router, chat):
+    assert router.run(SHORT_TEXT_CHARS, chat, _reject()) == ("model-mini", "model-mini")
+
+
+def test_rejected_answer_escalates_to_next_tier(router, chat, stand_ins):
+    assert router.run(10, chat, _reject("model-nano", "model-mini")) == ("model-full", "model-full")
+    assert stand_ins.counts["openai"] == 3
+    stats = router.stats()
+    assert stats["model-nano"]["escalation_rate"] == 1.0
+    assert stats["model-full"]["escalation_rate"] == 0.0
+
+
+def test_rejected_answer_on_last_tier_is_accepted(router, chat, stand_ins):
+    assert router.run(SHORT_TEXT_CHARS, chat, _reject(*TIERS)) == ("model-full", "model-full")
+    assert stand_ins.counts["openai"] == 2
+
+
+def test_explicit_model_skips_routing(router, chat, stand_ins):
+    assert router.run(SHORT_TEXT_CHARS, chat, _reject("model-custom"), model="model-custom") == \
+        ("model-custom", "model-custom")
+    assert stand_ins.counts["openai"] == 1
+
+
+def test_economy_mode_does_not_escalate(router, chat, budget, stand_ins):
+    budget(0.85)
+    assert cost_accounting.budget_mode() == BUDGET_MODE_ECONOMY
+    assert router.run(10, chat, _reject("model-nano")) == ("model-nano", "model-nano")
+    assert router.run(SHORT_TEXT_CHARS, chat, _reject("model-mini")) == ("model-mini", "model-mini")
+    assert stand_ins.counts["openai"] == 2
+
+
+def test_minimal_mode_uses_first_tier_only(router, chat, budget, stand_ins):
+    budget(1.0)
+    assert cost_accounting.budget_mode() == BUDGET_MODE_MINIMAL
+    assert router.run(SHORT_TEXT_CHARS, chat, _reject("model-nano")) == ("model-nano", "model-nano")
+    assert stand_ins.counts["openai"] == 1
+
+
+def test_budget_mode_follows_spending(budget):
+    budget(0.5)
+    assert cost_accounting.budget_mode() == BUDGET_MODE_NORMAL
+    cost_accounting.RUN_LEDGER.add("analysis", "model-nano", {"cost_usd": 0.35})
+    assert cost_accounting.budget_mode() == BUDGET_MODE_ECONOMY
+
+
+def test_request_errors_escalate_and_give_up(router, chat, stand_ins, failing_service):
+    failing_service("openai")
+    assert router.run(10, chat, _reject()) == (None, None)
+    assert stand_ins.counts["openai"] == model_router.ROUTING_MAX_ATTEMPTS
+    assert router.stats()["model-nano"]["errors"] == 1
+    assert router.stats()["model-full"]["errors"] == 1
+
+
+def test_unavailable_openai_is_not_retried(router, chat, stand_ins, failing_service, monkeypatch):
+    breaker = CircuitBreaker("openai", failure_threshold=1)
+    breaker.record(failed=True)
+    monkeypatch.setitem(circuit_breaker.BREAKERS, "openai", breaker)
+    failing_service("openai")
+    with pytest.raises(DependencyUnavailableError):
+        router.run(10, chat, _reject())
+    assert stand_ins.counts["openai"] == 1
@@ -0,0 +1,100 @@
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker
+from product_classifier import (ProductClassifier, CatalogGroupCache, load_product_config, CATEGORY_PLANT,
+                                CATEGORY_CACHEPOT)
+from retailcrm_integration import _fetch_offer_groups
+from conftest import PROJECT_ROOT
+
+CONFIG = {
+    "keywords": {
+        "cachepot": ["кашпо", "горшок"],
+        "accessory": ["грунт", "для кашпо"],
+    },
+    "catalog_groups": {"10": "accessory", "ext-pots": "cachepot"},
+}
+
+
+def _item(offer_id, name=""):
+    return {"offer": {"id": offer_id, "name": name}}
+
+
+@pytest.fixture
+def classifier(tmp_path):
+    def make(config=CONFIG):
+        classifier = ProductClassifier(config)
+        classifier.group_cache = CatalogGroupCache(tmp_path / "offer_groups.json")
+        return classifier
+    return make
+
+
+@pytest.fixture(autouse=True)
+def retailcrm_breaker(monkeypatch):
+    monkeypatch.setitem(circuit_breaker.BREAKERS, "retailcrm", CircuitBreaker("retailcrm"))
+
+
+def test_category_order_sets_priority(classifier):
+    rules = classifier()
+    assert rules.classify_name("Грунт для кашпо") == "cachepot"
+    assert rules.classify_name("Грунт универсальный") == "accessory"
+    assert rules.classify_name("Монстера") is None
+
+    reversed_rules = classifier({"keywords": {"accessory": ["грунт", "для кашпо"], "cachepot": ["кашпо"]}})
+    assert reversed_rules.classify_name("Грунт для кашпо") == "accessory"
+
+
+def test_shipped_config_matches_default_rules(classifier):
+    config = load_product_config(PROJECT_ROOT / "product_config.yaml")
+    for rules in (classifier(config), classifier({})):
+        assert rules.classify_items([_item(1, "Кашпо Lechuza"), _item(2, "Фикус"), _item(3, "Дренаж")]) == \
+            [CATEGORY_CACHEPOT, CATEGORY_PLANT, "accessory"]
+        assert rules.default_category == CATEGORY_PLANT
+
+
+def test_unknown_items_get_default_category(classifier):
+    rules = classifier({**CONFIG, "default_category": "other"})
+    assert rules.classify_items([_item(1, "Монстера"), {"productName": "Горшок"}]) == ["other", "cachepot"]
+
+
+def test_catalog_groups_resolve_unnamed_items_in_one_fetch(classifier):
+    requests = []
+
+    def fetch(offer_ids):
+        requests.append(offer_ids)
+        return {"1": ["10"], "2": ["5", "ext-pots"], "3": []}
+
+    rules = classifier()
+    items = [_item(1, "Набор Б"), _item(2, "Артикул 7"), _item(3, "Монстера"), _item(4, "Кашпо"), _item(1, "Набор Б")]
+    assert rules.classify_items(items, fetch) == ["accessory", "cachepot", CATEGORY_PLANT, "cachepot", "accessory"]
+    assert requests == [["1", "2", "3"]]
+
+    assert rules.classify_items(items[:3], fetch) == ["accessory", "cachepot", CATEGORY_PLANT]
+    assert len(requests) == 1
+
+
+def test_catalog_is_not_queried_without_catalog_groups(classifier):
+    def fetch(offer_ids):
+        raise AssertionError("каталог не должен запрашиваться")
+
+    assert classifier({"keywords": CONFIG["keywords"]}).classify_items([_item(1, "Монстера")], fetch) == \
+        [CATEGORY_PLANT]
+
+
+def test_offers_missing_from_catalog_are_cached_as_default(classifier, stand_ins):
+    rules = classifier()
+    assert rules.classify_items([_item(1, "Монстера")], _fetch_offer_groups) == [CATEGORY_PLANT]
+    assert stand_ins.counts["retailcrm"] == 1
+
+    assert classifier().classify_items([_item(1, "Монстера")], _fetch_offer_groups) == [CATEGORY_PLANT]
+    assert stand_ins.counts["retailcrm"] == 1
+
+
+def test_failed_catalog_request_is_not_cached(classifier, stand_ins, failing_service):
+    failing_service("retailcrm")
+    rules = classifier()
+    assert rules.classify_items([_item(1, "Монстера")], _fetch_offer_groups) == [CATEGORY_PLANT]
+
+    stand_ins.profiles.clear()
+    assert rules.classify_items([_item(1, "Монстера")], _fetch_offer_groups) == [CATEGORY_PLANT]
+    assert stand_ins.counts["retailcrm"] == 2
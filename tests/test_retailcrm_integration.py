@@ -0,0 +1,32 @@
+import pytest
+
+import retailcrm_integration
+from retailcrm_integration import get_analyzable_status_codes, ANALYZABLE_STATUS_CODES
+
+REFERENCE = {"new": {"code": "new", "group": "new"}, "complete": {"code": "complete", "group": "complete"}}
+
+
+@pytest.fixture
+def reference(monkeypatch, tmp_path):
+    monkeypatch.setattr(retailcrm_integration, "load_status_config", lambda: {"analyzable_groups": ["new"]})
+    load_status_reference = retailcrm_integration.load_status_reference
+    monkeypatch.setattr(retailcrm_integration, "load_status_reference",
+                        lambda ttl_hours: load_status_reference(ttl_hours, cache_path=tmp_path / "statuses.json"))
+    monkeypatch.setattr(retailcrm_integration, "_analyzable_status_codes_cache", None)
+    responses = []
+    monkeypatch.setattr(retailcrm_integration, "_fetch_status_reference", lambda: responses.pop(0))
+    return responses
+
+
+def test_fallback_is_cached_briefly(monkeypatch, reference):
+    clock = [1000.0]
+    monkeypatch.setattr(retailcrm_integration.time, "time", lambda: clock[0])
+    reference.extend([None, REFERENCE])
+
+    assert get_analyzable_status_codes() == frozenset(ANALYZABLE_STATUS_CODES)
+    clock[0] += retailcrm_integration.STATUS_FALLBACK_CACHE_SECONDS + 1
+    assert get_analyzable_status_codes() == frozenset({"new"})
+    # Набор из справочника держится полный TTL
+    clock[0] += retailcrm_integration.STATUS_FALLBACK_CACHE_SECONDS + 1
+    assert get_analyzable_status_codes() == frozenset({"new"})
+    assert reference == []
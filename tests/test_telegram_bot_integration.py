@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+import telegram_bot_integration
+from telegram_bot_integration import (split_long_message, pack_digest, AsyncRateLimiter, TelegramDeliveryQueue,
+                                      TELEGRAM_MAX_MESSAGE_LENGTH)
+
+
+def _parts(message, limit=TELEGRAM_MAX_MESSAGE_LENGTH):
+    parts = split_long_message(message, limit)
+    assert all(len(part) <= limit for part in parts)
+    return parts
+
+
+def test_short_message_is_not_split():
+    assert _parts("Отчет") == ["Отчет"]
+
+
+def test_early_paragraph_break_does_not_produce_short_part():
+    assert [len(part) for part in _parts("Header\n\n" + "x" * 5000)] == [4096, 912]
+    assert [len(part) for part in _parts("a" * 50 + "\n" + "y" * 5000)] == [4096, 955]
+
+
+def test_paragraph_break_preferred_in_second_half():
+    first, second = "а" * 3000, "б" * 2000
+    assert _parts(f"{first}\nстрока\n\n{second}") == [f"{first}\nстрока", second]
+
+
+def test_open_tags_are_closed_and_reopened():
+    parts = _parts("<b>" + "ж" * 150 + "</b>", limit=100)
+    assert len(parts) == 2
+    assert parts[0].startswith("<b>") and parts[0].endswith("</b>")
+    assert parts[1].startswith("<b>") and parts[1].endswith("</b>")
+
+
+def test_entities_are_not_cut():
+    assert _parts("a" * 95 + "&amp;" + "b" * 10, limit=98) == ["a" * 95, "&amp;" + "b" * 10]
+
+
+def test_pack_digest_keeps_order_within_limit():
+    packed = pack_digest(["один", "два", "три" * 40], limit=100)
+    assert packed[0].startswith("один") and "два" in packed[0]
+    assert all(len(message) <= 100 for message in packed)
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self._data = data or {}
+        self.text = ""
+
+    def json(self):
+        return self._data
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+
+    def post(self, url, data=None, files=None, timeout=None):
+        return self.responses.pop(0)
+
+
+def test_flood_limit_delays_all_recipients(monkeypatch):
+    monkeypatch.setattr(telegram_bot_integration, "TELEGRAM_BOT_TOKEN", "bench")
+    queue = TelegramDeliveryQueue(recipients=[])
+    chat_limiter, global_limiter = AsyncRateLimiter(0), AsyncRateLimiter(0)
+    session = FakeSession([FakeResponse(429, {"parameters": {"retry_after": 1}}), FakeResponse(200)])
+    recipient = {"chat_id": "1001", "topic_id": None}
+
+    delays = []
+    original_delay = AsyncRateLimiter.delay
+
+    def record_delay(limiter, seconds):
+        delays.append((limiter, seconds))
+        original_delay(limiter, seconds)
+
+    monkeypatch.setattr(AsyncRateLimiter, "delay", record_delay)
+    started = time.monotonic()
+    assert asyncio.run(queue._send_with_retry(session, recipient, "Отчет", chat_limiter, global_limiter))
+    assert (global_limiter, 1) in delays and (chat_limiter, 1) in delays
+    assert time.monotonic() - started >= 1
+
+
+def test_delivery_to_stand_in(monkeypatch, stand_ins):
+    monkeypatch.setattr(telegram_bot_integration, "TELEGRAM_PRIVATE_CHAT_INTERVAL", 0)
+    queue = TelegramDeliveryQueue(recipients=[{"chat_id": "1001", "topic_id": None},
+                                              {"chat_id": "1002", "topic_id": None}])
+    queue.enqueue("Отчет 1")
+    queue.enqueue("Отчет 2")
+    queue.flush()
+    assert (queue.sent, queue.failed) == (4, 0)
+    assert stand_ins.counts["telegram"] == 4
@@ -0,0 +1,34 @@
+import pytest
+
+import artifacts
+import transcriber
+from call_store import CallStore
+from transcriber import transcribe_all
+
+FOLDER_DATE = "15.01.2025"
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch, stand_ins):
+    monkeypatch.setattr(transcriber, "AUDIO_DIR", tmp_path / "audio")
+    monkeypatch.setattr(transcriber, "CallStore", lambda folder_date: CallStore(folder_date, base_dir=tmp_path))
+    store = CallStore(FOLDER_DATE, base_dir=tmp_path)
+    audio_dir = tmp_path / "audio" / f"звонки_{FOLDER_DATE}"
+    for communication_id in (1, 2, 3):
+        stem = f"call{communication_id}_7916000000{communication_id}"
+        artifacts.write_bytes(audio_dir / f"{stem}.mp3", stand_ins.mp3)
+        store.calls.append(communication_id, {"stem": stem, "start_time": "2025-01-15 12:00:00"})
+    return store
+
+
+def test_transcribes_only_claimed_calls(store, stand_ins):
+    transcribe_all(FOLDER_DATE, only_ids=[1, "3"])
+    assert sorted(store.transcripts.keys()) == ["1", "3"]
+    assert stand_ins.counts["openai"] == 2
+
+
+def test_transcribes_whole_folder_without_filter(store, stand_ins):
+    store.transcripts.append(2, {"stem": "call2_79160000002", "text": "Готово", "merged": False})
+    transcribe_all(FOLDER_DATE)
+    assert sorted(store.transcripts.keys()) == ["1", "2", "3"]
+    assert stand_ins.counts["openai"] == 2
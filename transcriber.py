@@ -1,36 +1,64 @@
 import os
+import logging
+import re
 import openai
 from pathlib import Path
+from typing import Dict, List, Any, Tuple, Optional, Iterable
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from openai import OpenAI
+from circuit_breaker import guarded_request, defer_if_unavailable
+from cost_accounting import record_usage, track_call, budget_mode, BUDGET_MODE_NORMAL
+from model_router import get_router
+from log_config import setup_logging, log_context
+import artifacts
+from call_store import CallStore
+from uis_call_downloader import _get_call_duration
+
+logger = logging.getLogger(__name__)
 
 # Загрузка API-ключа из .env
 load_dotenv()
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-# Определение директорий для аудио и транскриптов
+# Директория с аудиофайлами; транскрипты сохраняются в хранилище (call_store.py)
 AUDIO_DIR = Path("audio")
-TRANSCRIPTS_DIR = Path("transcripts")
+# Разметка ролей короче такой доли исходного текста считается сокращенной (реплики потеряны)
+ROLE_SPLIT_MIN_LENGTH_RATIO = 0.8
 
 
-def transcribe_single_audio_file(mp3_path: Path, transcript_path: Path, assign_roles=False) -> str:
+def transcribe_single_audio_file(mp3_path: Path, store: CallStore, communication_id: str, assign_roles=False,
+                                 save_errors=True) -> str:
     """
-    Транскрибирует один аудиофайл MP3 в текстовый файл.
+    Транскрибирует один аудиофайл MP3 и сохраняет транскрипт в хранилище (этап transcripts).
     При необходимости может разделять реплики на Менеджера и Клиента.
+    С save_errors=False текст ошибки транскрибации только возвращается, а не сохраняется как транскрипт.
     """
     try:
-        # Открываем аудиофайл в бинарном режиме
-        with mp3_path.open("rb") as audio_file:
-            # Отправляем аудиофайл в Whisper API для транскрибации
+        # Запись сверяется с контрольной суммой до отправки: обрезанный файл не уходит в платный запрос
+        audio_data = artifacts.read_bytes(mp3_path)
+    except artifacts.ArtifactCorruptedError as e:
+        # Транскрипт не пишем, запись удаляем: звонок будет скачан заново при следующем запуске
+        logger.warning(f"⚠️ {e}. Запись удалена и будет скачана заново.")
+        artifacts.remove(mp3_path)
+        return f"[Ошибка транскрибации]: {e}"
+
+    try:
+        # Отправляем аудиофайл в Whisper API для транскрибации
+        with guarded_request("openai", "whisper"):
             transcript = client.audio.transcriptions.create(
                 model="whisper-1",
-                file=audio_file,
+                file=(mp3_path.name, audio_data),
                 response_format="text" # Получаем ответ в виде простого текста
             )
+        # Whisper тарифицируется по длительности записи: берем ее из отчета UIS
+        record_usage("whisper", "whisper-1",
+                     audio_seconds=float(_get_call_duration(store.calls.get(communication_id) or {}) or 0))
         text = transcript.strip() # Удаляем лишние пробелы в начале и конце
 
-        if assign_roles:
+        if assign_roles and budget_mode() != BUDGET_MODE_NORMAL:
+            logger.warning(f"💸 Бюджет запуска почти исчерпан: разметка ролей для {mp3_path.name} пропущена.")
+        elif assign_roles:
             # Если требуется разделение ролей, формируем промпт для GPT
             role_prompt = (
                 "Ты - транскрибатор, твоя задача - взять предоставленный текст телефонного разговора "
@@ -48,60 +76,169 @@ def transcribe_single_audio_file(mp3_path: Path, transcript_path: Path, assign_r
                 "Текст звонка для разделения:\n" + text
             )
             # Отправляем текст звонка в GPT для разделения ролей
-            chat_response = client.chat.completions.create(
-                model="gpt-4o", # Используем модель GPT-4o
-                messages=[
-                    {"role": "system", "content": "Ты высокоточный эксперт по разделению ролей в телефонных звонках. Твоя цель - идеально разделить диалог на реплики Менеджера и Клиента, строго следуя инструкциям пользователя и не добавляя ничего лишнего."},
-                    {"role": "user", "content": role_prompt}
-                ],
-                temperature=0 # Устанавливаем температуру 0 для более детерминированного ответа
-            )
-            text = chat_response.choices[0].message.content.strip() # Обновляем текст с разделенными ролями
+            def request(model: str) -> str:
+                with guarded_request("openai", "role_split"):
+                    chat_response = client.chat.completions.create(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": "Ты высокоточный эксперт по разделению ролей в телефонных звонках. Твоя цель - идеально разделить диалог на реплики Менеджера и Клиента, строго следуя инструкциям пользователя и не добавляя ничего лишнего."},
+                            {"role": "user", "content": role_prompt}
+                        ],
+                        temperature=0 # Устанавливаем температуру 0 для более детерминированного ответа
+                    )
+                record_usage("role_split", model, getattr(chat_response, "usage", None))
+                return chat_response.choices[0].message.content.strip()
 
-        # Записываем транскрибированный текст в файл
-        with transcript_path.open("w", encoding="utf-8") as f:
-            f.write(text)
+            # Короткие звонки размечает дешевая модель; при плохой разметке запрос повторяется на более сильной
+            split_text, _ = get_router("role_split").run(len(text), request, lambda result: _validate_roles(text, result),
+                                                         label=mp3_path.name)
+            if split_text is None:
+                raise RuntimeError("не удалось разделить реплики по ролям")
+            text = split_text # Обновляем текст с разделенными ролями
+
+        # Сохраняем транскрибированный текст в хранилище
+        store.transcripts.append(communication_id, {"stem": mp3_path.stem, "text": text, "merged": False})
 
         return text
     except Exception as e:
-        # В случае ошибки транскрибации, записываем сообщение об ошибке в файл транскрипта
+        # OpenAI недоступен: транскрипт не сохраняем, звонок будет транскрибирован при следующем запуске
+        defer_if_unavailable("openai", e)
+        # В случае ошибки транскрибации сохраняем сообщение об ошибке вместо транскрипта
         error_text = f"[Ошибка транскрибации]: {e}"
-        with transcript_path.open("w", encoding="utf-8") as f:
-            f.write(error_text)
+        if save_errors:
+            store.transcripts.append(communication_id, {"stem": mp3_path.stem, "text": error_text, "merged": False})
         return error_text
 
 
-def transcribe_all(target_folder_date_str: str, assign_roles=False):
+def _validate_roles(source_text: str, split_text: str) -> List[str]:
+    """
+    Проблемы разметки ролей: реплики без "Менеджер:"/"Клиент:" или заметно сокращенный текст.
+    """
+    problems = []
+    lines = [line for line in split_text.splitlines() if line.strip()]
+    unlabeled = [line for line in lines if not line.lstrip().startswith(("Менеджер:", "Клиент:"))]
+    if not lines or unlabeled:
+        problems.append(f"реплик без роли: {len(unlabeled)}")
+    if len(split_text) < len(source_text) * ROLE_SPLIT_MIN_LENGTH_RATIO:
+        problems.append("текст сокращен")
+    return problems
+
+
+def transcribe_all(target_folder_date_str: str, assign_roles=False, only_ids: Optional[Iterable[Any]] = None):
     """
     Транскрибирует все MP3-файлы в указанной папке за определенную дату.
-    Сохраняет транскрипты с тем же базовым именем, что и исходные MP3-файлы,
-    обеспечивая сквозное соответствие (например, call_N_НОМЕР.mp3 -> call_N_НОМЕР.txt).
+    Транскрипты сохраняются в хранилище под communication_id звонка вместе с базовым именем MP3-файла
+    (например, call_N_НОМЕР.mp3 -> stem call_N_НОМЕР).
+    С only_ids — только звонки с этими communication_id: папка за день общая для всех процессов
+    (демон, приемник вебхуков, cron), и звонки, взятые другим процессом, транскрибирует он сам.
     """
     audio_dir = AUDIO_DIR / f"звонки_{target_folder_date_str}" # Путь к папке с аудиофайлами
-    transcript_dir = TRANSCRIPTS_DIR / f"транскрибация_{target_folder_date_str}" # Путь к папке для транскриптов
-    transcript_dir.mkdir(parents=True, exist_ok=True) # Создаем папку, если ее нет
 
     if not audio_dir.exists():
-        print(f"Папка с аудиофайлами не найдена: {audio_dir}")
+        logger.info(f"Папка с аудиофайлами не найдена: {audio_dir}")
         return
 
+    store = CallStore(target_folder_date_str)
+    ids_by_stem = {stem: communication_id for communication_id, (stem, _) in _load_call_stems(store).items()}
+    wanted_ids = {str(communication_id) for communication_id in only_ids} if only_ids is not None else None
+
     # Итерируем по всем MP3-файлам в отсортированном порядке
     for mp3_file in sorted(audio_dir.glob("*.mp3")):
-        # Используем mp3_file.stem, чтобы получить имя файла без расширения (например, "call1_79001234567")
-        transcript_path = transcript_dir / f"{mp3_file.stem}.txt"
+        communication_id = ids_by_stem.get(mp3_file.stem)
+        if wanted_ids is not None and communication_id not in wanted_ids:
+            continue
+        if communication_id is None:
+            logger.warning(f"Пропуск {mp3_file.name} - нет информации о звонке (запись будет скачана заново)")
+            continue
+
+        # Склеенные с основным звонком клиента транскрипты тоже лежат в хранилище и повторно не транскрибируются
+        if communication_id in store.transcripts:
+            logger.info(f"Пропуск {mp3_file.name} - транскрипт уже существует")
+            continue
+
+        with log_context(communication_id=communication_id, phone=_phone_from_stem(mp3_file.stem)), \
+                track_call(store, communication_id, mp3_file.stem):
+            logger.info(f"Обработка {mp3_file.name} → транскрипт")
+            transcribe_single_audio_file(mp3_file, store, communication_id, assign_roles=assign_roles)
 
-        if transcript_path.exists():
-            print(f"Пропуск {mp3_file.name} - транскрипт уже существует как {transcript_path.name}")
+
+def _phone_from_stem(stem: str) -> str:
+    """
+    Номер телефона из базового имени файла звонка (call12_79001234567 -> 79001234567).
+    """
+    match = re.search(r"call\d+_(\d+)", stem)
+    return match.group(1) if match else ""
+
+
+def _load_call_stems(store: CallStore) -> Dict[str, Tuple[str, str]]:
+    """
+    Сопоставляет communication_id звонка с базовым именем его файлов и временем начала
+    по записям этапа загрузки в хранилище.
+    """
+    audio_dir = AUDIO_DIR / f"звонки_{store.folder_date}"
+    stems = {}
+    for call_info in store.calls.read():
+        stem = call_info["stem"]
+        # Звонок без целой записи считается не скачанным и будет скачан заново
+        if artifacts.is_valid(audio_dir / f"{stem}.mp3"):
+            stems[call_info["communication_id"]] = (stem, call_info.get("start_time", ""))
+    return stems
+
+
+def merge_duplicate_transcripts(target_folder_date_str: str, merge_groups: Dict[Any, List[Any]]):
+    """
+    Склеивает транскрипты повторных звонков клиента в транскрипт основного звонка (в хронологическом порядке),
+    чтобы анализ выполнялся один раз на клиента. Транскрипты остальных звонков помечаются как склеенные
+    (merged) и не анализируются.
+
+    Args:
+        target_folder_date_str: Дата папки в формате "ДД.ММ.ГГГГ".
+        merge_groups: communication_id основного звонка -> список communication_id остальных звонков клиента.
+    """
+    store = CallStore(target_folder_date_str)
+    stems = _load_call_stems(store)
+
+    for primary_id, secondary_ids in merge_groups.items():
+        primary_id = str(primary_id)
+        primary = store.transcripts.get(primary_id)
+        if not primary or primary["merged"]:
             continue
 
-        print(f"Обработка {mp3_file.name} → {transcript_path.name}")
-        transcribe_single_audio_file(mp3_file, transcript_path, assign_roles=assign_roles)
+        group_ids = [primary_id] + [str(secondary_id) for secondary_id in secondary_ids]
+        if primary.get("merged_from"):
+            # Склеено в прошлый раз, но запуск прервался до пометки остальных транскриптов
+            parts = []
+        else:
+            parts = [(stems[communication_id][1], communication_id, record)
+                     for communication_id, record in zip(group_ids, map(store.transcripts.get, group_ids))
+                     if record and not record["merged"] and communication_id in stems]
+            if len(parts) < 2:
+                # Нечего склеивать
+                continue
+
+            parts.sort(key=lambda part: part[0])
+            combined = []
+            for number, (start_time, _, record) in enumerate(parts, start=1):
+                combined.append(f"--- Звонок {number} из {len(parts)} ({start_time or 'время неизвестно'}) ---\n"
+                                f"{record['text'].strip()}")
+            primary = {"stem": primary["stem"], "text": "\n\n".join(combined), "merged": False,
+                       "merged_from": [communication_id for _, communication_id, _ in parts
+                                       if communication_id != primary_id]}
+            store.transcripts.append(primary_id, primary)
+
+        for communication_id in primary["merged_from"]:
+            record = store.transcripts.get(communication_id)
+            if record and not record["merged"]:
+                store.transcripts.append(communication_id, {**record, "merged": True})
+        if parts:
+            logger.info(f"🔗 Склеено {len(parts)} транскриптов клиента в транскрипт {primary['stem']}")
 
 
 if __name__ == "__main__":
+    setup_logging()
     # Пример использования для тестирования модуля отдельно
     # Для тестирования вам нужно будет создать mock-файлы MP3 в папке audio/звонки_ДД.ММ.ГГГГ
-    print("\n--- Тестирование transcribe_all (для вчерашнего дня) ---")
+    logger.info("--- Тестирование transcribe_all (для вчерашнего дня) ---")
     yesterday_str = (datetime.now(timezone(timedelta(hours=3))) - timedelta(days=1)).strftime("%d.%m.%Y")
     transcribe_all(yesterday_str, assign_roles=True)
-    print("\nТранскрибация завершена.")
+    logger.info("Транскрибация завершена.")
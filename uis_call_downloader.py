@@ -1,5 +1,6 @@
 import requests
 import os
+import logging
 import json
 import time
 from datetime import datetime, timedelta, timezone
@@ -18,21 +19,34 @@ if str(project_root) not in sys.path:
 # Импортируем из розницы
 # ИСПРАВЛЕНИЕ: Оставлена только check_if_last_order_is_analyzable, так как check_if_phone_has_recent_order больше не используется для фильтрации.
 from retailcrm_integration import check_if_last_order_is_analyzable
+from call_table import MIN_CALL_DURATION_SECONDS
+from metrics import record_retry, inc
+from circuit_breaker import guarded_request, defer_if_unavailable, DependencyUnavailableError
+from log_config import setup_logging, log_context
+from locks import file_lock
+import artifacts
+from call_store import CallStore, call_info_record
+
+logger = logging.getLogger(__name__)
 
 # Load token from .env
 load_dotenv()
 ACCESS_TOKEN = os.getenv("UIS_API_TOKEN")
+# Адреса Data API и хранилища записей UIS (переопределяются, например, для локальных заглушек в benchmarks/)
+UIS_API_URL = os.getenv("UIS_API_URL", "https://dataapi.uiscom.ru/v2.0")
+UIS_MEDIA_URL = os.getenv("UIS_MEDIA_URL", "https://app.uiscom.ru/system/media/talk")
 
 # Define Moscow timezone (UTC+3)
 MSK = timezone(timedelta(hours=3))
 
 
-def get_calls_report(date_from: str, date_to: str) -> List[Dict[str, Any]]:
+def get_calls_report(date_from: str, date_to: str, report_filter: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
     """
     Retrieves call report from UIS server for a specified period.
     Returns a list of call metadata (dictionaries).
+    report_filter — optional Data API filter, e.g. {"field": "communication_id", "operator": "=", "value": 123}.
     """
-    url = 'https://dataapi.uiscom.ru/v2.0'
+    url = UIS_API_URL
     payload = {
         "id": "id777",
         "jsonrpc": "2.0",
@@ -43,48 +57,70 @@ def get_calls_report(date_from: str, date_to: str) -> List[Dict[str, Any]]:
             "date_till": date_to
         }
     }
+    if report_filter:
+        payload["params"]["filter"] = report_filter
 
-    print(f"🔍 Получаем список звонков с {date_from} по {date_to}...")
+    logger.info(f"🔍 Получаем список звонков с {date_from} по {date_to}...")
 
     max_retries = 5
     retry_delay = 1
 
     for attempt in range(max_retries):
         try:
-            response = requests.post(url, json=payload, timeout=(10, 60))
-            response.raise_for_status()
+            with guarded_request("uis", "calls_report"):
+                response = requests.post(url, json=payload, timeout=(10, 60))
+                response.raise_for_status()
             result = response.json()
 
             calls = result.get("result", {}).get("data", [])
             if not isinstance(calls, list):
                 raise ValueError("Неверный формат данных: 'result.data' должен быть списком звонков")
 
-            print(f"✅ Получено {len(calls)} звонков.")
+            logger.info(f"✅ Получено {len(calls)} звонков.")
             return calls
-        except (requests.exceptions.RequestException, ValueError) as e:
+        except (requests.exceptions.RequestException, ValueError, DependencyUnavailableError) as e:
+            # UIS недоступен: повторы не помогут, окно откладывается до следующего запуска
+            defer_if_unavailable("uis", e)
             if attempt < max_retries - 1:
-                print(
+                record_retry("uis", "calls_report")
+                logger.warning(
                     f"⚠️ Ошибка при получении звонков (попытка {attempt + 1}/{max_retries}): {e}. Повтор через {retry_delay} сек...")
                 time.sleep(retry_delay)
                 retry_delay *= 2
             else:
-                print(f"❌ Ошибка при получении звонков после {max_retries} попыток: {e}")
+                logger.error(f"❌ Ошибка при получении звонков после {max_retries} попыток: {e}")
                 return []
         except Exception as e:
-            print(f"❌ Непредвиденная ошибка в get_calls_report: {e}")
+            logger.error(f"❌ Непредвиденная ошибка в get_calls_report: {e}")
             return []
 
 
+def get_call_by_id(communication_id: Any, lookback_hours: int = 6) -> Optional[Dict[str, Any]]:
+    """
+    Retrieves metadata of a single call (e.g. after a call-finished notification).
+    The report requires a period, so the last lookback_hours are searched.
+    """
+    now = datetime.now(MSK)
+    calls = get_calls_report((now - timedelta(hours=lookback_hours)).strftime("%Y-%m-%d %H:%M:%S"),
+                             now.strftime("%Y-%m-%d %H:%M:%S"),
+                             {"field": "communication_id", "operator": "=", "value": int(communication_id)})
+    for call in calls:
+        if str(call.get("communication_id")) == str(communication_id):
+            return call
+    return None
+
+
 def get_next_call_index(directory: str) -> int:
     """
     Определяет следующий доступный индекс для нового файла звонка.
     """
-    existing_files = list(Path(directory).glob("call*.mp3"))
+    # Записи старше AUDIO_HOT_DAYS хранятся в Opus (retention.py), их номера тоже заняты
+    existing_files = list(Path(directory).glob("call*.mp3")) + list(Path(directory).glob("call*.opus"))
     used_indexes = set()
     for f in existing_files:
         try:
             # Обновлено регулярное выражение для более точного соответствия callN_phone.mp3
-            match = re.match(r'call(\d+)(?:_\d+)?\.mp3', f.name)
+            match = re.match(r'call(\d+)(?:_\d+)?\.(?:mp3|opus)', f.name)
             if match:
                 number = int(match.group(1))
                 used_indexes.add(number)
@@ -101,22 +137,23 @@ def _get_call_duration(call: dict) -> Optional[int]:
     return duration
 
 
-def download_record(call: Dict[str, Any], index: int, target_dir: Path) -> Optional[Path]:
+def download_record(call: Dict[str, Any], index: int, target_dir: Path, store: CallStore) -> Optional[str]:
     """
-    Загружает конкретную запись звонка и сохраняет информацию о нем.
-    Возвращает путь к созданному файлу call_info.json.
+    Загружает конкретную запись звонка и сохраняет информацию о нем в хранилище (этап calls).
+    Возвращает communication_id сохраненного звонка.
     """
     talk_id = call.get("communication_id")
     records = call.get("call_records", [])
     total_duration = _get_call_duration(call)
 
-    if not talk_id or not records or total_duration is None or total_duration <= 60:
-        print(
-            f"⏩ Пропускаем звонок {call.get('communication_id', 'N/A')} из-за отсутствия информации или длительности < 60с. Длительность: {total_duration}s")
+    # Основная фильтрация выполняется заранее (call_table.prefilter_calls), здесь — страховка для прямых вызовов
+    if not talk_id or not records or total_duration is None or total_duration <= MIN_CALL_DURATION_SECONDS:
+        logger.info(
+            f"⏩ Пропускаем звонок {call.get('communication_id', 'N/A')} из-за отсутствия информации или длительности < {MIN_CALL_DURATION_SECONDS}с. Длительность: {total_duration}s")
         return None
 
     record_hash = records[0]
-    record_url = f"https://app.uiscom.ru/system/media/talk/{talk_id}/{record_hash}/"
+    record_url = f"{UIS_MEDIA_URL}/{talk_id}/{record_hash}/"
 
     # Используем более надежный способ получения номера и направления
     contact_phone = call.get("contact_phone_number") or call.get("raw", {}).get("contact_phone_number", "")
@@ -127,75 +164,90 @@ def download_record(call: Dict[str, Any], index: int, target_dir: Path) -> Optio
         base_filename += f"_{contact_phone}"
 
     filename = Path(target_dir) / f"{base_filename}.mp3"
-    info_filename = Path(target_dir) / f"{base_filename}_call_info.json"
 
-    if filename.exists():
-        print(f"⏭ Запись {filename.name} уже существует, пропускаем загрузку.")
+    if artifacts.is_valid(filename):
+        logger.info(f"⏭ Запись {filename.name} уже существует, пропускаем загрузку.")
     else:
-        print(f"⬇ Загружаем {filename.name}...")
+        logger.info(f"⬇ Загружаем {filename.name}...")
         try:
-            response = requests.get(record_url, timeout=(10, 30))
+            with guarded_request("uis", "record_download"):
+                response = requests.get(record_url, timeout=(10, 30))
             if response.status_code == 200:
-                with open(filename, 'wb') as f:
-                    f.write(response.content)
-                print(f"✅ Сохранено: {filename.name}")
+                inc("uis_record_bytes_total", len(response.content))
+                artifacts.write_bytes(filename, response.content)
+                logger.info(f"✅ Сохранено: {filename.name}")
             else:
-                print(f"⚠ Ошибка загрузки {record_url}: HTTP {response.status_code}")
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Ошибка сетевого запроса при загрузке {talk_id}: {e}")
+                logger.warning(f"⚠ Ошибка загрузки {record_url}: HTTP {response.status_code}")
+        except (requests.exceptions.RequestException, DependencyUnavailableError) as e:
+            defer_if_unavailable("uis", e)
+            logger.error(f"❌ Ошибка сетевого запроса при загрузке {talk_id}: {e}")
         except Exception as e:
-            print(f"❌ Неизвестная ошибка при загрузке {talk_id}: {e}")
+            logger.error(f"❌ Неизвестная ошибка при загрузке {talk_id}: {e}")
 
-    order_link = ""
+    # Информация о звонке пишется только при целой записи: по ней следующие этапы считают звонок скачанным
+    if not artifacts.is_valid(filename):
+        return None
 
     try:
-        call_info = {
-            "start_time": call.get("start_time", ""),
-            "raw": call,
-            "customer_card_link": order_link,
-            "contact_phone_number": contact_phone,
-            "record_link": record_url
-        }
-        with open(info_filename, 'w', encoding='utf-8') as f:
-            json.dump(call_info, f, indent=2, ensure_ascii=False)
-        print(f"📝 Информация сохранена: {info_filename.name}")
-        return info_filename
+        store.calls.append(talk_id, call_info_record(base_filename, call, contact_phone, record_url))
+        logger.info(f"📝 Информация о звонке {base_filename} сохранена в хранилище")
+        return str(talk_id)
     except Exception as e:
-        print(f"❌ Ошибка сохранения информации о звонке для {talk_id}: {e}")
+        logger.error(f"❌ Ошибка сохранения информации о звонке для {talk_id}: {e}")
         return None
 
 
-def download_calls(calls_to_download: List[Dict[str, Any]], target_dir: Path) -> List[Path]:
+def download_calls(calls_to_download: List[Dict[str, Any]], target_dir: Path, store: CallStore) -> List[str]:
     """
     Загружает только те звонки, которые переданы в списке.
-    Возвращает список путей к созданным файлам info.json.
+    Возвращает communication_id загруженных звонков.
     """
     if not calls_to_download:
-        print("ℹ️ Список звонков для загрузки пуст. Пропускаем загрузку.")
+        logger.info("ℹ️ Список звонков для загрузки пуст. Пропускаем загрузку.")
         return []
 
-    print(f"🚀 Запускаем загрузку {len(calls_to_download)} звонков.")
+    logger.info(f"🚀 Запускаем загрузку {len(calls_to_download)} звонков.")
 
     if not ACCESS_TOKEN:
-        print("❗ ACCESS_TOKEN не найден в .env. Загрузка невозможна.")
+        logger.error("❗ ACCESS_TOKEN не найден в .env. Загрузка невозможна.")
         return []
 
-    downloaded_call_info_paths = []
+    downloaded_ids = []
+
+    try:
+        # Индексы файлов выдаются под блокировкой: в ту же папку могут писать демон и приемник вебхуков
+        with file_lock(Path(target_dir) / ".download.lock"):
+            downloaded_ids = _download_calls_locked(calls_to_download, target_dir, store)
+    except DependencyUnavailableError:
+        raise
+    except Exception as e:
+        logger.error(f"❗ Ошибка выполнения скрипта загрузки звонков: {e}")
+
+    return downloaded_ids
+
 
+def _download_calls_locked(calls_to_download: List[Dict[str, Any]], target_dir: Path, store: CallStore) -> List[str]:
+    downloaded_ids = []
     try:
         current_idx = get_next_call_index(str(target_dir))
         for call in calls_to_download:
-            info_file_path = download_record(call, current_idx, target_dir)
-            if info_file_path:
-                downloaded_call_info_paths.append(info_file_path)
+            raw = call.get("raw") or {}
+            with log_context(communication_id=call.get("communication_id") or raw.get("communication_id"),
+                             phone=call.get("contact_phone_number") or raw.get("contact_phone_number")):
+                communication_id = download_record(call, current_idx, target_dir, store)
+            if communication_id:
+                downloaded_ids.append(communication_id)
             current_idx += 1
+    except DependencyUnavailableError:
+        raise
     except Exception as e:
-        print(f"❗ Ошибка выполнения скрипта загрузки звонков: {e}")
+        logger.error(f"❗ Ошибка выполнения скрипта загрузки звонков: {e}")
 
-    return downloaded_call_info_paths
+    return downloaded_ids
 
 
 if __name__ == "__main__":
+    setup_logging()
     # --- БЛОК ТЕСТИРОВАНИЯ С ПОДРОБНЫМ ЛОГИРОВАНИЕМ ---
     # Измените эти значения для тестирования разных дат и времени
     TEST_DATE = "08.09.2025"
@@ -206,19 +258,19 @@ if __name__ == "__main__":
         test_start_datetime = datetime.strptime(f"{TEST_DATE} {TEST_START_TIME}", "%d.%m.%Y %H:%M:%S")
         test_end_datetime = datetime.strptime(f"{TEST_DATE} {TEST_END_TIME}", "%d.%m.%Y %H:%M:%S")
     except ValueError:
-        print("❌ Неверный формат даты или времени. Используйте формат ДД.ММ.ГГГГ ЧЧ:ММ:СС.")
+        logger.error("❌ Неверный формат даты или времени. Используйте формат ДД.ММ.ГГГГ ЧЧ:ММ:СС.")
         exit()
 
     target_folder_date = test_start_datetime.strftime("%d.%m.%Y")
     target_dir = Path("audio") / f"звонки_{target_folder_date}"
     target_dir.mkdir(parents=True, exist_ok=True)
 
-    print(f"\n--- Тестируем получение списка звонков за {TEST_DATE} с {TEST_START_TIME} по {TEST_END_TIME} ---")
+    logger.info(f"--- Тестируем получение списка звонков за {TEST_DATE} с {TEST_START_TIME} по {TEST_END_TIME} ---")
     calls_list = get_calls_report(test_start_datetime.strftime("%Y-%m-%d %H:%M:%S"),
                                   test_end_datetime.strftime("%Y-%m-%d %H:%M:%S"))
 
     if calls_list:
-        print("\n--- Запускаем подробную фильтрацию звонков ---")
+        logger.info("--- Запускаем подробную фильтрацию звонков ---")
         filtered_calls = []
         for i, call in enumerate(calls_list):
             call_id = call.get("communication_id", "N/A")
@@ -226,34 +278,34 @@ if __name__ == "__main__":
             phone_number = call.get("contact_phone_number") or call.get("raw", {}).get("contact_phone_number")
             call_direction = call.get("direction") or call.get("raw", {}).get("direction")
 
-            print(f"\n📞 Проверка звонка №{i + 1} (ID: {call_id}) от номера {phone_number}...")
+            logger.info(f"📞 Проверка звонка №{i + 1} (ID: {call_id}) от номера {phone_number}...")
 
             if not phone_number or not call_direction:
-                print(f"❌ Пропускаем: отсутствует номер ({phone_number}) или направление ({call_direction}) звонка.")
+                logger.info(f"❌ Пропускаем: отсутствует номер ({phone_number}) или направление ({call_direction}) звонка.")
                 continue
 
             # ИСПРАВЛЕНИЕ: Унифицированная фильтрация по статусу последнего заказа для IN и OUT звонков
             if call_direction == "in" or call_direction == "out":
-                print(f"  ➡️ Направление: {call_direction.upper()}. Проверяем, разрешен ли последний заказ к анализу...")
+                logger.info(f"  ➡️ Направление: {call_direction.upper()}. Проверяем, разрешен ли последний заказ к анализу...")
                 is_analyzable = check_if_last_order_is_analyzable(phone_number)
                 if is_analyzable:
-                    print(f"  ✅ Звонок прошел фильтр: последний заказ разрешен к анализу (или заказов нет). Добавляем в список для обработки.")
+                    logger.info(f"  ✅ Звонок прошел фильтр: последний заказ разрешен к анализу (или заказов нет). Добавляем в список для обработки.")
                     filtered_calls.append(call)
                 else:
                     # В новой логике False означает, что последний заказ в НЕанализируемом статусе
-                    print(f"  ❌ Звонок НЕ прошел фильтр: последний заказ НЕ разрешен к анализу. Пропускаем.")
+                    logger.info(f"  ❌ Звонок НЕ прошел фильтр: последний заказ НЕ разрешен к анализу. Пропускаем.")
             else:
-                print(f"  ⚠️ Неизвестное направление звонка: {call_direction}. Пропускаем.")
+                logger.warning(f"  ⚠️ Неизвестное направление звонка: {call_direction}. Пропускаем.")
 
-        print(f"\n➡️ Итого к обработке: {len(filtered_calls)} звонков из {len(calls_list)}.")
+        logger.info(f"➡️ Итого к обработке: {len(filtered_calls)} звонков из {len(calls_list)}.")
 
         if filtered_calls:
-            print("\n--- Запускаем загрузку отфильтрованных звонков ---")
-            downloaded_paths = download_calls(filtered_calls, target_dir)
-            print(f"✅ Загрузка завершена. Загружено файлов: {len(downloaded_paths)}")
+            logger.info("--- Запускаем загрузку отфильтрованных звонков ---")
+            downloaded_ids = download_calls(filtered_calls, target_dir, CallStore(target_folder_date))
+            logger.info(f"✅ Загрузка завершена. Загружено звонков: {len(downloaded_ids)}")
         else:
-            print("Нет звонков, соответствующих критериям фильтрации. Загрузка не требуется.")
+            logger.info("Нет звонков, соответствующих критериям фильтрации. Загрузка не требуется.")
     else:
-        print("Нет звонков для тестирования в указанном периоде.")
+        logger.info("Нет звонков для тестирования в указанном периоде.")
 
-    print("\nТестирование завершено.")
+    logger.info("Тестирование завершено.")
@@ -0,0 +1,350 @@
+import os
+import hmac
+import json
+import queue
+import signal
+import logging
+import argparse
+import threading
+import time
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Dict, List, Tuple
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from dotenv import load_dotenv
+
+from main import MSK, process_period, OrderLinksCache, processed_calls
+from checkpoints import WindowCheckpoint, STATUS_IN_PROGRESS
+from uis_call_downloader import get_call_by_id
+from metrics import timed_stage, inc, export_run_metrics, start_run_metrics, start_metrics_server, METRICS_PORT
+from model_router import routing_stats
+from cost_accounting import run_summary
+from circuit_breaker import circuit_states, CIRCUIT_RESET_SECONDS
+from log_config import setup_logging, log_context
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Адрес, на котором слушаются уведомления UIS о завершении звонка.
+# В личном кабинете UIS уведомление настраивается как POST на http://<хост>:<порт><путь>?token=<WEBHOOK_TOKEN>
+# с телом {"communication_id": "{{communication_id}}"} (JSON или form-urlencoded).
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8086"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/uis/call-finished")
+# Общий секрет: передается в query-параметре token или заголовке X-Webhook-Token.
+# Без него приемник запускается только на локальном адресе: иначе любой, кто видит порт, запускает платную обработку
+WEBHOOK_TOKEN = os.getenv("WEBHOOK_TOKEN", "")
+LOOPBACK_HOSTS = {"127.0.0.1", "localhost", "::1"}
+# Уведомления копятся столько секунд и обрабатываются одной пачкой (один проход транскрибации и анализа)
+WEBHOOK_BATCH_SECONDS = float(os.getenv("WEBHOOK_BATCH_SECONDS", "10"))
+# За сколько часов искать звонок в отчете UIS по communication_id
+WEBHOOK_LOOKBACK_HOURS = int(os.getenv("WEBHOOK_LOOKBACK_HOURS", "6"))
+
+# Звонок может появиться в отчете (или получить запись) с задержкой после уведомления
+METADATA_RETRIES = 3
+METADATA_RETRY_DELAY_SECONDS = 30
+
+
+def extract_communication_id(body: bytes, content_type: str, query: Dict[str, List[str]]) -> Optional[str]:
+    """
+    Достает communication_id из тела уведомления (JSON или form-urlencoded) или из query-параметров.
+    """
+    value = None
+    if body:
+        if "json" in content_type:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                return None
+            if isinstance(data, dict):
+                value = data.get("communication_id")
+        else:
+            value = (parse_qs(body.decode("utf-8", errors="replace")).get("communication_id") or [None])[0]
+    if value is None:
+        value = (query.get("communication_id") or [None])[0]
+    value = str(value).strip() if value is not None else ""
+    return value if value.isdigit() else None
+
+
+def call_start_time(call: dict) -> datetime:
+    """
+    Время начала звонка из отчета UIS (МСК); если его нет — текущее время.
+    """
+    try:
+        return datetime.strptime(str(call.get("start_time", ""))[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=MSK)
+    except ValueError:
+        return datetime.now(MSK).replace(microsecond=0)
+
+
+def call_folder_date(call: dict) -> str:
+    """
+    Дата папок звонка (ДД.ММ.ГГГГ) — по дню начала звонка из отчета UIS (МСК), а не по моменту обработки:
+    звонок около полуночи или после повторов и откладываний попадает в папку своего дня.
+    """
+    return call_start_time(call).strftime("%d.%m.%Y")
+
+
+class WebhookReceiver:
+    """
+    Прием уведомлений UIS о завершенных звонках и их обработка почти в реальном времени.
+
+    HTTP-обработчик только кладет communication_id в очередь и сразу отвечает 202. Отдельный поток
+    собирает пачку за WEBHOOK_BATCH_SECONDS, запрашивает метаданные звонков в UIS и отправляет их
+    через тот же пайплайн, что и запуски по расписанию (process_period). Звонки, обработанные здесь,
+    попадают в общий журнал и пропускаются периодическим отчетом (и наоборот).
+    """
+
+    def __init__(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                 token: str = WEBHOOK_TOKEN, batch_seconds: float = WEBHOOK_BATCH_SECONDS):
+        if not token and host not in LOOPBACK_HOSTS:
+            raise ValueError(f"WEBHOOK_TOKEN не задан: приемник на {host} не запускается без проверки токена "
+                             f"(без токена доступен только локальный адрес 127.0.0.1).")
+        self.path = path
+        self.token = token
+        self.batch_seconds = batch_seconds
+        self.order_links = OrderLinksCache()
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._attempts: Dict[str, int] = {}
+        # Окна, отложенные из-за недоступности сервиса: (когда повторить, звонки, дата папок).
+        # Отбор и пройденные этапы хранятся в контрольной точке окна, здесь — только момент повтора
+        self._deferred: List[Tuple[float, List[dict], str]] = []
+        self._stop = threading.Event()
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._worker = threading.Thread(target=self._work, name="webhook-worker")
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}{self.path}"
+
+    def enqueue(self, communication_id: str) -> bool:
+        """
+        Ставит звонок в очередь. Повторные уведомления о звонке, который уже ждет или обработан, игнорируются.
+        """
+        with self._pending_lock:
+            if communication_id in self._pending or communication_id in processed_calls:
+                return False
+            self._pending.add(communication_id)
+        self._queue.put(communication_id)
+        inc("webhook_notifications_total", status="queued")
+        return True
+
+    def _next_batch(self) -> List[str]:
+        try:
+            batch = [self._queue.get(timeout=1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_seconds
+        while not self._stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _fetch_calls(self, communication_ids: List[str]) -> List[dict]:
+        calls = []
+        for communication_id in communication_ids:
+            with log_context(communication_id=communication_id):
+                call = get_call_by_id(communication_id, WEBHOOK_LOOKBACK_HOURS)
+                if call and call.get("call_records"):
+                    calls.append(call)
+                    continue
+                attempts = self._attempts.get(communication_id, 0) + 1
+                if attempts < METADATA_RETRIES and not self._stop.is_set():
+                    self._attempts[communication_id] = attempts
+                    logger.info(f"⏳ Звонок {communication_id} еще не появился в отчете UIS с записью. "
+                                f"Повтор через {METADATA_RETRY_DELAY_SECONDS} сек.")
+                    self._retry_later(communication_id)
+                    continue
+                logger.warning(f"⚠️ Звонок {communication_id} не найден в отчете UIS или без записи. Пропускаем.")
+                inc("webhook_notifications_total", status="not_found")
+            self._attempts.pop(communication_id, None)
+            self._done(communication_id)
+        return calls
+
+    def _retry_later(self, communication_id: str):
+        timer = threading.Timer(METADATA_RETRY_DELAY_SECONDS, self._queue.put, args=(communication_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _done(self, communication_id: str):
+        with self._pending_lock:
+            self._pending.discard(communication_id)
+
+    def process_batch(self, communication_ids: List[str]):
+        logger.info(f"📥 Обработка {len(communication_ids)} звонков из уведомлений UIS.")
+        # У каждой пачки своя сводка метрик (см. metrics.start_run_metrics)
+        start_run_metrics()
+        with timed_stage("total"), log_context(stage="webhook"):
+            calls = self._fetch_calls(communication_ids)
+            if not calls:
+                return
+            calls_by_date: Dict[str, List[dict]] = {}
+            for call in calls:
+                calls_by_date.setdefault(call_folder_date(call), []).append(call)
+            for target_folder_date_str, folder_calls in calls_by_date.items():
+                self._process_window(folder_calls, target_folder_date_str)
+        self._export_metrics()
+
+    def _process_window(self, calls: List[dict], target_folder_date_str: str):
+        """
+        Пачка звонков одного дня обрабатывается как окно от начала первого до начала последнего звонка,
+        с контрольной точкой (process_period): отобранные звонки и пройденные этапы сохраняются на диске.
+        Отложенное из-за недоступности сервиса окно повторяется здесь же через CIRCUIT_RESET_SECONDS,
+        а после перезапуска процесса его доработает ближайший запуск по расписанию (resume_incomplete_windows).
+        """
+        start_times = [call_start_time(call) for call in calls]
+        start_time_period, end_time_period = min(start_times), max(start_times)
+        try:
+            self.order_links.add(process_period(start_time_period, end_time_period, target_folder_date_str,
+                                                self.order_links.get(), calls=calls))
+        finally:
+            for call in calls:
+                communication_id = str(call.get("communication_id"))
+                self._attempts.pop(communication_id, None)
+                self._done(communication_id)
+
+        checkpoint = WindowCheckpoint.for_window(start_time_period, end_time_period, target_folder_date_str)
+        if checkpoint.path.exists() and checkpoint.status == STATUS_IN_PROGRESS:
+            logger.warning(f"⏸ Обработка {len(calls)} звонков отложена на {CIRCUIT_RESET_SECONDS:.0f} сек.")
+            self._deferred.append((time.monotonic() + CIRCUIT_RESET_SECONDS, calls, target_folder_date_str))
+
+    def _export_metrics(self):
+        export_run_metrics(extra={"model_routing": routing_stats(), "costs": run_summary(),
+                                  "circuits": circuit_states()})
+
+    def _resume_deferred(self):
+        now = time.monotonic()
+        due = [item for item in self._deferred if item[0] <= now]
+        self._deferred = [item for item in self._deferred if item[0] > now]
+        if due:
+            start_run_metrics()
+        for _, calls, target_folder_date_str in due:
+            with timed_stage("total"), log_context(stage="webhook"):
+                logger.info(f"♻️ Возобновляем обработку {len(calls)} отложенных звонков.")
+                self._process_window(calls, target_folder_date_str)
+        if due:
+            self._export_metrics()
+
+    def _work(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                self._resume_deferred()
+            except Exception:
+                logger.exception("❌ Ошибка обработки отложенных звонков.")
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self.process_batch(batch)
+            except Exception:
+                logger.exception("❌ Ошибка обработки звонков из уведомлений UIS.")
+
+    def start(self) -> "WebhookReceiver":
+        threading.Thread(target=self._server.serve_forever, name="webhook-http", daemon=True).start()
+        self._worker.start()
+        logger.info(f"👂 Прием уведомлений UIS на {self.address}")
+        return self
+
+    def stop(self, signum=None, frame=None):
+        """
+        Перестает принимать уведомления и дожидается обработки уже поставленных в очередь.
+        """
+        logger.info("🛑 Остановка приема уведомлений: дорабатываем очередь...")
+        self._server.shutdown()
+        self._server.server_close()
+        self._stop.set()
+
+    def run_forever(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.order_links.get()
+        self.start()
+        while self._worker.is_alive():
+            self._worker.join(timeout=1)
+        logger.info("👋 Прием уведомлений остановлен.")
+
+
+def _make_handler(receiver: WebhookReceiver):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, data: dict):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path == "/health":
+                self._send_json(200, {"status": "ok", "queued": receiver._queue.qsize()})
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            parsed = urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            if parsed.path != receiver.path:
+                self._send_json(404, {"error": "not found"})
+                return
+
+            query = parse_qs(parsed.query)
+            token = self.headers.get("X-Webhook-Token") or (query.get("token") or [""])[0]
+            if receiver.token and not hmac.compare_digest(token.encode("utf-8"), receiver.token.encode("utf-8")):
+                inc("webhook_notifications_total", status="forbidden")
+                self._send_json(403, {"error": "invalid token"})
+                return
+
+            communication_id = extract_communication_id(body, self.headers.get("Content-Type", ""), query)
+            if not communication_id:
+                inc("webhook_notifications_total", status="invalid")
+                logger.warning(f"⚠️ Уведомление без communication_id: {body[:200]!r}")
+                self._send_json(400, {"error": "communication_id is required"})
+                return
+
+            queued = receiver.enqueue(communication_id)
+            self._send_json(202, {"communication_id": communication_id, "queued": queued})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def send_test_notification(communication_id: str, url: str, token: str = WEBHOOK_TOKEN) -> int:
+    """
+    Отправляет уведомление так же, как UIS: нужно для проверки приемника локально.
+    """
+    headers = {"X-Webhook-Token": token} if token else {}
+    response = requests.post(url, json={"communication_id": communication_id}, headers=headers, timeout=10)
+    logger.info(f"📨 Ответ приемника: {response.status_code} {response.text}")
+    return response.status_code
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Прием уведомлений UIS о завершенных звонках.")
+    parser.add_argument("--send", metavar="COMMUNICATION_ID",
+                        help="Не запускать приемник, а отправить тестовое уведомление о звонке.")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}",
+                        help="Адрес приемника для --send.")
+    args = parser.parse_args()
+
+    setup_logging()
+    if args.send:
+        send_test_notification(args.send, args.url)
+    else:
+        logger.info("🚀 Запуск приемника уведомлений UIS...")
+        if METRICS_PORT:
+            start_metrics_server(int(METRICS_PORT))
+        WebhookReceiver().run_forever()
@@ -0,0 +1,291 @@
+import os
+import socket
+import signal
+import logging
+import argparse
+import threading
+from collections import defaultdict
+from typing import List, Dict
+
+from dotenv import load_dotenv
+
+from main import OrderLinksCache, send_all_analyses_to_integrations
+from digest import TELEGRAM_REPORT_MODE
+from uis_call_downloader import download_calls
+from transcriber import (transcribe_single_audio_file, merge_duplicate_transcripts, _load_call_stems, _phone_from_stem,
+                         AUDIO_DIR)
+from call_store import CallStore
+from analyzer import analyze_transcripts, is_analysis_error
+from job_queue import JobQueue, Job, STAGES, DIGEST_STAGE
+from metrics import timed_stage, inc, start_metrics_server, METRICS_PORT
+from cost_accounting import track_call, start_run, stored_cost_usd
+from circuit_breaker import DependencyUnavailableError, CIRCUIT_RESET_SECONDS
+from log_config import setup_logging, log_context
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Сколько секунд задача остается за воркером без продления аренды. Воркер продлевает аренду, пока задача
+# выполняется, поэтому таймаут определяет, как быстро задача упавшего воркера достанется другому.
+JOB_VISIBILITY_TIMEOUT_SECONDS = int(os.getenv("JOB_VISIBILITY_TIMEOUT_SECONDS", "300"))
+# Пауза между опросами пустой очереди
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "5"))
+# Сколько задач этапа брать за раз: отправка идет пачками, чтобы сохранить пакетную отправку в Forms/Telegram
+STAGE_BATCH_SIZE = {"download": 1, "transcribe": 1, "analyze": 1, "deliver": 20}
+# Поля окна обработки, которые передаются в задачи следующих этапов
+WINDOW_FIELDS = ("window", "report_title")
+
+
+def _window_fields(job: Job) -> Dict[str, str]:
+    return {key: job.payload.get(key) for key in WINDOW_FIELDS}
+
+
+class StageWorker:
+    """
+    Воркер одного этапа пайплайна. Берет задачи этапа из очереди, выполняет их и ставит задачу следующего этапа.
+    Несколько воркеров одного этапа (процессов или контейнеров) могут работать параллельно на общей очереди.
+    """
+
+    def __init__(self, stage: str, queue: JobQueue = None, visibility_timeout: int = JOB_VISIBILITY_TIMEOUT_SECONDS):
+        self.stage = stage
+        self.queue = queue or JobQueue()
+        self.visibility_timeout = visibility_timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{stage}"
+        self.order_links = OrderLinksCache()
+        self._stop = threading.Event()
+        self._handlers = {
+            "download": self.download,
+            "transcribe": self.transcribe,
+            "analyze": self.analyze,
+            DIGEST_STAGE: self.digest,
+        }
+
+    def _start_window_budget(self, job: Job, store: CallStore):
+        """
+        Бюджет OpenAI (RUN_BUDGET_USD) считается по окну, а не по процессу воркера: перед платным этапом
+        учет начинается заново с уже сохраненных затрат звонков окна.
+        """
+        window = job.payload.get("window")
+        if window:
+            communication_ids = {str(call.get("communication_id")) for payload in
+                                 self.queue.window_payloads("download", window, status=None)
+                                 for call in payload["calls"]}
+        else:
+            communication_ids = {job.payload["communication_id"]}
+        start_run(stored_cost_usd(store, communication_ids))
+
+    # --- Обработчики этапов ---
+
+    def download(self, job: Job):
+        folder_date = job.payload["folder_date"]
+        audio_dir = AUDIO_DIR / f"звонки_{folder_date}"
+        audio_dir.mkdir(parents=True, exist_ok=True)
+
+        # При повторе задачи звонки, скачанные в прошлой попытке, не скачиваются заново
+        store = CallStore(folder_date)
+        downloaded = _load_call_stems(store)
+        missing = [call for call in job.payload["calls"] if str(call.get("communication_id")) not in downloaded]
+        if missing:
+            download_calls(missing, audio_dir, store)
+            downloaded = _load_call_stems(store)
+
+        if job.payload["communication_id"] not in downloaded:
+            raise RuntimeError(f"Запись звонка {job.payload['communication_id']} не скачана")
+        inc("pipeline_calls_total", len(job.payload["calls"]), stage="downloaded")
+        self.queue.enqueue("transcribe", job.key, {**{key: job.payload[key] for key in
+                                                      ("folder_date", "communication_id", "merge_group")},
+                                                   **_window_fields(job)})
+
+    def transcribe(self, job: Job):
+        folder_date = job.payload["folder_date"]
+        audio_dir = AUDIO_DIR / f"звонки_{folder_date}"
+        store = CallStore(folder_date)
+        stems = _load_call_stems(store)
+        self._start_window_budget(job, store)
+
+        primary_id = job.payload["communication_id"]
+        for communication_id in [primary_id] + job.payload["merge_group"]:
+            if communication_id not in stems or communication_id in store.transcripts:
+                continue
+            stem = stems[communication_id][0]
+            with log_context(communication_id=communication_id, phone=_phone_from_stem(stem)), \
+                    track_call(store, communication_id, stem):
+                logger.info(f"Обработка {stem}.mp3 → транскрипт")
+                # Ошибка не сохраняется как транскрипт: в режиме очереди задача повторяется
+                text = transcribe_single_audio_file(audio_dir / f"{stem}.mp3", store, communication_id,
+                                                    assign_roles=True, save_errors=False)
+            if text.startswith("[Ошибка транскрибации]"):
+                raise RuntimeError(text)
+
+        if job.payload["merge_group"]:
+            merge_duplicate_transcripts(folder_date, {primary_id: job.payload["merge_group"]})
+        self.queue.enqueue("analyze", job.key, {"folder_date": folder_date, "communication_id": primary_id,
+                                                "stem": stems[primary_id][0], **_window_fields(job)})
+
+    def analyze(self, job: Job):
+        folder_date, stem = job.payload["folder_date"], job.payload["stem"]
+        self._start_window_budget(job, CallStore(folder_date))
+        analyze_transcripts(folder_date, only_stems={stem})
+        # Звонки "Курьер/Технический" не сохраняются и дальше не идут
+        record = CallStore(folder_date).analyses.get(job.payload["communication_id"])
+        if record is None:
+            return
+        # Ошибка анализа сохраняется как запись, а не исключение: в режиме очереди задача повторяется
+        if is_analysis_error(record):
+            raise RuntimeError(record["analysis"]["summary"])
+        self.queue.enqueue("deliver", job.key, job.payload)
+
+    def deliver(self, jobs: List[Job]):
+        """
+        Отправка идет пачкой задач: одна отправка в Google Forms на папку, как в обычном запуске.
+        Отчет по окну в Telegram отправляет отдельная задача digest, когда обработаны все звонки окна;
+        в режиме отчетов по звонкам (TELEGRAM_REPORT_MODE=per_call) они уходят вместе с отправкой.
+        """
+        stems_by_date: Dict[str, set] = defaultdict(set)
+        for job in jobs:
+            stems_by_date[job.payload["folder_date"]].add(job.payload["stem"])
+        for folder_date, stems in stems_by_date.items():
+            sent_order_links = send_all_analyses_to_integrations(folder_date, self.order_links.get(),
+                                                                 only_stems=stems,
+                                                                 telegram=TELEGRAM_REPORT_MODE != "window")
+            self.order_links.add(sent_order_links)
+
+    def digest(self, job: Job):
+        """
+        Отчет по окну в Telegram: сводка и документ по всем отправленным звонкам окна.
+        """
+        stems = {payload["stem"] for payload in self.queue.window_payloads("deliver", job.key)}
+        if not stems:
+            logger.info(f"ℹ️ В окне {job.key} нет отправленных звонков, отчет не нужен.")
+            return
+        send_all_analyses_to_integrations(job.payload["folder_date"], set(), only_stems=stems,
+                                          report_title=job.payload.get("report_title"), forms=False)
+
+    def _schedule_digests(self, jobs: List[Job]):
+        """
+        Ставит задачу отчета по окну, если у окна не осталось задач в очереди или в аренде. Проверка идет
+        после завершения задач, поэтому последний воркер окна ее увидит; ключ задачи — окно, дублей не будет.
+        """
+        if TELEGRAM_REPORT_MODE != "window":
+            return
+        for window, folder_date, report_title in {(job.payload.get("window"), job.payload["folder_date"],
+                                                   job.payload.get("report_title")) for job in jobs}:
+            if window and not self.queue.window_pending(window):
+                if self.queue.enqueue(DIGEST_STAGE, window, {"window": window, "folder_date": folder_date,
+                                                             "report_title": report_title}):
+                    logger.info(f"📰 Все звонки окна {window} обработаны: поставлен отчет по окну.")
+
+    # --- Цикл воркера ---
+
+    def _heartbeat(self, jobs: List[Job], done: threading.Event):
+        while not done.wait(self.visibility_timeout / 3):
+            try:
+                self.queue.extend(jobs, self.visibility_timeout)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось продлить аренду задач: {e}")
+
+    def _finish(self, job: Job, error: Exception = None):
+        if error is None:
+            self.queue.complete(job)
+            inc("queue_jobs_total", stage=self.stage, status="done")
+            return
+        if isinstance(error, DependencyUnavailableError):
+            self.queue.defer(job, CIRCUIT_RESET_SECONDS, str(error))
+            inc("queue_jobs_total", stage=self.stage, status="deferred")
+            logger.warning(f"⏸ {job} отложена на {CIRCUIT_RESET_SECONDS:.0f} сек.: {error}")
+            return
+        if self.queue.fail(job, f"{type(error).__name__}: {error}"):
+            inc("queue_jobs_total", stage=self.stage, status="retry")
+            logger.warning(f"⚠️ {job} завершилась ошибкой, будет повторена: {error}")
+        else:
+            inc("queue_jobs_total", stage=self.stage, status="failed")
+            logger.error(f"❌ {job} завершилась ошибкой, попытки исчерпаны: {error}")
+
+    def run_once(self) -> int:
+        """
+        Берет и выполняет одну порцию задач. Возвращает число взятых задач.
+        """
+        jobs = self.queue.lease(self.stage, self.owner, self.visibility_timeout, STAGE_BATCH_SIZE[self.stage])
+        # Отчеты по окнам отправляет воркер этапа deliver
+        digest_jobs = self.queue.lease(DIGEST_STAGE, self.owner, self.visibility_timeout) \
+            if self.stage == "deliver" else []
+        if not jobs and not digest_jobs:
+            return 0
+
+        done = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(jobs + digest_jobs, done), daemon=True).start()
+        try:
+            with timed_stage(self.stage), log_context(stage=self.stage):
+                if self.stage == "deliver" and jobs:
+                    try:
+                        self.deliver(jobs)
+                    except Exception as e:
+                        logger.exception("❌ Ошибка отправки анализов.")
+                        for job in jobs:
+                            self._finish(job, e)
+                    else:
+                        for job in jobs:
+                            self._finish(job)
+
+                for job in (digest_jobs if self.stage == "deliver" else jobs):
+                    with log_context(communication_id=job.payload.get("communication_id")):
+                        try:
+                            self._handlers[job.stage](job)
+                        except Exception as e:
+                            logger.exception(f"❌ Ошибка выполнения {job}.")
+                            self._finish(job, e)
+                        else:
+                            self._finish(job)
+            self._schedule_digests(jobs)
+        finally:
+            done.set()
+        return len(jobs) + len(digest_jobs)
+
+    def stop(self, signum=None, frame=None):
+        logger.info("🛑 Получен сигнал остановки: текущая задача будет завершена, новые не берутся.")
+        self._stop.set()
+
+    def run_forever(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info(f"👷 Воркер этапа '{self.stage}' запущен ({self.owner}).")
+        while not self._stop.is_set():
+            try:
+                taken = self.run_once()
+            except Exception:
+                logger.exception("❌ Ошибка работы с очередью задач.")
+                taken = 0
+            if not taken:
+                self._stop.wait(WORKER_POLL_SECONDS)
+        logger.info("👋 Воркер остановлен.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Воркер этапа пайплайна, работающий с очередью задач.")
+    parser.add_argument("--stage", choices=STAGES, help="Этап, задачи которого выполняет воркер.")
+    parser.add_argument("--once", action="store_true", help="Выполнить задачи, готовые сейчас, и завершиться.")
+    parser.add_argument("--stats", action="store_true", help="Показать число задач по этапам и статусам.")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Вернуть в очередь задачи, исчерпавшие попытки (для --stage или всех этапов).")
+    args = parser.parse_args()
+
+    setup_logging()
+    queue = JobQueue()
+    if args.stats:
+        for stage, counts in queue.stats().items():
+            logger.info(f"{stage}: " + (", ".join(f"{status}={count}" for status, count in sorted(counts.items())) or "—"))
+    elif args.retry_failed:
+        logger.info(f"🔁 Возвращено в очередь задач: {queue.retry_failed(args.stage)}")
+    elif not args.stage:
+        parser.error("укажите --stage")
+    else:
+        if METRICS_PORT:
+            start_metrics_server(int(METRICS_PORT))
+        queue.purge()
+        worker = StageWorker(args.stage, queue)
+        if args.once:
+            while worker.run_once():
+                pass
+        else:
+            worker.run_forever()